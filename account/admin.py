@@ -1,10 +1,47 @@
 from django.contrib import admin
+from django.forms import ModelForm
 from .models import Account, Withdraw, AccountTransfer
 from simple_history.admin import SimpleHistoryAdmin
 from unfold.admin import ModelAdmin
 from unfold.contrib.import_export.forms import ExportForm, ImportForm
 from import_export.admin import ImportExportModelAdmin
 
+class WithdrawForm(ModelForm):
+    """
+    Shows an insufficient balance as a form error. The balance is checked
+    again, atomically, by the guarded debit when the withdrawal is saved.
+    """
+
+    class Meta:
+        model = Withdraw
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        account = cleaned_data.get('account')
+        amount = cleaned_data.get('amount')
+        if account and amount is not None and amount > account.balance:
+            self.add_error('amount', 'Insufficient balance for the withdrawal.')
+        return cleaned_data
+
+class AccountTransferForm(ModelForm):
+    """
+    Shows an insufficient source balance as a form error. The balance is
+    checked again, atomically, by the guarded debit when the transfer is saved.
+    """
+
+    class Meta:
+        model = AccountTransfer
+        fields = '__all__'
+
+    def clean(self):
+        cleaned_data = super().clean()
+        from_account = cleaned_data.get('from_account')
+        amount = cleaned_data.get('amount')
+        if from_account and amount is not None and amount > from_account.balance:
+            self.add_error('amount', 'Insufficient balance in the source account for the transfer.')
+        return cleaned_data
+
 @admin.register(Account)
 class AccountAdmin(SimpleHistoryAdmin, ModelAdmin, ImportExportModelAdmin):
     list_display = ('name', 'balance')
@@ -14,6 +51,7 @@ class AccountAdmin(SimpleHistoryAdmin, ModelAdmin, ImportExportModelAdmin):
 
 @admin.register(Withdraw)
 class WithdrawAdmin(SimpleHistoryAdmin, ModelAdmin):
+    form = WithdrawForm
     list_display = ('account', 'amount', 'withdrawn_at')
     list_filter = ('account', 'withdrawn_at')
 
@@ -26,6 +64,7 @@ class WithdrawAdmin(SimpleHistoryAdmin, ModelAdmin):
 
 @admin.register(AccountTransfer)
 class AccountTransferAdmin(SimpleHistoryAdmin, ModelAdmin):
+    form = AccountTransferForm
     list_display = ('from_account', 'to_account', 'amount', 'transferred_at')
     list_filter = ('from_account', 'to_account', 'transferred_at')
 
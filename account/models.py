@@ -1,8 +1,9 @@
-from django.db import models
+from django.db import models, transaction
 from django.core.exceptions import ValidationError
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
 from simple_history.models import HistoricalRecords
+from utils import FieldTrackerMixin
 
 class Account(models.Model):
     name = models.CharField(max_length=100, unique=True)
@@ -17,7 +18,7 @@ class Account(models.Model):
             ("can_view_icon_account", "Can view icon account"),
         ]
 
-class Withdraw(models.Model):
+class Withdraw(FieldTrackerMixin, models.Model):
     account = models.ForeignKey(Account, related_name='withdrawals', on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=12, decimal_places=2)
     withdrawn_at = models.DateTimeField(auto_now_add=True)
@@ -31,18 +32,20 @@ class Withdraw(models.Model):
             ("can_view_icon_withdraw", "Can view icon withdraw"),
         ]
 
-    def clean(self):
-        if self.amount > self.account.balance:
-            raise ValidationError('Insufficient balance for the withdrawal.')
-        super().clean()
-
     def save(self, *args, **kwargs):
-        """Save the withdrawal without updating the balance (signals will handle it)."""
+        """
+        Save the withdrawal without updating the balance (signals will handle it).
+
+        The signal debits the account with a guarded update and raises
+        ValidationError if the balance does not cover the amount, which rolls
+        the withdrawal back with it.
+        """
         self.full_clean()
-        super().save(*args, **kwargs)
+        with transaction.atomic():
+            super().save(*args, **kwargs)
 
 
-class AccountTransfer(models.Model):
+class AccountTransfer(FieldTrackerMixin, models.Model):
     from_account = models.ForeignKey(Account, related_name='outgoing_transfers', on_delete=models.CASCADE)
     to_account = models.ForeignKey(Account, related_name='incoming_transfers', on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=12, decimal_places=2)
@@ -58,13 +61,17 @@ class AccountTransfer(models.Model):
         ]
 
     def clean(self):
-        if self.amount > self.from_account.balance:
-            raise ValidationError('Insufficient balance in the source account for the transfer.')
-        if self.from_account == self.to_account:
+        if self.from_account_id == self.to_account_id:
             raise ValidationError('Cannot transfer to the same account.')
         super().clean()
 
     def save(self, *args, **kwargs):
-        """Save the transfer without updating balances (signals will handle it)."""
+        """
+        Save the transfer without updating balances (signals will handle it).
+
+        The source account is debited with a guarded update, so a transfer the
+        balance does not cover raises ValidationError and is rolled back.
+        """
         self.full_clean()
-        super().save(*args, **kwargs)
\ No newline at end of file
+        with transaction.atomic():
+            super().save(*args, **kwargs)
\ No newline at end of file
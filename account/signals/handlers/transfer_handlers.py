@@ -1,6 +1,7 @@
 from django.db.models.signals import pre_save, post_save, pre_delete
 from django.dispatch import receiver
-from ..utils import safe_get_original
+from bulk_recompute import skip_during_bulk_recompute
+from ..utils import capture_original
 from ..logic.transfer_logic import (
     handle_transfer_create,
     handle_transfer_update,
@@ -8,11 +9,13 @@ from ..logic.transfer_logic import (
 )
 
 @receiver(pre_save, sender='account.AccountTransfer')
+@skip_during_bulk_recompute
 def transfer_pre_save(sender, instance, **kwargs):
     if instance.pk:
-        safe_get_original(instance, 'AccountTransfer', ['amount', 'from_account', 'to_account'])
+        capture_original(instance, ['amount', 'from_account', 'to_account'])
 
 @receiver(post_save, sender='account.AccountTransfer')
+@skip_during_bulk_recompute
 def transfer_post_save(sender, instance, created, **kwargs):
     if created:
         handle_transfer_create(instance)
@@ -20,5 +23,6 @@ def transfer_post_save(sender, instance, created, **kwargs):
         handle_transfer_update(instance)
 
 @receiver(pre_delete, sender='account.AccountTransfer')
+@skip_during_bulk_recompute
 def transfer_pre_delete(sender, instance, **kwargs):
     handle_transfer_delete(instance)
@@ -1,6 +1,7 @@
 from django.db.models.signals import pre_save, post_save, pre_delete
 from django.dispatch import receiver
-from ..utils import safe_get_original
+from bulk_recompute import skip_during_bulk_recompute
+from ..utils import capture_original
 from ..logic.withdraw_logic import (
     handle_withdraw_create,
     handle_withdraw_update,
@@ -8,11 +9,13 @@ from ..logic.withdraw_logic import (
 )
 
 @receiver(pre_save, sender='account.Withdraw')
+@skip_during_bulk_recompute
 def withdraw_pre_save(sender, instance, **kwargs):
     if instance.pk:
-        safe_get_original(instance, 'Withdraw', ['amount', 'account'])
+        capture_original(instance, ['amount', 'account'])
 
 @receiver(post_save, sender='account.Withdraw')
+@skip_during_bulk_recompute
 def withdraw_post_save(sender, instance, created, **kwargs):
     if created:
         handle_withdraw_create(instance)
@@ -20,5 +23,6 @@ def withdraw_post_save(sender, instance, created, **kwargs):
         handle_withdraw_update(instance)
 
 @receiver(pre_delete, sender='account.Withdraw')
+@skip_during_bulk_recompute
 def withdraw_pre_delete(sender, instance, **kwargs):
     handle_withdraw_delete(instance)
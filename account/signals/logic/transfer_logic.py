@@ -1,5 +1,7 @@
 from django.db import transaction
 
+from ..utils import debit_balance, save_balance
+
 def handle_transfer_create(instance):
     with transaction.atomic():
         # Set history reason directly on transfer instance
@@ -9,14 +11,12 @@ def handle_transfer_create(instance):
         # Set history reason and update balance for from_account
         instance.from_account._change_reason  = getattr(instance.from_account, '_change_reason',
             f"Balance decreased by {instance.amount} due to transfer to {instance.to_account}")
-        instance.from_account.balance -= instance.amount
-        instance.from_account.save(update_fields=['balance'])
+        debit_balance(instance.from_account, instance.amount)
         
         # Set history reason and update balance for to_account
         instance.to_account._change_reason  = getattr(instance.to_account, '_change_reason',
             f"Balance increased by {instance.amount} due to transfer from {instance.from_account}")
-        instance.to_account.balance += instance.amount
-        instance.to_account.save(update_fields=['balance'])
+        save_balance(instance.to_account, instance.amount)
 
 def handle_transfer_update(instance):
     with transaction.atomic():
@@ -39,30 +39,22 @@ def handle_transfer_update(instance):
         # Set history reason and update balance for original from_account
         instance._original_from_account._change_reason  = getattr(instance._original_from_account, '_change_reason',
             f"Balance increased by {instance._original_amount} due to transfer update/reversal")
-        instance._original_from_account.balance += instance._original_amount
-        instance._original_from_account.save(update_fields=['balance'])
+        save_balance(instance._original_from_account, instance._original_amount)
         
         # Set history reason and update balance for original to_account
         instance._original_to_account._change_reason  = getattr(instance._original_to_account, '_change_reason',
             f"Balance decreased by {instance._original_amount} due to transfer update/reversal")
-        instance._original_to_account.balance -= instance._original_amount
-        instance._original_to_account.save(update_fields=['balance'])
+        save_balance(instance._original_to_account, -instance._original_amount)
         
         # Set history reason and update balance for new from_account
         instance.from_account._change_reason  = getattr(instance.from_account, '_change_reason',
             f"Balance decreased by {instance.amount} due to updated transfer to {instance.to_account}")
-        instance.from_account.balance -= instance.amount
-        instance.from_account.save(update_fields=['balance'])
+        debit_balance(instance.from_account, instance.amount)
         
         # Set history reason and update balance for new to_account
         instance.to_account._change_reason  = getattr(instance.to_account, '_change_reason',
             f"Balance increased by {instance.amount} due to updated transfer from {instance.from_account}")
-        instance.to_account.balance += instance.amount
-        instance.to_account.save(update_fields=['balance'])
-        
-        # Save the transfer instance after all related changes
-        instance.save_without_historical_record = True
-        instance.save(update_fields=['amount'])
+        save_balance(instance.to_account, instance.amount)
 
 def handle_transfer_delete(instance):
     with transaction.atomic():
@@ -73,11 +65,9 @@ def handle_transfer_delete(instance):
         # Set history reason and update balance for from_account
         instance.from_account._change_reason  = getattr(instance.from_account, '_change_reason',
             f"Balance increased by {instance.amount} due to deleted transfer to {instance.to_account}")
-        instance.from_account.balance += instance.amount
-        instance.from_account.save(update_fields=['balance'])
+        save_balance(instance.from_account, instance.amount)
         
         # Set history reason and update balance for to_account
         instance.to_account._change_reason  = getattr(instance.to_account, '_change_reason',
             f"Balance decreased by {instance.amount} due to deleted transfer from {instance.from_account}")
-        instance.to_account.balance -= instance.amount
-        instance.to_account.save(update_fields=['balance'])
\ No newline at end of file
+        save_balance(instance.to_account, -instance.amount)
\ No newline at end of file
@@ -1,14 +1,15 @@
 from django.db import transaction
 
+from ..utils import debit_balance, save_balance
+
 def handle_withdraw_create(instance):
     with transaction.atomic():
         # Set history reason directly on instances
         instance._change_reason  = getattr(instance, '_change_reason', f"New withdrawal of {instance.amount} created")
         instance.account._change_reason  = getattr(instance.account, '_change_reason', f"Balance decreased by {instance.amount} due to withdrawal")
         
-        # Update account balance
-        instance.account.balance -= instance.amount
-        instance.account.save(update_fields=['balance'])
+        # Debit the account only if its balance covers the withdrawal
+        debit_balance(instance.account, instance.amount)
 
 def handle_withdraw_update(instance):
     with transaction.atomic():
@@ -21,16 +22,14 @@ def handle_withdraw_update(instance):
                 f"Balance increased by {instance._original_amount} due to withdrawal transfer to {instance.account}")
             
             # Update original account balance
-            instance._original_account.balance += instance._original_amount
-            instance._original_account.save(update_fields=['balance'])
+            save_balance(instance._original_account, instance._original_amount)
             
             # Set history reason for new account
             instance.account._change_reason  = getattr(instance.account, '_change_reason',
                 f"Balance decreased by {instance.amount} due to withdrawal transferred from {instance._original_account}")
             
-            # Update new account balance
-            instance.account.balance -= instance.amount
-            instance.account.save(update_fields=['balance'])
+            # Debit the new account only if its balance covers the withdrawal
+            debit_balance(instance.account, instance.amount)
         else:
             delta = instance._original_amount - instance.amount
             if delta != 0:
@@ -47,13 +46,11 @@ def handle_withdraw_update(instance):
                 # Set history reason for account
                 instance.account._change_reason  = getattr(instance.account, '_change_reason', change_description)
                 
-                # Update account balance
-                instance.account.balance += delta
-                instance.account.save(update_fields=['balance'])
-
-        # Save the withdrawal instance after all related changes
-        instance.save_without_historical_record = True
-        instance.save(update_fields=['amount'])
+                # Update account balance; an increased withdrawal must be covered
+                if delta > 0:
+                    save_balance(instance.account, delta)
+                else:
+                    debit_balance(instance.account, -delta)
 
 def handle_withdraw_delete(instance):
     with transaction.atomic():
@@ -65,5 +62,4 @@ def handle_withdraw_delete(instance):
             f"Balance increased by {instance.amount} due to withdrawal deletion")
         
         # Update account balance
-        instance.account.balance += instance.amount
-        instance.account.save(update_fields=['balance'])
\ No newline at end of file
+        save_balance(instance.account, instance.amount)
\ No newline at end of file
@@ -1,14 +1,42 @@
+from django.core.exceptions import ValidationError
+
+from utils import guarded_update, increment_field
+
+
 def save_balance(account, amount_delta):
-    account.balance += amount_delta
-    account.save(update_fields=['balance'])
-
-def safe_get_original(instance, model_name, fields):
-    from django.apps import apps
-    try:
-        model = apps.get_model('account', model_name)
-        original = model.objects.get(pk=instance.pk)
-        for field in fields:
-            setattr(instance, f'_original_{field}', getattr(original, field))
-    except model.DoesNotExist:
-        for field in fields:
-            setattr(instance, f'_original_{field}', None)
+    """Add an amount to an account's balance with an F() update, without a bounds check."""
+    increment_field(account, 'balance', amount_delta)
+
+def capture_original(instance, fields):
+    """
+    Set _original_<field> on the instance from its change tracker.
+
+    Foreign keys give the related object as stored, which is the instance's
+    own related object unless the key changed.
+    """
+    for field in fields:
+        if instance._meta.get_field(field).is_relation:
+            setattr(instance, f'_original_{field}', instance.original_related(field))
+        else:
+            setattr(instance, f'_original_{field}', instance.original(field))
+
+def debit_balance(account, amount):
+    """
+    Take an amount from an account only if its balance covers it.
+
+    The check and the debit are one guarded UPDATE, so two withdrawals or
+    transfers racing for the same balance cannot both succeed. The account
+    is refreshed afterwards and its history written with its _change_reason.
+
+    Args:
+        account: The Account to debit
+        amount: Amount to take
+
+    Raises:
+        ValidationError: If the balance is lower than the amount
+    """
+    model = type(account)
+    if not guarded_update(model.objects.filter(pk=account.pk), 'balance', -amount, minimum=0):
+        raise ValidationError(f'Insufficient balance in {account} for {amount}.')
+    account.refresh_from_db(fields=['balance'])
+    model.history.bulk_history_create([account], update=True)
@@ -0,0 +1,97 @@
+from decimal import Decimal
+from django.core.exceptions import ValidationError
+from django.test import TestCase
+
+from account.admin import WithdrawForm
+from account.models import Account, AccountTransfer, Withdraw
+from bulk_recompute import bulk_recompute
+
+
+class AccountDebitTestCase(TestCase):
+    """Test that withdrawals and transfers only debit balances that cover them."""
+
+    def setUp(self):
+        """Set up two accounts."""
+        self.cash = Account.objects.create(name="Cash", balance=Decimal('100.00'))
+        self.bank = Account.objects.create(name="Bank", balance=Decimal('0.00'))
+
+    def test_withdraw_debits_covered_balance(self):
+        """Test that a covered withdrawal is debited and recorded in the account history."""
+        history = self.cash.history.count()
+
+        Withdraw.objects.create(account=self.cash, amount=Decimal('60.00'))
+
+        self.cash.refresh_from_db()
+        self.assertEqual(self.cash.balance, Decimal('40.00'))
+        self.assertEqual(self.cash.history.count(), history + 1)
+        self.assertEqual(self.cash.history.first().balance, Decimal('40.00'))
+
+    def test_withdraw_beyond_balance_is_rolled_back(self):
+        """Test that a withdrawal the balance cannot cover leaves no trace."""
+        with self.assertRaises(ValidationError):
+            Withdraw.objects.create(account=self.cash, amount=Decimal('100.01'))
+
+        self.cash.refresh_from_db()
+        self.assertEqual(self.cash.balance, Decimal('100.00'))
+        self.assertFalse(Withdraw.objects.exists())
+
+    def test_guard_uses_current_balance_not_stale_instance(self):
+        """Test that the guard checks the balance in the database, not the loaded instance."""
+        stale = Account.objects.get(pk=self.cash.pk)
+        Account.objects.filter(pk=self.cash.pk).update(balance=Decimal('10.00'))
+
+        with self.assertRaises(ValidationError):
+            AccountTransfer.objects.create(from_account=stale, to_account=self.bank, amount=Decimal('50.00'))
+
+        self.bank.refresh_from_db()
+        self.assertEqual(self.bank.balance, Decimal('0.00'))
+        self.assertFalse(AccountTransfer.objects.exists())
+
+    def test_transfer_moves_covered_amount(self):
+        """Test that a covered transfer debits the source and credits the destination."""
+        AccountTransfer.objects.create(from_account=self.cash, to_account=self.bank, amount=Decimal('100.00'))
+
+        self.cash.refresh_from_db()
+        self.bank.refresh_from_db()
+        self.assertEqual(self.cash.balance, Decimal('0.00'))
+        self.assertEqual(self.bank.balance, Decimal('100.00'))
+
+    def test_credits_add_to_current_balance_not_stale_instance(self):
+        """Test that credits are added in the database, so a stale instance does not overwrite other changes."""
+        stale = Account.objects.get(pk=self.bank.pk)
+        Account.objects.filter(pk=self.bank.pk).update(balance=Decimal('30.00'))
+
+        transfer = AccountTransfer.objects.create(from_account=self.cash, to_account=stale, amount=Decimal('20.00'))
+        self.assertEqual(stale.balance, Decimal('50.00'))
+        self.assertEqual(stale.history.first().balance, Decimal('50.00'))
+
+        Account.objects.filter(pk=self.cash.pk).update(balance=Decimal('5.00'))
+        transfer.delete()
+
+        self.cash.refresh_from_db()
+        self.bank.refresh_from_db()
+        self.assertEqual(self.cash.balance, Decimal('25.00'))
+        self.assertEqual(self.bank.balance, Decimal('30.00'))
+
+    def test_withdraw_form_reports_insufficient_balance(self):
+        """Test that the admin form shows an insufficient balance as a field error."""
+        form = WithdrawForm(data={'account': self.cash.pk, 'amount': Decimal('150.00')})
+        self.assertFalse(form.is_valid())
+        self.assertIn('amount', form.errors)
+
+    def test_bulk_recompute_moves_balances_by_net_change(self):
+        """Test that withdrawals and transfers made in bulk_recompute move balances once, on exit."""
+        with bulk_recompute():
+            withdraw = Withdraw.objects.create(account=self.cash, amount=Decimal('30.00'))
+            transfer = AccountTransfer.objects.create(from_account=self.cash, to_account=self.bank,
+                                                      amount=Decimal('50.00'))
+            transfer.amount = Decimal('40.00')
+            transfer.save()
+            withdraw.delete()
+            self.cash.refresh_from_db()
+            self.assertEqual(self.cash.balance, Decimal('100.00'))
+
+        self.cash.refresh_from_db()
+        self.bank.refresh_from_db()
+        self.assertEqual((self.cash.balance, self.bank.balance), (Decimal('60.00'), Decimal('40.00')))
+        self.assertEqual(self.bank.history.first().history_change_reason, "Bulk recompute")
@@ -0,0 +1,567 @@
+import logging
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+from functools import wraps
+
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.db.models.signals import pre_delete, pre_save
+from django.dispatch import receiver
+
+from account.models import Account, AccountTransfer, Withdraw
+from customer.models import Customer
+from expense.models import Expense
+from inventory.models.stock import Stock
+from inventory.models.stock_movement import StockMovement
+from inventory.models.stock_transfers import StockTransfer, StockTransferItem
+from inventory.services.stock_ledger import build_movement, record_movements
+from inventory.services.stock_lots import adjust_lots, fifo_costing_enabled
+from inventory.services.stock_posting import (calculate_selling_price, lock_stock_rows, post_stock_transfers,
+                                              stock_changed, weighted_average_cost, write_stock_rows)
+from payment.models import Payment
+from product.models import Product
+from purchase_invoice.models import PurchaseInvoice, PurchaseInvoiceItem
+from receipt.models import Receipt
+from sale_invoice.models import SalesInvoice, SalesInvoiceItem
+from sale_invoice.services.fifo_costing import cost_sales_items_fifo
+from supplier.models import Supplier
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+ZERO = Decimal('0.00')
+BULK_REASON = "Bulk recompute"
+
+
+class BulkRecompute:
+    """
+    Records which derived rows a block of bulk work touches and brings them
+    up to date once, when the block ends.
+
+    While a bulk recompute is active the derived-state signal handlers
+    (wrapped in skip_during_bulk_recompute) return straight away, and the
+    receivers at the bottom of this module record what each save or delete
+    would have changed instead: the invoices to re-total, the stock rows and
+    the net quantity (and purchase value) each one moves by, and the net
+    change to each account balance, customer credit and supplier payable.
+    Work that bypasses signals (bulk_create, QuerySet.update) records its
+    effects itself through the same touch_*/add_* methods.
+
+    On flush the touched invoices are re-totalled from their lines with one
+    aggregate UPDATE per invoice model, and their paid amounts moved by the
+    receipts and payments recorded against them. Each customer's credit and
+    supplier's payable then moves by the net change of their invoices' totals
+    less what was paid, in one bulk update per model, and the accounts by
+    their net balance change. Stock rows are locked together and written with
+    one upsert, one bulk history insert and one bulk movement insert (transfer
+    lines go through post_stock_transfers), with purchases re-deriving the
+    average cost. Balances move by recorded deltas rather than being summed
+    from scratch, so opening balances and imported figures are kept.
+
+    The checks the handlers make on the way (credit limits, withdrawals the
+    balance must cover, over-paid invoices) are not made for the block.
+    """
+
+    def __init__(self):
+        self.sales_invoices = {}
+        self.purchase_invoices = {}
+        self.expenses = {}
+        self.deleted_parties = {}
+        self.stock_deltas = {}
+        self.purchase_values = {}
+        self.transfer_lines = []
+        self.stock_keys = set()
+        self.balances = {}
+        self.credits = {}
+        self.payables = {}
+        self.sold_items = []
+        self.lot_changes = []
+        self._shops = {}
+
+    def touch_sales_invoice(self, invoice_id, paid=ZERO):
+        """Mark a sales invoice for re-totalling, moving its paid amount by ``paid`` on flush."""
+        if invoice_id is not None:
+            self.sales_invoices[invoice_id] = self.sales_invoices.get(invoice_id, ZERO) + paid
+
+    def touch_purchase_invoice(self, invoice_id, paid=ZERO):
+        """Mark a purchase invoice for re-totalling, moving its paid amount by ``paid`` on flush."""
+        if invoice_id is not None:
+            self.purchase_invoices[invoice_id] = self.purchase_invoices.get(invoice_id, ZERO) + paid
+
+    def touch_payable(self, content_type_id, object_id, paid):
+        """Record a payment against whatever it pays (a purchase invoice or an expense)."""
+        model = ContentType.objects.get_for_id(content_type_id).model_class()
+        if model is PurchaseInvoice:
+            self.touch_purchase_invoice(object_id, paid)
+        elif model is Expense:
+            self.expenses[object_id] = self.expenses.get(object_id, ZERO) + paid
+
+    def add_stock(self, shop_id, product_id, quantity, movement_type=StockMovement.ADJUSTMENT, value=None):
+        """Queue a quantity change (and, for purchases, the value it brings in) for one stock row."""
+        if shop_id is None or product_id is None:
+            return
+        key = (shop_id, product_id)
+        deltas = self.stock_deltas.setdefault(key, {})
+        deltas[movement_type] = deltas.get(movement_type, 0) + quantity
+        if value is not None:
+            self.purchase_values[key] = self.purchase_values.get(key, ZERO) + value
+
+    def add_transfer(self, from_shop_id, to_shop_id, product_id, quantity, source=None):
+        """Queue a transfer line (a negative quantity undoes one), posted as post_stock_transfers does."""
+        if from_shop_id is not None and to_shop_id is not None and quantity:
+            self.transfer_lines.append((from_shop_id, to_shop_id, product_id, quantity, source))
+
+    def touch_stock(self, shop_id, product_id):
+        """Mark a stock row whose product summary and shop version need refreshing."""
+        self.stock_keys.add((shop_id, product_id))
+
+    def add_balance(self, account_id, amount):
+        if account_id is not None:
+            self.balances[account_id] = self.balances.get(account_id, ZERO) + amount
+
+    def add_credit(self, customer_id, amount):
+        if customer_id is not None:
+            self.credits[customer_id] = self.credits.get(customer_id, ZERO) + amount
+
+    def add_payable(self, supplier_id, amount):
+        if supplier_id is not None:
+            self.payables[supplier_id] = self.payables.get(supplier_id, ZERO) + amount
+
+    def _shops_of(self, model, pk, fields, related=None):
+        """Shop ids of an invoice or transfer, read once per row (or taken from its cached instance)."""
+        key = (model, pk)
+        if key not in self._shops:
+            if related is not None and related.pk == pk:
+                self._shops[key] = tuple(getattr(related, field) for field in fields)
+            else:
+                self._shops[key] = model._base_manager.filter(pk=pk).values_list(*fields).first()
+        return self._shops[key] or (None,) * len(fields)
+
+    def add_sale(self, invoice_id, product_id, quantity, item, invoice=None):
+        """Queue a sales line's stock change (negative when sold) and mark its invoice."""
+        shop_id, = self._shops_of(SalesInvoice, invoice_id, ['shop_id'], invoice)
+        self.add_stock(shop_id, product_id, quantity, StockMovement.SALE)
+        self.touch_sales_invoice(invoice_id)
+        if fifo_costing_enabled() and shop_id is not None:
+            self.sold_items.append((shop_id, product_id, quantity, item))
+
+    def add_purchase(self, invoice_id, product_id, quantity, value, item, unit_cost=None, invoice=None):
+        """Queue a purchase line's stock and value change and mark its invoice."""
+        shop_id, = self._shops_of(PurchaseInvoice, invoice_id, ['shop_id'], invoice)
+        self.add_stock(shop_id, product_id, quantity, StockMovement.PURCHASE, value=value)
+        self.touch_purchase_invoice(invoice_id)
+        if fifo_costing_enabled() and shop_id is not None:
+            self.lot_changes.append((shop_id, product_id, quantity, item, unit_cost))
+
+    def add_transfer_item(self, transfer_id, product_id, quantity, item, transfer=None):
+        """Queue a transfer item between its transfer's shops."""
+        from_shop_id, to_shop_id = self._shops_of(StockTransfer, transfer_id, ['from_shop_id', 'to_shop_id'],
+                                                  transfer)
+        self.add_transfer(from_shop_id, to_shop_id, product_id, quantity, item)
+
+    def flush(self):
+        """Bring every recorded invoice, stock row, customer, supplier and account up to date."""
+        fifo = fifo_costing_enabled()
+        if not fifo and self.sales_invoices:
+            # Cost new lines at the stock row's average cost before purchases in the block move it
+            self._cost_sales_items()
+        self._post_stock(fifo)
+        if self.transfer_lines:
+            post_stock_transfers(self.transfer_lines, logger, reason=BULK_REASON)
+        if fifo and self.sold_items:
+            # Deleted items are still in the batch; updating their cost touches no rows
+            items = {item.pk: item for _, _, _, item in self.sold_items}
+            cost_sales_items_fifo(self.sold_items, list(items.values()))
+
+        self._recompute_sales_invoices()
+        self._recompute_purchase_invoices()
+        _apply_deltas(Expense, 'paid_amount', self.expenses)
+        _apply_deltas(Customer, 'credit', self.credits)
+        _apply_deltas(Supplier, 'payable', self.payables)
+        _apply_deltas(Account, 'balance', self.balances)
+        if self.stock_keys:
+            stock_changed(self.stock_keys)
+
+        logger.info(f"Bulk recompute: {len(self.sales_invoices)} sales invoices, "
+                    f"{len(self.purchase_invoices)} purchase invoices, {len(self.stock_deltas)} stock rows, "
+                    f"{len(self.transfer_lines)} transfer lines, {len(self.balances)} accounts")
+
+    def _cost_sales_items(self):
+        """Give lines of the touched invoices without an average cost their stock row's, one UPDATE per shop."""
+        shop_ids = (SalesInvoice.objects.filter(pk__in=self.sales_invoices)
+                    .values_list('shop_id', flat=True).distinct().order_by())
+        for shop_id in shop_ids:
+            average_cost = Stock.objects.filter(shop_id=shop_id, product=OuterRef('product')).values('average_cost')
+            (SalesInvoiceItem.objects
+             .filter(sales_invoice__in=self.sales_invoices, sales_invoice__shop_id=shop_id, average_cost=None)
+             .update(average_cost=Subquery(average_cost[:1])))
+
+    def _post_stock(self, fifo):
+        """Apply the net sales, purchase and adjustment quantities to their stock rows in one write."""
+        keys = {key for key, deltas in self.stock_deltas.items()
+                if any(deltas.values()) or self.purchase_values.get(key)}
+        if keys:
+            stocks = lock_stock_rows(keys)
+            # Rows that end up with stock are created, as sales returns and purchases do
+            created = {key for key in keys - set(stocks) if sum(self.stock_deltas[key].values()) > 0}
+            if created:
+                Stock.objects.bulk_create(
+                    [Stock(shop_id=shop_id, product_id=product_id, quantity=0, average_cost=ZERO,
+                           selling_price=ZERO) for shop_id, product_id in sorted(created)],
+                    ignore_conflicts=True,
+                )
+                stocks = lock_stock_rows(keys)
+            original = {key: stock.average_cost for key, stock in stocks.items()}
+
+            movements = []
+            for key in sorted(keys & set(stocks)):
+                stock, deltas = stocks[key], self.stock_deltas[key]
+                purchased = deltas.get(StockMovement.PURCHASE, 0)
+                unit_cost = None
+                if key in self.purchase_values:
+                    value = self.purchase_values[key]
+                    stock.average_cost = weighted_average_cost(stock.quantity, stock.average_cost, purchased, value)
+                    unit_cost = (value / purchased).quantize(Decimal('0.01')) if purchased else None
+                for movement_type, quantity in sorted(deltas.items()):
+                    new_quantity = stock.quantity + quantity
+                    if new_quantity < 0:
+                        logger.warning(f"Prevented negative stock for product {key[1]} in shop {key[0]}")
+                        new_quantity = 0
+                    movements.append(build_movement(
+                        key[0], key[1], new_quantity - stock.quantity, movement_type, note=BULK_REASON,
+                        unit_cost=unit_cost if movement_type == StockMovement.PURCHASE else None))
+                    stock.quantity = new_quantity
+            for key in sorted(keys - set(stocks)):
+                logger.error(f"No stock record found for product {key[1]} in shop {key[0]}")
+
+            repriced = [stock for key, stock in stocks.items()
+                        if key in created or stock.average_cost != original[key]]
+            if repriced:
+                margins = dict(Product.objects.filter(pk__in={stock.product_id for stock in repriced})
+                               .values_list('pk', 'profit_margin'))
+                for stock in repriced:
+                    stock.selling_price = calculate_selling_price(stock.average_cost, margins[stock.product_id])
+            changed = [stocks[key] for key in sorted(stocks)]
+            write_stock_rows(changed)
+            Stock.history.bulk_history_create(changed, update=True, default_change_reason=BULK_REASON,
+                                              batch_size=1000)
+            record_movements(movements)
+            self.stock_keys |= keys
+
+        if fifo and self.lot_changes:
+            adjust_lots(self.lot_changes)
+
+    def _recompute_sales_invoices(self):
+        """Re-total the touched sales invoices from their lines and move their customers' credit."""
+        if not self.sales_invoices:
+            return
+        invoices = SalesInvoice.objects.filter(pk__in=self.sales_invoices)
+        before = {pk: total for pk, total in invoices.select_for_update().values_list('pk', 'total_amount')}
+        lines = SalesInvoiceItem.objects.filter(sales_invoice=OuterRef('pk')).values('sales_invoice').order_by()
+        invoices.update(
+            total_amount=Coalesce(Subquery(lines.annotate(total=Sum(SalesInvoiceItem.line_total_expression()))
+                                           .values('total')), Value(ZERO)),
+            cost_total=Coalesce(Subquery(lines.annotate(cost=Sum(SalesInvoiceItem.line_cost_expression()))
+                                         .values('cost')), Value(ZERO)),
+        )
+        invoices.update(profit=F('total_amount') - F('cost_total'))
+        self._settle_invoices(SalesInvoice, list(invoices), before, self.sales_invoices, self.add_credit,
+                              'customer_id')
+
+    def _recompute_purchase_invoices(self):
+        """Re-total the touched purchase invoices from their lines and move their suppliers' payable."""
+        if not self.purchase_invoices:
+            return
+        invoices = PurchaseInvoice.objects.filter(pk__in=self.purchase_invoices)
+        before = {pk: total for pk, total in invoices.select_for_update().values_list('pk', 'total_amount')}
+        lines = (PurchaseInvoiceItem.objects.filter(purchase_invoice=OuterRef('pk'))
+                 .values('purchase_invoice').order_by()
+                 .annotate(total=Sum(F('price') * F('quantity'))).values('total'))
+        invoices.update(total_amount=Coalesce(Subquery(lines), Value(ZERO)))
+        self._settle_invoices(PurchaseInvoice, list(invoices), before, self.purchase_invoices, self.add_payable,
+                              'supplier_id')
+
+    def _settle_invoices(self, model, invoices, before, paid, add_to_party, party_field):
+        """
+        Move the re-totalled invoices' paid amounts by what was paid in the block,
+        and their customer or supplier by the change in what is owed. An invoice
+        deleted in the block was taken off its party when it was deleted; only
+        the payments recorded against it since are left to settle.
+        """
+        for invoice in invoices:
+            invoice.paid_amount += paid[invoice.pk]
+            add_to_party(getattr(invoice, party_field), invoice.total_amount - before[invoice.pk] - paid[invoice.pk])
+        model.objects.bulk_update(invoices, ['paid_amount'], batch_size=1000)
+        model.history.bulk_history_create(invoices, update=True, default_change_reason=BULK_REASON, batch_size=1000)
+        for pk in set(paid) - set(before):
+            add_to_party(self.deleted_parties.get((model, pk)), -paid[pk])
+
+
+def _apply_deltas(model, field, deltas):
+    """Add each row's net change to a balance field, in one bulk update with one bulk history insert."""
+    deltas = {pk: delta for pk, delta in deltas.items() if delta}
+    if not deltas:
+        return
+    rows = list(model.objects.select_for_update().filter(pk__in=deltas).order_by('pk'))
+    for row in rows:
+        setattr(row, field, getattr(row, field) + deltas[row.pk])
+    model.objects.bulk_update(rows, [field], batch_size=1000)
+    model.history.bulk_history_create(rows, update=True, default_change_reason=BULK_REASON, batch_size=1000)
+
+
+def current_bulk_recompute():
+    """The bulk recompute active on this thread, or None."""
+    return getattr(_state, 'bulk_recompute', None)
+
+
+@contextmanager
+def bulk_recompute():
+    """
+    Run a block of bulk work (data fixes, imports, bulk edits) with the
+    derived-state signal handlers off, inside a transaction, and bring the
+    invoices, stock rows, customers, suppliers and accounts it touched up to
+    date when it ends (see BulkRecompute).
+
+    Nested calls join the outer bulk recompute, which flushes once when it
+    ends. If the block raises, nothing recorded is applied and the
+    transaction rolls back.
+    """
+    active = current_bulk_recompute()
+    if active is not None:
+        yield active
+        return
+
+    recompute = BulkRecompute()
+    with transaction.atomic():
+        _state.bulk_recompute = recompute
+        try:
+            yield recompute
+        finally:
+            _state.bulk_recompute = None
+        recompute.flush()
+
+
+def skip_during_bulk_recompute(handler):
+    """Make a derived-state signal handler return straight away while a bulk recompute is active."""
+    @wraps(handler)
+    def wrapper(*args, **kwargs):
+        if current_bulk_recompute() is not None:
+            return None
+        return handler(*args, **kwargs)
+    return wrapper
+
+
+def _stored(instance):
+    """Whether a tracked instance being saved already has a row, so its original values apply."""
+    return instance.pk is not None and instance.original(instance._meta.pk.name) is not None
+
+
+def _cached(instance, field_name):
+    """The related object behind a foreign key if it is already loaded, otherwise None."""
+    return instance._meta.get_field(field_name).get_cached_value(instance, None)
+
+
+@receiver(pre_save, sender=SalesInvoiceItem)
+def record_sales_item_save(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is None:
+        return
+    if getattr(instance, '_update_average_cost', False) and not fifo_costing_enabled():
+        # Re-costed from its stock row on flush, as the average cost handler would on save
+        instance.average_cost = None
+        del instance._update_average_cost
+    if _stored(instance):
+        recompute.add_sale(instance.original('sales_invoice'), instance.original('product'),
+                           instance.original('quantity'), instance)
+    recompute.add_sale(instance.sales_invoice_id, instance.product_id, -instance.quantity, instance,
+                       invoice=_cached(instance, 'sales_invoice'))
+
+
+@receiver(pre_delete, sender=SalesInvoiceItem)
+def record_sales_item_delete(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is not None:
+        recompute.add_sale(instance.sales_invoice_id, instance.product_id, instance.quantity, instance,
+                           invoice=_cached(instance, 'sales_invoice'))
+
+
+@receiver(pre_delete, sender=SalesInvoice)
+def record_sales_invoice_delete(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is not None:
+        # Its lines leave the customer's credit with it; receipts deleted with it are settled on flush
+        recompute.add_credit(instance.customer_id, -instance.total_amount)
+        recompute.deleted_parties[(SalesInvoice, instance.pk)] = instance.customer_id
+
+
+@receiver(pre_save, sender=Receipt)
+def record_receipt_save(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is None:
+        return
+    if _stored(instance):
+        recompute.add_balance(instance.original('account'), -instance.original('amount'))
+        recompute.touch_sales_invoice(instance.original('sales_invoice'), paid=-instance.original('amount'))
+    recompute.add_balance(instance.account_id, instance.amount)
+    recompute.touch_sales_invoice(instance.sales_invoice_id, paid=instance.amount)
+
+
+@receiver(pre_delete, sender=Receipt)
+def record_receipt_delete(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is not None:
+        recompute.add_balance(instance.account_id, -instance.amount)
+        recompute.touch_sales_invoice(instance.sales_invoice_id, paid=-instance.amount)
+
+
+@receiver(pre_save, sender=PurchaseInvoiceItem)
+def record_purchase_item_save(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is None:
+        return
+    invoice = _cached(instance, 'purchase_invoice')
+    if _stored(instance):
+        original_quantity, original_price = instance.original('quantity'), instance.original('price')
+        if not instance.has_changed('purchase_invoice') and not instance.has_changed('product'):
+            # One net line, so FIFO lots are adjusted by the difference as the handler does
+            recompute.add_purchase(instance.purchase_invoice_id, instance.product_id,
+                                   instance.quantity - original_quantity,
+                                   instance.price * instance.quantity - original_price * original_quantity,
+                                   instance, unit_cost=instance.price, invoice=invoice)
+            return
+        recompute.add_purchase(instance.original('purchase_invoice'), instance.original('product'),
+                               -original_quantity, -original_price * original_quantity, instance)
+    recompute.add_purchase(instance.purchase_invoice_id, instance.product_id, instance.quantity,
+                           instance.price * instance.quantity, instance, unit_cost=instance.price, invoice=invoice)
+
+
+@receiver(pre_delete, sender=PurchaseInvoiceItem)
+def record_purchase_item_delete(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is not None:
+        recompute.add_purchase(instance.purchase_invoice_id, instance.product_id, -instance.quantity,
+                               -instance.price * instance.quantity, instance,
+                               invoice=_cached(instance, 'purchase_invoice'))
+
+
+@receiver(pre_save, sender=PurchaseInvoice)
+def record_purchase_invoice_save(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is None or not _stored(instance):
+        return
+    if instance.supplier_id is not None and instance.has_changed('supplier'):
+        # The stored total moves to the new supplier; any change to it is settled on flush
+        recompute.add_payable(instance.original('supplier'), -instance.original('total_amount'))
+        recompute.add_payable(instance.supplier_id, instance.original('total_amount'))
+
+
+@receiver(pre_delete, sender=PurchaseInvoice)
+def record_purchase_invoice_delete(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is not None:
+        recompute.add_payable(instance.original('supplier'), -instance.original('total_amount'))
+        recompute.deleted_parties[(PurchaseInvoice, instance.pk)] = instance.original('supplier')
+
+
+@receiver(pre_save, sender=Payment)
+def record_payment_save(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is None:
+        return
+    if _stored(instance):
+        recompute.add_balance(instance.original('account'), instance.original('amount'))
+        recompute.touch_payable(instance.original('content_type'), instance.original('object_id'),
+                                -instance.original('amount'))
+    recompute.add_balance(instance.account_id, -instance.amount)
+    recompute.touch_payable(instance.content_type_id, instance.object_id, instance.amount)
+
+
+@receiver(pre_delete, sender=Payment)
+def record_payment_delete(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is not None:
+        recompute.add_balance(instance.account_id, instance.amount)
+        recompute.touch_payable(instance.content_type_id, instance.object_id, -instance.amount)
+
+
+@receiver(pre_save, sender=Withdraw)
+def record_withdraw_save(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is None:
+        return
+    if _stored(instance):
+        recompute.add_balance(instance.original('account'), instance.original('amount'))
+    recompute.add_balance(instance.account_id, -instance.amount)
+
+
+@receiver(pre_delete, sender=Withdraw)
+def record_withdraw_delete(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is not None:
+        recompute.add_balance(instance.account_id, instance.amount)
+
+
+@receiver(pre_save, sender=AccountTransfer)
+def record_account_transfer_save(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is None:
+        return
+    if _stored(instance):
+        recompute.add_balance(instance.original('from_account'), instance.original('amount'))
+        recompute.add_balance(instance.original('to_account'), -instance.original('amount'))
+    recompute.add_balance(instance.from_account_id, -instance.amount)
+    recompute.add_balance(instance.to_account_id, instance.amount)
+
+
+@receiver(pre_delete, sender=AccountTransfer)
+def record_account_transfer_delete(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is not None:
+        recompute.add_balance(instance.from_account_id, instance.amount)
+        recompute.add_balance(instance.to_account_id, -instance.amount)
+
+
+@receiver(pre_save, sender=StockTransferItem)
+def record_transfer_item_save(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is None:
+        return
+    if _stored(instance):
+        recompute.add_transfer_item(instance.original('stock_transfer'), instance.original('product'),
+                                    -instance.original('quantity'), instance)
+    recompute.add_transfer_item(instance.stock_transfer_id, instance.product_id, instance.quantity, instance,
+                                transfer=_cached(instance, 'stock_transfer'))
+
+
+@receiver(pre_delete, sender=StockTransferItem)
+def record_transfer_item_delete(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is not None:
+        recompute.add_transfer_item(instance.stock_transfer_id, instance.product_id, -instance.quantity, instance,
+                                    transfer=_cached(instance, 'stock_transfer'))
+
+
+@receiver(pre_save, sender=StockTransfer)
+def record_stock_transfer_save(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is None or not _stored(instance):
+        return
+    if instance.has_changed('from_shop') or instance.has_changed('to_shop'):
+        # Undo every item between the original shops and redo it between the new ones
+        for item in StockTransferItem.objects.filter(stock_transfer=instance):
+            recompute.add_transfer(instance.original('from_shop'), instance.original('to_shop'), item.product_id,
+                                   -item.quantity, item)
+            recompute.add_transfer(instance.from_shop_id, instance.to_shop_id, item.product_id, item.quantity, item)
+        recompute._shops[(StockTransfer, instance.pk)] = (instance.from_shop_id, instance.to_shop_id)
+
+
+@receiver(pre_save, sender=Stock)
+@receiver(pre_delete, sender=Stock)
+def record_stock_change(sender, instance, **kwargs):
+    recompute = current_bulk_recompute()
+    if recompute is not None:
+        recompute.touch_stock(instance.shop_id, instance.product_id)
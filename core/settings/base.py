@@ -134,6 +134,10 @@ LOGGING = {
 
 SIMPLE_HISTORY_REVERT_DISABLED = True
 
+# How sales and transfers are costed: 'average' (the stock row's moving
+# average cost) or 'fifo' (purchase lots consumed oldest first)
+INVENTORY_COSTING_METHOD = 'average'
+
 UNFOLD = {
     "SITE_TITLE": "MS Sports",
     "SITE_HEADER": "MS Sports",
@@ -247,6 +251,18 @@ UNFOLD = {
                     "link": reverse_lazy("admin:inventory_stocktransfer_changelist"),
                     "permission": lambda request: request.user.has_perm("inventory.can_view_icon_stock_transfe"),
                 },
+                {
+                    "title": "Stock Movements",
+                    "icon": "receipt_long",
+                    "link": reverse_lazy("admin:inventory_stockmovement_changelist"),
+                    "permission": lambda request: request.user.has_perm("inventory.can_view_icon_stock_movement"),
+                },
+                {
+                    "title": "Stock Counts",
+                    "icon": "fact_check",
+                    "link": reverse_lazy("admin:inventory_stockcount_changelist"),
+                    "permission": lambda request: request.user.has_perm("inventory.can_view_icon_stock_count"),
+                },
                 {
                     "title": "Shops",
                     "icon": "store",
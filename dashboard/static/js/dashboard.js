@@ -2,6 +2,7 @@ const Dashboard = (function() {
     // Configuration
     const config = {
         itemsPerPage: 30,
+        inventoryPageSize: 1000,
         defaultSort: {
             column: 'shop_name',
             order: 'asc'
@@ -11,7 +12,10 @@ const Dashboard = (function() {
     // State
     const state = {
         allShops: [],
-        allInventoryData: [],
+        // Loaded stock rows and the cursor of the next page, per tab ('all' or a shop id)
+        inventory: {},
+        cursors: {},
+        totals: {value: '0.00', products: 0},
         currentPage: 1,
         currentSort: {...config.defaultSort}
     };
@@ -97,45 +101,57 @@ const Dashboard = (function() {
             }
         },
         
+        snapshotUrl: (shopId, cursor) => {
+            let url = `/api/inventory/inventory-snapshot/?limit=${config.inventoryPageSize}`;
+            if (shopId !== 'all') {
+                url += `&shop_id=${shopId}`;
+            }
+            if (cursor) {
+                url += `&cursor=${encodeURIComponent(cursor)}`;
+            }
+            return url;
+        },
+        
+        fetchInventoryPage: async (shopId) => {
+            // Load the next page of one tab's stock rows and redraw the tab
+            try {
+                const response = await fetch(api.snapshotUrl(shopId, state.cursors[shopId]));
+                const snapshot = await response.json();
+                state.inventory[shopId] = (state.inventory[shopId] || []).concat(snapshot.products);
+                state.cursors[shopId] = snapshot.next_cursor;
+                
+                if (shopId === 'all') {
+                    displayAllInventory(filterAllInventory());
+                } else {
+                    displayShopInventory(shopId, filterShopInventory(shopId));
+                }
+            } catch (error) {
+                console.error("Error fetching inventory", error);
+            }
+        },
+        
         fetchShops: async () => {
             try {
-                const response = await fetch('/api/shop/');
-                state.allShops = await response.json();
+                // Shop totals and the first page of inventory come in one request;
+                // further pages are loaded per tab when asked for
+                const response = await fetch(api.snapshotUrl('all'));
+                const snapshot = await response.json();
+                state.allShops = snapshot.shops;
+                state.inventory.all = snapshot.products;
+                state.cursors.all = snapshot.next_cursor;
+                state.totals = {value: snapshot.total_inventory_value, products: snapshot.total_products};
                 
                 // Remove loading tab
                 document.querySelector('.tab[data-shop-id="loading"]').style.display = 'none';
                 
-                // Create tabs for each shop
+                // Create tabs for each shop; their inventory is loaded when they are opened
                 for (const shop of state.allShops) {
-                    try {
-                        const inventoryRes = await fetch(`/api/inventory/inventory-value/?shop_id=${shop.id}`);
-                        const inventoryData = await inventoryRes.json();
-                        // Add shop inventory data
-                        shop.total_inventory_value = inventoryData.total_inventory_value;
-                        shop.total_products = inventoryData.products.length;
-                        
-                        // Add inventory data to global array
-                        inventoryData.products.forEach(product => {
-                            product.shop_id = shop.id.toString();
-                            product.shop_name = shop.name;
-                            state.allInventoryData.push(product);
-                        });
-                        
-                        // Create tab for this shop
-                        createShopTab(shop);
-                        
-                        // Populate the shop's inventory table
-                        const shopInventory = state.allInventoryData.filter(item => item.shop_id === shop.id.toString());
-                        displayShopInventory(shop.id.toString(), shopInventory);
-                        
-                    } catch (inventoryError) {
-                        console.error(`Error fetching inventory for shop ${shop.id}`, inventoryError);
-                    }
+                    createShopTab(shop);
                 }
                 
                 // Setup all inventory tab and populate it
                 setupAllInventoryTab();
-                displayAllInventory(state.allInventoryData);
+                displayAllInventory(filterAllInventory());
                 
             } catch (error) {
                 console.error("Error fetching shops", error);
@@ -164,6 +180,11 @@ const Dashboard = (function() {
             
             // Reset to first page when switching tabs
             state.currentPage = 1;
+            
+            // Load a shop's first page the first time its tab is opened
+            if (shopId !== 'all' && !(shopId in state.inventory)) {
+                api.fetchInventoryPage(shopId.toString());
+            }
         },
         
         createPagination: (totalItems, currentPage, containerId) => {
@@ -229,6 +250,16 @@ const Dashboard = (function() {
                 }
             };
             paginationContainer.appendChild(pageSizeSelect);
+            
+            // Offer the next page from the server while there is one
+            const tabId = containerId.replace('-pagination', '');
+            if (state.cursors[tabId]) {
+                const moreButton = document.createElement('button');
+                moreButton.className = 'pagination-button';
+                moreButton.textContent = 'Load more';
+                moreButton.onclick = () => api.fetchInventoryPage(tabId);
+                paginationContainer.appendChild(moreButton);
+            }
         },
         
         goToPage: (page, paginationId) => {
@@ -282,7 +313,7 @@ const Dashboard = (function() {
         const minValue = document.getElementById('all-filter-min-value').value;
         const maxValue = document.getElementById('all-filter-max-value').value;
         
-        return state.allInventoryData.filter(item => {
+        return (state.inventory.all || []).filter(item => {
             const matchesProduct = !productFilter || (item.product_name && item.product_name.toLowerCase().includes(productFilter));
             const matchesMinQty = !minQty || item.quantity >= parseInt(minQty);
             const matchesMaxQty = !maxQty || item.quantity <= parseInt(maxQty);
@@ -300,9 +331,7 @@ const Dashboard = (function() {
         const minValue = document.getElementById(`${shopId}-filter-min-value`).value;
         const maxValue = document.getElementById(`${shopId}-filter-max-value`).value;
         
-        return state.allInventoryData.filter(item => {
-            if (item.shop_id !== shopId) return false;
-            
+        return (state.inventory[shopId] || []).filter(item => {
             const matchesProduct = !productFilter || (item.product_name && item.product_name.toLowerCase().includes(productFilter));
             const matchesMinQty = !minQty || item.quantity >= parseInt(minQty);
             const matchesMaxQty = !maxQty || item.quantity <= parseInt(maxQty);
@@ -349,7 +378,7 @@ const Dashboard = (function() {
         }
         
         // Update all shops summary
-        updateAllShopsSummary(filteredData);
+        updateAllShopsSummary(filteredData, filteredData.length < (state.inventory.all || []).length);
         
         // Update sort indicators
         const table = document.getElementById('all-inventory-table');
@@ -364,7 +393,14 @@ const Dashboard = (function() {
         ui.createPagination(totalItems, state.currentPage, 'all-pagination');
     };
     
-    const updateAllShopsSummary = (data) => {
+    const updateAllShopsSummary = (data, filtered) => {
+        // Unfiltered, show the server's totals rather than those of the pages loaded so far
+        if (!filtered) {
+            elements.allShopsSummary.inventoryValue.textContent = utils.formatNumber(state.totals.value);
+            elements.allShopsSummary.productsCount.textContent = state.totals.products;
+            return;
+        }
+        
         let totalValue = 0;
         let uniqueProducts = new Set();
         
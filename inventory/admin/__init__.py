@@ -1,3 +1,6 @@
 from .stock import StockAdmin
 from .stock_transfers import StockTransferAdmin
 from .stock_transfers import StockTransferItem
+from .stock_movement import StockMovementAdmin
+from .stock_count import StockCountAdmin, StockCountLineAdmin
+from .stock_lot import StockLotAdmin
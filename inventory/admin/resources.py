@@ -0,0 +1,178 @@
+import codecs
+import csv
+
+from django.core.exceptions import ValidationError
+from import_export import fields, resources, widgets
+
+from inventory.models.stock import Stock
+from inventory.models.stock_movement import StockMovement
+from inventory.services.stock_ledger import build_movement, record_movements
+from inventory.services.stock_posting import calculate_selling_price, stock_changed, stock_filter, write_stock_rows
+from product.models import Product
+from shop.models import Shop
+
+IMPORT_BATCH_SIZE = 1000
+IMPORT_REASON = "Stock imported"
+
+
+class _Echo:
+    """File-like object whose write() hands the line back, for streaming csv.writer output."""
+
+    def write(self, value):
+        return value
+
+
+class StockResource(resources.ModelResource):
+    """
+    Stock import/export keyed by shop and product id.
+
+    Imports run in bulk mode: before the import the sheet is read in chunks
+    and each chunk's existing Stock rows and products are loaded with
+    one query each, so rows are matched and priced from memory instead of
+    being fetched one at a time. Unchanged rows are skipped; the rest are
+    written with one bulk insert or upsert per batch, followed by one bulk
+    history insert and one ledger insert for the batch. Stock.save() and the
+    Stock signals are bypassed, so the batch refreshes the product summaries
+    and shop stock versions itself.
+    """
+
+    shop = fields.Field(attribute='shop_id', column_name='shop', widget=widgets.IntegerWidget())
+    product = fields.Field(attribute='product_id', column_name='product', widget=widgets.IntegerWidget())
+    selling_price = fields.Field(attribute='selling_price', column_name='selling_price',
+                                 widget=widgets.DecimalWidget(), readonly=True)
+
+    class Meta:
+        model = Stock
+        fields = ('shop', 'product', 'quantity', 'average_cost', 'selling_price')
+        import_id_fields = ('shop', 'product')
+        use_bulk = True
+        batch_size = IMPORT_BATCH_SIZE
+        skip_diff = True
+        chunk_size = IMPORT_BATCH_SIZE
+
+    def __init__(self, **kwargs):
+        super().__init__(**kwargs)
+        self.stocks = {}
+        self.products = {}
+        self.shops = {}
+        self.seen_keys = set()
+
+    def row_key(self, row):
+        """(shop_id, product_id) of an import row."""
+        return self.fields['shop'].clean(row), self.fields['product'].clean(row)
+
+    def before_import(self, dataset, **kwargs):
+        """Load the existing Stock rows and products the sheet refers to, one chunk at a time."""
+        self.shops = Shop.objects.in_bulk()
+        headers = dataset.headers or []
+        if 'shop' not in headers or 'product' not in headers:
+            return
+        rows = [dict(zip(headers, values)) for values in dataset]
+        for start in range(0, len(rows), self._meta.batch_size):
+            keys = set()
+            for row in rows[start:start + self._meta.batch_size]:
+                try:
+                    keys.add(self.row_key(row))
+                except ValueError:
+                    # Reported against the row when it is imported
+                    continue
+            keys = {(shop_id, product_id) for shop_id, product_id in keys if shop_id and product_id}
+            if not keys:
+                continue
+            self.stocks.update({(stock.shop_id, stock.product_id): stock
+                                for stock in Stock.objects.filter(stock_filter(keys))})
+            self.products.update(Product.objects.in_bulk({product_id for _, product_id in keys}))
+
+    def get_instance(self, instance_loader, row):
+        return self.stocks.get(self.row_key(row))
+
+    def import_instance(self, instance, row, **kwargs):
+        super().import_instance(instance, row, **kwargs)
+        errors = {}
+        # Attach the preloaded shop and product, which str(instance) in the import result needs
+        if instance.shop_id in self.shops:
+            instance.shop = self.shops[instance.shop_id]
+        else:
+            errors['shop'] = f"Shop {instance.shop_id} does not exist."
+        if instance.product_id in self.products:
+            instance.product = self.products[instance.product_id]
+        else:
+            errors['product'] = f"Product {instance.product_id} does not exist."
+        key = (instance.shop_id, instance.product_id)
+        if key in self.seen_keys:
+            errors['product'] = "This shop and product appear more than once in the file."
+        self.seen_keys.add(key)
+        if errors:
+            raise ValidationError(errors)
+
+    def skip_row(self, instance, original, row, import_validation_errors=None):
+        if import_validation_errors or instance.pk is None:
+            return False
+        return not (instance.has_changed('quantity') or instance.has_changed('average_cost'))
+
+    def before_save_instance(self, instance, row, **kwargs):
+        if instance.pk is None or instance.has_changed('average_cost'):
+            instance.selling_price = calculate_selling_price(instance.average_cost, instance.product.profit_margin)
+
+    def bulk_create(self, using_transactions, dry_run, raise_errors, batch_size=None, result=None):
+        try:
+            if self.create_instances and (using_transactions or not dry_run):
+                movements = self.build_movements(self.create_instances)
+                Stock.objects.bulk_create(self.create_instances, batch_size=batch_size)
+                self.record_batch(self.create_instances, movements, created=True)
+        except Exception as e:
+            self.handle_import_error(result, e, raise_errors)
+        finally:
+            self.create_instances.clear()
+
+    def bulk_update(self, using_transactions, dry_run, raise_errors, batch_size=None, result=None):
+        try:
+            if self.update_instances and (using_transactions or not dry_run):
+                movements = self.build_movements(self.update_instances)
+                write_stock_rows(self.update_instances)
+                self.record_batch(self.update_instances, movements, created=False)
+        except Exception as e:
+            self.handle_import_error(result, e, raise_errors)
+        finally:
+            self.update_instances.clear()
+
+    def build_movements(self, stocks):
+        """Adjustment movements for a batch of rows, built from their loaded quantities before the write."""
+        return [
+            build_movement(stock.shop_id, stock.product_id, stock.quantity - (stock.original('quantity') or 0),
+                           StockMovement.ADJUSTMENT, unit_cost=stock.average_cost, note=IMPORT_REASON)
+            for stock in stocks
+        ]
+
+    def record_batch(self, stocks, movements, created):
+        """
+        Write history and ledger movements for a batch of imported rows and
+        refresh what is derived from them.
+        """
+        keys = {(stock.shop_id, stock.product_id) for stock in stocks}
+        # Read the rows back: bulk_create does not set primary keys on every backend
+        saved = list(Stock.objects.filter(stock_filter(keys)))
+        Stock.history.bulk_history_create(saved, update=not created, default_change_reason=IMPORT_REASON,
+                                          batch_size=self._meta.batch_size)
+        record_movements(movements)
+        stock_changed(keys)
+
+    def stream_csv(self, queryset, export_fields=None, encoding=None):
+        """
+        Yield the export as CSV, one line at a time, reading the queryset with
+        .iterator() so the whole export never sits in memory.
+
+        Args:
+            queryset: Stock rows to export
+            export_fields: Names of the fields to export, or None for all
+            encoding: Encode the lines to bytes with this encoding, if given
+        """
+        writer = csv.writer(_Echo())
+        encoder = codecs.getincrementalencoder(encoding)() if encoding else None
+        yield self._encode(encoder, writer.writerow(self.get_export_headers(selected_fields=export_fields)))
+        for stock in queryset.iterator(chunk_size=self.get_chunk_size()):
+            yield self._encode(encoder, writer.writerow(self.export_resource(stock, selected_fields=export_fields)))
+
+    @staticmethod
+    def _encode(encoder, line):
+        return encoder.encode(line) if encoder else line
@@ -1,16 +1,50 @@
 from django.contrib import admin
+from django.core.exceptions import PermissionDenied
+from django.http import StreamingHttpResponse
 from django.utils.html import format_html
-from django.db.models import Sum
+from django.db.models import Prefetch
 from django.urls import reverse
 from django.template.loader import render_to_string
 from unfold.contrib.import_export.forms import ExportForm, ImportForm
 from import_export.admin import ImportExportModelAdmin
+from import_export.formats.base_formats import CSV
+from import_export.signals import post_export
 
 from simple_history.admin import SimpleHistoryAdmin
 from unfold.admin import ModelAdmin
+from unfold.views import ChangeList
 
 from inventory.models.stock import Stock
+from product.models import Product
 from inventory.admin.filters import QuantityRangeFilter, PriceComparisonFilter
+from inventory.admin.resources import StockResource
+
+
+class ProductStockChangeList(ChangeList):
+    """
+    Stock changelist with one row per product.
+
+    Filters and search apply to individual Stock rows; the list then pages
+    over the products that have a matching row, so the database counts and
+    slices products through a plain semi-join instead of grouping the whole
+    Stock table. Only the visible page's products get their per-shop stock
+    prefetched, and their cross-shop totals come from the product stock
+    summary in the same query.
+    """
+
+    def get_queryset(self, request, exclude_parameters=None):
+        qs = super().get_queryset(request, exclude_parameters)
+        shop_stocks = Prefetch(
+            'stock_set',
+            queryset=Stock.objects.select_related('shop').order_by('shop__code'),
+            to_attr='shop_stocks',
+        )
+        return (
+            Product.objects.filter(pk__in=qs.order_by().values('product'))
+            .select_related('stock_summary')
+            .prefetch_related(shop_stocks)
+            .order_by('name', 'pk')
+        )
 
 
 @admin.register(Stock)
@@ -30,9 +64,12 @@ class StockAdmin(SimpleHistoryAdmin, ModelAdmin, ImportExportModelAdmin):
     readonly_fields = ('shop', 'product' )
     exclude = ('selling_price', )
     list_per_page = 20
+    ordering = ('product__name',)
+    show_full_result_count = False
     list_display_links = None  
     import_form_class = ImportForm
     export_form_class = ExportForm
+    resource_classes = [StockResource]
 
     def has_change_permission(self, request, obj=None):
         return True
@@ -43,27 +80,52 @@ class StockAdmin(SimpleHistoryAdmin, ModelAdmin, ImportExportModelAdmin):
     def has_add_permission(self, request):
         return False
 
-    def product_with_shops(self, obj):
-        stocks = Stock.objects.filter(product=obj.product).select_related('shop', 'product')
-        total_quantity = stocks.aggregate(total=Sum('quantity'))['total'] or 0
+    def get_changelist(self, request, **kwargs):
+        if getattr(request, 'exporting_stock', False):
+            return super().get_changelist(request, **kwargs)
+        return ProductStockChangeList
+
+    def get_export_queryset(self, request):
+        # Export every matching Stock row, not just one row per product
+        request.exporting_stock = True
+        return super().get_export_queryset(request)
+
+    def _do_file_export(self, file_format, request, queryset, export_form=None):
+        """Stream CSV exports line by line instead of building the whole file in memory."""
+        if not isinstance(file_format, CSV):
+            return super()._do_file_export(file_format, request, queryset, export_form=export_form)
+        if not self.has_export_permission(request):
+            raise PermissionDenied
+
+        resource_class = self.choose_export_resource_class(export_form, request)
+        resource = resource_class(**self.get_export_resource_kwargs(request, export_form=export_form))
+        export_fields = self.get_export_resource_fields_from_form(export_form)
+        response = StreamingHttpResponse(
+            resource.stream_csv(queryset, export_fields=export_fields, encoding=self.to_encoding),
+            content_type=file_format.get_content_type(),
+        )
+        response["Content-Disposition"] = 'attachment; filename="{}"'.format(
+            self.get_export_filename(request, queryset, file_format),
+        )
+        post_export.send(sender=None, model=self.model)
+        return response
+
+    def product_with_shops(self, product):
+        # The changelist lists products; see ProductStockChangeList
+        stocks = getattr(product, 'shop_stocks', None)
+        if stocks is None:
+            stocks = Stock.objects.filter(product=product).select_related('shop').order_by('shop__code')
+        summary = getattr(product, 'stock_summary', None)
+        if summary is not None:
+            total_quantity = summary.total_qty
+        else:
+            total_quantity = sum(stock.quantity for stock in stocks)
 
         context = {
-            'product': obj.product,
+            'product': product,
             'stocks': stocks,
             'total_quantity': total_quantity,
         }
 
         html = render_to_string('admin/inventory/product_with_shops.html', context)
         return format_html(html)
-    
-    def get_queryset(self, request):
-        qs = super().get_queryset(request)
-        products = set()
-        result_ids = []
-        all_stocks = Stock.objects.all().select_related('product').order_by('product__name', '-quantity')
-        for stock in all_stocks:
-            if stock.product.id not in products:
-                products.add(stock.product.id)
-                result_ids.append(stock.id)
-        return qs.filter(id__in=result_ids).order_by('product__name')
-
@@ -0,0 +1,99 @@
+from django import forms
+from django.contrib import admin, messages
+from django.core.exceptions import ValidationError
+from django.shortcuts import redirect
+from django.urls import reverse
+from django.utils.html import format_html
+from unfold.admin import ModelAdmin
+
+from inventory.models.stock_count import StockCount, StockCountLine
+from inventory.services.stock_counts import apply_stock_count, compute_variances, read_count_file, record_counts
+
+
+class StockCountForm(forms.ModelForm):
+    count_file = forms.FileField(
+        required=False,
+        help_text="CSV file with product (id) and counted_quantity columns. "
+                  "Products already counted are replaced.",
+    )
+
+    class Meta:
+        model = StockCount
+        fields = ('shop', 'note')
+
+
+@admin.register(StockCount)
+class StockCountAdmin(ModelAdmin):
+    form = StockCountForm
+    list_display = ('id', 'shop', 'status', 'note', 'created_at', 'applied_at', 'lines_link')
+    list_filter = ('status', 'shop', 'created_at')
+    search_fields = ('shop__name', 'note')
+    list_select_related = ('shop',)
+    readonly_fields = ('status', 'created_at', 'applied_at')
+    actions = ['compute_count_variances', 'apply_counts']
+    list_per_page = 20
+
+    def get_readonly_fields(self, request, obj=None):
+        if obj is not None:
+            return self.readonly_fields + ('shop',)
+        return self.readonly_fields
+
+    def has_change_permission(self, request, obj=None):
+        if obj is not None and not obj.is_open:
+            return False
+        return super().has_change_permission(request, obj)
+
+    def lines_link(self, obj):
+        url = reverse('admin:inventory_stockcountline_changelist') + f'?count__id__exact={obj.pk}'
+        return format_html('<a href="{}">Lines</a>', url)
+    lines_link.short_description = "Lines"
+
+    def save_model(self, request, obj, form, change):
+        super().save_model(request, obj, form, change)
+        count_file = form.cleaned_data.get('count_file')
+        if count_file:
+            recorded = record_counts(obj, read_count_file(count_file))
+            self.message_user(request, f"Recorded {recorded} counted quantities.")
+
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        try:
+            return super().changeform_view(request, object_id, form_url, extra_context)
+        except ValidationError as e:
+            # Raised while recording the uploaded counts; the save has been rolled back
+            self.message_user(request, " ".join(e.messages), level=messages.ERROR)
+            return redirect(request.get_full_path())
+
+    @admin.action(description="Compute variances")
+    def compute_count_variances(self, request, queryset):
+        for count in queryset.filter(status=StockCount.OPEN):
+            summary = compute_variances(count)
+            self.message_user(request, f"{count}: {summary['variances']} of {summary['lines']} lines differ, "
+                                       f"net variance {summary['net_variance']}.")
+
+    @admin.action(description="Apply approved counts to stock")
+    def apply_counts(self, request, queryset):
+        for count in queryset:
+            try:
+                adjusted = apply_stock_count(count)
+            except ValidationError as e:
+                self.message_user(request, f"{count}: {' '.join(e.messages)}", level=messages.ERROR)
+            else:
+                self.message_user(request, f"{count}: adjusted {adjusted} stock rows.")
+
+
+@admin.register(StockCountLine)
+class StockCountLineAdmin(ModelAdmin):
+    list_display = ('product', 'counted_quantity', 'expected_quantity', 'variance', 'approved')
+    list_editable = ('approved',)
+    list_filter = ('count', 'approved')
+    search_fields = ('product__name',)
+    list_select_related = ('product',)
+    list_per_page = 100
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        if obj is not None and not obj.count.is_open:
+            return False
+        return super().has_change_permission(request, obj)
@@ -0,0 +1,23 @@
+from django.contrib import admin
+from unfold.admin import ModelAdmin
+
+from inventory.models.stock_lot import StockLot
+
+
+@admin.register(StockLot)
+class StockLotAdmin(ModelAdmin):
+    list_display = ('received_at', 'shop', 'product', 'unit_cost', 'quantity', 'remaining_quantity', 'depleted')
+    list_filter = ('depleted', 'shop', 'received_at')
+    search_fields = ('product__name', 'shop__name')
+    list_select_related = ('shop', 'product')
+    date_hierarchy = 'received_at'
+    list_per_page = 50
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
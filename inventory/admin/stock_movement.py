@@ -0,0 +1,23 @@
+from django.contrib import admin
+from unfold.admin import ModelAdmin
+
+from inventory.models.stock_movement import StockMovement
+
+
+@admin.register(StockMovement)
+class StockMovementAdmin(ModelAdmin):
+    list_display = ('created_at', 'shop', 'product', 'movement_type', 'quantity', 'unit_cost', 'note')
+    list_filter = ('movement_type', 'shop', 'created_at')
+    search_fields = ('product__name', 'shop__name', 'note')
+    list_select_related = ('shop', 'product')
+    date_hierarchy = 'created_at'
+    list_per_page = 50
+
+    def has_add_permission(self, request):
+        return False
+
+    def has_change_permission(self, request, obj=None):
+        return False
+
+    def has_delete_permission(self, request, obj=None):
+        return False
@@ -8,7 +8,7 @@ class StockSerializer(serializers.ModelSerializer):
     
     class Meta:
         model = Stock
-        fields = ['product_id', 'product_name', 'product_code', 'quantity']
+        fields = ['product_id', 'product_name', 'product_code', 'quantity', 'reserved_quantity']
 
 class InventoryValueSerializer(serializers.ModelSerializer):
     product_name = serializers.CharField(source='product.name', read_only=True)
@@ -21,4 +21,46 @@ class InventoryValueSerializer(serializers.ModelSerializer):
     
     def get_inventory_value(self, obj):
         """Calculate inventory value as average_cost * quantity"""
-        return obj.average_cost * obj.quantity
\ No newline at end of file
+        return obj.average_cost * obj.quantity
+
+class StockTransferLineSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class BulkStockTransferSerializer(serializers.Serializer):
+    """One transfer of a bulk transfer request. Ids are checked against the database in bulk later."""
+    from_shop = serializers.IntegerField()
+    to_shop = serializers.IntegerField()
+    description = serializers.CharField(max_length=255, required=False, allow_blank=True, allow_null=True)
+    reference = serializers.CharField(max_length=255, required=False, allow_blank=True)
+    items = StockTransferLineSerializer(many=True, allow_empty=False)
+
+    def validate(self, data):
+        if data['from_shop'] == data['to_shop']:
+            raise serializers.ValidationError({"to_shop": "Cannot transfer stock to the same shop."})
+        return data
+
+
+class StockReservationLineSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1)
+
+
+class StockReservationSerializer(serializers.Serializer):
+    shop_id = serializers.IntegerField()
+    items = StockReservationLineSerializer(many=True, allow_empty=False)
+
+
+class StockCountSerializer(serializers.Serializer):
+    shop_id = serializers.IntegerField()
+    note = serializers.CharField(max_length=255, required=False, allow_blank=True)
+
+
+class StockCountLineSerializer(serializers.Serializer):
+    product_id = serializers.IntegerField()
+    counted_quantity = serializers.IntegerField(min_value=0)
+
+
+class StockCountLinesSerializer(serializers.Serializer):
+    lines = StockCountLineSerializer(many=True, allow_empty=False)
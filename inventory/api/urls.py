@@ -1,8 +1,15 @@
 from django.urls import path
 
-from inventory.api.views import InventoryValueAPI, StockAPI
+from inventory.api.views import (BulkStockTransferAPI, InventorySnapshotAPI, InventoryValueAPI, StockAPI,
+                                 StockCountAPI, StockCountApplyAPI, StockCountLinesAPI, StockReservationAPI)
 
 urlpatterns = [
     path('stock/', StockAPI.as_view(), name='stock-api'),
     path('inventory-value/', InventoryValueAPI.as_view(), name='inventory-value-api'),
+    path('stock-reservations/', StockReservationAPI.as_view(), name='stock-reservation-api'),
+    path('stock-transfers/bulk/', BulkStockTransferAPI.as_view(), name='bulk-stock-transfer-api'),
+    path('inventory-snapshot/', InventorySnapshotAPI.as_view(), name='inventory-snapshot-api'),
+    path('stock-counts/', StockCountAPI.as_view(), name='stock-count-api'),
+    path('stock-counts/<int:count_id>/lines/', StockCountLinesAPI.as_view(), name='stock-count-lines-api'),
+    path('stock-counts/<int:count_id>/apply/', StockCountApplyAPI.as_view(), name='stock-count-apply-api'),
 ]
\ No newline at end of file
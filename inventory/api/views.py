@@ -1,35 +1,87 @@
+import binascii
+import logging
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from decimal import Decimal, InvalidOperation
+
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Q, Sum
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.http import parse_etags, quote_etag
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 
-from inventory.api.serializers import StockSerializer
+from inventory.api.serializers import (BulkStockTransferSerializer, StockCountLinesSerializer, StockCountSerializer,
+                                       StockReservationSerializer, StockSerializer)
 from inventory.models.stock import Stock
+from inventory.models.stock_count import StockCount
+from inventory.models.stock_reservation import StockReservation
+from inventory.services.stock_counts import apply_stock_count, compute_variances, record_counts
+from inventory.services.inventory_cache import SNAPSHOT_TIMEOUT, snapshot_cache_key
+from inventory.services.stock_reservations import (RESERVATION_TTL, new_reservation_token, release_reservations,
+                                                   reserve_stock_lines)
+from inventory.services.stock_transfers import create_stock_transfers
+from inventory.services.stock_version import stock_version
+from shop.models import Shop
+from shop.permissions import forbidden_shops
+
+logger = logging.getLogger(__name__)
 
 class StockAPI(APIView):
     """
     API to get product stock information
+
+    Modes:
+        ``product_id``: one product
+        ``product_ids``: several products (comma-separated or repeated), from one query
+        neither: every product in the shop
+
+    Responses carry an ETag built from the shop's stock version, so a poll
+    with a matching If-None-Match gets a 304 without the stock being read.
     """
     def get(self, request):
         shop_id = request.query_params.get('shop_id')
         product_id = request.query_params.get('product_id')
-        
+        product_ids = request.query_params.getlist('product_ids')
+
         if not shop_id:
             return Response(
                 {'error': 'shop_id parameter is required'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        
+
+        try:
+            product_ids = [int(value) for values in product_ids for value in values.split(',') if value.strip()]
+        except ValueError:
+            return Response(
+                {'error': 'product_ids must be a comma-separated list of integers'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        etag = quote_etag(f"stock-{shop_id}-{stock_version(shop_id)}")
+        if etag in parse_etags(request.headers.get('If-None-Match', '')):
+            return Response(status=status.HTTP_304_NOT_MODIFIED, headers={'ETag': etag})
+
         if product_id:
             # Single product mode
             try:
-                stock = Stock.objects.get(shop_id=shop_id, product_id=product_id)
+                stock = Stock.objects.select_related('product').get(shop_id=shop_id, product_id=product_id)
                 serializer = StockSerializer(stock)
-                return Response(serializer.data)
+                data = serializer.data
             except Stock.DoesNotExist:
-                return Response(
-                    {'quantity': 0, 'product_id': product_id, 'product_name': 'Unknown', 'product_code': ''},
-                    status=status.HTTP_200_OK
-                )
+                data = {'quantity': 0, 'product_id': product_id, 'product_name': 'Unknown', 'product_code': ''}
+        elif product_ids:
+            # Bulk mode: the requested products only, missing ones at zero
+            stocks = Stock.objects.filter(shop_id=shop_id, product_id__in=product_ids).select_related('product')
+            serializer = StockSerializer(stocks, many=True)
+            data = {
+                requested: {'quantity': 0, 'product_id': requested, 'product_name': 'Unknown', 'product_code': ''}
+                for requested in product_ids
+            }
+            data.update({item['product_id']: item for item in serializer.data})
         else:
             # All products for shop mode
             stocks = Stock.objects.filter(shop_id=shop_id).select_related('product')
@@ -37,12 +89,23 @@ class StockAPI(APIView):
             
             # Convert to {product_id: quantity} format for frontend
             data = {item['product_id']: item for item in serializer.data}
-            return Response(data)
+
+        return Response(data, headers={'ETag': etag})
         
 class InventoryValueAPI(APIView):
     """
     API to get total inventory value information for all products (average_cost * quantity)
+
+    Products are returned one page at a time, ordered by inventory value
+    (``ordering=inventory_value`` or ``-inventory_value``, the default) and
+    paged with an opaque ``cursor`` taken from the previous page's
+    ``next_cursor``. The totals cover every product that matches the filters,
+    not just the page.
     """
+    DEFAULT_LIMIT = 100
+    MAX_LIMIT = 1000
+    ORDERINGS = ('inventory_value', '-inventory_value')
+
     def get(self, request):
         shop_id = request.query_params.get('shop_id')
         product_id = request.query_params.get('product_id')
@@ -50,57 +113,83 @@ class InventoryValueAPI(APIView):
         max_quantity = request.query_params.get('max_quantity')
         min_value = request.query_params.get('min_value')
         max_value = request.query_params.get('max_value')
-        
+        ordering = request.query_params.get('ordering', '-inventory_value')
+        cursor = request.query_params.get('cursor')
+
         if not shop_id:
             return Response(
                 {'error': 'shop_id parameter is required'},
                 status=status.HTTP_400_BAD_REQUEST
             )
-        
-        # Start with base query for the shop
-        query = Stock.objects.filter(shop_id=shop_id).select_related('product', 'shop')
-        
+
+        if ordering not in self.ORDERINGS:
+            return Response(
+                {'error': f"ordering must be one of: {', '.join(self.ORDERINGS)}"},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        try:
+            limit = min(max(int(request.query_params.get('limit', self.DEFAULT_LIMIT)), 1), self.MAX_LIMIT)
+        except ValueError:
+            limit = self.DEFAULT_LIMIT
+
+        # Start with base query for the shop, valued in the database
+        query = Stock.objects.filter(shop_id=shop_id).annotate(inventory_value=inventory_value_expression())
+
         # Apply filters if provided
         if product_id:
             query = query.filter(product_id=product_id)
-        
+
         if min_quantity:
             try:
                 query = query.filter(quantity__gte=int(min_quantity))
             except ValueError:
                 pass
-                
+
         if max_quantity:
             try:
                 query = query.filter(quantity__lte=int(max_quantity))
             except ValueError:
                 pass
-        
-        # Get all filtered products for the shop
-        stocks = list(query)
-        
-        # Apply value-based filters (need to be done in Python since it's a computed value)
-        if min_value or max_value:
-            filtered_stocks = []
-            for stock in stocks:
-                value = stock.average_cost * stock.quantity
-                
-                if min_value and value < float(min_value):
-                    continue
-                    
-                if max_value and value > float(max_value):
-                    continue
-                    
-                filtered_stocks.append(stock)
-            
-            stocks = filtered_stocks
-        
-        # Calculate total inventory value
-        total_value = sum(stock.average_cost * stock.quantity for stock in stocks)
-        
+
+        if min_value:
+            try:
+                query = query.filter(inventory_value__gte=Decimal(min_value))
+            except InvalidOperation:
+                pass
+
+        if max_value:
+            try:
+                query = query.filter(inventory_value__lte=Decimal(max_value))
+            except InvalidOperation:
+                pass
+
+        # Totals for everything that matched, independent of the page
+        totals = query.aggregate(total_value=Sum('inventory_value'), total_products=Count('pk'))
+
+        # Keyset pagination on (inventory_value, id)
+        descending = ordering.startswith('-')
+        page = query
+        if cursor:
+            try:
+                last_value, last_id = decode_value_cursor(cursor)
+            except ValueError:
+                return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+            if descending:
+                page = page.filter(Q(inventory_value__lt=last_value) | Q(inventory_value=last_value, id__lt=last_id))
+            else:
+                page = page.filter(Q(inventory_value__gt=last_value) | Q(inventory_value=last_value, id__gt=last_id))
+        order = ('-inventory_value', '-id') if descending else ('inventory_value', 'id')
+        stocks = list(page.select_related('product').order_by(*order)[:limit + 1])
+
+        next_cursor = None
+        if len(stocks) > limit:
+            stocks = stocks[:limit]
+            next_cursor = encode_value_cursor(stocks[-1].inventory_value, stocks[-1].id)
+
         # Get shop name
-        shop_name = stocks[0].shop.name if stocks else "Unknown Shop"
-        
+        shop_name = Shop.objects.filter(pk=shop_id).values_list('name', flat=True).first() or "Unknown Shop"
+
         # Get individual product inventory values
         product_values = []
         for stock in stocks:
@@ -111,13 +200,374 @@ class InventoryValueAPI(APIView):
                 'quantity': stock.quantity,
                 'average_cost': str(stock.average_cost),
                 'selling_price': str(stock.selling_price),
-                'inventory_value': str(stock.average_cost * stock.quantity)
+                'inventory_value': str(stock.inventory_value)
             })
-        
+
         return Response({
-            'total_inventory_value': str(total_value),
+            'total_inventory_value': str(totals['total_value'] or Decimal('0.00')),
             'products': product_values,
             'shop_id': shop_id,
             'shop_name': shop_name,
-            'total_products': len(product_values)
-        })
\ No newline at end of file
+            'total_products': totals['total_products'],
+            'next_cursor': next_cursor,
+        })
+
+
+class InventorySnapshotAPI(APIView):
+    """
+    API to get the inventory of every shop in one request
+
+    Returns per-shop and overall totals plus one page of stock rows across all
+    shops (or one shop with ``shop_id``), ordered by inventory value and paged
+    with ``cursor``/``next_cursor`` like InventoryValueAPI. Responses are cached
+    until the next stock change.
+    """
+    permission_classes = [IsAuthenticated]
+
+    DEFAULT_LIMIT = 500
+    MAX_LIMIT = 1000
+
+    def get(self, request):
+        shop_id = request.query_params.get('shop_id') or ''
+        cursor = request.query_params.get('cursor') or ''
+
+        if shop_id:
+            try:
+                shop_id = str(int(shop_id))
+            except ValueError:
+                return Response(
+                    {'error': 'shop_id must be an integer'},
+                    status=status.HTTP_400_BAD_REQUEST
+                )
+
+        try:
+            limit = min(max(int(request.query_params.get('limit', self.DEFAULT_LIMIT)), 1), self.MAX_LIMIT)
+        except ValueError:
+            limit = self.DEFAULT_LIMIT
+
+        key = snapshot_cache_key(shop_id, limit, cursor)
+        data = cache.get(key)
+        if data is None:
+            try:
+                data = self.build_snapshot(shop_id, limit, cursor)
+            except ValueError:
+                return Response({'error': 'Invalid cursor'}, status=status.HTTP_400_BAD_REQUEST)
+            cache.set(key, data, SNAPSHOT_TIMEOUT)
+        return Response(data)
+
+    def build_snapshot(self, shop_id, limit, cursor):
+        """Build the response body from one grouped totals query and one page query."""
+        value = inventory_value_expression()
+        stocks = Stock.objects.all()
+        if shop_id:
+            stocks = stocks.filter(shop_id=shop_id)
+
+        # Per-shop totals in one grouped query
+        totals = {
+            row['shop_id']: row
+            for row in stocks.values('shop_id')
+                             .annotate(total_value=Sum(value), total_products=Count('pk'))
+                             .order_by()
+        }
+        shops = Shop.objects.order_by('name')
+        if shop_id:
+            shops = shops.filter(pk=shop_id)
+        shop_values = []
+        for shop in shops:
+            shop_totals = totals.get(shop.pk, {})
+            shop_values.append({
+                'id': shop.pk,
+                'name': shop.name,
+                'code': shop.code,
+                'is_warehouse': shop.is_warehouse,
+                'total_inventory_value': str(shop_totals.get('total_value') or Decimal('0.00')),
+                'total_products': shop_totals.get('total_products', 0),
+            })
+
+        # One page of stock rows across the shops, keyset-paged by value
+        page = stocks.annotate(inventory_value=value)
+        if cursor:
+            last_value, last_id = decode_value_cursor(cursor)
+            page = page.filter(Q(inventory_value__lt=last_value) | Q(inventory_value=last_value, id__lt=last_id))
+        rows = list(page.select_related('product', 'shop').order_by('-inventory_value', '-id')[:limit + 1])
+
+        next_cursor = None
+        if len(rows) > limit:
+            rows = rows[:limit]
+            next_cursor = encode_value_cursor(rows[-1].inventory_value, rows[-1].id)
+
+        product_values = []
+        for stock in rows:
+            product_values.append({
+                'id': stock.id,
+                'shop_id': str(stock.shop_id),
+                'shop_name': stock.shop.name,
+                'product_id': stock.product_id,
+                'product_name': stock.product.name,
+                'quantity': stock.quantity,
+                'average_cost': str(stock.average_cost),
+                'selling_price': str(stock.selling_price),
+                'inventory_value': str(stock.inventory_value)
+            })
+
+        return {
+            'total_inventory_value': str(sum((row['total_value'] or Decimal('0.00') for row in totals.values()),
+                                             Decimal('0.00'))),
+            'total_products': sum(row['total_products'] for row in totals.values()),
+            'shops': shop_values,
+            'products': product_values,
+            'next_cursor': next_cursor,
+        }
+
+
+class BulkStockTransferAPI(APIView):
+    """
+    API to create many stock transfers in one request
+
+    Accepts ``{"transfers": [{"from_shop", "to_shop", "description", "reference",
+    "items": [{"product", "quantity"}]}]}`` and answers with one result per
+    transfer, in request order. Valid transfers are created and posted even if
+    others in the batch are rejected. A transfer is rejected unless the user
+    has the ``shop.view_shop`` permission on both of its shops.
+    """
+    permission_classes = [IsAuthenticated]
+    MAX_TRANSFERS = 1000
+
+    def post(self, request):
+        transfers = request.data.get('transfers') if isinstance(request.data, dict) else None
+        if not isinstance(transfers, list) or not transfers:
+            return Response(
+                {'error': 'transfers must be a non-empty list'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(transfers) > self.MAX_TRANSFERS:
+            return Response(
+                {'error': f'At most {self.MAX_TRANSFERS} transfers can be sent in one request'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        results = [None] * len(transfers)
+        valid = []
+        for index, transfer in enumerate(transfers):
+            serializer = BulkStockTransferSerializer(data=transfer)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                results[index] = {'errors': serializer.errors}
+
+        forbidden = set(forbidden_shops(request.user, [data[field] for index, data in valid
+                                                       for field in ('from_shop', 'to_shop')]))
+        if forbidden:
+            allowed = []
+            for index, data in valid:
+                denied = [data[field] for field in ('from_shop', 'to_shop') if data[field] in forbidden]
+                if denied:
+                    results[index] = {'errors': [f"You do not have permission to move stock in shop {shop_id}"
+                                                 for shop_id in denied]}
+                else:
+                    allowed.append((index, data))
+            valid = allowed
+
+        if valid:
+            posted = create_stock_transfers([data for index, data in valid], logger)
+            for (index, data), result in zip(valid, posted):
+                results[index] = result
+
+        response = []
+        for index, (transfer, result) in enumerate(zip(transfers, results)):
+            reference = transfer.get('reference') if isinstance(transfer, dict) else None
+            response.append({
+                'index': index,
+                'reference': reference,
+                'status': 'created' if 'transfer_id' in result else 'rejected',
+                **result,
+            })
+
+        created = sum(1 for result in response if result['status'] == 'created')
+        if created == len(response):
+            response_status = status.HTTP_201_CREATED
+        elif created:
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({'created': created, 'rejected': len(response) - created, 'results': response},
+                        status=response_status)
+
+
+class StockReservationAPI(APIView):
+    """
+    API to hold stock for a sale until it is checked out
+
+    POST ``{"shop_id", "items": [{"product_id", "quantity"}]}`` reserves every
+    line or none of them and returns the reservation token, which the sale
+    passes on when it is committed. DELETE ``?token=`` releases the stock
+    again. Reservations that are neither consumed nor released expire.
+    Both need the ``shop.view_shop`` permission on the reservation's shop.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = StockReservationSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        if forbidden_shops(request.user, [data['shop_id']]):
+            return Response(
+                {'error': f"You do not have permission to reserve stock in shop {data['shop_id']}"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        token = new_reservation_token()
+        shortages = reserve_stock_lines(data['shop_id'],
+                                        [(item['product_id'], item['quantity']) for item in data['items']], token)
+        if shortages:
+            return Response(
+                {'error': 'Insufficient stock',
+                 'available': [{'product_id': product_id, 'available': available}
+                               for product_id, available in shortages.items()]},
+                status=status.HTTP_409_CONFLICT
+            )
+        return Response({'token': token, 'expires_at': timezone.now() + RESERVATION_TTL},
+                        status=status.HTTP_201_CREATED)
+
+    def delete(self, request):
+        token = request.query_params.get('token')
+        if not token:
+            return Response(
+                {'error': 'token parameter is required'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        shop_ids = StockReservation.objects.filter(token=token).values_list('shop_id', flat=True).distinct()
+        forbidden = forbidden_shops(request.user, shop_ids)
+        if forbidden:
+            return Response(
+                {'error': f"You do not have permission to release stock in shop {forbidden[0]}"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        release_reservations(token)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+def shop_forbidden_response(user, shop_id):
+    """A 403 response if the user has no ``shop.view_shop`` permission on the shop, else None."""
+    if forbidden_shops(user, [shop_id]):
+        return Response({'error': f"You do not have permission to count stock in shop {shop_id}"},
+                        status=status.HTTP_403_FORBIDDEN)
+    return None
+
+
+class StockCountAPI(APIView):
+    """
+    API to open a stock count of one shop
+
+    POST ``{"shop_id", "note"}`` creates the count and returns its id.
+    Counted quantities are then posted in batches to the count's lines
+    endpoint and applied with its apply endpoint. All three endpoints need
+    the ``shop.view_shop`` permission on the count's shop.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def post(self, request):
+        serializer = StockCountSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        if not Shop.objects.filter(pk=data['shop_id']).exists():
+            return Response({'error': f"Shop {data['shop_id']} does not exist"}, status=status.HTTP_400_BAD_REQUEST)
+        forbidden = shop_forbidden_response(request.user, data['shop_id'])
+        if forbidden:
+            return forbidden
+        count = StockCount.objects.create(shop_id=data['shop_id'], note=data.get('note', ''))
+        return Response({'id': count.pk, 'shop_id': count.shop_id, 'status': count.status},
+                        status=status.HTTP_201_CREATED)
+
+
+class StockCountLinesAPI(APIView):
+    """
+    API to post counted quantities to an open stock count
+
+    POST ``{"lines": [{"product_id", "counted_quantity"}]}``. Batches may be
+    posted one after another; a product counted again replaces its earlier
+    count. A batch is recorded completely or not at all.
+    """
+    permission_classes = [IsAuthenticated]
+    MAX_LINES = 5000
+
+    def post(self, request, count_id):
+        count = get_object_or_404(StockCount, pk=count_id)
+        forbidden = shop_forbidden_response(request.user, count.shop_id)
+        if forbidden:
+            return forbidden
+        serializer = StockCountLinesSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        lines = serializer.validated_data['lines']
+        if len(lines) > self.MAX_LINES:
+            return Response(
+                {'error': f'At most {self.MAX_LINES} lines can be sent in one request'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        try:
+            recorded = record_counts(count, [(line['product_id'], line['counted_quantity']) for line in lines])
+        except ValidationError as e:
+            return Response({'error': ' '.join(e.messages)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'recorded': recorded})
+
+
+class StockCountApplyAPI(APIView):
+    """
+    API to review and apply a stock count
+
+    GET compares the count with the shop's current stock and returns the
+    variance totals. POST sets the shop's stock to the approved counted
+    quantities and closes the count.
+    """
+    permission_classes = [IsAuthenticated]
+
+    def get(self, request, count_id):
+        count = get_object_or_404(StockCount, pk=count_id)
+        forbidden = shop_forbidden_response(request.user, count.shop_id)
+        if forbidden:
+            return forbidden
+        if not count.is_open:
+            return Response({'error': 'This stock count has already been applied.'},
+                            status=status.HTTP_400_BAD_REQUEST)
+        return Response(compute_variances(count))
+
+    def post(self, request, count_id):
+        count = get_object_or_404(StockCount, pk=count_id)
+        forbidden = shop_forbidden_response(request.user, count.shop_id)
+        if forbidden:
+            return forbidden
+        try:
+            adjusted = apply_stock_count(count)
+        except ValidationError as e:
+            return Response({'error': ' '.join(e.messages)}, status=status.HTTP_400_BAD_REQUEST)
+        return Response({'adjusted': adjusted})
+
+
+def inventory_value_expression():
+    """SQL expression for a Stock row's inventory value, average_cost * quantity."""
+    return ExpressionWrapper(F('average_cost') * F('quantity'),
+                             output_field=DecimalField(max_digits=14, decimal_places=2))
+
+
+def encode_value_cursor(value, stock_id):
+    """Opaque cursor pointing just after the given (inventory_value, id) position."""
+    return urlsafe_b64encode(f"{value}|{stock_id}".encode()).decode()
+
+
+def decode_value_cursor(cursor):
+    """
+    Decode a cursor made by encode_value_cursor.
+
+    Raises:
+        ValueError: If the cursor is malformed
+    """
+    try:
+        value, stock_id = urlsafe_b64decode(cursor.encode()).decode().split('|')
+        return Decimal(value), int(stock_id)
+    except (InvalidOperation, UnicodeDecodeError, binascii.Error, TypeError) as error:
+        raise ValueError(f"Invalid cursor: {cursor}") from error
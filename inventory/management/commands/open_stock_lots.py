@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from inventory.services.stock_lots import open_stock_lots
+
+
+class Command(BaseCommand):
+    help = ("Create opening FIFO lots for stock that no open lot covers, at each stock row's "
+            "average cost. Run once when switching INVENTORY_COSTING_METHOD to 'fifo'.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--batch-size',
+            type=int,
+            default=1000,
+            help="Number of lots inserted per query (default: 1000)",
+        )
+
+    def handle(self, *args, **options):
+        count = open_stock_lots(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f"Created {count} opening stock lots"))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from inventory.services.stock_summary import rebuild_product_summaries
+
+
+class Command(BaseCommand):
+    help = ("Rebuild every product's cross-shop stock summary (total quantity, total value, "
+            "shops in stock, last movement) from the Stock rows and the movement ledger.")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help="Number of products rebuilt per transaction (default: 1000)",
+        )
+
+    def handle(self, *args, **options):
+        count = rebuild_product_summaries(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"Rebuilt stock summaries for {count} products"))
@@ -0,0 +1,20 @@
+from django.core.management.base import BaseCommand
+
+from inventory.services.stock_reservations import release_expired_reservations
+
+
+class Command(BaseCommand):
+    help = ("Release stock reservations whose time to live has passed, making the stock "
+            "available again. Run every few minutes (e.g. from cron).")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--chunk-size',
+            type=int,
+            default=1000,
+            help="Number of reservations released per transaction (default: 1000)",
+        )
+
+    def handle(self, *args, **options):
+        count = release_expired_reservations(chunk_size=options['chunk_size'])
+        self.stdout.write(self.style.SUCCESS(f"Released {count} expired stock reservations"))
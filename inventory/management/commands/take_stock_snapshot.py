@@ -0,0 +1,43 @@
+from datetime import datetime, time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from inventory.services.stock_ledger import take_snapshot
+
+
+class Command(BaseCommand):
+    help = ("Snapshot every shop's stock level so point-in-time stock queries only scan "
+            "the movements recorded since. Run periodically (e.g. nightly from cron).")
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            '--at',
+            help="Date or datetime to snapshot (ISO format), not in the future. "
+                 "Defaults to the start of today.",
+        )
+
+    def handle(self, *args, **options):
+        at = self.parse_at(options['at'])
+        try:
+            count = take_snapshot(at)
+        except ValueError as e:
+            raise CommandError(str(e))
+        if count:
+            self.stdout.write(self.style.SUCCESS(f"Snapshot of {count} stock rows taken at {at}"))
+        else:
+            self.stdout.write(f"Nothing to snapshot at {at} (already taken, or no stock)")
+
+    def parse_at(self, value):
+        if not value:
+            return timezone.make_aware(datetime.combine(timezone.localdate(), time.min))
+        at = parse_datetime(value)
+        if at is None:
+            day = parse_date(value)
+            if day is None:
+                raise CommandError(f"Invalid date or datetime: {value}")
+            at = datetime.combine(day, time.min)
+        if timezone.is_naive(at):
+            at = timezone.make_aware(at)
+        return at
@@ -0,0 +1,52 @@
+# Generated by Django 5.2 on 2026-10-17 02:20
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('contenttypes', '0002_remove_content_type_name'),
+        ('inventory', '0006_alter_stock_options_alter_stocktransfer_options'),
+        ('product', '0006_alter_category_options_alter_product_options'),
+        ('shop', '0006_alter_shop_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockMovement',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField()),
+                ('unit_cost', models.DecimalField(blank=True, decimal_places=2, max_digits=10, null=True)),
+                ('movement_type', models.CharField(choices=[('sale', 'Sale'), ('purchase', 'Purchase'), ('transfer', 'Transfer'), ('adjustment', 'Adjustment')], default='adjustment', max_length=10)),
+                ('object_id', models.PositiveIntegerField(blank=True, null=True)),
+                ('note', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('content_type', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='contenttypes.contenttype')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_movements', to='product.product')),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_movements', to='shop.shop')),
+            ],
+            options={
+                'ordering': ['-created_at', '-id'],
+                'permissions': [('can_view_icon_stock_movement', 'Can view icon stock movement')],
+                'indexes': [models.Index(fields=['shop', 'product', 'created_at'], name='inventory_s_shop_id_384226_idx'), models.Index(fields=['created_at'], name='inventory_s_created_05ebf5_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockSnapshot',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.IntegerField()),
+                ('taken_at', models.DateTimeField()),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_snapshots', to='product.product')),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_snapshots', to='shop.shop')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['taken_at'], name='inventory_s_taken_a_f1ea29_idx')],
+                'unique_together': {('shop', 'product', 'taken_at')},
+            },
+        ),
+    ]
@@ -0,0 +1,30 @@
+# Generated by Django 5.2 on 2026-10-17 02:29
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0007_stockmovement_stocksnapshot'),
+        ('product', '0006_alter_category_options_alter_product_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ProductStockSummary',
+            fields=[
+                ('product', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock_summary', serialize=False, to='product.product')),
+                ('total_qty', models.IntegerField(default=0)),
+                ('total_value', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('shops_in_stock', models.PositiveIntegerField(default=0)),
+                ('last_movement_at', models.DateTimeField(blank=True, null=True)),
+                ('updated_at', models.DateTimeField(auto_now=True)),
+            ],
+            options={
+                'verbose_name_plural': 'Product stock summaries',
+                'indexes': [models.Index(fields=['total_qty'], name='inventory_p_total_q_7d99c9_idx')],
+            },
+        ),
+    ]
@@ -0,0 +1,22 @@
+# Generated by Django 5.2 on 2026-10-17 02:33
+
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0008_productstocksummary'),
+        ('shop', '0006_alter_shop_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockVersion',
+            fields=[
+                ('shop', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='stock_version', serialize=False, to='shop.shop')),
+                ('version', models.PositiveBigIntegerField(default=0)),
+            ],
+        ),
+    ]
@@ -0,0 +1,42 @@
+# Generated by Django 5.2 on 2026-10-17 02:40
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0009_stockversion'),
+        ('product', '0006_alter_category_options_alter_product_options'),
+        ('shop', '0006_alter_shop_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalstock',
+            name='reserved_quantity',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='stock',
+            name='reserved_quantity',
+            field=models.IntegerField(default=0),
+        ),
+        migrations.CreateModel(
+            name='StockReservation',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('quantity', models.PositiveIntegerField()),
+                ('token', models.CharField(db_index=True, max_length=64)),
+                ('expires_at', models.DateTimeField(db_index=True)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_reservations', to='product.product')),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_reservations', to='shop.shop')),
+            ],
+            options={
+                'permissions': [('can_view_icon_stock_reservation', 'Can view icon stock reservation')],
+            },
+        ),
+    ]
@@ -0,0 +1,46 @@
+# Generated by Django 5.2 on 2026-10-17 02:59
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('inventory', '0010_stock_reservations'),
+        ('product', '0006_alter_category_options_alter_product_options'),
+        ('shop', '0006_alter_shop_options'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='StockCount',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('status', models.CharField(choices=[('open', 'Open'), ('applied', 'Applied')], default='open', max_length=10)),
+                ('note', models.CharField(blank=True, max_length=255)),
+                ('created_at', models.DateTimeField(default=django.utils.timezone.now)),
+                ('applied_at', models.DateTimeField(blank=True, null=True)),
+                ('shop', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_counts', to='shop.shop')),
+            ],
+            options={
+                'ordering': ['-created_at', '-id'],
+                'permissions': [('can_view_icon_stock_count', 'Can view icon stock count')],
+            },
+        ),
+        migrations.CreateModel(
+            name='StockCountLine',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('counted_quantity', models.PositiveIntegerField()),
+                ('expected_quantity', models.IntegerField(blank=True, null=True)),
+                ('approved', models.BooleanField(default=True)),
+                ('count', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='lines', to='inventory.stockcount')),
+                ('product', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='stock_count_lines', to='product.product')),
+            ],
+            options={
+                'unique_together': {('count', 'product')},
+            },
+        ),
+    ]
@@ -1,2 +1,8 @@
 from .stock import Stock
 from .stock_transfers import StockTransfer, StockTransferItem
+from .stock_movement import StockMovement, StockSnapshot
+from .product_stock_summary import ProductStockSummary
+from .stock_version import StockVersion
+from .stock_reservation import StockReservation
+from .stock_count import StockCount, StockCountLine
+from .stock_lot import StockLot, StockLotConsumption
@@ -0,0 +1,27 @@
+from django.db import models
+
+
+class ProductStockSummary(models.Model):
+    """
+    Cross-shop stock totals for one product.
+
+    Recomputed from the product's Stock rows once the transaction that
+    changes them commits, so a product's total quantity and inventory value
+    is a single-row read. Rebuild with the rebuild_stock_summaries command.
+    """
+    product = models.OneToOneField('product.Product', on_delete=models.CASCADE, primary_key=True,
+                                   related_name='stock_summary')
+    total_qty = models.IntegerField(default=0)
+    total_value = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+    shops_in_stock = models.PositiveIntegerField(default=0)
+    last_movement_at = models.DateTimeField(blank=True, null=True)
+    updated_at = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        verbose_name_plural = "Product stock summaries"
+        indexes = [
+            models.Index(fields=['total_qty']),
+        ]
+
+    def __str__(self):
+        return f"Product {self.product_id}: {self.total_qty} in {self.shops_in_stock} shops"
@@ -2,10 +2,14 @@ from django.db import models
 from decimal import Decimal
 from simple_history.models import HistoricalRecords
 
-class Stock(models.Model):
+from utils import FieldTrackerMixin
+from .stock_movement import StockMovement
+
+class Stock(FieldTrackerMixin, models.Model):
     shop = models.ForeignKey('shop.Shop', on_delete=models.CASCADE)
     product = models.ForeignKey('product.Product', on_delete=models.CASCADE)
     quantity = models.IntegerField(default=0)
+    reserved_quantity = models.IntegerField(default=0)
     average_cost = models.DecimalField(max_digits=10, decimal_places=2)
     selling_price = models.DecimalField(max_digits=10, decimal_places=2)
     history = HistoricalRecords()
@@ -19,6 +23,11 @@ class Stock(models.Model):
     def __str__(self):
         return f"{self.shop.name} - {self.product.name} ({self.quantity})"
 
+    @property
+    def available_quantity(self):
+        """Quantity not held by an open stock reservation."""
+        return self.quantity - self.reserved_quantity
+
     def update_stock(self, quantity_change):
         self.quantity += quantity_change
         self.save()
@@ -32,15 +41,26 @@ class Stock(models.Model):
         except Exception:
             return self.selling_price
     
-    def save(self, *args, **kwargs):
+    def save(self, *args, record_movement=True, **kwargs):
+        """
+        Save the stock row, recording any quantity change as an adjustment in
+        the stock movement ledger. Callers that record their own movement
+        (the stock posting service) pass record_movement=False.
+        """
+        old_quantity = 0
         if self.pk:
-            try:
-                old_instance = Stock.objects.get(pk=self.pk)
-                if old_instance.average_cost != self.average_cost:
-                    self.selling_price = self.calculate_selling_price()
-            except Stock.DoesNotExist:
-                self.selling_price = self.calculate_selling_price()
-        else:
+            old_quantity = self.original('quantity') or 0
+        if self.has_changed('average_cost'):
             self.selling_price = self.calculate_selling_price()
 
-        super().save(*args, **kwargs)
\ No newline at end of file
+        super().save(*args, **kwargs)
+
+        if record_movement and self.quantity != old_quantity:
+            StockMovement.objects.create(
+                shop_id=self.shop_id,
+                product_id=self.product_id,
+                quantity=self.quantity - old_quantity,
+                movement_type=StockMovement.ADJUSTMENT,
+                unit_cost=self.average_cost,
+                note="Stock adjusted",
+            )
\ No newline at end of file
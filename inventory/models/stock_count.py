@@ -0,0 +1,65 @@
+from django.db import models
+from django.utils import timezone
+
+
+class StockCount(models.Model):
+    """
+    A stocktake of one shop.
+
+    Counted quantities are loaded as lines while the count is open, compared
+    with the shop's Stock rows to find the variances, and applied in one go,
+    after which the count is closed.
+    """
+    OPEN = 'open'
+    APPLIED = 'applied'
+    STATUS_CHOICES = [
+        (OPEN, 'Open'),
+        (APPLIED, 'Applied'),
+    ]
+
+    shop = models.ForeignKey('shop.Shop', on_delete=models.CASCADE, related_name='stock_counts')
+    status = models.CharField(max_length=10, choices=STATUS_CHOICES, default=OPEN)
+    note = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+    applied_at = models.DateTimeField(blank=True, null=True)
+
+    class Meta:
+        ordering = ['-created_at', '-id']
+        permissions = [
+            ("can_view_icon_stock_count", "Can view icon stock count"),
+        ]
+
+    def __str__(self):
+        return f"Stock count #{self.pk} of shop {self.shop_id} ({self.get_status_display()})"
+
+    @property
+    def is_open(self):
+        return self.status == self.OPEN
+
+
+class StockCountLine(models.Model):
+    """
+    Counted quantity of one product in a stock count.
+
+    expected_quantity is the Stock quantity the count was last compared with;
+    it is empty until the variances are computed. Lines that are not approved
+    are left out when the count is applied.
+    """
+    count = models.ForeignKey(StockCount, on_delete=models.CASCADE, related_name='lines')
+    product = models.ForeignKey('product.Product', on_delete=models.CASCADE, related_name='stock_count_lines')
+    counted_quantity = models.PositiveIntegerField()
+    expected_quantity = models.IntegerField(blank=True, null=True)
+    approved = models.BooleanField(default=True)
+
+    class Meta:
+        unique_together = ('count', 'product')
+
+    def __str__(self):
+        return f"Product {self.product_id}: counted {self.counted_quantity}"
+
+    @property
+    def variance(self):
+        """Counted minus expected quantity, or None before the variances are computed."""
+        if self.expected_quantity is None:
+            return None
+        return self.counted_quantity - self.expected_quantity
@@ -0,0 +1,61 @@
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.utils import timezone
+
+
+class StockLot(models.Model):
+    """
+    A quantity of a product received into a shop at one unit cost, for FIFO
+    costing (settings.INVENTORY_COSTING_METHOD = 'fifo').
+
+    Lots are consumed oldest first. Lots with nothing left are flagged
+    depleted, so the (shop, product, depleted, id) index leads a FIFO read
+    straight to the open lots, however many lots a product has had.
+    """
+    shop = models.ForeignKey('shop.Shop', on_delete=models.CASCADE, related_name='stock_lots')
+    product = models.ForeignKey('product.Product', on_delete=models.CASCADE, related_name='stock_lots')
+    unit_cost = models.DecimalField(max_digits=10, decimal_places=2)
+    quantity = models.IntegerField()
+    remaining_quantity = models.IntegerField()
+    depleted = models.BooleanField(default=False)
+    content_type = models.ForeignKey(ContentType, on_delete=models.SET_NULL, blank=True, null=True)
+    object_id = models.PositiveIntegerField(blank=True, null=True)
+    source = GenericForeignKey('content_type', 'object_id')
+    received_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['shop', 'product', 'depleted', 'id'], name='inventory_stocklot_fifo'),
+            models.Index(fields=['content_type', 'object_id'], name='inventory_stocklot_source'),
+        ]
+
+    def __str__(self):
+        return (f"{self.remaining_quantity}/{self.quantity} of product {self.product_id} "
+                f"at shop {self.shop_id} @ {self.unit_cost}")
+
+
+class StockLotConsumption(models.Model):
+    """
+    Quantity a sale or transfer took from a stock lot, at the lot's unit cost.
+
+    Consumption that no lot could cover (stock that predates FIFO costing)
+    has no lot and is valued at the stock row's average cost.
+    """
+    lot = models.ForeignKey(StockLot, on_delete=models.CASCADE, blank=True, null=True, related_name='consumptions')
+    shop = models.ForeignKey('shop.Shop', on_delete=models.CASCADE, related_name='stock_lot_consumptions')
+    product = models.ForeignKey('product.Product', on_delete=models.CASCADE, related_name='stock_lot_consumptions')
+    quantity = models.IntegerField()
+    unit_cost = models.DecimalField(max_digits=10, decimal_places=2)
+    content_type = models.ForeignKey(ContentType, on_delete=models.SET_NULL, blank=True, null=True)
+    object_id = models.PositiveIntegerField(blank=True, null=True)
+    source = GenericForeignKey('content_type', 'object_id')
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['content_type', 'object_id'], name='inventory_lotconsumption_src'),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} of product {self.product_id} at shop {self.shop_id} @ {self.unit_cost}"
@@ -0,0 +1,77 @@
+from django.contrib.contenttypes.fields import GenericForeignKey
+from django.contrib.contenttypes.models import ContentType
+from django.db import models
+from django.utils import timezone
+
+
+class StockMovement(models.Model):
+    """
+    Append-only ledger of every change to a Stock quantity.
+
+    The source points at whatever caused the movement (sales item, purchase
+    item, transfer item, ...). Manual adjustments may have no source.
+    """
+    SALE = 'sale'
+    PURCHASE = 'purchase'
+    TRANSFER = 'transfer'
+    ADJUSTMENT = 'adjustment'
+    MOVEMENT_TYPE_CHOICES = [
+        (SALE, 'Sale'),
+        (PURCHASE, 'Purchase'),
+        (TRANSFER, 'Transfer'),
+        (ADJUSTMENT, 'Adjustment'),
+    ]
+
+    shop = models.ForeignKey('shop.Shop', on_delete=models.CASCADE, related_name='stock_movements')
+    product = models.ForeignKey('product.Product', on_delete=models.CASCADE, related_name='stock_movements')
+    quantity = models.IntegerField()
+    unit_cost = models.DecimalField(max_digits=10, decimal_places=2, blank=True, null=True)
+    movement_type = models.CharField(max_length=10, choices=MOVEMENT_TYPE_CHOICES, default=ADJUSTMENT)
+    content_type = models.ForeignKey(ContentType, on_delete=models.SET_NULL, blank=True, null=True)
+    object_id = models.PositiveIntegerField(blank=True, null=True)
+    source = GenericForeignKey('content_type', 'object_id')
+    note = models.CharField(max_length=255, blank=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        ordering = ['-created_at', '-id']
+        indexes = [
+            models.Index(fields=['shop', 'product', 'created_at']),
+            models.Index(fields=['created_at']),
+        ]
+        permissions = [
+            ("can_view_icon_stock_movement", "Can view icon stock movement"),
+        ]
+
+    def __str__(self):
+        return f"{self.get_movement_type_display()} {self.quantity:+} of product {self.product_id} at shop {self.shop_id}"
+
+    def save(self, *args, **kwargs):
+        if not self._state.adding:
+            raise ValueError("Stock movements are append-only and cannot be changed.")
+        super().save(*args, **kwargs)
+
+    def delete(self, *args, **kwargs):
+        raise ValueError("Stock movements are append-only and cannot be deleted.")
+
+
+class StockSnapshot(models.Model):
+    """
+    Quantity of a product in a shop at a point in time.
+
+    Snapshots are taken for every stock row at once, so a point-in-time query
+    only needs the latest snapshot before that time plus the movements since.
+    """
+    shop = models.ForeignKey('shop.Shop', on_delete=models.CASCADE, related_name='stock_snapshots')
+    product = models.ForeignKey('product.Product', on_delete=models.CASCADE, related_name='stock_snapshots')
+    quantity = models.IntegerField()
+    taken_at = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('shop', 'product', 'taken_at')
+        indexes = [
+            models.Index(fields=['taken_at']),
+        ]
+
+    def __str__(self):
+        return f"Product {self.product_id} at shop {self.shop_id}: {self.quantity} ({self.taken_at})"
@@ -0,0 +1,27 @@
+from django.db import models
+from django.utils import timezone
+
+
+class StockReservation(models.Model):
+    """
+    Stock held for a sale that has been validated but not yet committed.
+
+    While a reservation is open its quantity is counted in the Stock row's
+    reserved_quantity, so other sales only see quantity - reserved_quantity as
+    available. Reservations are consumed when the sale is committed, released
+    when it is abandoned, and swept once expires_at has passed.
+    """
+    shop = models.ForeignKey('shop.Shop', on_delete=models.CASCADE, related_name='stock_reservations')
+    product = models.ForeignKey('product.Product', on_delete=models.CASCADE, related_name='stock_reservations')
+    quantity = models.PositiveIntegerField()
+    token = models.CharField(max_length=64, db_index=True)
+    expires_at = models.DateTimeField(db_index=True)
+    created_at = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        permissions = [
+            ("can_view_icon_stock_reservation", "Can view icon stock reservation"),
+        ]
+
+    def __str__(self):
+        return f"{self.quantity} of product {self.product_id} at shop {self.shop_id} until {self.expires_at}"
@@ -1,8 +1,9 @@
 from django.db import models
 from django.forms import ValidationError
 from simple_history.models import HistoricalRecords
+from utils import FieldTrackerMixin
 
-class StockTransfer(models.Model):
+class StockTransfer(FieldTrackerMixin, models.Model):
     from_shop = models.ForeignKey('shop.Shop', on_delete=models.CASCADE, related_name='outgoing_transfers')
     to_shop = models.ForeignKey('shop.Shop', on_delete=models.CASCADE, related_name='incoming_transfers')
     description = models.CharField(max_length=255,blank=True, null=True)
@@ -22,7 +23,7 @@ class StockTransfer(models.Model):
             ("can_view_icon_stock_transfer", "Can view icon stock transfer"),
         ]
 
-class StockTransferItem(models.Model):
+class StockTransferItem(FieldTrackerMixin, models.Model):
     stock_transfer = models.ForeignKey(StockTransfer, on_delete=models.CASCADE)
     product = models.ForeignKey('product.Product', on_delete=models.CASCADE)
     quantity = models.IntegerField()
@@ -0,0 +1,17 @@
+from django.db import models
+
+
+class StockVersion(models.Model):
+    """
+    Change counter for one shop's stock.
+
+    Incremented after every committed write to the shop's Stock rows, so API
+    clients can tell whether anything changed (ETag / If-None-Match) without
+    the stock itself being read.
+    """
+    shop = models.OneToOneField('shop.Shop', on_delete=models.CASCADE, primary_key=True,
+                                related_name='stock_version')
+    version = models.PositiveBigIntegerField(default=0)
+
+    def __str__(self):
+        return f"Shop {self.shop_id} stock version {self.version}"
@@ -0,0 +1,27 @@
+from django.core.cache import cache
+
+SNAPSHOT_VERSION_KEY = 'inventory:snapshot-version'
+SNAPSHOT_TIMEOUT = 300
+
+
+def snapshot_version():
+    """Current generation of cached inventory snapshots."""
+    cache.add(SNAPSHOT_VERSION_KEY, 1, timeout=None)
+    return cache.get(SNAPSHOT_VERSION_KEY, 1)
+
+
+def expire_inventory_snapshots():
+    """
+    Retire every cached inventory snapshot by moving to the next generation.
+
+    Old entries are never read again and age out on their own timeout.
+    """
+    try:
+        cache.incr(SNAPSHOT_VERSION_KEY)
+    except ValueError:
+        cache.add(SNAPSHOT_VERSION_KEY, 1, timeout=None)
+
+
+def snapshot_cache_key(*parts):
+    """Cache key for one inventory snapshot response in the current generation."""
+    return ':'.join(['inventory:snapshot', str(snapshot_version()), *(str(part) for part in parts)])
@@ -0,0 +1,186 @@
+import csv
+import io
+from itertools import islice
+
+from django.core.exceptions import ValidationError
+from django.db import connection, transaction
+from django.db.models import Count, F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from inventory.models.stock import Stock
+from inventory.models.stock_count import StockCount, StockCountLine
+from inventory.models.stock_movement import StockMovement
+from inventory.services.stock_ledger import build_movement, record_movements
+from inventory.services.stock_posting import ZERO, stock_changed
+from product.models import Product
+
+COUNT_BATCH_SIZE = 1000
+
+
+def _batches(items, size):
+    items = iter(items)
+    while batch := list(islice(items, size)):
+        yield batch
+
+
+def read_count_file(file):
+    """
+    Read counted quantities from an uploaded CSV file with ``product`` (id)
+    and ``counted_quantity`` columns, one line at a time.
+
+    Yields:
+        (product_id, counted_quantity) tuples
+
+    Raises:
+        ValidationError: If a column is missing or a line is not two whole numbers
+    """
+    reader = csv.DictReader(io.TextIOWrapper(file, encoding='utf-8-sig'))
+    missing = {'product', 'counted_quantity'} - set(reader.fieldnames or [])
+    if missing:
+        raise ValidationError(f"The file has no {', '.join(sorted(missing))} column.")
+    for row in reader:
+        try:
+            yield int(row['product']), int(row['counted_quantity'])
+        except (TypeError, ValueError):
+            raise ValidationError(f"Line {reader.line_num}: product and counted_quantity must be whole numbers.")
+
+
+def record_counts(count, lines, batch_size=COUNT_BATCH_SIZE):
+    """
+    Add counted quantities to an open stock count, replacing any earlier
+    count of the same product.
+
+    Lines are written one batch at a time: each batch checks its products
+    with one query and is upserted with one INSERT ... ON CONFLICT UPDATE,
+    which also clears the expected quantity so the variance is recomputed.
+
+    Args:
+        count: The StockCount
+        lines: Iterable of (product_id, counted_quantity) tuples
+        batch_size: Number of lines per query
+
+    Returns:
+        Number of lines recorded
+
+    Raises:
+        ValidationError: If the count is not open, a product does not exist or
+            a quantity is negative; nothing is recorded
+    """
+    if not count.is_open:
+        raise ValidationError("This stock count has already been applied.")
+    unique_fields = ['count', 'product'] if connection.features.supports_update_conflicts_with_target else None
+    recorded = 0
+    with transaction.atomic():
+        for batch in _batches(lines, batch_size):
+            # The last count of a product in the batch wins
+            quantities = dict(batch)
+            negative = sorted(product_id for product_id, quantity in quantities.items() if quantity < 0)
+            if negative:
+                raise ValidationError(f"Counted quantities cannot be negative (products {negative}).")
+            known = set(Product.objects.filter(pk__in=quantities).values_list('pk', flat=True))
+            unknown = sorted(set(quantities) - known)
+            if unknown:
+                raise ValidationError(f"Products {unknown} do not exist.")
+            StockCountLine.objects.bulk_create(
+                [StockCountLine(count=count, product_id=product_id, counted_quantity=quantity)
+                 for product_id, quantity in quantities.items()],
+                update_conflicts=True, update_fields=['counted_quantity', 'expected_quantity'],
+                unique_fields=unique_fields,
+            )
+            recorded += len(quantities)
+    return recorded
+
+
+def compute_variances(count):
+    """
+    Compare every line of a stock count with the shop's current Stock
+    quantities, in one UPDATE. Products without a Stock row are expected at 0.
+
+    Returns:
+        The variance summary (see variance_summary)
+    """
+    stock_quantity = Stock.objects.filter(shop_id=count.shop_id, product_id=OuterRef('product_id')).values('quantity')
+    count.lines.update(expected_quantity=Coalesce(Subquery(stock_quantity[:1]), Value(0)))
+    return variance_summary(count)
+
+
+def variance_summary(count):
+    """
+    Totals of a stock count's variances, from one aggregate query.
+
+    Returns:
+        dict with the number of 'lines', the number of 'variances' (lines
+        whose count differs from the expected quantity), the 'net_variance'
+        in units and the number of lines 'pending' a variance computation
+    """
+    totals = count.lines.aggregate(
+        lines=Count('pk'),
+        variances=Count('pk', filter=~Q(counted_quantity=F('expected_quantity'))),
+        net_variance=Sum(F('counted_quantity') - F('expected_quantity')),
+        pending=Count('pk', filter=Q(expected_quantity__isnull=True)),
+    )
+    totals['net_variance'] = totals['net_variance'] or 0
+    return totals
+
+
+def apply_stock_count(count, reason=''):
+    """
+    Set the shop's Stock quantities to the approved counted quantities.
+
+    Inside one transaction the counted Stock rows are locked, the missing
+    ones created, and the variances recomputed against the locked quantities.
+    Every row whose count differs is then updated with a single set-based
+    UPDATE, followed by one bulk history insert and one bulk insert of
+    adjustment movements whose source is the count. The count is closed.
+
+    Args:
+        count: The StockCount
+        reason: History change reason and movement note
+
+    Returns:
+        Number of Stock rows adjusted
+
+    Raises:
+        ValidationError: If the count has already been applied
+    """
+    reason = reason or f"Stock count #{count.pk}"
+    with transaction.atomic():
+        count = StockCount.objects.select_for_update().get(pk=count.pk)
+        if not count.is_open:
+            raise ValidationError("This stock count has already been applied.")
+        shop_stock = Stock.objects.filter(shop_id=count.shop_id)
+        approved = count.lines.filter(approved=True)
+
+        list(shop_stock.select_for_update().filter(product_id__in=approved.values('product_id'))
+             .order_by('product_id').values_list('pk', flat=True))
+        missing = (approved.filter(counted_quantity__gt=0)
+                   .exclude(product_id__in=shop_stock.values('product_id'))
+                   .values_list('product_id', flat=True))
+        Stock.objects.bulk_create(
+            [Stock(shop_id=count.shop_id, product_id=product_id, quantity=0, average_cost=ZERO, selling_price=ZERO)
+             for product_id in missing],
+            ignore_conflicts=True,
+        )
+        compute_variances(count)
+
+        changed = approved.exclude(counted_quantity=F('expected_quantity'))
+        variances = dict(changed.values_list('product_id', F('counted_quantity') - F('expected_quantity')))
+        if variances:
+            counted = changed.filter(product_id=OuterRef('product_id')).values('counted_quantity')
+            stocks = shop_stock.filter(product_id__in=changed.values('product_id'))
+            stocks.update(quantity=Subquery(counted[:1]))
+            stocks = list(stocks)
+            Stock.history.bulk_history_create(stocks, update=True, default_change_reason=reason,
+                                              batch_size=COUNT_BATCH_SIZE)
+            record_movements([
+                build_movement(stock.shop_id, stock.product_id, variances[stock.product_id],
+                               StockMovement.ADJUSTMENT, source=count, unit_cost=stock.average_cost, note=reason)
+                for stock in stocks
+            ])
+            stock_changed((stock.shop_id, stock.product_id) for stock in stocks)
+
+        count.status = StockCount.APPLIED
+        count.applied_at = timezone.now()
+        count.save(update_fields=['status', 'applied_at'])
+    return len(variances)
@@ -0,0 +1,202 @@
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import Max, Q, Sum
+from django.utils import timezone
+
+from inventory.models.stock import Stock
+from inventory.models.stock_movement import StockMovement, StockSnapshot
+
+SNAPSHOT_CHUNK_SIZE = 1000
+
+
+def build_movement(shop_id, product_id, quantity, movement_type, source=None, unit_cost=None, note=''):
+    """
+    Build an unsaved StockMovement for the given stock row and source.
+
+    Args:
+        shop_id: Shop id
+        product_id: Product id
+        quantity: Signed quantity that was applied to the stock row
+        movement_type: One of the StockMovement movement types
+        source: Model instance that caused the movement, if any
+        unit_cost: Cost per unit the movement was valued at, if known
+        note: Free text, usually the history change reason
+    """
+    movement = StockMovement(
+        shop_id=shop_id,
+        product_id=product_id,
+        quantity=quantity,
+        movement_type=movement_type,
+        unit_cost=unit_cost,
+        note=note[:255],
+    )
+    if source is not None:
+        movement.content_type = ContentType.objects.get_for_model(source)
+        movement.object_id = source.pk
+    return movement
+
+
+def record_movements(movements):
+    """Insert movements in one query, skipping zero quantities."""
+    movements = [movement for movement in movements if movement.quantity]
+    if movements:
+        StockMovement.objects.bulk_create(movements)
+    return movements
+
+
+def _key_filter(shops=None, products=None, prefix=''):
+    condition = Q()
+    if shops is not None:
+        condition &= Q(**{f'{prefix}shop_id__in': shops})
+    if products is not None:
+        condition &= Q(**{f'{prefix}product_id__in': products})
+    return condition
+
+
+def _net_movements(start, end, shops=None, products=None):
+    """Net quantity per (shop_id, product_id) for movements in (start, end]."""
+    movements = StockMovement.objects.filter(_key_filter(shops, products))
+    if start is not None:
+        movements = movements.filter(created_at__gt=start)
+    if end is not None:
+        movements = movements.filter(created_at__lte=end)
+    rows = movements.values('shop_id', 'product_id').annotate(net=Sum('quantity')).order_by()
+    return {(row['shop_id'], row['product_id']): row['net'] for row in rows}
+
+
+def latest_snapshot_time(at):
+    """Time of the most recent snapshot taken at or before ``at``, or None."""
+    return StockSnapshot.objects.filter(taken_at__lte=at).aggregate(latest=Max('taken_at'))['latest']
+
+
+def stock_levels(at, shops=None, products=None):
+    """
+    Stock quantity per (shop_id, product_id) at a point in time.
+
+    Starts from the latest snapshot at or before ``at`` and adds the
+    movements recorded since, so the scan is bounded by the snapshot interval.
+    Before the first snapshot, works back from the current stock instead.
+
+    Args:
+        at: Point in time to report on
+        shops: Optional iterable of shop ids to restrict to
+        products: Optional iterable of product ids to restrict to
+
+    Returns:
+        dict mapping (shop_id, product_id) to quantity; rows at zero are omitted
+    """
+    snapshot_time = latest_snapshot_time(at)
+    if snapshot_time is None:
+        levels = {
+            (row['shop_id'], row['product_id']): row['quantity']
+            for row in Stock.objects.filter(_key_filter(shops, products)).values('shop_id', 'product_id', 'quantity')
+        }
+        for key, net in _net_movements(at, None, shops, products).items():
+            levels[key] = levels.get(key, 0) - net
+    else:
+        snapshot = StockSnapshot.objects.filter(_key_filter(shops, products), taken_at=snapshot_time)
+        levels = {
+            (row['shop_id'], row['product_id']): row['quantity']
+            for row in snapshot.values('shop_id', 'product_id', 'quantity')
+        }
+        for key, net in _net_movements(snapshot_time, at, shops, products).items():
+            levels[key] = levels.get(key, 0) + net
+    return {key: quantity for key, quantity in levels.items() if quantity}
+
+
+def stock_on_date(shop, product, at):
+    """Quantity of one product in one shop at a point in time."""
+    shop_id, product_id = getattr(shop, 'pk', shop), getattr(product, 'pk', product)
+    return stock_levels(at, shops=[shop_id], products=[product_id]).get((shop_id, product_id), 0)
+
+
+def movement_summary(start, end, shops=None, products=None):
+    """
+    Opening stock, quantity in, quantity out and closing stock per
+    (shop_id, product_id) between two points in time.
+
+    Returns:
+        dict mapping (shop_id, product_id) to a dict with
+        'opening', 'in', 'out' and 'closing' quantities
+    """
+    opening = stock_levels(start, shops, products)
+    movements = StockMovement.objects.filter(_key_filter(shops, products), created_at__gt=start, created_at__lte=end)
+    rows = (movements.values('shop_id', 'product_id')
+            .annotate(quantity_in=Sum('quantity', filter=Q(quantity__gt=0)),
+                      quantity_out=Sum('quantity', filter=Q(quantity__lt=0)))
+            .order_by())
+
+    summary = {key: {'opening': quantity, 'in': 0, 'out': 0, 'closing': quantity}
+               for key, quantity in opening.items()}
+    for row in rows:
+        key = (row['shop_id'], row['product_id'])
+        entry = summary.setdefault(key, {'opening': 0, 'in': 0, 'out': 0, 'closing': 0})
+        entry['in'] = row['quantity_in'] or 0
+        entry['out'] = -(row['quantity_out'] or 0)
+        entry['closing'] = entry['opening'] + entry['in'] - entry['out']
+    return summary
+
+
+def _locked_levels(at, after, chunk_size):
+    """
+    Stock levels at ``at`` of the next chunk of Stock rows after the key ``after``.
+
+    The chunk's rows are locked, which waits for any posting still holding
+    them, so every movement posted to them so far is committed and anything
+    posted later is timestamped after ``at``. A row's level at ``at`` is then
+    its quantity less the movements recorded since. The movements are read
+    after the lock is taken, so they are read from after it too.
+
+    Returns:
+        List of ((shop_id, product_id), quantity) in key order, empty past the last row
+    """
+    stocks = Stock.objects.order_by('shop_id', 'product_id')
+    if after is not None:
+        stocks = stocks.filter(Q(shop_id__gt=after[0]) | Q(shop_id=after[0], product_id__gt=after[1]))
+    with transaction.atomic():
+        rows = list(stocks.select_for_update().values_list('shop_id', 'product_id', 'quantity')[:chunk_size])
+        if not rows:
+            return []
+        later = _net_movements(at, None, {row[0] for row in rows}, {row[1] for row in rows})
+    return [((shop_id, product_id), quantity - later.get((shop_id, product_id), 0))
+            for shop_id, product_id, quantity in rows]
+
+
+def take_snapshot(at=None, chunk_size=SNAPSHOT_CHUNK_SIZE):
+    """
+    Record the stock level of every shop and product at ``at``.
+
+    Levels are read from the Stock rows under their row locks, a chunk at a
+    time (see _locked_levels), rather than by adding up movements: a
+    movement is timestamped when it is inserted but only visible once its
+    transaction commits, so one committed just after a movement-based
+    snapshot would be left out of it for good.
+
+    Args:
+        at: Point in time to snapshot, not in the future; defaults to now
+        chunk_size: Number of Stock rows locked at a time
+
+    Returns:
+        Number of snapshot rows written (0 if a snapshot already exists at that time)
+    """
+    now = timezone.now()
+    at = at or now
+    if at > now:
+        raise ValueError("A stock snapshot cannot be taken of a time still to come.")
+    if StockSnapshot.objects.filter(taken_at=at).exists():
+        return 0
+
+    levels, after = [], None
+    while chunk := _locked_levels(at, after, chunk_size):
+        levels += chunk
+        after = chunk[-1][0]
+
+    with transaction.atomic():
+        if StockSnapshot.objects.filter(taken_at=at).exists():
+            return 0
+        snapshots = [
+            StockSnapshot(shop_id=shop_id, product_id=product_id, quantity=quantity, taken_at=at)
+            for (shop_id, product_id), quantity in levels if quantity
+        ]
+        StockSnapshot.objects.bulk_create(snapshots, batch_size=1000)
+    return len(snapshots)
@@ -0,0 +1,336 @@
+from decimal import ROUND_HALF_UP, Decimal
+
+from django.conf import settings
+from django.contrib.contenttypes.models import ContentType
+from django.db import transaction
+from django.db.models import F, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+
+from inventory.models.stock import Stock
+from inventory.models.stock_lot import StockLot, StockLotConsumption
+
+FIFO = 'fifo'
+# Open lots read per query when consuming; doubled while the demand is not covered
+LOT_PAGE_SIZE = 8
+
+
+def fifo_costing_enabled():
+    """Whether sales and transfers are costed from FIFO lots (settings.INVENTORY_COSTING_METHOD)."""
+    return getattr(settings, 'INVENTORY_COSTING_METHOD', 'average') == FIFO
+
+
+def source_key(source):
+    """(content type id, object id) identifying a lot's or consumption's source instance."""
+    if source is None:
+        return None
+    return ContentType.objects.get_for_model(source).pk, source.pk
+
+
+def _source_fields(source):
+    if source is None:
+        return {}
+    return {'content_type': ContentType.objects.get_for_model(source), 'object_id': source.pk}
+
+
+def _source_filter(sources):
+    """Q matching rows whose source is any of the given instances, grouped by content type."""
+    by_type = {}
+    for source in sources:
+        if source is not None:
+            by_type.setdefault(ContentType.objects.get_for_model(source).pk, set()).add(source.pk)
+    condition = Q(pk__in=[])
+    for content_type_id, object_ids in by_type.items():
+        condition |= Q(content_type_id=content_type_id, object_id__in=object_ids)
+    return condition
+
+
+def _row_key(row):
+    source = (row.content_type_id, row.object_id) if row.object_id is not None else None
+    return row.shop_id, row.product_id, source
+
+
+def _open_lots(shop_id, product_id, quantity):
+    """
+    Lock and return the oldest open lots of a product in a shop, enough to
+    cover the quantity if there are. Lots are read a page at a time, so only
+    the lots that are actually consumed (and at most one page more) are read.
+    """
+    lots, last_id, page_size = [], 0, LOT_PAGE_SIZE
+    while quantity > 0:
+        page = list(StockLot.objects.select_for_update()
+                    .filter(shop_id=shop_id, product_id=product_id, depleted=False, id__gt=last_id)
+                    .order_by('id')[:page_size])
+        lots += page
+        quantity -= sum(lot.remaining_quantity for lot in page)
+        if len(page) < page_size:
+            break
+        last_id, page_size = page[-1].id, page_size * 2
+    return lots
+
+
+def receive_lots(receipts, received_at=None):
+    """
+    Create stock lots in one insert.
+
+    Args:
+        receipts: Iterable of (shop_id, product_id, quantity, unit_cost, source) tuples
+        received_at: Time the stock arrived; defaults to now
+    """
+    extra = {'received_at': received_at} if received_at else {}
+    lots = [StockLot(shop_id=shop_id, product_id=product_id, unit_cost=unit_cost, quantity=quantity,
+                     remaining_quantity=quantity, **_source_fields(source), **extra)
+            for shop_id, product_id, quantity, unit_cost, source in receipts if quantity > 0]
+    if lots:
+        StockLot.objects.bulk_create(lots)
+    return lots
+
+
+def adjust_lots(changes):
+    """
+    Change the lots received from given sources (purchase lines, transfer
+    lines), e.g. after the line was edited or deleted.
+
+    A positive quantity is added to the source's newest lot (or a new lot).
+    A negative quantity is taken out of what is left of its lots, newest
+    first; quantity that has already been consumed cannot be taken back and
+    is returned as not adjusted. A unit cost, if given, becomes the lots'
+    cost for whatever is consumed from now on.
+
+    Args:
+        changes: Iterable of (shop_id, product_id, quantity_delta, source, unit_cost) tuples
+
+    Returns:
+        Total quantity that could not be taken back
+    """
+    changes = list(changes)
+    if not changes:
+        return 0
+    with transaction.atomic():
+        existing = {}
+        for lot in (StockLot.objects.select_for_update()
+                    .filter(_source_filter(source for _, _, _, source, _ in changes)).order_by('-id')):
+            existing.setdefault(_row_key(lot), []).append(lot)
+
+        changed, created, missing = {}, [], 0
+        for shop_id, product_id, quantity, source, unit_cost in changes:
+            lots = existing.get((shop_id, product_id, source_key(source)), [])
+            if unit_cost is not None:
+                for lot in lots:
+                    lot.unit_cost = unit_cost
+                    changed[lot.pk] = lot
+            if quantity > 0:
+                if lots:
+                    lots[0].quantity += quantity
+                    lots[0].remaining_quantity += quantity
+                    lots[0].depleted = False
+                    changed[lots[0].pk] = lots[0]
+                else:
+                    created += receive_lots([(shop_id, product_id, quantity, unit_cost or Decimal('0.00'), source)])
+            elif quantity < 0:
+                wanted = -quantity
+                for lot in lots:
+                    taken = min(wanted, lot.remaining_quantity)
+                    if taken:
+                        lot.quantity -= taken
+                        lot.remaining_quantity -= taken
+                        lot.depleted = lot.remaining_quantity == 0
+                        changed[lot.pk] = lot
+                        wanted -= taken
+                missing += wanted
+
+        if changed:
+            StockLot.objects.bulk_update(list(changed.values()),
+                                         ['unit_cost', 'quantity', 'remaining_quantity', 'depleted'])
+    return missing
+
+
+def consume_lots(demands):
+    """
+    Take stock out of the lots FIFO, oldest lot first, for a batch of
+    demands (e.g. every line of an invoice).
+
+    Each (shop, product) reads only the open lots it consumes, in pages; the
+    lots are written back with one bulk update and the consumptions inserted
+    with one bulk insert for the whole batch. Quantity no lot covers (stock
+    from before FIFO costing) is consumed without a lot at the stock row's
+    average cost.
+
+    Args:
+        demands: Iterable of (shop_id, product_id, quantity, source) tuples
+
+    Returns:
+        The StockLotConsumption rows created, in demand order per (shop, product)
+    """
+    by_key = {}
+    for shop_id, product_id, quantity, source in demands:
+        if quantity > 0:
+            by_key.setdefault((shop_id, product_id), []).append((quantity, source))
+    if not by_key:
+        return []
+
+    with transaction.atomic():
+        consumptions, touched, shortfalls = [], {}, []
+        for (shop_id, product_id), wanted in sorted(by_key.items()):
+            lots = iter(_open_lots(shop_id, product_id, sum(quantity for quantity, _ in wanted)))
+            lot = next(lots, None)
+            for quantity, source in wanted:
+                while quantity and lot is not None:
+                    taken = min(quantity, lot.remaining_quantity)
+                    lot.remaining_quantity -= taken
+                    lot.depleted = lot.remaining_quantity == 0
+                    touched[lot.pk] = lot
+                    consumptions.append(StockLotConsumption(lot=lot, shop_id=shop_id, product_id=product_id,
+                                                            quantity=taken, unit_cost=lot.unit_cost,
+                                                            **_source_fields(source)))
+                    quantity -= taken
+                    if lot.depleted:
+                        lot = next(lots, None)
+                if quantity:
+                    shortfalls.append((shop_id, product_id, quantity, source))
+
+        if shortfalls:
+            keys = {(shop_id, product_id) for shop_id, product_id, _, _ in shortfalls}
+            condition = Q(pk__in=[])
+            for shop_id, product_id in keys:
+                condition |= Q(shop_id=shop_id, product_id=product_id)
+            costs = {(shop_id, product_id): cost for shop_id, product_id, cost in
+                     Stock.objects.filter(condition).values_list('shop_id', 'product_id', 'average_cost')}
+            consumptions += [
+                StockLotConsumption(shop_id=shop_id, product_id=product_id, quantity=quantity,
+                                    unit_cost=costs.get((shop_id, product_id)) or Decimal('0.00'),
+                                    **_source_fields(source))
+                for shop_id, product_id, quantity, source in shortfalls
+            ]
+
+        if touched:
+            StockLot.objects.bulk_update(list(touched.values()), ['remaining_quantity', 'depleted'])
+        StockLotConsumption.objects.bulk_create(consumptions)
+    return consumptions
+
+
+def release_lots(releases):
+    """
+    Put stock a source consumed back into the lots it came from, newest
+    consumption first (a sale line reduced or deleted, a transfer undone).
+
+    Args:
+        releases: Iterable of (shop_id, product_id, quantity, source) tuples
+
+    Returns:
+        Total quantity released
+    """
+    releases = [(shop_id, product_id, quantity, source)
+                for shop_id, product_id, quantity, source in releases if quantity > 0 and source is not None]
+    if not releases:
+        return 0
+
+    with transaction.atomic():
+        consumed = {}
+        for consumption in (StockLotConsumption.objects.select_for_update()
+                            .filter(_source_filter(source for _, _, _, source in releases)).order_by('-id')):
+            consumed.setdefault(_row_key(consumption), []).append(consumption)
+        lots = StockLot.objects.select_for_update().in_bulk(
+            {consumption.lot_id for rows in consumed.values() for consumption in rows if consumption.lot_id})
+
+        changed, released = {}, 0
+        for shop_id, product_id, quantity, source in releases:
+            for consumption in consumed.get((shop_id, product_id, source_key(source)), []):
+                returned = min(quantity, consumption.quantity)
+                if not returned:
+                    continue
+                consumption.quantity -= returned
+                changed[consumption.pk] = consumption
+                lot = lots.get(consumption.lot_id)
+                if lot is not None:
+                    lot.remaining_quantity += returned
+                    lot.depleted = False
+                quantity -= returned
+                released += returned
+
+        emptied = [pk for pk, consumption in changed.items() if consumption.quantity == 0]
+        if emptied:
+            StockLotConsumption.objects.filter(pk__in=emptied).delete()
+        reduced = [consumption for consumption in changed.values() if consumption.quantity]
+        if reduced:
+            StockLotConsumption.objects.bulk_update(reduced, ['quantity'])
+        if lots:
+            StockLot.objects.bulk_update(list(lots.values()), ['remaining_quantity', 'depleted'])
+    return released
+
+
+def consumed_unit_costs(sources):
+    """
+    Unit cost of what each source has consumed, weighted by quantity, from
+    one grouped query.
+
+    Returns:
+        dict mapping source_key(source) to the unit cost; sources that have
+        consumed nothing are left out
+    """
+    rows = (StockLotConsumption.objects.filter(_source_filter(sources))
+            .values('content_type_id', 'object_id')
+            .annotate(total_quantity=Sum('quantity'), total_value=Sum(F('quantity') * F('unit_cost')))
+            .order_by())
+    return {
+        (row['content_type_id'], row['object_id']):
+            (Decimal(row['total_value']) / row['total_quantity']).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+        for row in rows if row['total_quantity']
+    }
+
+
+def transfer_lots(lines):
+    """
+    Move FIFO lots along with a batch of transfer lines.
+
+    A transfer consumes its quantity from the source shop's lots and
+    receives it into the destination shop as lots at the same unit costs,
+    so the cost layers travel with the stock. A negative line (a transfer
+    undone) releases the consumption in the source shop and takes the lots
+    back out of the destination.
+
+    Args:
+        lines: Iterable of (from_shop_id, to_shop_id, product_id, quantity, source) tuples
+    """
+    lines = list(lines)
+    returned = [line for line in lines if line[3] < 0]
+    sent = [line for line in lines if line[3] > 0]
+    with transaction.atomic():
+        if returned:
+            release_lots([(from_id, product_id, -quantity, source)
+                          for from_id, to_id, product_id, quantity, source in returned])
+            adjust_lots([(to_id, product_id, quantity, source, None)
+                         for from_id, to_id, product_id, quantity, source in returned])
+        if sent:
+            destinations = {(from_id, product_id, source_key(source)): to_id
+                            for from_id, to_id, product_id, quantity, source in sent}
+            sources = {source_key(source): source for _, _, _, _, source in sent}
+            consumptions = consume_lots([(from_id, product_id, quantity, source)
+                                         for from_id, to_id, product_id, quantity, source in sent])
+            receive_lots([
+                (destinations[_row_key(consumption)], consumption.product_id, consumption.quantity,
+                 consumption.unit_cost, sources[_row_key(consumption)[2]])
+                for consumption in consumptions
+            ])
+
+
+def open_stock_lots(batch_size=1000):
+    """
+    Give every Stock row an opening lot for the quantity its open lots do
+    not cover, at the row's average cost, e.g. when switching to FIFO
+    costing. The uncovered quantities are worked out in one query.
+
+    Returns:
+        Number of opening lots created
+    """
+    lotted = (StockLot.objects.filter(shop_id=OuterRef('shop_id'), product_id=OuterRef('product_id'), depleted=False)
+              .values('shop_id', 'product_id').annotate(total=Sum('remaining_quantity')).values('total'))
+    uncovered = (Stock.objects.annotate(lotted=Coalesce(Subquery(lotted[:1]), Value(0)))
+                 .filter(quantity__gt=F('lotted'))
+                 .values_list('shop_id', 'product_id', F('quantity') - F('lotted'), 'average_cost'))
+    created = 0
+    with transaction.atomic():
+        rows = list(uncovered)
+        for start in range(0, len(rows), batch_size):
+            created += len(receive_lots((shop_id, product_id, quantity, average_cost, None)
+                                        for shop_id, product_id, quantity, average_cost in rows[start:start + batch_size]))
+    return created
@@ -0,0 +1,429 @@
+from decimal import ROUND_HALF_UP, Decimal
+from django.db import IntegrityError, connection, transaction
+from django.db.models import F, OuterRef, Q, Subquery, Value
+from django.db.models.functions import Round
+
+from inventory.models.stock import Stock
+from inventory.models.stock_movement import StockMovement
+from inventory.services.stock_ledger import build_movement, record_movements
+from inventory.services.stock_lots import fifo_costing_enabled, transfer_lots
+from inventory.services.stock_summary import refresh_product_summaries
+from inventory.services.stock_version import bump_stock_versions
+from product.models import Product
+from utils import guarded_update
+
+ZERO = Decimal('0.00')
+CENT = Decimal('0.01')
+
+
+def _pk(obj):
+    """Accept either a model instance or a raw primary key."""
+    return getattr(obj, 'pk', obj)
+
+
+def stock_filter(keys):
+    """
+    Build a Q object matching every (shop_id, product_id) pair, grouped by shop
+    so the database can use the (shop, product) unique index.
+    """
+    by_shop = {}
+    for shop_id, product_id in keys:
+        by_shop.setdefault(shop_id, set()).add(product_id)
+    condition = Q(pk__in=[])
+    for shop_id, product_ids in by_shop.items():
+        condition |= Q(shop_id=shop_id, product_id__in=product_ids)
+    return condition
+
+
+def lock_stock_rows(keys):
+    """
+    Lock the Stock rows for the given (shop_id, product_id) pairs.
+
+    Rows are always locked in (shop_id, product_id) order, so two postings that
+    touch the same rows (e.g. opposite transfers between two shops) queue up
+    instead of deadlocking. Must be called inside a transaction.
+
+    Args:
+        keys: Iterable of (shop_id, product_id) tuples
+
+    Returns:
+        dict mapping (shop_id, product_id) to the locked Stock instance
+    """
+    keys = sorted(set(keys))
+    if not keys:
+        return {}
+    stocks = (Stock.objects.select_for_update()
+              .filter(stock_filter(keys))
+              .order_by('shop_id', 'product_id'))
+    return {(stock.shop_id, stock.product_id): stock for stock in stocks}
+
+
+def selling_price_expression(average_cost):
+    """
+    SQL expression for the selling price of a Stock row at the given average
+    cost, using the product's current profit margin (same formula as
+    Stock.calculate_selling_price).
+    """
+    margin = Subquery(Product.objects.filter(pk=OuterRef('product_id')).values('profit_margin')[:1])
+    # Multiply by 0.01 rather than divide by 100: SQLite truncates integer division
+    return Round(average_cost + average_cost * margin * Value(CENT), 2)
+
+
+def weighted_average_cost(quantity, average_cost, quantity_delta, value_delta):
+    """
+    Re-derive the average cost after moving quantity and value in or out.
+
+    Keeps the current average cost when the result would be meaningless
+    (no quantity left, or the remaining value is not positive).
+    """
+    new_quantity = quantity + quantity_delta
+    new_value = average_cost * quantity + value_delta
+    if new_quantity > 0 and new_value > 0:
+        return (new_value / new_quantity).quantize(CENT)
+    return average_cost
+
+
+def write_stock_history(keys, reason=''):
+    """
+    Write one HistoricalStock row per touched Stock row.
+
+    Set-based updates bypass Stock.save(), so history is written in bulk
+    from a single read-back of the affected rows.
+
+    Returns:
+        dict mapping (shop_id, product_id) to the refreshed Stock instance
+    """
+    keys = set(keys)
+    if not keys:
+        return {}
+    stocks = list(Stock.objects.filter(stock_filter(keys)))
+    Stock.history.bulk_history_create(stocks, update=True, default_change_reason=reason)
+    return {(stock.shop_id, stock.product_id): stock for stock in stocks}
+
+
+def stock_changed(keys):
+    """
+    Bring everything derived from Stock in line after the given rows changed:
+    the products' cross-shop summaries straight away, and the shops' stock
+    versions once the transaction commits.
+
+    Args:
+        keys: Iterable of (shop_id, product_id) tuples
+    """
+    keys = list(keys)
+    refresh_product_summaries({product_id for shop_id, product_id in keys})
+    bump_stock_versions({shop_id for shop_id, product_id in keys})
+
+
+def write_stock_rows(stocks, fields=('quantity', 'average_cost', 'selling_price')):
+    """
+    Write already locked Stock rows back in bulk.
+
+    Uses INSERT ... ON CONFLICT (ON DUPLICATE KEY on MySQL) UPDATE with plain
+    values instead of bulk_update, whose per-row CASE expressions get slow to
+    build and to run once there are thousands of rows.
+    """
+    if not stocks:
+        return
+    unique_fields = ['shop', 'product'] if connection.features.supports_update_conflicts_with_target else None
+    Stock.objects.bulk_create(stocks, update_conflicts=True, update_fields=list(fields),
+                              unique_fields=unique_fields, batch_size=1000)
+
+
+def _create_stock(shop_id, product_id, quantity, average_cost):
+    """
+    Create a missing Stock row. Returns None if another transaction created
+    it first, in which case the caller should post against that row instead.
+    """
+    stock = Stock(shop_id=shop_id, product_id=product_id, quantity=quantity, average_cost=average_cost)
+    try:
+        with transaction.atomic():
+            stock.save(force_insert=True, record_movement=False)
+    except IntegrityError:
+        return None
+    return stock
+
+
+def _set_stock_values(stock, quantity, average_cost):
+    """Write new quantity/average cost to an already locked Stock row."""
+    changes = {'quantity': quantity}
+    if average_cost != stock.average_cost:
+        changes['average_cost'] = average_cost
+        changes['selling_price'] = selling_price_expression(Value(average_cost))
+    Stock.objects.filter(pk=stock.pk).update(**changes)
+    stock.quantity = quantity
+    stock.average_cost = average_cost
+
+
+def post_stock_quantity(shop, product, quantity_delta, logger, create_missing=False, reason='',
+                        movement_type=StockMovement.ADJUSTMENT, source=None, splits=None):
+    """
+    Apply a quantity-only change (sale, sale return) to one Stock row.
+
+    Increments and covered decrements are a single ``quantity = quantity + delta``
+    UPDATE, so concurrent tills selling the same product never overwrite each
+    other. A decrement larger than the stock on hand locks the row and clamps
+    it to zero, as the signal handlers always did.
+
+    The change posts a sale that has already been recorded, so it is applied
+    even when it takes stock other sales hold reserved; that is logged as a
+    warning. Callers check availability (quantity - reserved_quantity)
+    before recording the sale, and a sale consumes its own reservations
+    before its stock is posted.
+
+    Args:
+        shop: Shop instance or id
+        product: Product instance or id
+        quantity_delta: Signed change to apply
+        logger: Logger instance for recording operations
+        create_missing: Create the row (zero cost) when a positive delta has nowhere to go
+        reason: History change reason
+        movement_type: StockMovement type recorded in the ledger
+        source: Model instance recorded as the movement source
+        splits: Optional (quantity, source) pairs that make up quantity_delta, recorded as
+            one movement each when the whole delta is applied
+
+    Returns:
+        The quantity change actually applied, or None if there is no stock row
+    """
+    shop_id, product_id = _pk(shop), _pk(product)
+    if quantity_delta == 0:
+        return 0
+
+    rows = Stock.objects.filter(shop_id=shop_id, product_id=product_id)
+    with transaction.atomic():
+        applied = None
+        if quantity_delta > 0:
+            if rows.update(quantity=F('quantity') + quantity_delta):
+                applied = quantity_delta
+        elif guarded_update(rows, 'quantity', quantity_delta, minimum=F('reserved_quantity')):
+            applied = quantity_delta
+        elif guarded_update(rows, 'quantity', quantity_delta, minimum=0):
+            logger.warning(f"Change of {quantity_delta} for product {product_id} in shop {shop_id} "
+                           f"takes reserved stock")
+            applied = quantity_delta
+        else:
+            stock = rows.select_for_update().first()
+            if stock is not None:
+                logger.warning(f"Insufficient stock for product {product_id} in shop {shop_id}. "
+                               f"Available: {stock.quantity}, Requested: {-quantity_delta}")
+                applied = -stock.quantity
+                rows.update(quantity=0)
+                logger.warning(f"Stock quantity set to zero for product {product_id} in shop {shop_id}")
+
+        if applied is None:
+            if not (create_missing and quantity_delta > 0):
+                logger.error(f"No stock record found for product {product_id} in shop {shop_id}")
+                return None
+            if _create_stock(shop_id, product_id, quantity_delta, ZERO) is None:
+                return post_stock_quantity(shop_id, product_id, quantity_delta, logger, reason=reason,
+                                           movement_type=movement_type, source=source, splits=splits)
+            logger.warning(f"Created new stock record for product {product_id} in shop {shop_id} "
+                           f"with quantity {quantity_delta}")
+            applied = quantity_delta
+        else:
+            write_stock_history([(shop_id, product_id)], reason)
+        if splits and applied == quantity_delta:
+            record_movements([build_movement(shop_id, product_id, quantity, movement_type,
+                                             source=split_source, note=reason)
+                              for quantity, split_source in splits])
+        else:
+            record_movements([build_movement(shop_id, product_id, applied, movement_type,
+                                             source=source, note=reason)])
+        stock_changed([(shop_id, product_id)])
+
+    logger.info(f"Stock changed by {applied} for product {product_id} in shop {shop_id}")
+    return applied
+
+
+def post_stock_value(shop, product, quantity_delta, value_delta, logger, create_cost=None, reason='',
+                     movement_type=StockMovement.ADJUSTMENT, source=None):
+    """
+    Move quantity and inventory value together (purchases and their edits),
+    re-deriving the moving average cost.
+
+    The row is locked for the duration of the calculation so the average cost
+    is always computed from the committed quantity and value.
+
+    Args:
+        shop: Shop instance or id
+        product: Product instance or id
+        quantity_delta: Signed quantity change
+        value_delta: Signed change in total inventory value (price * quantity)
+        logger: Logger instance for recording operations
+        create_cost: Unit cost to create a missing row with; None skips creation
+        reason: History change reason
+        movement_type: StockMovement type recorded in the ledger
+        source: Model instance recorded as the movement source
+
+    Returns:
+        The updated Stock instance, or None if there is no stock row
+    """
+    shop_id, product_id = _pk(shop), _pk(product)
+    key = (shop_id, product_id)
+    unit_cost = (value_delta / quantity_delta).quantize(CENT) if quantity_delta else None
+
+    with transaction.atomic():
+        stock = lock_stock_rows([key]).get(key)
+        if stock is None:
+            if create_cost is None or quantity_delta <= 0:
+                logger.warning(f"No stock record found for product {product_id} at shop {shop_id}")
+                return None
+            stock = _create_stock(shop_id, product_id, quantity_delta, create_cost)
+            if stock is None:
+                return post_stock_value(shop_id, product_id, quantity_delta, value_delta, logger, reason=reason,
+                                        movement_type=movement_type, source=source)
+            record_movements([build_movement(shop_id, product_id, quantity_delta, movement_type,
+                                             source=source, unit_cost=unit_cost, note=reason)])
+            logger.info(f"Created new stock record for product {product_id} at shop {shop_id}. "
+                        f"Quantity: {stock.quantity}, Average cost: {stock.average_cost}")
+            return stock
+
+        average_cost = weighted_average_cost(stock.quantity, stock.average_cost, quantity_delta, value_delta)
+        new_quantity = stock.quantity + quantity_delta
+        if new_quantity < 0:
+            logger.warning(f"Prevented negative stock for product {product_id} at shop {shop_id}")
+            new_quantity = 0
+        applied = new_quantity - stock.quantity
+        _set_stock_values(stock, new_quantity, average_cost)
+        write_stock_history([key], reason)
+        record_movements([build_movement(shop_id, product_id, applied, movement_type,
+                                         source=source, unit_cost=unit_cost, note=reason)])
+        stock_changed([key])
+
+    logger.info(f"Updated stock for product {product_id} at shop {shop_id}, "
+                f"new quantity: {stock.quantity}, new avg cost: {stock.average_cost}")
+    return stock
+
+
+def calculate_selling_price(average_cost, profit_margin):
+    """Selling price at the given average cost and margin, rounded like selling_price_expression."""
+    return (average_cost + average_cost * Decimal(profit_margin) * CENT).quantize(CENT, rounding=ROUND_HALF_UP)
+
+
+def post_stock_transfer(from_shop, to_shop, product, quantity, logger, reason='', source=None):
+    """
+    Move stock of one product between two shops.
+
+    A positive quantity takes stock out of the source shop and adds it to the
+    destination at the source's average cost. A negative quantity undoes a
+    transfer: stock goes back to the source and is removed from the
+    destination without touching either average cost.
+
+    Args:
+        from_shop: Source Shop instance or id
+        to_shop: Destination Shop instance or id
+        product: Product instance or id
+        quantity: Signed quantity to transfer
+        logger: Logger instance for recording operations
+        reason: History change reason
+        source: Model instance recorded as the movement source
+    """
+    post_stock_transfers([(from_shop, to_shop, product, quantity, source)], logger, reason=reason)
+
+
+def post_stock_transfers(lines, logger, reason=''):
+    """
+    Post many transfer lines (see post_stock_transfer) as one set-based unit.
+
+    Every Stock row the lines touch, in every shop, is locked with a single
+    query in (shop_id, product_id) order. Rows a line needs to create are
+    inserted first in one bulk insert. The new quantities and weighted
+    average costs are then worked out in memory, line by line in the order
+    given, and written back with one bulk update, one bulk history insert and
+    one bulk movement insert, all in one transaction. Under FIFO costing the
+    lines' lots are moved too (see transfer_lots).
+
+    The lines are transfers that have already been recorded, so reserved
+    stock is not held back from them; create_stock_transfers checks the
+    unreserved quantity before it records a transfer.
+
+    Args:
+        lines: Iterable of (from_shop, to_shop, product, quantity, source) tuples,
+            shops and product as instances or ids, source the model instance
+            recorded as the movement source (or None)
+        logger: Logger instance for recording operations
+        reason: History change reason
+    """
+    lines = [(_pk(from_shop), _pk(to_shop), _pk(product), quantity, source)
+             for from_shop, to_shop, product, quantity, source in lines if quantity]
+    if not lines:
+        return
+
+    keys, creatable = set(), set()
+    for from_id, to_id, product_id, quantity, source in lines:
+        keys |= {(from_id, product_id), (to_id, product_id)}
+        # Transfers create the destination row, returns create the source row
+        creatable.add((to_id, product_id) if quantity > 0 else (from_id, product_id))
+
+    with transaction.atomic():
+        stocks = lock_stock_rows(keys)
+        created = creatable - set(stocks)
+        if created:
+            Stock.objects.bulk_create(
+                [Stock(shop_id=shop_id, product_id=product_id, quantity=0, average_cost=ZERO, selling_price=ZERO)
+                 for shop_id, product_id in sorted(created)],
+                ignore_conflicts=True,
+            )
+            stocks = lock_stock_rows(keys)
+        original = {key: (stock.quantity, stock.average_cost) for key, stock in stocks.items()}
+        movements = []
+
+        for from_id, to_id, product_id, quantity, source in lines:
+            source_key, dest_key = (from_id, product_id), (to_id, product_id)
+            source_stock, dest_stock = stocks.get(source_key), stocks.get(dest_key)
+            ledger = dict(movement_type=StockMovement.TRANSFER, source=source, note=reason)
+
+            if quantity > 0:
+                if source_stock is not None:
+                    if source_stock.quantity < quantity:
+                        logger.warning(f"Insufficient stock for product {product_id} in shop {from_id}. "
+                                       f"Available: {source_stock.quantity}, Requested: {quantity}")
+                    remaining = max(source_stock.quantity - quantity, 0)
+                    movements.append(build_movement(from_id, product_id, remaining - source_stock.quantity,
+                                                    unit_cost=source_stock.average_cost, **ledger))
+                    source_stock.quantity = remaining
+                    transfer_cost = source_stock.average_cost
+                else:
+                    logger.warning(f"No stock record exists for product {product_id} in source shop {from_id}")
+                    transfer_cost = dest_stock.average_cost
+
+                dest_stock.average_cost = weighted_average_cost(dest_stock.quantity, dest_stock.average_cost,
+                                                                quantity, transfer_cost * quantity)
+                dest_stock.quantity += quantity
+                movements.append(build_movement(to_id, product_id, quantity, unit_cost=transfer_cost, **ledger))
+            else:
+                returned = -quantity
+                source_stock.quantity += returned
+                movements.append(build_movement(from_id, product_id, returned, **ledger))
+
+                if dest_stock is not None:
+                    if dest_stock.quantity < returned:
+                        logger.warning(f"Prevented negative stock for product {product_id} in shop {to_id}")
+                    remaining = max(dest_stock.quantity - returned, 0)
+                    movements.append(build_movement(to_id, product_id, remaining - dest_stock.quantity, **ledger))
+                    dest_stock.quantity = remaining
+                else:
+                    logger.warning(f"No stock record found for product {product_id} in destination shop {to_id}")
+
+        changed = {key for key, stock in stocks.items()
+                   if key in created or (stock.quantity, stock.average_cost) != original[key]}
+        repriced = [stocks[key] for key in changed if key in created or stocks[key].average_cost != original[key][1]]
+        if repriced:
+            margins = dict(Product.objects.filter(pk__in={stock.product_id for stock in repriced})
+                           .values_list('pk', 'profit_margin'))
+            for stock in repriced:
+                stock.selling_price = calculate_selling_price(stock.average_cost, margins[stock.product_id])
+        write_stock_rows([stocks[key] for key in sorted(changed)])
+
+        new_stocks = [stocks[key] for key in sorted(created) if key in stocks]
+        if new_stocks:
+            Stock.history.bulk_history_create(new_stocks, default_change_reason=reason)
+            logger.info(f"Created {len(new_stocks)} new stock records for transfer lines")
+        write_stock_history(changed - created, reason)
+        record_movements(movements)
+        stock_changed(keys)
+        if fifo_costing_enabled():
+            transfer_lots(lines)
+
+    logger.info(f"Posted {len(lines)} transfer lines, {len(changed)} stock rows changed")
@@ -0,0 +1,129 @@
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import DecimalField, F, Value
+from django.db.models.functions import Round
+
+from inventory.models.stock import Stock
+from inventory.services.inventory_cache import expire_inventory_snapshots
+from inventory.services.stock_posting import CENT, selling_price_expression
+from inventory.services.stock_version import bump_stock_versions
+from product.models import Product
+
+PRODUCT_BATCH_SIZE = 1000
+
+
+def _chunks(items, size):
+    for start in range(0, len(items), size):
+        yield items[start:start + size]
+
+
+def reprice_stock(product_ids, reason='', batch_size=PRODUCT_BATCH_SIZE):
+    """
+    Recompute the selling price of every Stock row of the given products from
+    their average cost and current profit margin.
+
+    Each shop is repriced with one set-based UPDATE per batch of products,
+    followed by one bulk history insert for the rows it touched, so repricing
+    thousands of products never loads or saves the rows one at a time.
+
+    Args:
+        product_ids: Iterable of product ids whose margin changed
+        reason: History change reason
+        batch_size: Number of products per UPDATE
+
+    Returns:
+        Number of Stock rows repriced
+    """
+    product_ids = sorted(set(product_ids))
+    if not product_ids:
+        return 0
+    shop_ids = sorted(Stock.objects.filter(product_id__in=product_ids)
+                      .values_list('shop_id', flat=True).distinct())
+    repriced = 0
+    with transaction.atomic():
+        for shop_id in shop_ids:
+            for chunk in _chunks(product_ids, batch_size):
+                rows = Stock.objects.filter(shop_id=shop_id, product_id__in=chunk)
+                if rows.update(selling_price=selling_price_expression(F('average_cost'))):
+                    stocks = list(rows)
+                    Stock.history.bulk_history_create(stocks, update=True, default_change_reason=reason,
+                                                      batch_size=batch_size)
+                    repriced += len(stocks)
+        bump_stock_versions(shop_ids)
+        transaction.on_commit(expire_inventory_snapshots)
+    return repriced
+
+
+def category_margin_followers(category):
+    """
+    Products of a category that inherit the category's margin rather than
+    use one of their own (Product.inherits_category_margin).
+    """
+    return Product.objects.filter(category=category, inherits_category_margin=True)
+
+
+def apply_category_margin(category, previous_margin, reason='', batch_size=PRODUCT_BATCH_SIZE):
+    """
+    Carry a category's new profit margin over to the products that inherit
+    it, and reprice their stock.
+
+    The products are updated with one UPDATE and one bulk history insert per
+    batch, then their stock is repriced with reprice_stock().
+
+    Args:
+        category: The Category, already saved with its new margin
+        previous_margin: The margin the category had before, for the history reason
+        reason: History change reason
+        batch_size: Number of products per batch
+
+    Returns:
+        tuple: (number of products updated, number of Stock rows repriced)
+    """
+    reason = reason or f"Category {category} margin changed from {previous_margin} to {category.profit_margin}"
+    with transaction.atomic():
+        product_ids = list(category_margin_followers(category).order_by('pk').values_list('pk', flat=True))
+        for chunk in _chunks(product_ids, batch_size):
+            Product.objects.filter(pk__in=chunk).update(profit_margin=category.profit_margin)
+            Product.history.bulk_history_create(Product.objects.filter(pk__in=chunk), update=True,
+                                                default_change_reason=reason, batch_size=batch_size)
+        repriced = reprice_stock(product_ids, reason=reason, batch_size=batch_size)
+    return len(product_ids), repriced
+
+
+def preview_category_margin(category, new_margin, sample_size=20):
+    """
+    What changing a category's margin would do, without changing anything.
+
+    Args:
+        category: The Category
+        new_margin: The margin being considered
+        sample_size: Number of example price changes to return
+
+    Returns:
+        dict with the number of 'products' and 'stock_rows' that would change,
+        and 'samples': up to sample_size dicts with the product, shop, average
+        cost and current and new selling price
+    """
+    products = category_margin_followers(category)
+    stocks = Stock.objects.filter(product__in=products)
+    new_price = Round(F('average_cost') + F('average_cost') * Value(new_margin) * Value(CENT), 2,
+                      output_field=DecimalField(max_digits=10, decimal_places=2))
+    samples = (stocks.annotate(new_selling_price=new_price)
+               .order_by('product__name', 'shop__name')
+               .values('product__name', 'shop__name', 'average_cost', 'selling_price', 'new_selling_price')
+               [:sample_size])
+    return {
+        'products': products.count(),
+        'stock_rows': stocks.count(),
+        'samples': [
+            {
+                'product': row['product__name'],
+                'shop': row['shop__name'],
+                'average_cost': row['average_cost'],
+                'selling_price': row['selling_price'],
+                'new_selling_price': Decimal(row['new_selling_price']).quantize(CENT),
+            }
+            for row in samples
+        ],
+    }
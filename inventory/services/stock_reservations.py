@@ -0,0 +1,151 @@
+import uuid
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.functions import Greatest
+from django.utils import timezone
+
+from inventory.models.stock import Stock
+from inventory.models.stock_reservation import StockReservation
+from inventory.services.stock_version import bump_stock_versions
+from utils import guarded_update
+
+RESERVATION_TTL = timedelta(minutes=15)
+
+
+def new_reservation_token():
+    """A fresh token to group the reservations of one sale."""
+    return uuid.uuid4().hex
+
+
+def available_quantity(shop, product):
+    """
+    Quantity of a product in a shop that is not reserved, from one indexed read.
+
+    Returns:
+        quantity - reserved_quantity, or None if the shop has no stock row for the product
+    """
+    shop_id, product_id = getattr(shop, 'pk', shop), getattr(product, 'pk', product)
+    return (Stock.objects.filter(shop_id=shop_id, product_id=product_id)
+            .values_list(F('quantity') - F('reserved_quantity'), flat=True).first())
+
+
+def reserve_stock(shop, product, quantity, token, ttl=RESERVATION_TTL):
+    """
+    Reserve stock if, and only if, enough of it is available.
+
+    The availability check and the reservation are one conditional UPDATE
+    (``reserved_quantity + n <= quantity``), so two sales can never both
+    reserve the last unit.
+
+    Args:
+        shop: Shop instance or id
+        product: Product instance or id
+        quantity: Quantity to reserve
+        token: Token grouping the reservations of one sale
+        ttl: How long the reservation holds before the sweeper releases it
+
+    Returns:
+        The StockReservation, or None if not enough stock is available
+    """
+    shop_id, product_id = getattr(shop, 'pk', shop), getattr(product, 'pk', product)
+    if quantity <= 0:
+        return None
+    with transaction.atomic():
+        reserved = guarded_update(Stock.objects.filter(shop_id=shop_id, product_id=product_id),
+                                  'reserved_quantity', quantity, maximum=F('quantity'))
+        if not reserved:
+            return None
+        bump_stock_versions([shop_id])
+        return StockReservation.objects.create(shop_id=shop_id, product_id=product_id, quantity=quantity,
+                                               token=token, expires_at=timezone.now() + ttl)
+
+
+def reserve_stock_lines(shop, lines, token, ttl=RESERVATION_TTL):
+    """
+    Reserve several products in one shop, all or nothing.
+
+    Args:
+        shop: Shop instance or id
+        lines: Iterable of (product, quantity) pairs; repeated products are added up
+        token: Token grouping the reservations of one sale
+        ttl: How long the reservations hold
+
+    Returns:
+        dict mapping product id to the quantity available, for every product that
+        could not be reserved; empty if everything was reserved
+    """
+    quantities = {}
+    for product, quantity in lines:
+        product_id = getattr(product, 'pk', product)
+        quantities[product_id] = quantities.get(product_id, 0) + quantity
+
+    shortages = {}
+    with transaction.atomic():
+        # Reserve in product order so concurrent multi-line sales lock rows in the same order
+        for product_id, quantity in sorted(quantities.items()):
+            if quantity > 0 and reserve_stock(shop, product_id, quantity, token, ttl) is None:
+                shortages[product_id] = available_quantity(shop, product_id) or 0
+        if shortages:
+            transaction.set_rollback(True)
+    return shortages
+
+
+def _release(reservations):
+    """Give the reserved quantity of the given reservations back and delete them."""
+    with transaction.atomic():
+        rows = list(reservations.select_for_update().values_list('pk', 'shop_id', 'product_id', 'quantity'))
+        totals = {}
+        for pk, shop_id, product_id, quantity in rows:
+            totals[(shop_id, product_id)] = totals.get((shop_id, product_id), 0) + quantity
+        for (shop_id, product_id), quantity in sorted(totals.items()):
+            (Stock.objects.filter(shop_id=shop_id, product_id=product_id)
+             .update(reserved_quantity=Greatest(F('reserved_quantity') - quantity, Value(0))))
+        StockReservation.objects.filter(pk__in=[row[0] for row in rows]).delete()
+        bump_stock_versions({shop_id for shop_id, product_id in totals})
+    return len(rows)
+
+
+def consume_reservations(token):
+    """
+    Consume the reservations of a sale that is being committed.
+
+    Call inside the transaction that decrements the stock, so the stock is
+    never counted as both reserved and sold.
+
+    Returns:
+        Number of reservations consumed
+    """
+    if not token:
+        return 0
+    return _release(StockReservation.objects.filter(token=token))
+
+
+def release_reservations(token):
+    """
+    Release the reservations of a sale that was abandoned.
+
+    Returns:
+        Number of reservations released
+    """
+    if not token:
+        return 0
+    return _release(StockReservation.objects.filter(token=token))
+
+
+def release_expired_reservations(now=None, chunk_size=1000):
+    """
+    Release every reservation whose expiry time has passed, in chunks.
+
+    Returns:
+        Number of reservations released
+    """
+    now = now or timezone.now()
+    released = 0
+    while True:
+        ids = list(StockReservation.objects.filter(expires_at__lte=now)
+                   .order_by('expires_at').values_list('pk', flat=True)[:chunk_size])
+        if not ids:
+            return released
+        released += _release(StockReservation.objects.filter(pk__in=ids, expires_at__lte=now))
@@ -0,0 +1,126 @@
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, DecimalField, ExpressionWrapper, F, Max, OuterRef, Q, Subquery, Sum, Value
+from django.db.models.functions import Coalesce
+from django.utils import timezone
+
+from inventory.models.product_stock_summary import ProductStockSummary
+from inventory.services.inventory_cache import expire_inventory_snapshots
+from inventory.models.stock import Stock
+from inventory.models.stock_movement import StockMovement
+from product.models import Product
+
+ZERO = Decimal('0.00')
+
+
+def _stock_totals(product_ids):
+    """Total quantity, total value and shops in stock per product, from the Stock rows."""
+    value = ExpressionWrapper(F('quantity') * F('average_cost'),
+                              output_field=DecimalField(max_digits=14, decimal_places=2))
+    rows = (Stock.objects.filter(product_id__in=product_ids)
+            .values('product_id')
+            .annotate(total_qty=Coalesce(Sum('quantity'), 0),
+                      total_value=Coalesce(Sum(value), Value(ZERO)),
+                      shops_in_stock=Count('pk', filter=Q(quantity__gt=0)))
+            .order_by())
+    return {row['product_id']: row for row in rows}
+
+
+def _apply_totals(summary, totals):
+    summary.total_qty = totals['total_qty'] if totals else 0
+    summary.total_value = Decimal(totals['total_value'] if totals else ZERO).quantize(Decimal('0.01'))
+    summary.shops_in_stock = totals['shops_in_stock'] if totals else 0
+
+
+def _summary_subqueries():
+    """Correlated subqueries of a summary row's totals over its product's Stock rows."""
+    value = ExpressionWrapper(F('quantity') * F('average_cost'),
+                              output_field=DecimalField(max_digits=14, decimal_places=2))
+    stocks = Stock.objects.filter(product_id=OuterRef('product_id')).values('product_id').order_by()
+    return {
+        'total_qty': Coalesce(Subquery(stocks.annotate(total=Sum('quantity')).values('total')), 0),
+        'total_value': Coalesce(Subquery(stocks.annotate(total=Sum(value)).values('total')), Value(ZERO)),
+        'shops_in_stock': Coalesce(Subquery(stocks.annotate(shops=Count('pk', filter=Q(quantity__gt=0)))
+                                            .values('shops')), 0),
+    }
+
+
+def _refresh_summaries(product_ids, moved_at):
+    ProductStockSummary.objects.bulk_create(
+        [ProductStockSummary(product_id=product_id) for product_id in product_ids],
+        ignore_conflicts=True,
+    )
+    ProductStockSummary.objects.filter(product_id__in=product_ids).update(
+        last_movement_at=moved_at, updated_at=timezone.now(), **_summary_subqueries())
+    expire_inventory_snapshots()
+
+
+def refresh_product_summaries(product_ids, moved_at=None):
+    """
+    Recompute the cross-shop summary of the given products from their Stock rows.
+
+    Runs once the transaction that changed the stock commits (straight away
+    outside a transaction), as one UPDATE whose subqueries sum the Stock rows.
+    No summary row is locked while the stock transaction is open, so tills
+    selling the same product in different shops do not queue on it, and the
+    totals are read by the UPDATE itself (a locking read on InnoDB), so they
+    include every stock change committed before it; the refresh that runs
+    last always writes the latest totals.
+
+    Args:
+        product_ids: Iterable of product ids (or Product instances)
+        moved_at: Time of the stock change; defaults to now
+    """
+    product_ids = sorted({getattr(product, 'pk', product) for product in product_ids} - {None})
+    if not product_ids:
+        return
+    moved_at = moved_at or timezone.now()
+    transaction.on_commit(lambda: _refresh_summaries(product_ids, moved_at))
+
+
+def rebuild_product_summaries(chunk_size=1000):
+    """
+    Rebuild every product's summary from the Stock rows and the movement ledger.
+
+    Products are processed in primary key order, one transaction per chunk.
+
+    Returns:
+        Number of summary rows written
+    """
+    written = 0
+    last_pk = 0
+    while True:
+        product_ids = list(Product.objects.filter(pk__gt=last_pk).order_by('pk')
+                           .values_list('pk', flat=True)[:chunk_size])
+        if not product_ids:
+            return written
+        last_pk = product_ids[-1]
+
+        with transaction.atomic():
+            totals = _stock_totals(product_ids)
+            last_movements = dict(StockMovement.objects.filter(product_id__in=product_ids)
+                                  .values('product_id').annotate(latest=Max('created_at'))
+                                  .order_by().values_list('product_id', 'latest'))
+            summaries = []
+            for product_id in product_ids:
+                summary = ProductStockSummary(product_id=product_id, last_movement_at=last_movements.get(product_id),
+                                              updated_at=timezone.now())
+                _apply_totals(summary, totals.get(product_id))
+                summaries.append(summary)
+            ProductStockSummary.objects.filter(product_id__in=product_ids).delete()
+            ProductStockSummary.objects.bulk_create(summaries)
+            transaction.on_commit(expire_inventory_snapshots)
+        written += len(summaries)
+
+
+def product_availability(product):
+    """
+    Cross-shop stock of one product as a single-row read.
+
+    Returns:
+        The ProductStockSummary, or an unsaved empty one if the product has never had stock
+    """
+    product_id = getattr(product, 'pk', product)
+    summary = ProductStockSummary.objects.filter(product_id=product_id).first()
+    return summary or ProductStockSummary(product_id=product_id)
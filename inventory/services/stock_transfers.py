@@ -0,0 +1,102 @@
+from django.db import transaction
+
+from inventory.models.stock_transfers import StockTransfer, StockTransferItem
+from inventory.services.stock_posting import lock_stock_rows, post_stock_transfers
+from product.models import Product
+from shop.models import Shop
+
+
+def _requested_quantities(transfer):
+    """Total quantity requested per product in one transfer."""
+    quantities = {}
+    for item in transfer['items']:
+        quantities[item['product']] = quantities.get(item['product'], 0) + item['quantity']
+    return quantities
+
+
+def create_stock_transfers(transfers, logger):
+    """
+    Validate and post a batch of stock transfers in one transaction.
+
+    Every source and destination Stock row in the batch is locked with one
+    query. Transfers are then checked in order against a running tally of
+    what is available (quantity less reserved_quantity, so stock held for a
+    sale is not shipped), so a transfer may ship stock that an earlier
+    transfer in the same batch delivered. Transfers that fail are reported and
+    skipped; the rest are created with their items bulk-inserted and posted
+    through post_stock_transfers as one batch.
+
+    Args:
+        transfers: List of dicts with from_shop, to_shop, description and
+            items (a list of dicts with product and quantity), ids as integers
+        logger: Logger instance for recording operations
+
+    Returns:
+        List aligned with ``transfers``: {'transfer_id': id} for transfers that
+        were created, {'errors': [messages]} for ones that were not
+    """
+    requested = [_requested_quantities(transfer) for transfer in transfers]
+    shop_ids = {transfer[field] for transfer in transfers for field in ('from_shop', 'to_shop')}
+    product_ids = {product_id for quantities in requested for product_id in quantities}
+    results = [None] * len(transfers)
+
+    with transaction.atomic():
+        known_shops = set(Shop.objects.filter(pk__in=shop_ids).values_list('pk', flat=True))
+        known_products = set(Product.objects.filter(pk__in=product_ids).values_list('pk', flat=True))
+        keys = {(transfer[field], product_id)
+                for transfer, quantities in zip(transfers, requested)
+                for field in ('from_shop', 'to_shop')
+                for product_id in quantities}
+        available = {key: stock.quantity - stock.reserved_quantity for key, stock in lock_stock_rows(keys).items()}
+
+        accepted = []
+        for index, (transfer, quantities) in enumerate(zip(transfers, requested)):
+            from_id, to_id = transfer['from_shop'], transfer['to_shop']
+            errors = [f"Shop {shop_id} does not exist" for shop_id in (from_id, to_id) if shop_id not in known_shops]
+            errors += [f"Product {product_id} does not exist" for product_id in quantities
+                       if product_id not in known_products]
+            if not errors:
+                for product_id, quantity in quantities.items():
+                    available_stock = available.get((from_id, product_id), 0)
+                    if quantity > available_stock:
+                        errors.append(f"Insufficient stock for product {product_id} in shop {from_id}. "
+                                      f"Available: {available_stock}, Requested: {quantity}")
+            if errors:
+                results[index] = {'errors': errors}
+                continue
+
+            for product_id, quantity in quantities.items():
+                available[(from_id, product_id)] -= quantity
+                available[(to_id, product_id)] = available.get((to_id, product_id), 0) + quantity
+            accepted.append(index)
+
+        created = {}
+        for index in accepted:
+            transfer = transfers[index]
+            stock_transfer = StockTransfer(from_shop_id=transfer['from_shop'], to_shop_id=transfer['to_shop'],
+                                           description=transfer.get('description') or None)
+            stock_transfer.save()
+            created[stock_transfer.pk] = stock_transfer
+            results[index] = {'transfer_id': stock_transfer.pk}
+
+        StockTransferItem.objects.bulk_create([
+            StockTransferItem(stock_transfer_id=results[index]['transfer_id'],
+                              product_id=item['product'], quantity=item['quantity'])
+            for index in accepted
+            for item in transfers[index]['items']
+        ], batch_size=1000)
+        # Read the items back rather than rely on bulk_create setting primary keys (it does not on MySQL)
+        items = list(StockTransferItem.objects.filter(stock_transfer_id__in=created).order_by('pk'))
+        StockTransferItem.history.bulk_history_create(items, default_change_reason="Bulk stock transfer",
+                                                      batch_size=1000)
+
+        post_stock_transfers(
+            [(created[item.stock_transfer_id].from_shop_id, created[item.stock_transfer_id].to_shop_id,
+              item.product_id, item.quantity, item) for item in items],
+            logger,
+            reason="Bulk stock transfer",
+        )
+
+    logger.info(f"Bulk stock transfer: {len(accepted)} of {len(transfers)} transfers created, "
+                f"{len(items)} lines posted")
+    return results
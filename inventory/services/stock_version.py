@@ -0,0 +1,31 @@
+from django.db import transaction
+from django.db.models import F
+
+from inventory.models.stock_version import StockVersion
+
+
+def _increment(shop_ids):
+    StockVersion.objects.bulk_create([StockVersion(shop_id=shop_id) for shop_id in shop_ids],
+                                     ignore_conflicts=True)
+    StockVersion.objects.filter(shop_id__in=shop_ids).update(version=F('version') + 1)
+
+
+def bump_stock_versions(shop_ids):
+    """
+    Increment the stock version of the given shops once the current transaction commits.
+
+    The increment runs after commit, in its own statement, so the version row
+    is never held locked for the length of a sale or purchase and tills in the
+    same shop do not queue behind each other.
+
+    Args:
+        shop_ids: Iterable of shop ids (or Shop instances)
+    """
+    shop_ids = sorted({getattr(shop, 'pk', shop) for shop in shop_ids} - {None})
+    if shop_ids:
+        transaction.on_commit(lambda: _increment(shop_ids))
+
+
+def stock_version(shop_id):
+    """Current stock version of a shop (0 if its stock was never written)."""
+    return StockVersion.objects.filter(shop_id=shop_id).values_list('version', flat=True).first() or 0
@@ -1 +1,2 @@
 from .handlers import stock_transfer_handlers
+from .handlers import stock_handlers
@@ -0,0 +1,33 @@
+from django.db.models.signals import post_save, post_delete
+from django.dispatch import receiver
+import logging
+
+from bulk_recompute import skip_during_bulk_recompute
+from inventory.models.stock import Stock
+from inventory.signals.logic.stock_logic import process_stock_change
+
+# Set up logger
+logger = logging.getLogger(__name__)
+
+
+@receiver(post_save, sender=Stock)
+@skip_during_bulk_recompute
+def update_derived_stock_data_on_save(sender, instance, **kwargs):
+    """
+    Refresh the product's stock summary and the shop's stock version when a
+    Stock row is created or saved.
+
+    Set-based updates from the stock posting service bypass this signal and
+    do the same themselves.
+    """
+    process_stock_change(instance, logger)
+
+
+@receiver(post_delete, sender=Stock)
+@skip_during_bulk_recompute
+def update_derived_stock_data_on_delete(sender, instance, **kwargs):
+    """
+    Refresh the product's stock summary and the shop's stock version when a
+    Stock row is deleted.
+    """
+    process_stock_change(instance, logger)
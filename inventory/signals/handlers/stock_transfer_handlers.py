@@ -2,6 +2,7 @@ from django.db.models.signals import pre_save, post_save, pre_delete, post_delet
 from django.dispatch import receiver
 import logging
 
+from bulk_recompute import skip_during_bulk_recompute
 from inventory.models.stock_transfers import StockTransfer, StockTransferItem
 from inventory.signals.logic.stock_transfer_logic import capture_original_item_data, capture_original_transfer_data, process_transfer_item_creation, process_transfer_item_deletion, process_transfer_item_update, process_transfer_shop_changes
 
@@ -10,6 +11,7 @@ logger = logging.getLogger(__name__)
 
 
 @receiver(pre_save, sender=StockTransfer)
+@skip_during_bulk_recompute
 def store_original_transfer_data(sender, instance, **kwargs):
     """
     Store the original shop values before a StockTransfer is updated.
@@ -21,6 +23,7 @@ def store_original_transfer_data(sender, instance, **kwargs):
 
 
 @receiver(post_save, sender=StockTransfer)
+@skip_during_bulk_recompute
 def handle_transfer_shop_changes(sender, instance, created, **kwargs):
     """
     When a stock transfer's shops are changed, update all associated items.
@@ -38,6 +41,7 @@ def handle_transfer_shop_changes(sender, instance, created, **kwargs):
 
 
 @receiver(pre_save, sender=StockTransferItem)
+@skip_during_bulk_recompute
 def store_original_item_data(sender, instance, **kwargs):
     """
     Store the original quantity and product before a StockTransferItem is updated.
@@ -48,6 +52,7 @@ def store_original_item_data(sender, instance, **kwargs):
 
 
 @receiver(post_save, sender=StockTransferItem)
+@skip_during_bulk_recompute
 def update_stock_on_transfer_item_save(sender, instance, created, **kwargs):
     """
     Update stock quantities when a transfer item is created or updated.
@@ -68,6 +73,7 @@ def update_stock_on_transfer_item_save(sender, instance, created, **kwargs):
 
 
 @receiver(post_delete, sender=StockTransferItem)
+@skip_during_bulk_recompute
 def update_stock_on_transfer_item_delete(sender, instance, **kwargs):
     """
     When a stock transfer item is deleted, reverse the stock changes.
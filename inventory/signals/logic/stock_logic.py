@@ -0,0 +1,14 @@
+from inventory.services.stock_posting import stock_changed
+
+
+def process_stock_change(instance, logger):
+    """
+    Refresh what is derived from a Stock row (product summary, shop stock version)
+    after it was saved or deleted.
+
+    Args:
+        instance: The Stock instance that changed
+        logger: Logger instance for recording operations
+    """
+    stock_changed([(instance.shop_id, instance.product_id)])
+    logger.debug(f"Processed stock change for product {instance.product_id} in shop {instance.shop_id}")
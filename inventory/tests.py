@@ -0,0 +1,1308 @@
+import logging
+import threading
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections, transaction
+from django.test import TestCase, TransactionTestCase, override_settings, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from guardian.shortcuts import assign_perm
+from tablib import Dataset
+
+from inventory.admin.resources import StockResource
+from inventory.models.product_stock_summary import ProductStockSummary
+from inventory.models.stock import Stock
+from inventory.models.stock_count import StockCount
+from inventory.models.stock_lot import StockLot, StockLotConsumption
+from inventory.models.stock_reservation import StockReservation
+from inventory.models.stock_movement import StockMovement, StockSnapshot
+from inventory.models.stock_transfers import StockTransfer, StockTransferItem
+from inventory.services.stock_counts import apply_stock_count, compute_variances, read_count_file, record_counts
+from inventory.services.stock_lots import consume_lots, open_stock_lots
+from inventory.services.stock_ledger import movement_summary, stock_on_date, take_snapshot
+from inventory.services.stock_posting import post_stock_quantity, post_stock_transfer, post_stock_value
+from inventory.services.stock_reservations import (available_quantity, release_reservations, reserve_stock,
+                                                   reserve_stock_lines)
+from inventory.services.stock_summary import product_availability
+from product.models import Category, Product
+from purchase_invoice.models import PurchaseInvoice, PurchaseInvoiceItem
+from sale_invoice.models import SalesInvoice, SalesInvoiceItem
+from sale_invoice.services.unit_of_work import sales_unit_of_work
+from shop.models import Shop
+from supplier.models import Supplier
+
+logger = logging.getLogger(__name__)
+
+
+class StockPostingTestCase(TestCase):
+    """Test the stock posting service used by the sales, purchase and transfer signals."""
+
+    def setUp(self):
+        """Set up two shops and a stocked product."""
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.other_shop = Shop.objects.create(name="Branch Shop", code="BS01")
+        self.product = Product.objects.create(name="Product 1", profit_margin=Decimal('10.00'))
+        self.stock = Stock.objects.create(
+            shop=self.shop,
+            product=self.product,
+            quantity=10,
+            average_cost=Decimal('100.00')
+        )
+
+    def test_quantity_decrement_and_increment(self):
+        """Test that quantity postings are applied and recorded in history."""
+        history_count = self.stock.history.count()
+
+        self.assertEqual(post_stock_quantity(self.shop, self.product, -4, logger), -4)
+        self.assertEqual(post_stock_quantity(self.shop.pk, self.product.pk, 2, logger), 2)
+
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 8)
+        self.assertEqual(self.stock.history.count(), history_count + 2)
+
+    def test_quantity_decrement_is_clamped_at_zero(self):
+        """Test that overselling clamps the stock at zero and reports the applied change."""
+        self.assertEqual(post_stock_quantity(self.shop, self.product, -15, logger), -10)
+
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 0)
+
+    def test_quantity_posting_without_stock_row(self):
+        """Test that a missing row is only created when asked to."""
+        self.assertIsNone(post_stock_quantity(self.other_shop, self.product, 5, logger))
+        self.assertFalse(Stock.objects.filter(shop=self.other_shop, product=self.product).exists())
+
+        self.assertEqual(post_stock_quantity(self.other_shop, self.product, 5, logger, create_missing=True), 5)
+        self.assertEqual(Stock.objects.get(shop=self.other_shop, product=self.product).quantity, 5)
+
+    def test_value_posting_updates_average_cost_and_selling_price(self):
+        """Test the weighted average cost and selling price after a purchase."""
+        post_stock_value(self.shop, self.product, 10, Decimal('1200.00'), logger)
+
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 20)
+        self.assertEqual(self.stock.average_cost, Decimal('110.00'))
+        self.assertEqual(self.stock.selling_price, Decimal('121.00'))
+
+    def test_value_posting_creates_missing_row(self):
+        """Test that a purchase into a shop without stock creates the row at the purchase cost."""
+        stock = post_stock_value(self.other_shop, self.product, 3, Decimal('150.00'), logger,
+                                 create_cost=Decimal('50.00'))
+
+        self.assertEqual(stock.quantity, 3)
+        self.assertEqual(stock.average_cost, Decimal('50.00'))
+        self.assertEqual(stock.selling_price, Decimal('55.00'))
+
+    def test_transfer_and_reversal(self):
+        """Test that a transfer moves stock at source cost and that a reversal undoes it."""
+        post_stock_transfer(self.shop, self.other_shop, self.product, 4, logger)
+
+        destination = Stock.objects.get(shop=self.other_shop, product=self.product)
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 6)
+        self.assertEqual(destination.quantity, 4)
+        self.assertEqual(destination.average_cost, Decimal('100.00'))
+
+        post_stock_transfer(self.shop, self.other_shop, self.product, -4, logger)
+
+        destination.refresh_from_db()
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 10)
+        self.assertEqual(destination.quantity, 0)
+
+    def test_transfer_item_signals_use_posting_service(self):
+        """Test transfer item create, update and delete through the signal handlers."""
+        transfer = StockTransfer.objects.create(from_shop=self.shop, to_shop=self.other_shop)
+        item = StockTransferItem.objects.create(stock_transfer=transfer, product=self.product, quantity=3)
+        destination = Stock.objects.get(shop=self.other_shop, product=self.product)
+        self.assertEqual(destination.quantity, 3)
+
+        item.quantity = 5
+        item.save()
+        destination.refresh_from_db()
+        self.stock.refresh_from_db()
+        self.assertEqual(destination.quantity, 5)
+        self.assertEqual(self.stock.quantity, 5)
+
+        item.delete()
+        destination.refresh_from_db()
+        self.stock.refresh_from_db()
+        self.assertEqual(destination.quantity, 0)
+        self.assertEqual(self.stock.quantity, 10)
+
+
+    def test_transfer_shop_change_is_posted_as_one_batch(self):
+        """Test that changing a transfer's shops moves every item in a fixed number of queries."""
+        third_shop = Shop.objects.create(name="Third Shop", code="TS01")
+        products = [self.product] + [Product.objects.create(name=f"Product {n}", profit_margin=Decimal('10.00'))
+                                     for n in range(2, 12)]
+        for product in products[1:]:
+            Stock.objects.create(shop=self.shop, product=product, quantity=10, average_cost=Decimal('20.00'))
+        transfer = StockTransfer.objects.create(from_shop=self.shop, to_shop=self.other_shop)
+        for product in products:
+            StockTransferItem.objects.create(stock_transfer=transfer, product=product, quantity=2)
+
+        transfer.to_shop = third_shop
+        with CaptureQueriesContext(connection) as queries:
+            transfer.save()
+
+        self.assertLess(len(queries), 30)
+        self.assertEqual(set(Stock.objects.filter(shop=self.other_shop).values_list('quantity', flat=True)), {0})
+        moved = Stock.objects.filter(shop=third_shop).order_by('product_id')
+        self.assertEqual([stock.quantity for stock in moved], [2] * len(products))
+        self.assertEqual(moved[0].average_cost, Decimal('100.00'))
+        self.assertEqual(moved[0].selling_price, Decimal('110.00'))
+        self.assertEqual(Stock.objects.get(shop=self.shop, product=self.product).quantity, 8)
+
+
+class FieldTrackerTestCase(TestCase):
+    """Test the field tracker that replaces the pre_save re-fetches."""
+
+    def setUp(self):
+        """Set up two shops and a stocked product."""
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.other_shop = Shop.objects.create(name="Branch Shop", code="BS01")
+        self.product = Product.objects.create(name="Product 1", profit_margin=Decimal('10.00'))
+        self.stock = Stock.objects.create(shop=self.shop, product=self.product, quantity=10,
+                                          average_cost=Decimal('100.00'))
+
+    def test_original_and_has_changed(self):
+        """Test that loaded values are remembered, foreign keys by id, and move forward on save."""
+        stock = Stock.objects.get(pk=self.stock.pk)
+        self.assertFalse(stock.has_changed('quantity'))
+
+        stock.quantity = 12
+        stock.shop = self.other_shop
+        self.assertTrue(stock.has_changed('quantity'))
+        self.assertEqual(stock.original('quantity'), 10)
+        self.assertEqual(stock.original('shop'), self.shop.pk)
+        with self.assertNumQueries(1):
+            self.assertEqual(stock.original_related('shop'), self.shop)
+
+        stock.save()
+        self.assertFalse(stock.has_changed('quantity'))
+        self.assertEqual(stock.original('shop'), self.other_shop.pk)
+
+    def test_hand_built_instance_reads_stored_values_once(self):
+        """Test that an instance not loaded from the database falls back to one read."""
+        stock = Stock(pk=self.stock.pk, shop=self.shop, product=self.product, quantity=3,
+                      average_cost=Decimal('100.00'))
+        with self.assertNumQueries(1):
+            self.assertEqual(stock.original('quantity'), 10)
+            self.assertTrue(stock.has_changed('quantity'))
+            self.assertFalse(stock.has_changed('average_cost'))
+
+    def test_stock_save_does_not_refetch_the_row(self):
+        """Test that a stock adjustment records its movement from the tracked quantity."""
+        stock = Stock.objects.select_related('product').get(pk=self.stock.pk)
+        stock.quantity = 7
+        with CaptureQueriesContext(connection) as queries:
+            stock.save()
+        self.assertFalse([query for query in queries if query['sql'].startswith('SELECT')
+                          and f'WHERE "{Stock._meta.db_table}"."id" =' in query['sql']])
+        self.assertEqual(StockMovement.objects.filter(shop=self.shop, product=self.product).first().quantity, -3)
+
+
+class StockRepricingTestCase(TestCase):
+    """Test the bulk selling price recalculation on profit margin changes."""
+
+    def setUp(self):
+        """Set up a category with an inheriting product and two with their own margins, stocked in two shops."""
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.other_shop = Shop.objects.create(name="Branch Shop", code="BS01")
+        self.category = Category.objects.create(name="Drinks", profit_margin=Decimal('10.00'))
+        self.follower = Product.objects.create(name="Cola", category=self.category, inherits_category_margin=True)
+        self.custom = Product.objects.create(name="Water", category=self.category, profit_margin=Decimal('50.00'))
+        self.same = Product.objects.create(name="Juice", category=self.category, profit_margin=Decimal('10.00'))
+        for shop in (self.shop, self.other_shop):
+            for product in (self.follower, self.custom, self.same):
+                Stock.objects.create(shop=shop, product=product, quantity=5, average_cost=Decimal('100.00'))
+
+    def test_product_margin_change_reprices_its_stock(self):
+        """Test that a real margin change reprices every shop and writes history in bulk."""
+        stock = Stock.objects.get(shop=self.shop, product=self.custom)
+        history = stock.history.count()
+
+        self.custom.profit_margin = Decimal('25.00')
+        self.custom.save()
+
+        self.assertEqual(set(Stock.objects.filter(product=self.custom).values_list('selling_price', flat=True)),
+                         {Decimal('125.00')})
+        self.assertEqual(stock.history.count(), history + 1)
+
+    def test_save_without_margin_change_does_nothing(self):
+        """Test that saving a product without changing its margin writes no stock."""
+        self.follower.name = "Cola Zero"
+        with CaptureQueriesContext(connection) as queries:
+            self.follower.save()
+        self.assertFalse([query for query in queries if 'inventory_stock' in query['sql']])
+
+    def test_category_margin_change_moves_following_products(self):
+        """Test that a category margin change carries over to inheriting products only, not equal margins."""
+        self.category.profit_margin = Decimal('20.00')
+        self.category.save()
+
+        self.follower.refresh_from_db()
+        self.custom.refresh_from_db()
+        self.same.refresh_from_db()
+        self.assertEqual(self.follower.profit_margin, Decimal('20.00'))
+        self.assertEqual(self.custom.profit_margin, Decimal('50.00'))
+        self.assertEqual(self.same.profit_margin, Decimal('10.00'))
+        self.assertEqual(set(Stock.objects.filter(product=self.follower).values_list('selling_price', flat=True)),
+                         {Decimal('120.00')})
+        self.assertEqual(set(Stock.objects.filter(product=self.custom).values_list('selling_price', flat=True)),
+                         {Decimal('150.00')})
+        self.assertEqual(self.follower.history.first().history_type, '~')
+
+    def test_inheriting_product_takes_the_category_margin(self):
+        """Test that a product set to inherit takes the category margin over its own."""
+        self.custom.inherits_category_margin = True
+        self.custom.save()
+
+        self.custom.refresh_from_db()
+        self.assertEqual(self.custom.profit_margin, Decimal('10.00'))
+        self.assertEqual(Stock.objects.get(shop=self.shop, product=self.custom).selling_price, Decimal('110.00'))
+
+    def test_reprice_category_command_previews_and_applies(self):
+        """Test that the command previews without changing anything, then applies the change."""
+        out = StringIO()
+        call_command('reprice_category', str(self.category.pk), '30', '--dry-run', stdout=out)
+        self.assertIn("1 products, 2 stock rows", out.getvalue())
+        self.assertIn("110.00 -> 130.00", out.getvalue())
+        self.follower.refresh_from_db()
+        self.assertEqual(self.follower.profit_margin, Decimal('10.00'))
+
+        call_command('reprice_category', 'Drinks', '30', stdout=StringIO())
+        self.assertEqual(Stock.objects.get(shop=self.shop, product=self.follower).selling_price, Decimal('130.00'))
+
+
+class StockLedgerTestCase(TestCase):
+    """Test the stock movement ledger and point-in-time stock queries."""
+
+    def setUp(self):
+        """Set up a shop with a stocked product."""
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.other_shop = Shop.objects.create(name="Branch Shop", code="BS01")
+        self.product = Product.objects.create(name="Product 1", profit_margin=Decimal('10.00'))
+        self.stock = Stock.objects.create(
+            shop=self.shop,
+            product=self.product,
+            quantity=10,
+            average_cost=Decimal('100.00')
+        )
+
+    def test_postings_are_recorded_with_source(self):
+        """Test that every posting leaves a typed movement pointing at its source."""
+        transfer = StockTransfer.objects.create(from_shop=self.shop, to_shop=self.other_shop)
+        item = StockTransferItem.objects.create(stock_transfer=transfer, product=self.product, quantity=4)
+
+        movements = StockMovement.objects.filter(movement_type=StockMovement.TRANSFER)
+        self.assertEqual(
+            sorted(movements.values_list('shop_id', 'quantity')),
+            sorted([(self.shop.pk, -4), (self.other_shop.pk, 4)])
+        )
+        self.assertTrue(all(movement.source == item for movement in movements))
+
+    def test_manual_adjustment_is_recorded(self):
+        """Test that saving a changed quantity records an adjustment."""
+        self.stock.quantity = 7
+        self.stock.save()
+
+        adjustment = StockMovement.objects.filter(movement_type=StockMovement.ADJUSTMENT).first()
+        self.assertEqual(adjustment.quantity, -3)
+
+    def test_movements_are_append_only(self):
+        """Test that recorded movements cannot be edited or deleted."""
+        movement = StockMovement.objects.first()
+        movement.quantity = 99
+        with self.assertRaises(ValueError):
+            movement.save()
+        with self.assertRaises(ValueError):
+            movement.delete()
+
+    def test_stock_on_date_with_and_without_snapshot(self):
+        """Test point-in-time quantities before and after a snapshot is taken."""
+        before_sales = timezone.now()
+        post_stock_quantity(self.shop, self.product, -3, logger, movement_type=StockMovement.SALE)
+        after_first_sale = timezone.now()
+
+        # No snapshot yet: worked back from the current stock
+        self.assertEqual(stock_on_date(self.shop, self.product, before_sales), 10)
+
+        self.assertEqual(take_snapshot(after_first_sale), 1)
+        self.assertEqual(take_snapshot(after_first_sale), 0)
+        post_stock_quantity(self.shop, self.product, -2, logger, movement_type=StockMovement.SALE)
+
+        self.assertEqual(StockSnapshot.objects.get().quantity, 7)
+        self.assertEqual(stock_on_date(self.shop, self.product, after_first_sale), 7)
+        self.assertEqual(stock_on_date(self.shop, self.product, timezone.now()), 5)
+        self.assertEqual(stock_on_date(self.other_shop, self.product, timezone.now()), 0)
+
+    def test_movement_summary(self):
+        """Test opening, in, out and closing quantities between two dates."""
+        start = timezone.now()
+        post_stock_quantity(self.shop, self.product, -3, logger, movement_type=StockMovement.SALE)
+        post_stock_value(self.shop, self.product, 5, Decimal('500.00'), logger, movement_type=StockMovement.PURCHASE)
+        post_stock_quantity(self.shop, self.product, -1, logger, movement_type=StockMovement.SALE)
+        take_snapshot(start + timedelta(microseconds=1))
+
+        summary = movement_summary(start, timezone.now())
+
+        self.assertEqual(summary[(self.shop.pk, self.product.pk)],
+                         {'opening': 10, 'in': 5, 'out': 4, 'closing': 11})
+
+
+class ProductStockSummaryTestCase(TestCase):
+    """Test that the cross-shop stock summary follows every stock change."""
+
+    def setUp(self):
+        """Set up two shops and a product stocked in one of them."""
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.other_shop = Shop.objects.create(name="Branch Shop", code="BS01")
+        self.product = Product.objects.create(name="Product 1", profit_margin=Decimal('10.00'))
+        with self.captureOnCommitCallbacks(execute=True):
+            Stock.objects.create(shop=self.shop, product=self.product, quantity=10, average_cost=Decimal('100.00'))
+
+    def assertSummary(self, total_qty, total_value, shops_in_stock):
+        summary = product_availability(self.product)
+        self.assertEqual((summary.total_qty, summary.total_value, summary.shops_in_stock),
+                         (total_qty, Decimal(total_value), shops_in_stock))
+
+    def test_summary_follows_postings(self):
+        """Test that sales, purchases and transfers keep the totals in step."""
+        self.assertSummary(10, '1000.00', 1)
+
+        # Summaries are refreshed once the stock change commits
+        with self.captureOnCommitCallbacks(execute=True):
+            post_stock_quantity(self.shop, self.product, -4, logger)
+        self.assertSummary(6, '600.00', 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post_stock_value(self.other_shop, self.product, 2, Decimal('300.00'), logger,
+                             create_cost=Decimal('150.00'))
+        self.assertSummary(8, '900.00', 2)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post_stock_transfer(self.shop, self.other_shop, self.product, 6, logger)
+        self.assertSummary(8, '900.00', 1)
+        self.assertIsNotNone(product_availability(self.product).last_movement_at)
+
+    def test_summary_follows_saves_and_deletes(self):
+        """Test that direct saves and deletes of Stock rows refresh the summary."""
+        stock = Stock.objects.get(shop=self.shop, product=self.product)
+        stock.average_cost = Decimal('50.00')
+        with self.captureOnCommitCallbacks(execute=True):
+            stock.save()
+        self.assertSummary(10, '500.00', 1)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            stock.delete()
+        self.assertSummary(0, '0.00', 0)
+
+    def test_rebuild(self):
+        """Test that the rebuild command restores summaries that drifted or were never written."""
+        ProductStockSummary.objects.all().delete()
+        unstocked = Product.objects.create(name="Product 2", profit_margin=Decimal('10.00'))
+
+        call_command('rebuild_stock_summaries', stdout=StringIO())
+
+        self.assertSummary(10, '1000.00', 1)
+        self.assertEqual(ProductStockSummary.objects.get(product=unstocked).total_qty, 0)
+        self.assertEqual(ProductStockSummary.objects.get(product=self.product).last_movement_at,
+                         StockMovement.objects.filter(product=self.product).latest('created_at').created_at)
+
+
+class StockReservationTestCase(TestCase):
+    """Test stock reservations and the availability they leave."""
+
+    def setUp(self):
+        """Set up a shop with three units of one product and one of another."""
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.product = Product.objects.create(name="Product 1", profit_margin=Decimal('10.00'))
+        self.other_product = Product.objects.create(name="Product 2", profit_margin=Decimal('10.00'))
+        Stock.objects.create(shop=self.shop, product=self.product, quantity=3, average_cost=Decimal('10.00'))
+        Stock.objects.create(shop=self.shop, product=self.other_product, quantity=1, average_cost=Decimal('10.00'))
+
+    def test_reserve_only_what_is_available(self):
+        """Test that a reservation succeeds only while unreserved stock covers it."""
+        self.assertIsNotNone(reserve_stock(self.shop, self.product, 2, 'till-1'))
+        self.assertEqual(available_quantity(self.shop, self.product), 1)
+
+        self.assertIsNone(reserve_stock(self.shop, self.product, 2, 'till-2'))
+        self.assertIsNotNone(reserve_stock(self.shop, self.product, 1, 'till-2'))
+        self.assertEqual(available_quantity(self.shop, self.product), 0)
+
+        release_reservations('till-1')
+        self.assertEqual(available_quantity(self.shop, self.product), 2)
+        self.assertFalse(StockReservation.objects.filter(token='till-1').exists())
+
+    def test_reserve_lines_is_all_or_nothing(self):
+        """Test that one short line leaves no reservation behind."""
+        shortages = reserve_stock_lines(self.shop, [(self.product, 2), (self.other_product, 2)], 'till-1')
+
+        self.assertEqual(shortages, {self.other_product.pk: 1})
+        self.assertFalse(StockReservation.objects.exists())
+        self.assertEqual(Stock.objects.get(shop=self.shop, product=self.product).reserved_quantity, 0)
+
+    def test_sweeper_releases_expired_reservations(self):
+        """Test that the sweeper command releases expired reservations and keeps live ones."""
+        reserve_stock(self.shop, self.product, 1, 'expired', ttl=timedelta(seconds=-1))
+        reserve_stock(self.shop, self.product, 1, 'live')
+
+        call_command('release_expired_reservations', stdout=StringIO())
+
+        self.assertEqual(list(StockReservation.objects.values_list('token', flat=True)), ['live'])
+        self.assertEqual(Stock.objects.get(shop=self.shop, product=self.product).reserved_quantity, 1)
+
+
+    def test_posting_a_recorded_sale_takes_reserved_stock(self):
+        """Test that posting a sale that was already recorded overrides other sales' reservations."""
+        reserve_stock(self.shop, self.product, 2, 'till-1')
+        logger = logging.getLogger('inventory.tests')
+
+        with self.assertLogs(logger, 'WARNING') as logs:
+            applied = post_stock_quantity(self.shop, self.product, -2, logger)
+
+        self.assertEqual(applied, -2)
+        self.assertIn("takes reserved stock", logs.output[0])
+        stock = Stock.objects.get(shop=self.shop, product=self.product)
+        self.assertEqual((stock.quantity, stock.reserved_quantity), (1, 2))
+
+    def test_api_requires_permission_on_the_shop(self):
+        """Test that stock of a shop the user has no permission on can be neither reserved nor released."""
+        other_shop = Shop.objects.create(name="Branch Shop", code="BS01")
+        Stock.objects.create(shop=other_shop, product=self.product, quantity=3, average_cost=Decimal('10.00'))
+        reserve_stock(other_shop, self.product, 1, 'other-till')
+        user = User.objects.create_user('clerk', 'clerk@test.com', 'password')
+        assign_perm('shop.view_shop', user, self.shop)
+        self.client.force_login(user)
+        url = reverse('stock-reservation-api')
+
+        response = self.client.post(url, {'shop_id': other_shop.id,
+                                          'items': [{'product_id': self.product.id, 'quantity': 2}]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.delete(f"{url}?token=other-till").status_code, 403)
+        self.assertEqual(available_quantity(other_shop, self.product), 2)
+
+        response = self.client.post(url, {'shop_id': self.shop.id,
+                                          'items': [{'product_id': self.product.id, 'quantity': 2}]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        self.assertEqual(self.client.delete(f"{url}?token={response.json()['token']}").status_code, 204)
+        self.assertEqual(available_quantity(self.shop, self.product), 3)
+
+class StockChangelistTestCase(TestCase):
+    """Test the product-centric stock changelist."""
+
+    def setUp(self):
+        """Set up an admin user and three shops."""
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'password')
+        self.client.force_login(self.user)
+        self.shops = [Shop.objects.create(name=f"Shop {code}", code=code) for code in ('AA', 'BB', 'CC')]
+        self.url = reverse('admin:inventory_stock_changelist')
+
+    def create_products(self, count, start=0):
+        """Create products stocked in every shop."""
+        for number in range(start, start + count):
+            product = Product.objects.create(name=f"Product {number:03}", profit_margin=Decimal('10.00'))
+            for quantity, shop in enumerate(self.shops, start=1):
+                Stock.objects.create(shop=shop, product=product, quantity=quantity,
+                                     average_cost=Decimal('10.00'))
+
+    def changelist_queries(self, params=None):
+        """Render the changelist and return the response and the number of queries it ran."""
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, params or {})
+        self.assertEqual(response.status_code, 200)
+        return response, len(queries)
+
+    def test_one_row_per_product(self):
+        """Test that each product is listed once, with every shop's stock and the total."""
+        self.create_products(2)
+
+        response, _ = self.changelist_queries()
+
+        self.assertEqual(response.context['cl'].result_count, 2)
+        self.assertContains(response, "Product 000", count=1)
+        self.assertContains(response, "CC")
+
+    def test_filters_apply_before_grouping(self):
+        """Test that a product is listed when any of its stock rows matches the filter."""
+        self.create_products(2)
+        Stock.objects.filter(product__name="Product 001").update(quantity=0)
+
+        response, _ = self.changelist_queries({'quantity_range': '0'})
+
+        self.assertEqual(response.context['cl'].result_count, 1)
+        self.assertContains(response, "Product 001")
+
+    def test_query_count_does_not_grow_with_products(self):
+        """Test that a full page costs the same number of queries as a page with two products."""
+        self.create_products(2)
+        _, small_page = self.changelist_queries()
+
+        self.create_products(30, start=2)
+        _, full_page = self.changelist_queries()
+
+        self.assertEqual(full_page, small_page)
+
+    def test_pages_over_products(self):
+        """Test that pages are counted and sliced by product, not by stock row."""
+        self.create_products(25)
+
+        response, _ = self.changelist_queries({'p': '2'})
+
+        cl = response.context['cl']
+        self.assertEqual(cl.result_count, 25)
+        self.assertEqual([product.name for product in cl.result_list],
+                         [f"Product {number:03}" for number in range(20, 25)])
+
+
+class StockImportExportTestCase(TestCase):
+    """Test the bulk stock import and the streamed stock export."""
+
+    def setUp(self):
+        """Set up two shops, two products and one existing stock row."""
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.other_shop = Shop.objects.create(name="Branch Shop", code="BS01")
+        self.product = Product.objects.create(name="Product 1", profit_margin=Decimal('10.00'))
+        self.other_product = Product.objects.create(name="Product 2", profit_margin=Decimal('20.00'))
+        self.stock = Stock.objects.create(shop=self.shop, product=self.product, quantity=5,
+                                          average_cost=Decimal('10.00'))
+
+    def import_rows(self, rows, dry_run=False):
+        """Import (shop, product, quantity, average_cost) rows through the stock resource."""
+        dataset = Dataset(headers=['shop', 'product', 'quantity', 'average_cost'])
+        for row in rows:
+            dataset.append(row)
+        return StockResource().import_data(dataset, dry_run=dry_run, use_transactions=True)
+
+    def test_import_creates_updates_and_skips(self):
+        """Test that an import updates, creates and skips rows and records history and movements."""
+        with self.captureOnCommitCallbacks(execute=True):
+            result = self.import_rows([
+                (self.shop.id, self.product.id, 8, '12.00'),
+                (self.other_shop.id, self.product.id, 3, '10.00'),
+                (self.shop.id, self.other_product.id, 0, '10.00'),
+            ])
+        unchanged = self.import_rows([(self.shop.id, self.product.id, 8, '12.00')])
+
+        self.assertFalse(result.has_errors() or result.has_validation_errors())
+        self.assertEqual(result.totals['update'], 1)
+        self.assertEqual(result.totals['new'], 2)
+        self.assertEqual(unchanged.totals['skip'], 1)
+        stock = Stock.objects.get(pk=self.stock.pk)
+        self.assertEqual((stock.quantity, stock.average_cost, stock.selling_price),
+                         (8, Decimal('12.00'), Decimal('13.20')))
+        self.assertEqual(Stock.objects.get(shop=self.shop, product=self.other_product).selling_price,
+                         Decimal('12.00'))
+        self.assertEqual(stock.history.first().history_change_reason, "Stock imported")
+        self.assertEqual(Stock.history.filter(history_change_reason="Stock imported").count(), 3)
+        self.assertEqual(
+            sorted(StockMovement.objects.filter(note="Stock imported").values_list('quantity', flat=True)),
+            [3, 3])
+        self.assertEqual(ProductStockSummary.objects.get(product=self.product).total_qty, 11)
+
+    def test_import_rejects_unknown_and_duplicate_rows(self):
+        """Test that unknown shops or products and repeated rows are reported, not imported."""
+        result = self.import_rows([
+            (self.shop.id, 999, 1, '1.00'),
+            (999, self.product.id, 1, '1.00'),
+            (self.other_shop.id, self.product.id, 1, '1.00'),
+            (self.other_shop.id, self.product.id, 2, '1.00'),
+        ])
+
+        self.assertEqual(len(result.invalid_rows), 3)
+        self.assertEqual(Stock.objects.count(), 2)
+
+    def test_dry_run_changes_nothing(self):
+        """Test that a dry run reports the changes and rolls them back."""
+        result = self.import_rows([(self.shop.id, self.product.id, 9, '10.00')], dry_run=True)
+
+        self.assertEqual(result.totals['update'], 1)
+        self.assertEqual(Stock.objects.get(pk=self.stock.pk).quantity, 5)
+        self.assertFalse(StockMovement.objects.filter(note="Stock imported").exists())
+
+    def test_query_count_does_not_grow_with_rows(self):
+        """Test that importing many rows costs the same number of queries as importing two."""
+        products = [Product.objects.create(name=f"Bulk {number}", profit_margin=Decimal('10.00'))
+                    for number in range(40)]
+
+        def import_queries(items, quantity):
+            with CaptureQueriesContext(connection) as queries:
+                result = self.import_rows([(self.shop.id, product.id, quantity, '5.00') for product in items])
+            self.assertFalse(result.has_errors() or result.has_validation_errors())
+            return len(queries)
+
+        self.assertEqual(import_queries(products[:2], 1), import_queries(products[2:], 1))
+        self.assertEqual(import_queries(products[:2], 2), import_queries(products[2:], 2))
+
+    def test_export_streams_every_stock_row(self):
+        """Test that the admin CSV export streams one line per stock row, not one per product."""
+        Stock.objects.create(shop=self.other_shop, product=self.product, quantity=2, average_cost=Decimal('10.00'))
+        user = User.objects.create_superuser('admin', 'admin@test.com', 'password')
+        self.client.force_login(user)
+
+        response = self.client.post(reverse('admin:inventory_stock_export'), {'format': '0', 'resource': '0'})
+
+        self.assertTrue(response.streaming)
+        lines = b''.join(response.streaming_content).decode().splitlines()
+        self.assertEqual(lines[0], 'shop,product,quantity,average_cost,selling_price')
+        self.assertEqual(len(lines), 3)
+
+
+class StockCountTestCase(TestCase):
+    """Test stock count sessions: recording counts, variances and applying them."""
+
+    def setUp(self):
+        """Set up a shop with three stocked products and an open count."""
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.other_shop = Shop.objects.create(name="Branch Shop", code="BS01")
+        self.products = [Product.objects.create(name=f"Product {number}", profit_margin=Decimal('10.00'))
+                         for number in range(4)]
+        for product, quantity in zip(self.products[:3], (10, 5, 7)):
+            Stock.objects.create(shop=self.shop, product=product, quantity=quantity, average_cost=Decimal('2.00'))
+        Stock.objects.create(shop=self.other_shop, product=self.products[0], quantity=3,
+                             average_cost=Decimal('2.00'))
+        self.count = StockCount.objects.create(shop=self.shop)
+
+    def quantity(self, product, shop=None):
+        return Stock.objects.get(shop=shop or self.shop, product=product).quantity
+
+    def test_variances_against_shop_stock(self):
+        """Test that variances compare the counts with the shop's stock, missing rows at zero."""
+        record_counts(self.count, [(self.products[0].id, 8), (self.products[1].id, 5), (self.products[3].id, 2)])
+
+        summary = compute_variances(self.count)
+
+        self.assertEqual(summary, {'lines': 3, 'variances': 2, 'net_variance': 0, 'pending': 0})
+        line = self.count.lines.get(product=self.products[0])
+        self.assertEqual((line.expected_quantity, line.variance), (10, -2))
+
+    def test_recount_replaces_earlier_count(self):
+        """Test that counting a product again replaces the count and clears its expected quantity."""
+        record_counts(self.count, [(self.products[0].id, 8)])
+        compute_variances(self.count)
+        record_counts(self.count, [(self.products[0].id, 9)])
+
+        line = self.count.lines.get()
+        self.assertEqual((line.counted_quantity, line.expected_quantity), (9, None))
+
+    def test_invalid_batch_records_nothing(self):
+        """Test that a batch with an unknown product or a negative count is rejected as a whole."""
+        with self.assertRaises(ValidationError):
+            record_counts(self.count, [(self.products[0].id, 8), (999, 1)])
+        with self.assertRaises(ValidationError):
+            record_counts(self.count, [(self.products[0].id, -1)])
+
+        self.assertFalse(self.count.lines.exists())
+
+    def test_apply_adjusts_approved_lines_only(self):
+        """Test that applying sets approved counts, creates missing rows and writes history and movements."""
+        record_counts(self.count, [(self.products[0].id, 8), (self.products[1].id, 9),
+                                   (self.products[2].id, 7), (self.products[3].id, 2)])
+        self.count.lines.filter(product=self.products[1]).update(approved=False)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            adjusted = apply_stock_count(self.count)
+
+        self.assertEqual(adjusted, 2)
+        self.assertEqual([self.quantity(product) for product in self.products], [8, 5, 7, 2])
+        self.assertEqual(self.quantity(self.products[0], self.other_shop), 3)
+        movements = StockMovement.objects.filter(object_id=self.count.id, note=f"Stock count #{self.count.id}")
+        self.assertEqual(sorted(movements.values_list('quantity', flat=True)), [-2, 2])
+        self.assertEqual(Stock.history.filter(history_change_reason=f"Stock count #{self.count.id}").count(), 2)
+        self.assertEqual(ProductStockSummary.objects.get(product=self.products[0]).total_qty, 11)
+        self.count.refresh_from_db()
+        self.assertEqual(self.count.status, StockCount.APPLIED)
+        with self.assertRaises(ValidationError):
+            apply_stock_count(self.count)
+        with self.assertRaises(ValidationError):
+            record_counts(self.count, [(self.products[0].id, 1)])
+
+    def test_apply_uses_stock_at_apply_time(self):
+        """Test that stock sold after the variances were computed is still counted correctly."""
+        record_counts(self.count, [(self.products[0].id, 8)])
+        compute_variances(self.count)
+        post_stock_quantity(self.shop, self.products[0], -4, logger)
+
+        apply_stock_count(self.count)
+
+        self.assertEqual(self.quantity(self.products[0]), 8)
+        self.assertEqual(StockMovement.objects.filter(object_id=self.count.id).get().quantity, 2)
+
+    def test_query_count_does_not_grow_with_lines(self):
+        """Test that applying many lines costs the same number of queries as applying two."""
+        products = [Product.objects.create(name=f"Bulk {number}", profit_margin=Decimal('10.00'))
+                    for number in range(40)]
+
+        def apply_queries(items):
+            count = StockCount.objects.create(shop=self.other_shop)
+            record_counts(count, [(product.id, 4) for product in items])
+            with CaptureQueriesContext(connection) as queries:
+                apply_stock_count(count)
+            return len(queries)
+
+        self.assertEqual(apply_queries(products[:2]), apply_queries(products[2:]))
+        self.assertEqual(apply_queries(products[:2]), apply_queries(products[2:]))
+
+    def test_read_count_file(self):
+        """Test reading counts from a CSV file and reporting bad lines."""
+        lines = list(read_count_file(BytesIO(b"product,counted_quantity\r\n1,4\r\n2,0\r\n")))
+        self.assertEqual(lines, [(1, 4), (2, 0)])
+        with self.assertRaises(ValidationError):
+            list(read_count_file(BytesIO(b"product,quantity\r\n1,4\r\n")))
+        with self.assertRaises(ValidationError):
+            list(read_count_file(BytesIO(b"product,counted_quantity\r\n1,four\r\n")))
+
+    def test_api_count_session(self):
+        """Test opening, filling, reviewing and applying a count through the API."""
+        user = User.objects.create_user('clerk', 'clerk@test.com', 'password')
+        assign_perm('shop.view_shop', user, self.shop)
+        self.client.force_login(user)
+
+        response = self.client.post(reverse('stock-count-api'), {'shop_id': self.shop.id}, content_type='application/json')
+        self.assertEqual(response.status_code, 201)
+        count_id = response.json()['id']
+        lines_url = reverse('stock-count-lines-api', args=[count_id])
+        for batch in ([{'product_id': self.products[0].id, 'counted_quantity': 12}],
+                      [{'product_id': self.products[1].id, 'counted_quantity': 5}]):
+            response = self.client.post(lines_url, {'lines': batch}, content_type='application/json')
+            self.assertEqual(response.json(), {'recorded': 1})
+        response = self.client.post(lines_url, {'lines': [{'product_id': 999, 'counted_quantity': 1}]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 400)
+
+        apply_url = reverse('stock-count-apply-api', args=[count_id])
+        self.assertEqual(self.client.get(apply_url).json()['net_variance'], 2)
+        self.assertEqual(self.client.post(apply_url).json(), {'adjusted': 1})
+        self.assertEqual(self.quantity(self.products[0]), 12)
+        self.assertEqual(self.client.post(apply_url).status_code, 400)
+
+    def test_api_requires_permission_on_the_shop(self):
+        """Test that counts of a shop the user has no permission on can be neither opened nor used."""
+        user = User.objects.create_user('clerk', 'clerk@test.com', 'password')
+        assign_perm('shop.view_shop', user, self.shop)
+        self.client.force_login(user)
+        other_count = StockCount.objects.create(shop=self.other_shop)
+
+        response = self.client.post(reverse('stock-count-api'), {'shop_id': self.other_shop.id},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        response = self.client.post(reverse('stock-count-lines-api', args=[other_count.id]),
+                                    {'lines': [{'product_id': self.products[0].id, 'counted_quantity': 0}]},
+                                    content_type='application/json')
+        self.assertEqual(response.status_code, 403)
+        self.assertEqual(self.client.post(reverse('stock-count-apply-api', args=[other_count.id])).status_code, 403)
+        self.assertFalse(other_count.lines.exists())
+        self.assertEqual(StockCount.objects.filter(shop=self.other_shop).count(), 1)
+
+    def test_admin_upload(self):
+        """Test creating a count from an uploaded file in the admin."""
+        user = User.objects.create_superuser('admin', 'admin@test.com', 'password')
+        self.client.force_login(user)
+        upload = SimpleUploadedFile('count.csv', f"product,counted_quantity\n{self.products[2].id},6\n".encode())
+
+        self.client.post(reverse('admin:inventory_stockcount_add'), {'shop': self.other_shop.id, 'note': 'Year end',
+                                                                     'count_file': upload})
+
+        count = StockCount.objects.get(note='Year end')
+        self.assertEqual(list(count.lines.values_list('product_id', 'counted_quantity')), [(self.products[2].id, 6)])
+
+
+class StockAPITestCase(TestCase):
+    """Test the bulk lookup and conditional GET of the stock API."""
+
+    def setUp(self):
+        """Set up a shop with three stocked products."""
+        self.user = User.objects.create_user('clerk', 'clerk@test.com', 'password')
+        self.client.force_login(self.user)
+        self.url = reverse('stock-api')
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.products = [Product.objects.create(name=f"Product {number}", profit_margin=Decimal('10.00'))
+                         for number in range(3)]
+        for quantity, product in enumerate(self.products, start=1):
+            Stock.objects.create(shop=self.shop, product=product, quantity=quantity, average_cost=Decimal('10.00'))
+
+    def test_bulk_mode(self):
+        """Test that only the requested products are returned, unknown ones at zero."""
+        ids = f"{self.products[0].pk},{self.products[2].pk},999999"
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(self.url, {'shop_id': self.shop.pk, 'product_ids': ids})
+
+        data = response.json()
+        self.assertEqual({key: row['quantity'] for key, row in data.items()},
+                         {str(self.products[0].pk): 1, str(self.products[2].pk): 3, '999999': 0})
+        self.assertEqual(len([query for query in queries if 'inventory_stock"' in query['sql']]), 1)
+
+    def test_unchanged_poll_gets_not_modified(self):
+        """Test that the ETag holds until the shop's stock is written."""
+        params = {'shop_id': self.shop.pk}
+        with self.captureOnCommitCallbacks(execute=True):
+            etag = self.client.get(self.url, params)['ETag']
+
+        response = self.client.get(self.url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 304)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post_stock_quantity(self.shop, self.products[0], -1, logger)
+
+        response = self.client.get(self.url, params, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertNotEqual(response['ETag'], etag)
+
+
+class BulkStockTransferAPITestCase(TestCase):
+    """Test the bulk stock transfer endpoint used by replenishment jobs."""
+
+    def setUp(self):
+        """Set up a warehouse stocking two products and two shops."""
+        self.user = User.objects.create_user('job', 'job@test.com', 'password')
+        self.client.force_login(self.user)
+        self.url = reverse('bulk-stock-transfer-api')
+        self.warehouse = Shop.objects.create(name="Warehouse", code="WH01", is_warehouse=True)
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.other_shop = Shop.objects.create(name="Branch Shop", code="BS01")
+        for shop in (self.warehouse, self.shop, self.other_shop):
+            assign_perm('shop.view_shop', self.user, shop)
+        self.products = [Product.objects.create(name=f"Product {number}", profit_margin=Decimal('10.00'))
+                         for number in range(2)]
+        for product in self.products:
+            Stock.objects.create(shop=self.warehouse, product=product, quantity=10, average_cost=Decimal('10.00'))
+
+    def post(self, transfers):
+        return self.client.post(self.url, {'transfers': transfers}, content_type='application/json')
+
+    def quantity(self, shop, product):
+        stock = Stock.objects.filter(shop=shop, product=product).first()
+        return stock.quantity if stock else 0
+
+    def test_valid_batch_is_created_and_posted(self):
+        """Test that every transfer is created and later transfers can ship earlier deliveries."""
+        first, second = self.products
+        response = self.post([
+            {'from_shop': self.warehouse.pk, 'to_shop': self.shop.pk, 'reference': 'run-1',
+             'items': [{'product': first.pk, 'quantity': 6}, {'product': first.pk, 'quantity': 2},
+                       {'product': second.pk, 'quantity': 4}]},
+            {'from_shop': self.shop.pk, 'to_shop': self.other_shop.pk,
+             'items': [{'product': first.pk, 'quantity': 3}]},
+        ])
+
+        self.assertEqual(response.status_code, 201)
+        results = response.json()['results']
+        self.assertEqual([result['status'] for result in results], ['created', 'created'])
+        self.assertEqual(results[0]['reference'], 'run-1')
+        self.assertEqual(StockTransferItem.objects.filter(stock_transfer_id=results[0]['transfer_id']).count(), 3)
+        self.assertEqual(self.quantity(self.warehouse, first), 2)
+        self.assertEqual(self.quantity(self.shop, first), 5)
+        self.assertEqual(self.quantity(self.other_shop, first), 3)
+        self.assertEqual(self.quantity(self.shop, second), 4)
+        self.assertEqual(StockMovement.objects.filter(movement_type=StockMovement.TRANSFER).count(), 8)
+
+    def test_invalid_transfers_are_rejected_individually(self):
+        """Test that bad transfers are reported while the rest of the batch goes through."""
+        first = self.products[0]
+        response = self.post([
+            {'from_shop': self.warehouse.pk, 'to_shop': self.shop.pk,
+             'items': [{'product': first.pk, 'quantity': 8}]},
+            {'from_shop': self.warehouse.pk, 'to_shop': self.other_shop.pk,
+             'items': [{'product': first.pk, 'quantity': 8}]},
+            {'from_shop': self.warehouse.pk, 'to_shop': self.warehouse.pk,
+             'items': [{'product': first.pk, 'quantity': 1}]},
+            {'from_shop': 999999, 'to_shop': self.shop.pk,
+             'items': [{'product': first.pk, 'quantity': 1}]},
+        ])
+
+        self.assertEqual(response.status_code, 207)
+        results = response.json()['results']
+        self.assertEqual([result['status'] for result in results], ['created', 'rejected', 'rejected', 'rejected'])
+        self.assertIn("Available: 2, Requested: 8", results[1]['errors'][0])
+        self.assertIn('to_shop', results[2]['errors'])
+        self.assertEqual(results[3]['errors'], ["Shop 999999 does not exist"])
+        self.assertEqual(StockTransfer.objects.count(), 1)
+        self.assertEqual(self.quantity(self.warehouse, first), 2)
+        self.assertEqual(self.quantity(self.other_shop, first), 0)
+
+    def test_transfers_need_permission_on_both_shops(self):
+        """Test that a transfer touching a shop the user has no permission on is rejected."""
+        first = self.products[0]
+        closed_shop = Shop.objects.create(name="Closed Shop", code="CS01")
+
+        response = self.post([
+            {'from_shop': self.warehouse.pk, 'to_shop': self.shop.pk,
+             'items': [{'product': first.pk, 'quantity': 1}]},
+            {'from_shop': self.warehouse.pk, 'to_shop': closed_shop.pk,
+             'items': [{'product': first.pk, 'quantity': 1}]},
+        ])
+
+        self.assertEqual(response.status_code, 207)
+        results = response.json()['results']
+        self.assertEqual([result['status'] for result in results], ['created', 'rejected'])
+        self.assertEqual(results[1]['errors'], [f"You do not have permission to move stock in shop {closed_shop.pk}"])
+        self.assertEqual(self.quantity(closed_shop, first), 0)
+
+    def test_reserved_stock_is_not_shipped(self):
+        """Test that a transfer can only ship the stock no sale holds reserved."""
+        first = self.products[0]
+        reserve_stock(self.warehouse, first, 7, 'till-1')
+
+        response = self.post([{'from_shop': self.warehouse.pk, 'to_shop': self.shop.pk,
+                               'items': [{'product': first.pk, 'quantity': 4}]}])
+
+        self.assertEqual(response.status_code, 400)
+        self.assertIn("Available: 3, Requested: 4", response.json()['results'][0]['errors'][0])
+        self.assertEqual(self.quantity(self.warehouse, first), 10)
+
+    def test_query_count_does_not_grow_with_lines(self):
+        """Test that the lines of a transfer are validated and posted in a fixed number of queries."""
+        products = [Product.objects.create(name=f"Bulk {number}", profit_margin=Decimal('10.00'))
+                    for number in range(40)]
+        for product in products:
+            Stock.objects.create(shop=self.warehouse, product=product, quantity=5, average_cost=Decimal('1.00'))
+
+        def post_lines(count, to_shop):
+            items = [{'product': product.pk, 'quantity': 1} for product in products[:count]]
+            with CaptureQueriesContext(connection) as queries:
+                response = self.post([{'from_shop': self.warehouse.pk, 'to_shop': to_shop.pk, 'items': items}])
+            self.assertEqual(response.status_code, 201)
+            return len(queries)
+
+        self.assertEqual(post_lines(40, self.shop), post_lines(5, self.other_shop))
+
+
+class InventoryValueAPITestCase(TestCase):
+    """Test the database-side filtering, totals and pagination of the inventory value API."""
+
+    def setUp(self):
+        """Set up a shop with five products worth 100, 200, 200, 400 and 500."""
+        self.user = User.objects.create_user('clerk', 'clerk@test.com', 'password')
+        self.client.force_login(self.user)
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.url = reverse('inventory-value-api')
+        for number, (quantity, cost) in enumerate([(1, '100.00'), (2, '100.00'), (4, '50.00'),
+                                                   (8, '50.00'), (10, '50.00')]):
+            product = Product.objects.create(name=f"Product {number}", profit_margin=Decimal('10.00'))
+            Stock.objects.create(shop=self.shop, product=product, quantity=quantity, average_cost=Decimal(cost))
+
+    def get(self, **params):
+        response = self.client.get(self.url, {'shop_id': self.shop.pk, **params})
+        self.assertEqual(response.status_code, 200)
+        return response.json()
+
+    def test_value_filters_and_totals(self):
+        """Test that value filters are applied in the database and totals cover every match."""
+        data = self.get(min_value='150', max_value='450', limit=1)
+
+        self.assertEqual(data['total_products'], 3)
+        self.assertEqual(Decimal(data['total_inventory_value']), Decimal('800.00'))
+        self.assertEqual([Decimal(row['inventory_value']) for row in data['products']], [Decimal('400.00')])
+        self.assertEqual(data['shop_name'], "Main Shop")
+
+    def test_keyset_pagination_by_value(self):
+        """Test that following next_cursor walks every product once, in value order, ties by id."""
+        for ordering in ('-inventory_value', 'inventory_value'):
+            values, ids, cursor = [], [], None
+            while True:
+                params = {'limit': 2, 'ordering': ordering}
+                if cursor:
+                    params['cursor'] = cursor
+                data = self.get(**params)
+                values += [Decimal(row['inventory_value']) for row in data['products']]
+                ids += [row['id'] for row in data['products']]
+                cursor = data['next_cursor']
+                if cursor is None:
+                    break
+
+            self.assertEqual(values, sorted(values, reverse=ordering.startswith('-')))
+            self.assertEqual(len(set(ids)), 5)
+
+    def test_invalid_cursor_and_ordering(self):
+        """Test that a malformed cursor or unknown ordering is rejected."""
+        self.assertEqual(self.client.get(self.url, {'shop_id': self.shop.pk, 'cursor': 'nope'}).status_code, 400)
+        self.assertEqual(self.client.get(self.url, {'shop_id': self.shop.pk, 'ordering': 'name'}).status_code, 400)
+
+
+class InventorySnapshotAPITestCase(TestCase):
+    """Test the multi-shop inventory snapshot used by the dashboard."""
+
+    def setUp(self):
+        """Set up three shops, two of them stocked."""
+        cache.clear()
+        self.user = User.objects.create_user('clerk', 'clerk@test.com', 'password')
+        self.client.force_login(self.user)
+        self.url = reverse('inventory-snapshot-api')
+        self.shops = [Shop.objects.create(name=f"Shop {code}", code=code) for code in ('AA', 'BB', 'CC')]
+        self.product = Product.objects.create(name="Product 1", profit_margin=Decimal('10.00'))
+        Stock.objects.create(shop=self.shops[0], product=self.product, quantity=2, average_cost=Decimal('10.00'))
+        Stock.objects.create(shop=self.shops[1], product=self.product, quantity=3, average_cost=Decimal('20.00'))
+
+    def test_totals_per_shop_and_overall(self):
+        """Test that every shop is listed with its totals, including shops without stock."""
+        data = self.client.get(self.url).json()
+
+        totals = {shop['code']: (Decimal(shop['total_inventory_value']), shop['total_products'])
+                  for shop in data['shops']}
+        self.assertEqual(totals, {'AA': (Decimal('20.00'), 1), 'BB': (Decimal('60.00'), 1), 'CC': (Decimal('0.00'), 0)})
+        self.assertEqual(Decimal(data['total_inventory_value']), Decimal('80.00'))
+        self.assertEqual([row['shop_name'] for row in data['products']], ["Shop BB", "Shop AA"])
+
+    def test_requires_login(self):
+        """Test that anonymous requests are refused."""
+        self.client.logout()
+        self.assertEqual(self.client.get(self.url).status_code, 403)
+
+    def test_invalid_shop_id(self):
+        """Test that a shop_id that is not an integer is reported as such, not as a bad cursor."""
+        response = self.client.get(self.url, {'shop_id': 'abc'})
+
+        self.assertEqual(response.status_code, 400)
+        self.assertEqual(response.json(), {'error': 'shop_id must be an integer'})
+
+    def test_query_count_does_not_grow_with_shops(self):
+        """Test that the snapshot is built from a fixed number of queries."""
+        with CaptureQueriesContext(connection) as few_shops:
+            self.client.get(self.url)
+
+        for code in range(10):
+            shop = Shop.objects.create(name=f"Shop {code}", code=str(code))
+            Stock.objects.create(shop=shop, product=self.product, quantity=1, average_cost=Decimal('1.00'))
+        cache.clear()
+        with CaptureQueriesContext(connection) as many_shops:
+            self.client.get(self.url)
+
+        self.assertEqual(len(many_shops), len(few_shops))
+
+    def test_cached_until_stock_changes(self):
+        """Test that the snapshot is served from cache and expired by a stock change."""
+        self.client.get(self.url)
+        with self.assertNumQueries(2):  # session and user only
+            self.client.get(self.url)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            post_stock_quantity(self.shops[0], self.product, 5, logger)
+
+        data = self.client.get(self.url).json()
+        self.assertEqual(Decimal(data['total_inventory_value']), Decimal('130.00'))
+
+
+@override_settings(INVENTORY_COSTING_METHOD='fifo')
+class FifoCostingTestCase(TestCase):
+    """Test FIFO lot costing of purchases, sales and transfers."""
+
+    def setUp(self):
+        """Set up two shops and two purchases of one product at different costs."""
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.other_shop = Shop.objects.create(name="Branch Shop", code="BS01")
+        self.product = Product.objects.create(name="Product 1", profit_margin=Decimal('10.00'))
+        supplier = Supplier.objects.create(name="Supplier", mobile_number="0700000000", payable=Decimal('0.00'))
+        self.purchase = PurchaseInvoice.objects.create(supplier=supplier, shop=self.shop)
+        self.first = PurchaseInvoiceItem.objects.create(purchase_invoice=self.purchase, product=self.product,
+                                                        quantity=10, price=Decimal('10.00'))
+        self.second = PurchaseInvoiceItem.objects.create(purchase_invoice=self.purchase, product=self.product,
+                                                         quantity=10, price=Decimal('20.00'))
+        self.invoice = SalesInvoice.objects.create(shop=self.shop, total_amount=Decimal('0.00'),
+                                                   paid_amount=Decimal('0.00'),
+                                                   due_date=timezone.now().date() + timedelta(days=30))
+
+    def sell(self, quantity):
+        return SalesInvoiceItem.objects.create(sales_invoice=self.invoice, product=self.product,
+                                               quantity=quantity, price=Decimal('30.00'))
+
+    def remaining(self, shop=None):
+        return list(StockLot.objects.filter(shop=shop or self.shop).order_by('id')
+                    .values_list('unit_cost', 'remaining_quantity'))
+
+    def test_purchases_create_lots(self):
+        """Test that each purchase line becomes a lot, and edits and deletions change it."""
+        self.assertEqual(self.remaining(), [(Decimal('10.00'), 10), (Decimal('20.00'), 10)])
+
+        self.second.quantity = 6
+        self.second.price = Decimal('18.00')
+        self.second.save()
+        self.first.delete()
+
+        self.assertEqual(self.remaining(), [(Decimal('10.00'), 0), (Decimal('18.00'), 6)])
+
+    def test_sale_is_costed_from_oldest_lots(self):
+        """Test that a sale consumes the oldest lots first and is costed at their weighted cost."""
+        item = self.sell(15)
+
+        self.assertEqual(item.average_cost, Decimal('13.33'))
+        self.assertEqual(SalesInvoiceItem.objects.get(pk=item.pk).average_cost, Decimal('13.33'))
+        self.assertEqual(self.remaining(), [(Decimal('10.00'), 0), (Decimal('20.00'), 5)])
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.cost_total, Decimal('13.33') * 15)
+
+    def test_sale_edits_and_deletion_release_lots(self):
+        """Test that reducing or deleting a sale puts the stock back into the lots it came from."""
+        item = self.sell(15)
+
+        item.quantity = 8
+        item.save()
+        self.assertEqual(item.average_cost, Decimal('10.00'))
+        self.assertEqual(self.remaining(), [(Decimal('10.00'), 2), (Decimal('20.00'), 10)])
+
+        item.delete()
+        self.assertEqual(self.remaining(), [(Decimal('10.00'), 10), (Decimal('20.00'), 10)])
+        self.assertFalse(StockLotConsumption.objects.exists())
+
+    def test_unit_of_work_costs_the_invoice_in_one_batch(self):
+        """Test that items saved in a unit of work are costed from the lots when it is flushed."""
+        with sales_unit_of_work():
+            first = self.sell(5)
+            second = self.sell(10)
+
+        first.refresh_from_db()
+        second.refresh_from_db()
+        self.assertEqual((first.average_cost, second.average_cost), (Decimal('10.00'), Decimal('15.00')))
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.cost_total, Decimal('200.00'))
+
+    def test_editing_a_sale_from_before_fifo_keeps_its_cost(self):
+        """Test that a price-only edit of a line sold under average costing keeps its cost."""
+        with self.settings(INVENTORY_COSTING_METHOD='average'):
+            item = self.sell(2)
+        self.assertEqual(item.average_cost, Decimal('15.00'))
+        open_stock_lots()
+
+        item.price = Decimal('35.00')
+        item.save()
+
+        self.assertEqual(SalesInvoiceItem.objects.get(pk=item.pk).average_cost, Decimal('15.00'))
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.cost_total, Decimal('30.00'))
+
+    def test_transfer_moves_cost_layers(self):
+        """Test that a transfer carries the consumed lots' costs to the destination, and undoing it returns them."""
+        transfer = StockTransfer.objects.create(from_shop=self.shop, to_shop=self.other_shop)
+        item = StockTransferItem.objects.create(stock_transfer=transfer, product=self.product, quantity=12)
+
+        self.assertEqual(self.remaining(), [(Decimal('10.00'), 0), (Decimal('20.00'), 8)])
+        self.assertEqual(self.remaining(self.other_shop), [(Decimal('10.00'), 10), (Decimal('20.00'), 2)])
+
+        item.delete()
+        self.assertEqual(self.remaining(), [(Decimal('10.00'), 10), (Decimal('20.00'), 10)])
+        self.assertEqual(self.remaining(self.other_shop), [(Decimal('10.00'), 0), (Decimal('20.00'), 0)])
+
+    def test_stock_without_lots_is_costed_at_average_cost(self):
+        """Test that stock no lot covers is consumed at the average cost, and opening lots cover it."""
+        stock = Stock.objects.create(shop=self.other_shop, product=self.product, quantity=5,
+                                     average_cost=Decimal('7.00'))
+        consumption, = consume_lots([(self.other_shop.id, self.product.id, 2, None)])
+        self.assertEqual((consumption.lot, consumption.unit_cost), (None, Decimal('7.00')))
+
+        Stock.objects.filter(pk=stock.pk).update(quantity=3)
+        self.assertEqual(open_stock_lots(), 1)
+        self.assertEqual(self.remaining(self.other_shop), [(Decimal('7.00'), 3)])
+        self.assertEqual(open_stock_lots(), 0)
+
+    def test_consumption_reads_only_the_lots_it_uses(self):
+        """Test that consuming from the oldest lot costs the same queries however many lots are open."""
+        def consume_queries():
+            with CaptureQueriesContext(connection) as queries:
+                consume_lots([(self.shop.id, self.product.id, 1, None)])
+            return len(queries)
+
+        few = consume_queries()
+        for number in range(50):
+            PurchaseInvoiceItem.objects.create(purchase_invoice=self.purchase, product=self.product,
+                                               quantity=1, price=Decimal('5.00'))
+        self.assertEqual(consume_queries(), few)
+
+
+class ConcurrentStockPostingTestCase(TransactionTestCase):
+    """Post stock from several threads at once and check that no update is lost."""
+
+    threads = 8
+    postings_per_thread = 25
+
+    def setUp(self):
+        """Set up a shop with one well stocked product."""
+        self.shop = Shop.objects.create(name="Main Shop", code="MS01")
+        self.other_shop = Shop.objects.create(name="Branch Shop", code="BS01")
+        self.product = Product.objects.create(name="Product 1", profit_margin=Decimal('10.00'))
+        self.stock = Stock.objects.create(
+            shop=self.shop,
+            product=self.product,
+            quantity=1000,
+            average_cost=Decimal('10.00')
+        )
+
+    def _run_in_threads(self, target):
+        """Run target in parallel threads, each with its own connection, and re-raise any error."""
+        errors = []
+        barrier = threading.Barrier(self.threads)
+
+        def worker():
+            try:
+                barrier.wait()
+                for _ in range(self.postings_per_thread):
+                    target()
+            except Exception as e:  # pragma: no cover - surfaced through the assertion below
+                errors.append(e)
+            finally:
+                connections.close_all()
+
+        workers = [threading.Thread(target=worker) for _ in range(self.threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        self.assertEqual(errors, [])
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_concurrent_sales_do_not_lose_updates(self):
+        """Test that parallel sales of the same product all reach the stock row."""
+        self._run_in_threads(lambda: post_stock_quantity(self.shop.pk, self.product.pk, -1, logger))
+
+        self.stock.refresh_from_db()
+        self.assertEqual(self.stock.quantity, 1000 - self.threads * self.postings_per_thread)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_opposite_transfers_do_not_deadlock(self):
+        """Test that transfers in both directions between two shops serialise without losing stock."""
+        Stock.objects.create(shop=self.other_shop, product=self.product, quantity=1000,
+                             average_cost=Decimal('10.00'))
+        flip = threading.local()
+
+        def transfer():
+            flip.value = not getattr(flip, 'value', False)
+            source, destination = (self.shop, self.other_shop) if flip.value else (self.other_shop, self.shop)
+            post_stock_transfer(source.pk, destination.pk, self.product.pk, 1, logger)
+
+        self._run_in_threads(transfer)
+
+        total = sum(Stock.objects.filter(product=self.product).values_list('quantity', flat=True))
+        self.assertEqual(total, 2000)
+
+    @skipUnlessDBFeature('has_select_for_update')
+    def test_snapshot_waits_for_postings_in_flight(self):
+        """Test that a sale timestamped before a snapshot but committed after it starts is in the snapshot."""
+        posted, release = threading.Event(), threading.Event()
+
+        def sell():
+            try:
+                with transaction.atomic():
+                    post_stock_quantity(self.shop.pk, self.product.pk, -5, logger)
+                    posted.set()
+                    release.wait(5)
+            finally:
+                connections.close_all()
+
+        seller = threading.Thread(target=sell)
+        seller.start()
+        posted.wait(5)
+        threading.Timer(0.2, release.set).start()
+        take_snapshot()
+        seller.join()
+
+        self.assertEqual(StockSnapshot.objects.get(shop=self.shop, product=self.product).quantity, 995)
@@ -2,10 +2,11 @@ from django.db import models
 from simple_history.models import HistoricalRecords
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes.fields import GenericForeignKey
+from utils import FieldTrackerMixin
 
 from purchase_invoice.models import PurchaseInvoice
 
-class Payment(models.Model):
+class Payment(FieldTrackerMixin, models.Model):
     content_type = models.ForeignKey(ContentType, on_delete=models.CASCADE)
     object_id = models.PositiveIntegerField()
     payable = GenericForeignKey('content_type', 'object_id')
@@ -1,5 +1,6 @@
 from django.db.models.signals import pre_save, post_save, pre_delete
 from django.dispatch import receiver
+from bulk_recompute import skip_during_bulk_recompute
 from payment.models import Payment
 from ..logic.payment_logic import (
     capture_original_payment_state,
@@ -10,20 +11,24 @@ from ..logic.payment_logic import (
 
 
 @receiver(pre_save, sender=Payment)
+@skip_during_bulk_recompute
 def payment_pre_save(sender, instance, **kwargs):
     capture_original_payment_state(instance)
 
 
 @receiver(post_save, sender=Payment)
+@skip_during_bulk_recompute
 def payment_post_save_account(sender, instance, created, **kwargs):
     update_account_on_payment_save(instance, created)
 
 
 @receiver(post_save, sender=Payment)
+@skip_during_bulk_recompute
 def payment_post_save_payable(sender, instance, created, **kwargs):
     update_payable_object_on_payment_save(instance, created)
 
 
 @receiver(pre_delete, sender=Payment)
+@skip_during_bulk_recompute
 def payment_pre_delete(sender, instance, **kwargs):
     handle_payment_delete(instance)
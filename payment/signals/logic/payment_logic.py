@@ -6,17 +6,20 @@ logger = logging.getLogger(__name__)
 
 
 def capture_original_payment_state(instance):
+    """
+    Capture the original amount, account and payable of a payment from its
+    change tracker; the original objects are only loaded if they changed.
+    """
     if instance.pk:
-        from payment.models import Payment
-        try:
-            old_payment = Payment.objects.get(pk=instance.pk)
-            instance._original_amount = old_payment.amount
-            instance._original_account = old_payment.account
-            instance._original_payable = old_payment.payable
-        except Payment.DoesNotExist:
-            instance._original_amount = None
-            instance._original_account = None
-            instance._original_payable = None
+        instance._original_amount = instance.original('amount')
+        instance._original_account = instance.original_related('account')
+        if instance.has_changed('content_type') or instance.has_changed('object_id'):
+            from django.contrib.contenttypes.models import ContentType
+            content_type = ContentType.objects.get_for_id(instance.original('content_type'))
+            instance._original_payable = content_type.model_class()._base_manager.filter(
+                pk=instance.original('object_id')).first()
+        else:
+            instance._original_payable = instance.payable
 
 
 def update_account_on_payment_save(instance, created):
@@ -80,17 +80,18 @@ class ProductAdminForm(forms.ModelForm):
             "<strong></strong>" + js_code
         )
         self.fields['profit_margin'].help_text = mark_safe(
-            "<strong style='color: #336699;'>Add a manual profit margin if you want to use a product-specific profit margin</strong>"
+            "<strong style='color: #336699;'>Add a manual profit margin if you want to use a product-specific profit margin. "
+            "It is ignored while the product inherits the category margin.</strong>"
         )
 
 
 @admin.register(Product)
 class ProductAdmin(SimpleHistoryAdmin, ModelAdmin, ImportExportModelAdmin):
     form = ProductAdminForm
-    list_display = ('name', 'category', 'description', 'profit_margin')
+    list_display = ('name', 'category', 'description', 'profit_margin', 'inherits_category_margin')
     search_fields = ('name', 'description', 'category__name')
-    list_filter = ('category', 'profit_margin',)
-    fields = ('name', 'description', 'category', 'profit_margin')
+    list_filter = ('category', 'profit_margin', 'inherits_category_margin')
+    fields = ('name', 'description', 'category', 'inherits_category_margin', 'profit_margin')
     list_per_page = 20
     import_form_class = ImportForm
     export_form_class = ExportForm
\ No newline at end of file
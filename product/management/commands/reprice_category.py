@@ -0,0 +1,58 @@
+from decimal import Decimal, InvalidOperation
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+
+from inventory.services.stock_repricing import preview_category_margin
+from product.models import Category
+
+
+class Command(BaseCommand):
+    help = ("Change a category's profit margin, moving the products that inherit the category margin "
+            "with it and repricing their stock in bulk. Use --dry-run to preview the change.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('category', help="Category id or name")
+        parser.add_argument('margin', help="New profit margin, in percent")
+        parser.add_argument(
+            '--dry-run',
+            action='store_true',
+            help="Only show what would change",
+        )
+        parser.add_argument(
+            '--sample-size',
+            type=int,
+            default=20,
+            help="Number of example price changes to show (default: 20)",
+        )
+
+    def handle(self, *args, **options):
+        category = self.get_category(options['category'])
+        try:
+            margin = Decimal(options['margin'])
+        except InvalidOperation:
+            raise CommandError(f"Invalid margin: {options['margin']}")
+
+        preview = preview_category_margin(category, margin, sample_size=options['sample_size'])
+        self.stdout.write(f"Category {category}: margin {category.profit_margin} -> {margin}, "
+                          f"{preview['products']} products, {preview['stock_rows']} stock rows")
+        for sample in preview['samples']:
+            self.stdout.write(f"  {sample['product']} @ {sample['shop']}: cost {sample['average_cost']}, "
+                              f"price {sample['selling_price']} -> {sample['new_selling_price']}")
+
+        if options['dry_run']:
+            self.stdout.write("Dry run, nothing changed")
+            return
+
+        # Saving the category runs the margin cascade
+        with transaction.atomic():
+            category.profit_margin = margin
+            category.save()
+        self.stdout.write(self.style.SUCCESS(f"Repriced category {category}"))
+
+    def get_category(self, value):
+        categories = Category.objects.filter(pk=value) if value.isdigit() else Category.objects.filter(name=value)
+        category = categories.first()
+        if category is None:
+            raise CommandError(f"Category not found: {value}")
+        return category
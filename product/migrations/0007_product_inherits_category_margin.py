@@ -0,0 +1,32 @@
+# Generated by Django 5.2 on 2026-10-17 03:49
+
+from django.db import migrations, models
+from django.db.models import F
+
+
+def mark_inheriting_products(apps, schema_editor):
+    """Products whose margin equals their category's were following it until now; keep them doing so."""
+    Product = apps.get_model('product', 'Product')
+    Product.objects.filter(category__isnull=False, profit_margin=F('category__profit_margin')).update(
+        inherits_category_margin=True)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('product', '0006_alter_category_options_alter_product_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalproduct',
+            name='inherits_category_margin',
+            field=models.BooleanField(default=False, help_text="Use the category's profit margin and follow it when it changes"),
+        ),
+        migrations.AddField(
+            model_name='product',
+            name='inherits_category_margin',
+            field=models.BooleanField(default=False, help_text="Use the category's profit margin and follow it when it changes"),
+        ),
+        migrations.RunPython(mark_inheriting_products, migrations.RunPython.noop),
+    ]
@@ -1,7 +1,8 @@
 from django.db import models
 from simple_history.models import HistoricalRecords
+from utils import FieldTrackerMixin
 
-class Category(models.Model):
+class Category(FieldTrackerMixin, models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)
     profit_margin = models.DecimalField(max_digits=5, decimal_places=2, default=10.00)
@@ -16,11 +17,15 @@ class Category(models.Model):
     def __str__(self):
         return self.name
 
-class Product(models.Model):
+class Product(FieldTrackerMixin, models.Model):
     name = models.CharField(max_length=255)
     description = models.TextField(blank=True, null=True)
     profit_margin = models.DecimalField(max_digits=5, decimal_places=2, default=10.00)
     category = models.ForeignKey(Category, on_delete=models.SET_NULL, null=True, blank=True, related_name='products')
+    inherits_category_margin = models.BooleanField(
+        default=False,
+        help_text="Use the category's profit margin and follow it when it changes",
+    )
     history = HistoricalRecords()
 
     class Meta:
@@ -31,3 +36,9 @@ class Product(models.Model):
 
     def __str__(self):
         return f'{self.name}'
+
+    def save(self, *args, **kwargs):
+        """Save the product, taking its category's margin while it inherits it."""
+        if self.inherits_category_margin and self.category_id is not None:
+            self.profit_margin = Category.objects.values_list('profit_margin', flat=True).get(pk=self.category_id)
+        super().save(*args, **kwargs)
@@ -1,22 +1,27 @@
 from django.db.models.signals import post_save
 from django.dispatch import receiver
-from decimal import Decimal
 
-from inventory.models.stock import Stock
-from product.models import Product
+from inventory.services.stock_repricing import apply_category_margin, reprice_stock
+from product.models import Category, Product
 
 @receiver(post_save, sender=Product)
-def update_stock_selling_price(sender, instance, **kwargs):
+def update_stock_selling_price(sender, instance, created, **kwargs):
     """
     Signal handler to update selling_price for all related stocks
-    whenever a product's profit_margin changes.
+    when a product's profit_margin actually changes.
     """
-    stocks = Stock.objects.filter(product=instance)
-    
-    for stock in stocks:
-        new_selling_price = stock.average_cost + (
-            (stock.average_cost * instance.profit_margin) / Decimal('100.0')
-        )
-        stock.selling_price = new_selling_price
-        # Use save with update_fields to avoid triggering other signals
-        stock.save(update_fields=['selling_price'])
+    if created or not instance.has_changed('profit_margin'):
+        return
+    reprice_stock([instance.pk], reason=f"Profit margin of {instance} changed from "
+                                        f"{instance.original('profit_margin')} to {instance.profit_margin}")
+
+
+@receiver(post_save, sender=Category)
+def cascade_category_profit_margin(sender, instance, created, **kwargs):
+    """
+    When a category's profit_margin changes, move the products that inherit
+    the category margin to the new one and reprice their stock.
+    """
+    if created or not instance.has_changed('profit_margin'):
+        return
+    apply_category_margin(instance, instance.original('profit_margin'))
@@ -1,8 +1,12 @@
+from decimal import Decimal
+
 from django.db import models
+from django.db.models import F, Sum
 from simple_history.models import HistoricalRecords
 from django.contrib.contenttypes.fields import GenericRelation
+from utils import FieldTrackerMixin
 
-class PurchaseInvoice(models.Model):
+class PurchaseInvoice(FieldTrackerMixin, models.Model):
     supplier = models.ForeignKey('supplier.supplier', on_delete=models.SET_NULL, null=True)
     shop = models.ForeignKey('shop.Shop', on_delete=models.CASCADE)  # Warehouse
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, editable=False)
@@ -19,13 +23,26 @@ class PurchaseInvoice(models.Model):
             ("can_view_icon_purchase_invoice", "Can view icon purchase invoice"),
         ]
 
-    def update_total_amount(self):
-        """Calculate and update total amount from invoice items."""
-        total = sum(item.price * item.quantity for item in self.purchaseinvoiceitem_set.all())
-        self.total_amount = total
-        self.save()
+    def update_total_amount(self, delta=None):
+        """Update total amount from invoice items.
+
+        Without a delta the total is summed in the database; with a delta (the
+        change in one line's total) it is added to the locked current total.
+        Only total_amount is written; the invoice's save signals move the
+        supplier payable by the change, measured from the locked total so an
+        out-of-date instance still moves it by the right amount."""
+        current = (PurchaseInvoice.objects.select_for_update()
+                   .values_list('total_amount', flat=True).get(pk=self.pk))
+        self.total_amount = current
+        self.mark_as_loaded(['total_amount'])
+        if delta is None:
+            total = self.purchaseinvoiceitem_set.aggregate(total=Sum(F('price') * F('quantity')))['total']
+            self.total_amount = total or Decimal('0.00')
+        else:
+            self.total_amount = current + delta
+        self.save(update_fields=['total_amount'])
 
-class PurchaseInvoiceItem(models.Model):
+class PurchaseInvoiceItem(FieldTrackerMixin, models.Model):
     purchase_invoice = models.ForeignKey(PurchaseInvoice, on_delete=models.CASCADE)
     product = models.ForeignKey('product.Product', on_delete=models.CASCADE)
     quantity = models.IntegerField()
@@ -2,13 +2,14 @@ from django.db.models.signals import pre_save, post_save, post_delete
 from django.dispatch import receiver
 import logging
 
-from inventory.signals.logic.stock_transfer_logic import capture_original_item_data
+from bulk_recompute import skip_during_bulk_recompute
 from purchase_invoice.models import PurchaseInvoice, PurchaseInvoiceItem
-from purchase_invoice.signals.logic.invoice_item_logic import process_purchase_item_creation, process_purchase_item_deletion, process_purchase_item_update
+from purchase_invoice.signals.logic.invoice_item_logic import capture_original_item_data, process_purchase_item_creation, process_purchase_item_deletion, process_purchase_item_update
 
 logger = logging.getLogger(__name__)
 
 @receiver(pre_save, sender=PurchaseInvoiceItem)
+@skip_during_bulk_recompute
 def store_original_item_data(sender, instance, **kwargs):
     """
     Store the original values before a PurchaseInvoiceItem is updated.
@@ -20,6 +21,7 @@ def store_original_item_data(sender, instance, **kwargs):
 
 
 @receiver(post_save, sender=PurchaseInvoiceItem)
+@skip_during_bulk_recompute
 def update_stock_on_purchase_item_save(sender, instance, created, **kwargs):
     """
     Update stock when a purchase invoice item is created or updated.
@@ -31,6 +33,7 @@ def update_stock_on_purchase_item_save(sender, instance, created, **kwargs):
 
 
 @receiver(post_delete, sender=PurchaseInvoiceItem)
+@skip_during_bulk_recompute
 def update_stock_on_purchase_item_delete(sender, instance, **kwargs):
     """
     When a purchase invoice item is deleted, reverse the stock changes.
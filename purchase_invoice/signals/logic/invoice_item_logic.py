@@ -1,8 +1,9 @@
 from decimal import Decimal
 from django.db import transaction
-from django.conf import settings
 
-from inventory.models.stock import Stock
+from inventory.models.stock_movement import StockMovement
+from inventory.services.stock_lots import adjust_lots, fifo_costing_enabled
+from inventory.services.stock_posting import post_stock_value
 
 # Default markup percentage removed as no longer needed
 
@@ -10,26 +11,23 @@ def capture_original_item_data(instance, logger):
     """
     Store the original values before a PurchaseInvoiceItem is updated.
     
+    The values come from the item's change tracker. The original product is
+    kept as an id; the original invoice is only loaded if it changed.
+    
     Args:
         instance: The PurchaseInvoiceItem instance being saved
         logger: Logger instance for recording operations
     """
     if instance.pk:
-        try:
-            original = instance.__class__.objects.get(pk=instance.pk)
-            
-            # Store all relevant original values
-            instance._original_quantity = original.quantity
-            instance._original_price = original.price
-            instance._original_product = original.product
-            instance._original_invoice = original.purchase_invoice
-            
-            logger.debug(f"Stored original purchase item data: "
-                        f"quantity={original.quantity}, price={original.price}, "
-                        f"product={original.product}, invoice={original.purchase_invoice}")
-        except instance.__class__.DoesNotExist:
-            logger.warning(f"Could not find original purchase item with ID {instance.pk}")
-            pass
+        # Store all relevant original values
+        instance._original_quantity = instance.original('quantity')
+        instance._original_price = instance.original('price')
+        instance._original_product = instance.original('product')
+        instance._original_invoice = instance.original_related('purchase_invoice')
+        
+        logger.debug(f"Stored original purchase item data: "
+                    f"quantity={instance._original_quantity}, price={instance._original_price}, "
+                    f"product={instance._original_product}, invoice={instance.original('purchase_invoice')}")
 
 
 def process_purchase_item_creation(instance, logger):
@@ -40,8 +38,8 @@ def process_purchase_item_creation(instance, logger):
         instance: The new PurchaseInvoiceItem instance
         logger: Logger instance for recording operations
     """
-    shop = instance.purchase_invoice.shop
-    product = instance.product
+    shop = instance.purchase_invoice.shop_id
+    product = instance.product_id
     
     # Validate price is positive
     if instance.price <= Decimal('0'):
@@ -49,43 +47,14 @@ def process_purchase_item_creation(instance, logger):
 
     # Handle new items
     logger.info(f"Creating new purchase invoice item for product {product} at shop {shop}")
-    with transaction.atomic():
-        try:
-            stock = Stock.objects.get(shop=shop, product=product)
-            
-            # Update quantity and recalculate average cost
-            old_value = stock.average_cost * stock.quantity
-            new_value = instance.price * instance.quantity
-            new_total_quantity = stock.quantity + instance.quantity
-            
-            # Prevent division by zero
-            if new_total_quantity > 0:
-                stock.average_cost = (old_value + new_value) / new_total_quantity
-                # Selling price update removed
-            else:
-                # If somehow we end up with zero quantity, keep the existing average cost
-                logger.warning(f"Attempted division by zero in average cost calculation for "
-                             f"product {product} at shop {shop}")
-            
-            stock.quantity = new_total_quantity
-            stock.save()
-            logger.info(f"Updated existing stock for product {product} at shop {shop}. "
-                       f"New quantity: {new_total_quantity}, "
-                       f"New average cost: {stock.average_cost}")
-        except Stock.DoesNotExist:
-            # Create new stock without selling price logic
-            new_stock = Stock.objects.create(
-                shop=shop,
-                product=product,
-                quantity=instance.quantity,
-                average_cost=instance.price
-            )
-            logger.info(f"Created new stock record for product {product} at shop {shop}. "
-                       f"Quantity: {new_stock.quantity}, "
-                       f"Average cost: {new_stock.average_cost}")
+    post_stock_value(shop, product, instance.quantity, instance.price * instance.quantity, logger,
+                     create_cost=instance.price, movement_type=StockMovement.PURCHASE, source=instance,
+                     reason=f"Purchased on invoice {instance.purchase_invoice_id}")
+    if fifo_costing_enabled():
+        adjust_lots([(shop, product, instance.quantity, instance, instance.price)])
 
-    # Update the invoice total
-    instance.purchase_invoice.update_total_amount()
+    # Add this line to the invoice total
+    instance.purchase_invoice.update_total_amount(delta=instance.price * instance.quantity)
 
 
 def process_purchase_item_update(instance, logger):
@@ -101,183 +70,61 @@ def process_purchase_item_update(instance, logger):
         logger.warning(f"Missing original data for purchase item {instance.pk}")
         return
         
-    shop = instance.purchase_invoice.shop
-    product = instance.product
+    shop = instance.purchase_invoice.shop_id
+    product = instance.product_id
         
     # Check if the invoice changed
-    invoice_changed = (hasattr(instance, '_original_invoice') and 
-                      instance._original_invoice != instance.purchase_invoice)
+    invoice_changed = instance.has_changed('purchase_invoice')
     
     # Check if the product changed
-    product_changed = (hasattr(instance, '_original_product') and 
-                      instance._original_product != instance.product)
-    
-    # Calculate changes
-    quantity_change = instance.quantity - instance._original_quantity
-    price_changed = instance.price != instance._original_price
+    product_changed = instance.has_changed('product')
     
+    reason = f"Purchase item {instance.pk} changed"
     with transaction.atomic():
         try:
             # If invoice or product changed, handle specially
             if invoice_changed or product_changed:
                 logger.info(f"Product or invoice changed for purchase item {instance.pk}")
                 # First, revert the original item effects
-                try:
-                    original_shop = instance._original_invoice.shop
-                    original_product = instance._original_product
-                    
-                    original_stock = Stock.objects.get(
-                        shop=original_shop, 
-                        product=original_product
-                    )
-                    
-                    # Calculate the value that needs to be removed
-                    original_item_value = instance._original_price * instance._original_quantity
-                    original_total_value = original_stock.average_cost * original_stock.quantity
-                    
-                    # Adjust for the removed item
-                    new_quantity = original_stock.quantity - instance._original_quantity
-                    
-                    # Calculate new average cost if quantity will still be positive
-                    if new_quantity > 0:
-                        # When removing value, we need to be careful with the calculation
-                        # to avoid distorting the average cost
-                        new_total_value = original_total_value - original_item_value
-                        
-                        # Only update average cost if the math works out
-                        if new_total_value > 0:
-                            original_stock.average_cost = new_total_value / new_quantity
-                            # Selling price update removed
-                        # If new_total_value <= 0, keep the current average_cost
-                    
-                    # Update the quantity
-                    original_stock.quantity = new_quantity
-                    if original_stock.quantity < 0:
-                        original_stock.quantity = 0
-                    
-                    original_stock.save()
-                    logger.info(f"Adjusted original stock for product change: "
-                               f"product {original_product}, shop {original_shop}, "
-                               f"removed {instance._original_quantity} units, "
-                               f"new avg cost: {original_stock.average_cost}")
-                except (Stock.DoesNotExist, AttributeError) as e:
-                    logger.warning(f"Error adjusting original stock: {str(e)}")
+                original_shop = getattr(getattr(instance, '_original_invoice', None), 'shop_id', None)
+                original_product = getattr(instance, '_original_product', None)
+                if original_shop is not None and original_product is not None:
+                    post_stock_value(original_shop, original_product, -instance._original_quantity,
+                                     -instance._original_price * instance._original_quantity, logger,
+                                     movement_type=StockMovement.PURCHASE, source=instance, reason=reason)
+                else:
+                    logger.warning(f"Could not adjust original stock for purchase item {instance.pk}")
                 
                 # Then add the new item effects
-                try:
-                    new_stock = Stock.objects.get(shop=shop, product=product)
-                    
-                    # Update quantity and recalculate average cost
-                    old_value = new_stock.average_cost * new_stock.quantity
-                    new_value = instance.price * instance.quantity
-                    new_total_quantity = new_stock.quantity + instance.quantity
-                    
-                    if new_total_quantity > 0:
-                        new_stock.average_cost = (old_value + new_value) / new_total_quantity
-                        # Selling price update removed
-                    
-                    new_stock.quantity = new_total_quantity
-                    new_stock.save()
-                    
-                    logger.info(f"Updated stock for new product/shop: "
-                               f"product {product}, shop {shop}, "
-                               f"added {instance.quantity} units, "
-                               f"new avg cost: {new_stock.average_cost}")
-                except Stock.DoesNotExist:
-                    # Create with selling price based on profit margin
-                    new_stock = Stock.objects.create(
-                        shop=shop,
-                        product=product,
-                        quantity=instance.quantity,
-                        average_cost=instance.price
-                    )
-                    logger.info(f"Created new stock record for product {product} at shop {shop}")
+                post_stock_value(shop, product, instance.quantity, instance.price * instance.quantity, logger,
+                                 create_cost=instance.price, movement_type=StockMovement.PURCHASE,
+                                 source=instance, reason=reason)
+                if fifo_costing_enabled():
+                    # Move the line's lot to the new shop or product
+                    adjust_lots([(original_shop, original_product, -instance._original_quantity, instance, None),
+                                 (shop, product, instance.quantity, instance, instance.price)])
             else:
-                # Just a quantity or price change on the same product/shop
-                try:
-                    stock = Stock.objects.get(shop=shop, product=product)
-                    average_cost_changed = False
-                    
-                    # Case 1: Only quantity changed
-                    if quantity_change != 0 and not price_changed:
-                        if quantity_change > 0:
-                            # For additional quantity at the same price, straightforward calculation
-                            old_value = stock.average_cost * stock.quantity
-                            additional_value = instance.price * quantity_change
-                            new_total_quantity = stock.quantity + quantity_change
-                            
-                            if new_total_quantity > 0:
-                                stock.average_cost = (old_value + additional_value) / new_total_quantity
-                                average_cost_changed = True
-                        else:
-                            # For reduced quantity, we need to be careful
-                            # If the price at which units were "removed" is different from
-                            # the average cost, this changes the average cost of remaining units
-                            old_value = stock.average_cost * stock.quantity
-                            removed_value = instance.price * abs(quantity_change)
-                            new_total_quantity = stock.quantity + quantity_change  # quantity_change is negative
-                            
-                            if new_total_quantity > 0:
-                                # Only adjust avg cost if the price differs from avg cost
-                                if instance.price != stock.average_cost:
-                                    new_total_value = old_value - removed_value
-                                    stock.average_cost = new_total_value / new_total_quantity
-                                    average_cost_changed = True
-                        
-                        stock.quantity = new_total_quantity
-                        
-                    # Case 2: Only price changed
-                    elif price_changed and quantity_change == 0:
-                        # Recalculate by removing old value and adding new value
-                        old_item_value = instance._original_price * instance.quantity
-                        new_item_value = instance.price * instance.quantity
-                        
-                        old_total_value = stock.average_cost * stock.quantity
-                        # Remove contribution of old price, add contribution of new price
-                        adjusted_value = old_total_value - old_item_value + new_item_value
-                        
-                        if stock.quantity > 0:
-                            stock.average_cost = adjusted_value / stock.quantity
-                            average_cost_changed = True
-                    
-                    # Case 3: Both price and quantity changed
-                    elif price_changed and quantity_change != 0:
-                        # This is the most complex case
-                        # First, remove the old item completely
-                        old_total_value = stock.average_cost * stock.quantity
-                        old_item_value = instance._original_price * instance._original_quantity
-                        
-                        # Then add the new item
-                        new_item_value = instance.price * instance.quantity
-                        
-                        # Calculate the adjusted total and quantity
-                        adjusted_value = old_total_value - old_item_value + new_item_value
-                        new_total_quantity = stock.quantity - instance._original_quantity + instance.quantity
-                        
-                        if new_total_quantity > 0:
-                            stock.average_cost = adjusted_value / new_total_quantity
-                            average_cost_changed = True
-                        
-                        stock.quantity = new_total_quantity
-                    
-                    # Selling price update removed
-                    
-                    # Safety check to prevent negative quantities
-                    if stock.quantity < 0:
-                        stock.quantity = 0
-                        logger.warning(f"Prevented negative stock for product {product} at shop {shop}")
-                    
-                    stock.save()
-                    logger.info(f"Updated stock for product {product} at shop {shop}, "
-                               f"new quantity: {stock.quantity}, new avg cost: {stock.average_cost}")
-                except Stock.DoesNotExist:
-                    logger.warning(f"No stock record found for product {product} at shop {shop}")
+                # Just a quantity or price change on the same product/shop:
+                # take out the original line's quantity and value, put in the new ones
+                quantity_change = instance.quantity - instance._original_quantity
+                value_change = instance.price * instance.quantity - instance._original_price * instance._original_quantity
+                if quantity_change != 0 or value_change != 0:
+                    post_stock_value(shop, product, quantity_change, value_change, logger,
+                                     movement_type=StockMovement.PURCHASE, source=instance, reason=reason)
+                    if fifo_costing_enabled():
+                        adjust_lots([(shop, product, quantity_change, instance, instance.price)])
         except Exception as e:
             logger.error(f"Error updating stock on purchase item change: {str(e)}")
             raise  # Re-raise to ensure transaction rollback
 
-    # Update the invoice total
-    instance.purchase_invoice.update_total_amount()
+    # Update the invoice totals by the change in this line
+    original_line_total = instance._original_price * instance._original_quantity
+    line_total = instance.price * instance.quantity
+    if invoice_changed:
+        instance._original_invoice.update_total_amount(delta=-original_line_total)
+        instance.purchase_invoice.update_total_amount(delta=line_total)
+    elif line_total != original_line_total:
+        instance.purchase_invoice.update_total_amount(delta=line_total - original_line_total)
 
 
 def process_purchase_item_deletion(instance, logger):
@@ -289,50 +136,16 @@ def process_purchase_item_deletion(instance, logger):
         logger: Logger instance for recording operations
     """
     with transaction.atomic():
-        shop = instance.purchase_invoice.shop
-        product = instance.product
-        
-        try:
-            stock = Stock.objects.get(shop=shop, product=product)
-            average_cost_changed = False
-            
-            # Calculate the value that needs to be removed
-            item_value = instance.price * instance.quantity
-            total_value = stock.average_cost * stock.quantity
-            
-            # Calculate new quantity
-            new_quantity = stock.quantity - instance.quantity
-            
-            # Update the average cost if quantity will still be positive
-            if new_quantity > 0:
-                # When removing value, we need a careful calculation
-                new_total_value = total_value - item_value
-                
-                # Only update average cost if the math works out
-                if new_total_value > 0:
-                    stock.average_cost = new_total_value / new_quantity
-                    average_cost_changed = True
-                # If new_total_value <= 0, keep the current average_cost
-            
-            # Update the quantity
-            stock.quantity = new_quantity
-            
-            # Selling price update removed
-            
-            # Ensure quantity doesn't go below 0
-            if stock.quantity < 0:
-                stock.quantity = 0
-                logger.warning(f"Prevented negative stock for product {product} at shop {shop}")
-                
-            stock.save()
-            logger.info(f"Updated stock after item deletion: product {product}, shop {shop}, "
-                       f"quantity: {stock.quantity}, avg cost: {stock.average_cost}")
-        except Stock.DoesNotExist:
-            logger.warning(f"No stock record found for product {product} at shop {shop}")
+        post_stock_value(instance.purchase_invoice.shop_id, instance.product_id, -instance.quantity,
+                         -instance.price * instance.quantity, logger,
+                         movement_type=StockMovement.PURCHASE, source=instance,
+                         reason=f"Purchase item {instance.pk} deleted")
+        if fifo_costing_enabled():
+            adjust_lots([(instance.purchase_invoice.shop_id, instance.product_id, -instance.quantity, instance, None)])
             
         # Update the invoice total
         try:
-            instance.purchase_invoice.update_total_amount()
+            instance.purchase_invoice.update_total_amount(delta=-instance.price * instance.quantity)
         except instance.purchase_invoice.__class__.DoesNotExist:
             # Invoice might have been deleted as well
             logger.info("Could not update invoice total - invoice may have been deleted")
\ No newline at end of file
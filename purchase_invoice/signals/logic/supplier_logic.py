@@ -160,68 +160,3 @@ def handle_invoice_save(instance, created, logger):
     else:
         # For updated invoices, only add/subtract the difference
         update_supplier_payable_on_update(instance, logger)
-
-
-def handle_invoice_item_save(instance, created, logger):
-    """
-    Handle the business logic for when an invoice item is saved.
-    This centralizes the logic that would otherwise be in the signal handler.
-    
-    Args:
-        instance: The PurchaseInvoiceItem instance
-        created: Boolean indicating if this is a new instance
-        logger: Logger instance for recording operations
-    """
-    invoice = instance.purchase_invoice
-    
-    # Completely disable this function as we're letting the invoice post_save handle all updates
-    # This is the key change - we're not doing any supplier payable updates at the item level anymore
-    # Instead, we'll rely on the invoice's total amount being updated and then the invoice's post_save signal
-    # will handle updating the supplier payable
-    
-    with transaction.atomic():
-        # Update the invoice total - this will trigger the invoice's post_save signal
-        old_total = invoice.total_amount
-        invoice.update_total_amount()
-        new_total = invoice.total_amount
-        
-        # Only save the invoice if the total actually changed
-        if old_total != new_total:
-            logger.debug(f"Updating invoice {invoice.pk} total from {old_total} to {new_total}")
-            invoice.save(update_fields=['total_amount'])
-            
-            # Note: We do NOT update the supplier payable here.
-            # The invoice's post_save signal will handle that.
-
-
-def handle_invoice_item_delete(instance, logger):
-    """
-    Handle the business logic for when an invoice item is deleted.
-    This centralizes the logic that would otherwise be in the signal handler.
-    
-    Args:
-        instance: The PurchaseInvoiceItem instance being deleted
-        logger: Logger instance for recording operations
-    """
-    try:
-        invoice = instance.purchase_invoice
-        if not invoice or not invoice.supplier:
-            return
-        
-        with transaction.atomic():
-            # Update the invoice total - this will trigger the invoice's post_save signal
-            old_total = invoice.total_amount
-            invoice.update_total_amount()
-            new_total = invoice.total_amount
-            
-            # Only save the invoice if the total actually changed
-            if old_total != new_total:
-                logger.debug(f"Updating invoice {invoice.pk} total from {old_total} to {new_total} after item deletion")
-                invoice.save(update_fields=['total_amount'])
-                
-                # Note: We do NOT update the supplier payable here.
-                # The invoice's post_save signal will handle that.
-                
-    except Exception as e:
-        logger.error(f"Error updating invoice total after item deletion: {str(e)}")
-        # Let the exception propagate to rollback the transaction
\ No newline at end of file
@@ -1,9 +1,15 @@
 from decimal import Decimal
+from django.db import connection, transaction
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
 
+from account.models import Account
+from bulk_recompute import bulk_recompute
+from payment.models import Payment
 from shop.models import Shop
 from product.models import Product
 from supplier.models import Supplier
+from inventory.models.stock import Stock
 from purchase_invoice.models import PurchaseInvoice, PurchaseInvoiceItem
 
 
@@ -270,4 +276,99 @@ class SupplierPayableTestCase(TestCase):
         
         # Check supplier1's payable is zero but supplier2's is unchanged
         self.assertEqual(self.supplier1.payable, Decimal('0.00'))
-        self.assertEqual(self.supplier2.payable, Decimal('600.00'))
\ No newline at end of file
+        self.assertEqual(self.supplier2.payable, Decimal('600.00'))
+
+    def test_moving_item_between_invoices_updates_both_totals(self):
+        """Test that moving an item to another invoice moves its total and payable with it."""
+        invoice1 = PurchaseInvoice.objects.create(supplier=self.supplier1, shop=self.shop)
+        invoice2 = PurchaseInvoice.objects.create(supplier=self.supplier2, shop=self.shop)
+        item = PurchaseInvoiceItem.objects.create(
+            purchase_invoice=invoice1,
+            product=self.product,
+            quantity=4,
+            price=Decimal('25.00')
+        )
+        
+        # Move the item and change its quantity in the same save
+        item.purchase_invoice = invoice2
+        item.quantity = 6
+        item.save()
+        
+        invoice1.refresh_from_db()
+        invoice2.refresh_from_db()
+        self.supplier1.refresh_from_db()
+        self.supplier2.refresh_from_db()
+        
+        self.assertEqual(invoice1.total_amount, Decimal('0.00'))
+        self.assertEqual(invoice2.total_amount, Decimal('150.00'))  # 6 * 25
+        self.assertEqual(self.supplier1.payable, Decimal('0.00'))
+        self.assertEqual(self.supplier2.payable, Decimal('150.00'))
+        
+        # A full recompute agrees with the incremental totals
+        invoice2.update_total_amount()
+        self.assertEqual(invoice2.total_amount, Decimal('150.00'))
+
+    def test_item_update_uses_tracked_values_without_refetching(self):
+        """Test that an item edit moves stock and payable from its tracked values, without re-reading the item."""
+        invoice = PurchaseInvoice.objects.create(supplier=self.supplier1, shop=self.shop)
+        item = PurchaseInvoiceItem.objects.create(
+            purchase_invoice=invoice,
+            product=self.product,
+            quantity=10,
+            price=Decimal('10.00')
+        )
+        item = PurchaseInvoiceItem.objects.select_related('purchase_invoice').get(pk=item.pk)
+
+        item.price = Decimal('12.00')
+        with CaptureQueriesContext(connection) as queries:
+            item.save()
+        item_table = PurchaseInvoiceItem._meta.db_table
+        self.assertFalse([query for query in queries
+                          if query['sql'].startswith('SELECT') and f'FROM "{item_table}" WHERE' in query['sql']])
+
+        stock = Stock.objects.get(shop=self.shop, product=self.product)
+        self.supplier1.refresh_from_db()
+        self.assertEqual(stock.quantity, 10)
+        self.assertEqual(stock.average_cost, Decimal('12.00'))
+        self.assertEqual(self.supplier1.payable, Decimal('120.00'))
+
+    def purchase(self, account):
+        """Purchases, an edit, a payment and a supplier change."""
+        invoice = PurchaseInvoice.objects.create(supplier_id=self.supplier1.pk, shop=self.shop)
+        PurchaseInvoiceItem.objects.create(purchase_invoice=invoice, product=self.product, quantity=10,
+                                           price=Decimal('12.00'))
+        item = PurchaseInvoiceItem.objects.create(purchase_invoice=invoice, product=self.product, quantity=5,
+                                                  price=Decimal('20.00'))
+        item.price = Decimal('18.00')
+        item.save()
+        Payment.objects.create(payable=PurchaseInvoice.objects.get(pk=invoice.pk), amount=Decimal('50.00'),
+                               account=account)
+
+        moved = PurchaseInvoice.objects.create(supplier_id=self.supplier1.pk, shop=self.shop)
+        PurchaseInvoiceItem.objects.create(purchase_invoice=moved, product=self.product, quantity=2,
+                                           price=Decimal('15.00'))
+        moved = PurchaseInvoice.objects.get(pk=moved.pk)
+        moved.supplier_id = self.supplier2.pk
+        moved.save()
+
+    def test_bulk_recompute_matches_signal_handlers(self):
+        """Test that work inside bulk_recompute leaves the same stock, totals and payables as the handlers."""
+        account = Account.objects.create(name="Cash", balance=Decimal('500.00'))
+
+        def derived_state():
+            return (list(Supplier.objects.order_by('pk').values_list('payable', flat=True)),
+                    list(PurchaseInvoice.objects.order_by('pk').values_list('total_amount', 'paid_amount')),
+                    list(Stock.objects.values_list('quantity', 'average_cost', 'selling_price')),
+                    Account.objects.get(pk=account.pk).balance)
+
+        with transaction.atomic():
+            self.purchase(account)
+            expected = derived_state()
+            transaction.set_rollback(True)
+
+        with bulk_recompute():
+            self.purchase(account)
+            self.assertFalse(Stock.objects.exists())
+
+        self.assertEqual(derived_state(), expected)
+        self.assertEqual(expected[0], [Decimal('160.00'), Decimal('30.00')])
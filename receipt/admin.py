@@ -26,7 +26,12 @@ class ReceiptValidator:
     
     @staticmethod
     def validate_amount(amount, sales_invoice, original_amount=Decimal('0.00')):
-        """Validate that receipt amount doesn't exceed remaining unpaid amount"""
+        """
+        Validate that receipt amount doesn't exceed remaining unpaid amount.
+
+        This gives the form a friendly error; saving the receipt re-checks it
+        atomically with a guarded update of the invoice's paid amount.
+        """
         if not all([amount is not None, sales_invoice]):
             return
             
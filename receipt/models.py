@@ -1,9 +1,10 @@
-from django.db import models
+from django.db import models, transaction
 from simple_history.models import HistoricalRecords
+from utils import FieldTrackerMixin
 
 from sale_invoice.models import SalesInvoice
 
-class Receipt(models.Model):
+class Receipt(FieldTrackerMixin, models.Model):
     sales_invoice = models.ForeignKey(SalesInvoice, on_delete=models.CASCADE, related_name='receipts')
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     account = models.ForeignKey('account.Account', on_delete=models.CASCADE, related_name='received_payments')
@@ -17,3 +18,12 @@ class Receipt(models.Model):
         permissions = [
             ("can_view_icon_receipt", "Can view icon receipt"),
         ]
+
+    def save(self, *args, **kwargs):
+        """
+        Save the receipt and its signal effects in one transaction, so a receipt
+        the invoice cannot take (the guarded allocation raises ValidationError)
+        leaves no account or credit change behind.
+        """
+        with transaction.atomic():
+            super().save(*args, **kwargs)
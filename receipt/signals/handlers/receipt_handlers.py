@@ -1,10 +1,12 @@
 from django.db.models.signals import pre_save, post_save, pre_delete
 from django.dispatch import receiver
 
+from bulk_recompute import skip_during_bulk_recompute
 from receipt.models import Receipt
 from receipt.signals.logic.receipt_logic import capture_original_receipt_state, reverse_receipt_effects, update_account_balance, update_invoice_customer
 
 @receiver(pre_save, sender=Receipt)
+@skip_during_bulk_recompute
 def receipt_pre_save(sender, instance, **kwargs):
     """
     Capture the original state of a receipt before it's changed.
@@ -16,6 +18,7 @@ def receipt_pre_save(sender, instance, **kwargs):
 
 
 @receiver(post_save, sender=Receipt)
+@skip_during_bulk_recompute
 def receipt_account_update(sender, instance, created, **kwargs):
     """
     Update account balance after receipt is saved.
@@ -27,6 +30,7 @@ def receipt_account_update(sender, instance, created, **kwargs):
 
 
 @receiver(post_save, sender=Receipt)
+@skip_during_bulk_recompute
 def receipt_invoice_customer_update(sender, instance, created, **kwargs):
     """
     Update sales invoice paid amount and customer credit.
@@ -38,6 +42,7 @@ def receipt_invoice_customer_update(sender, instance, created, **kwargs):
 
 
 @receiver(pre_delete, sender=Receipt)
+@skip_during_bulk_recompute
 def receipt_pre_delete(sender, instance, **kwargs):
     """
     When a receipt is deleted, reverse all the financial effects.
@@ -1,27 +1,50 @@
+from django.core.exceptions import ValidationError
 from django.db import transaction
+from django.db.models import F
 from decimal import Decimal
 
-from receipt.models import Receipt
+from utils import guarded_update, increment_field
+
+
+def allocate_to_invoice(sales_invoice, amount):
+    """
+    Add a receipt amount to an invoice's paid amount, but only if the invoice
+    still has that much unpaid.
+
+    The check and the allocation are one guarded UPDATE
+    (``paid_amount + amount <= total_amount``), so two receipts racing for
+    the same invoice cannot overpay it. The invoice is refreshed afterwards
+    and its history written with its _change_reason.
+
+    Args:
+        sales_invoice: The SalesInvoice being paid
+        amount: Amount to allocate
+
+    Raises:
+        ValidationError: If the amount exceeds the remaining unpaid amount
+    """
+    model = type(sales_invoice)
+    if not guarded_update(model.objects.filter(pk=sales_invoice.pk), 'paid_amount', amount,
+                          maximum=F('total_amount')):
+        raise ValidationError(f"Receipt amount {amount} exceeds the remaining unpaid amount of {sales_invoice}.")
+    sales_invoice.refresh_from_db(fields=['paid_amount'])
+    model.history.bulk_history_create([sales_invoice], update=True)
 
 
 def capture_original_receipt_state(instance):
     """
     Capture the original state of a receipt before it's changed.
     
+    The values come from the receipt's change tracker, so no query is made
+    unless the account or invoice was changed (the original is then loaded).
+    
     Args:
         instance: The Receipt instance being saved
     """
     if instance.pk:
-        try:
-            old_receipt = Receipt.objects.get(pk=instance.pk)
-            instance._original_amount = old_receipt.amount
-            instance._original_account = old_receipt.account
-            instance._original_sales_invoice = old_receipt.sales_invoice
-        except Receipt.DoesNotExist:
-            # New instance or instance was deleted
-            instance._original_amount = None
-            instance._original_account = None
-            instance._original_sales_invoice = None
+        instance._original_amount = instance.original('amount')
+        instance._original_account = instance.original_related('account')
+        instance._original_sales_invoice = instance.original_related('sales_invoice')
 
 def update_account_balance(instance, created):
     """
@@ -42,8 +65,7 @@ def update_account_balance(instance, created):
                 f"Balance increased by {instance.amount} due to new receipt for invoice {instance.sales_invoice}")
             
             # Update account balance
-            instance.account.balance += instance.amount
-            instance.account.save(update_fields=['balance'])           
+            increment_field(instance.account, 'balance', instance.amount)           
     else:
         if hasattr(instance, '_original_amount') and hasattr(instance, '_original_account'):
             with transaction.atomic():
@@ -55,14 +77,12 @@ def update_account_balance(instance, created):
                     # Set history reason and update original account
                     instance._original_account._change_reason = getattr(instance._original_account, '_change_reason',
                         f"Balance decreased by {instance._original_amount} due to receipt transfer to {instance.account}")
-                    instance._original_account.balance -= instance._original_amount
-                    instance._original_account.save(update_fields=['balance'])
+                    increment_field(instance._original_account, 'balance', -instance._original_amount)
                     
                     # Set history reason and update new account
                     instance.account._change_reason = getattr(instance.account, '_change_reason',
                         f"Balance increased by {instance.amount} due to receipt transfer from {instance._original_account}")
-                    instance.account.balance += instance.amount
-                    instance.account.save(update_fields=['balance'])
+                    increment_field(instance.account, 'balance', instance.amount)
                 else:
                     # Same account but amount changed
                     delta = instance.amount - instance._original_amount
@@ -80,8 +100,7 @@ def update_account_balance(instance, created):
                         instance.account._change_reason = getattr(instance.account, '_change_reason', change_description)
                         
                         # Update account balance
-                        instance.account.balance += delta
-                        instance.account.save(update_fields=['balance'])
+                        increment_field(instance.account, 'balance', delta)
 
 def update_invoice_customer(instance, created):
     """
@@ -106,9 +125,8 @@ def update_invoice_customer(instance, created):
                 # If paid_amount is Decimal, convert amount to Decimal
                 amount = Decimal(str(amount))
             
-            # Update invoice paid amount
-            instance.sales_invoice.paid_amount += amount
-            instance.sales_invoice.save(update_fields=['paid_amount'])
+            # Allocate to the invoice only if it is not already paid off
+            allocate_to_invoice(instance.sales_invoice, amount)
             
             if instance.sales_invoice.customer:
                 # Set history reason for customer
@@ -123,8 +141,7 @@ def update_invoice_customer(instance, created):
                     customer_amount = float(customer_amount)
                 
                 # Update customer credit - FIXED: This should be SUBTRACTED from credit
-                instance.sales_invoice.customer.credit -= customer_amount
-                instance.sales_invoice.customer.save(update_fields=['credit'])
+                increment_field(instance.sales_invoice.customer, 'credit', -customer_amount)
     else:
         if hasattr(instance, '_original_amount') and hasattr(instance, '_original_sales_invoice'):
             with transaction.atomic():
@@ -153,8 +170,7 @@ def update_invoice_customer(instance, created):
                         f"Paid amount decreased by {original_amount} due to receipt transfer to invoice {instance.sales_invoice}")
                     
                     # Update original invoice paid amount
-                    instance._original_sales_invoice.paid_amount -= original_amount
-                    instance._original_sales_invoice.save(update_fields=['paid_amount'])
+                    increment_field(instance._original_sales_invoice, 'paid_amount', -original_amount)
                     
                     if instance._original_sales_invoice.customer:
                         # Set history reason for original customer
@@ -168,16 +184,14 @@ def update_invoice_customer(instance, created):
                         elif isinstance(instance._original_sales_invoice.customer.credit, float) and isinstance(customer_original_amount, Decimal):
                             customer_original_amount = float(customer_original_amount)
                             
-                        instance._original_sales_invoice.customer.credit += customer_original_amount
-                        instance._original_sales_invoice.customer.save(update_fields=['credit'])
+                        increment_field(instance._original_sales_invoice.customer, 'credit', customer_original_amount)
                     
                     # Set history reason for new invoice
                     instance.sales_invoice._change_reason = getattr(instance.sales_invoice, '_change_reason',
                         f"Paid amount increased by {current_amount} due to receipt transfer from invoice {instance._original_sales_invoice}")
                     
-                    # Update new invoice paid amount
-                    instance.sales_invoice.paid_amount += current_amount
-                    instance.sales_invoice.save(update_fields=['paid_amount'])
+                    # Allocate to the new invoice only if it is not already paid off
+                    allocate_to_invoice(instance.sales_invoice, current_amount)
                     
                     if instance.sales_invoice.customer:
                         # Set history reason for new customer
@@ -191,8 +205,7 @@ def update_invoice_customer(instance, created):
                         elif isinstance(instance.sales_invoice.customer.credit, float) and isinstance(customer_current_amount, Decimal):
                             customer_current_amount = float(customer_current_amount)
                             
-                        instance.sales_invoice.customer.credit -= customer_current_amount
-                        instance.sales_invoice.customer.save(update_fields=['credit'])
+                        increment_field(instance.sales_invoice.customer, 'credit', -customer_current_amount)
                 else:
                     # Same invoice but amount changed
                     delta = instance.amount - instance._original_amount
@@ -212,9 +225,11 @@ def update_invoice_customer(instance, created):
                         # Set history reason for invoice
                         instance.sales_invoice._change_reason = getattr(instance.sales_invoice, '_change_reason', invoice_change)
                         
-                        # Update invoice paid amount
-                        instance.sales_invoice.paid_amount += delta
-                        instance.sales_invoice.save(update_fields=['paid_amount'])
+                        # Update invoice paid amount; an increase must still fit the invoice total
+                        if delta > 0:
+                            allocate_to_invoice(instance.sales_invoice, delta)
+                        else:
+                            increment_field(instance.sales_invoice, 'paid_amount', delta)
                         
                         if instance.sales_invoice.customer:
                             # Determine change description for customer
@@ -227,8 +242,7 @@ def update_invoice_customer(instance, created):
                             instance.sales_invoice.customer._change_reason = getattr(instance.sales_invoice.customer, '_change_reason', customer_change)
                             
                             # Update customer credit - FIXED: When paid amount increases, credit should DECREASE
-                            instance.sales_invoice.customer.credit -= delta
-                            instance.sales_invoice.customer.save(update_fields=['credit'])
+                            increment_field(instance.sales_invoice.customer, 'credit', -delta)
 
 def reverse_receipt_effects(instance):
     """
@@ -247,8 +261,7 @@ def reverse_receipt_effects(instance):
             f"Balance decreased by {instance.amount} due to receipt deletion")
         
         # Update account balance
-        instance.account.balance -= instance.amount
-        instance.account.save(update_fields=['balance'])
+        increment_field(instance.account, 'balance', -instance.amount)
         
         # Convert amount based on target type
         amount = instance.amount
@@ -264,8 +277,7 @@ def reverse_receipt_effects(instance):
             f"Paid amount decreased by {amount} due to receipt deletion")
         
         # Update invoice paid amount
-        instance.sales_invoice.paid_amount -= amount
-        instance.sales_invoice.save(update_fields=['paid_amount'])
+        increment_field(instance.sales_invoice, 'paid_amount', -amount)
         
         if instance.sales_invoice.customer:
             # Set history reason for customer
@@ -280,5 +292,4 @@ def reverse_receipt_effects(instance):
                 customer_amount = float(customer_amount)
             
             # Update customer credit - FIXED: When receipt is deleted, ADD to credit
-            instance.sales_invoice.customer.credit += customer_amount
-            instance.sales_invoice.customer.save(update_fields=['credit'])
\ No newline at end of file
+            increment_field(instance.sales_invoice.customer, 'credit', customer_amount)
\ No newline at end of file
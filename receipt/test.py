@@ -30,7 +30,7 @@ class ReceiptTestCase(TransactionTestCase):
             name="Test Customer",
             mobile_number="1234567890",
             credit=Decimal('500.00'),
-            credit_limit=Decimal('1000.00')
+            credit_limit=Decimal('5000.00')
         )
         
         # Create accounts
@@ -168,6 +168,32 @@ class ReceiptTestCase(TransactionTestCase):
         self.assertFalse(form2.is_valid())
         self.assertIn('amount', form2.errors)
 
+    def test_receipt_cannot_overpay_invoice(self):
+        """
+        Test that a receipt saved without the form is still refused by the
+        guarded allocation, leaving the account, customer and invoice untouched
+        """
+        Receipt.objects.create(
+            sales_invoice=self.sales_invoice,
+            amount=Decimal('700.00'),
+            account=self.account1
+        )
+
+        with self.assertRaises(ValidationError):
+            Receipt.objects.create(
+                sales_invoice=self.sales_invoice,
+                amount=Decimal('400.00'),
+                account=self.account1
+            )
+
+        self.account1.refresh_from_db()
+        self.customer.refresh_from_db()
+        self.sales_invoice.refresh_from_db()
+        self.assertEqual(self.account1.balance, Decimal('700.00'))
+        self.assertEqual(self.customer.credit, Decimal('1600.00'))
+        self.assertEqual(self.sales_invoice.paid_amount, Decimal('700.00'))
+        self.assertEqual(Receipt.objects.filter(sales_invoice=self.sales_invoice).count(), 1)
+
     def test_receipt_amount_update(self):
         """
         Test that updating receipt amount:
@@ -1,6 +1,8 @@
+from decimal import Decimal
 from django import forms
 from django.forms.models import BaseInlineFormSet
 from django.utils import timezone
+from inventory.models.stock import Stock
 from sale_invoice.models import SalesInvoice, SalesInvoiceItem
 from .validators import CustomerValidator, InventoryValidator, InvoiceValidator
 
@@ -29,65 +31,107 @@ class SalesInvoiceForm(forms.ModelForm):
 
         return cleaned_data
 
+def validate_item_forms(item_forms, shop, reservation_token=None):
+    """
+    Validate the stock and prices of a batch of invoice item forms together.
+
+    The shop's Stock rows for every product involved and the saved versions of
+    the edited lines are read with one query each. Quantities are netted per
+    product (the new lines minus what the edited and deleted lines already
+    took), so a product on several lines is checked once, against its total.
+    Errors are added to the forms of the products concerned.
+    """
+    lines, returned = [], []
+    for form in item_forms:
+        cleaned_data = getattr(form, 'cleaned_data', None) or {}
+        if cleaned_data.get('DELETE'):
+            returned.append(form.instance.pk)
+        elif cleaned_data.get('product') and cleaned_data.get('quantity'):
+            lines.append(form)
+            returned.append(form.instance.pk)
+    if not lines or not shop:
+        return
+
+    demands, products = {}, {}
+    for form in lines:
+        product = form.cleaned_data['product']
+        products[product.pk] = product
+        demands[product.pk] = demands.get(product.pk, 0) + form.cleaned_data['quantity']
+    returned = [pk for pk in returned if pk]
+    if returned:
+        for product_id, quantity in SalesInvoiceItem.objects.filter(pk__in=returned).values_list('product_id',
+                                                                                                  'quantity'):
+            if product_id in demands:
+                demands[product_id] -= quantity
+    stocks = {stock.product_id: stock for stock in Stock.objects.filter(shop=shop, product_id__in=demands)}
+
+    errors = InventoryValidator.validate_stock_lines(
+        shop, {products[product_id]: quantity for product_id, quantity in demands.items()},
+        stocks, reservation_token,
+    )
+    for form in lines:
+        product = form.cleaned_data['product']
+        if product in errors:
+            form.add_error('quantity', errors[product])
+        price = form.cleaned_data.get('price')
+        if price:
+            try:
+                InventoryValidator.validate_price_against_stock(price, stocks.get(product.pk))
+            except forms.ValidationError as e:
+                form.add_error('price', e)
+
+
 class SalesInvoiceItemFormSet(BaseInlineFormSet):
+    def get_form_kwargs(self, index):
+        kwargs = super().get_form_kwargs(index)
+        # Stock and prices are validated for all the lines at once, in clean()
+        kwargs['validate_stock'] = False
+        return kwargs
+
     def clean(self):
         super().clean()
+        shop = getattr(self.instance, 'shop', None)
+        reservation_token = self.form_kwargs.get('reservation_token')
+        validate_item_forms(self.forms, shop, reservation_token)
         if any(self.errors):
             return
         
         if not self.forms:
             raise forms.ValidationError("Invoice must have at least one valid item.")
 
+        # Checked here so a sale over the credit limit is shown on the form instead of failing the save
+        total = Decimal('0.00')
+        for form in self.forms:
+            cleaned_data = form.cleaned_data
+            if cleaned_data.get('quantity') and not cleaned_data.get('DELETE'):
+                total += SalesInvoiceItem.calculate_line_total(
+                    cleaned_data['quantity'], cleaned_data.get('price'), cleaned_data.get('discount_method'),
+                    cleaned_data.get('discount_amount') or Decimal('0.00'))
+        stored_total = Decimal(self.instance.total_amount) if self.instance.pk else Decimal('0.00')
+        CustomerValidator.validate_credit_limit(getattr(self.instance, 'customer', None), total - stored_total)
+
 class SalesInvoiceItemForm(forms.ModelForm):
     class Meta:
         model = SalesInvoiceItem
         fields = '__all__'
 
+    def __init__(self, *args, reservation_token=None, validate_stock=True, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Stock that passes validation is reserved under this token until the invoice is saved
+        self.reservation_token = reservation_token
+        # Off when the formset validates every line together
+        self.validate_stock = validate_stock
+
     def clean(self):
         cleaned_data = super().clean()
-        product = cleaned_data.get('product')
-        quantity = cleaned_data.get('quantity')
-        price = cleaned_data.get('price')
+        if not self.validate_stock:
+            return cleaned_data
         sales_invoice = cleaned_data.get('sales_invoice')
         shop = sales_invoice.shop if sales_invoice else None
 
         if not shop and hasattr(self, 'parent_form'):
             parent_data = self.parent_form.cleaned_data
             shop = parent_data.get('shop')
-        
-        if product and quantity and shop:
-            original_quantity = 0
-            original_product = None            
-            if self.instance and self.instance.pk:
-                try:
-                    original = self.instance.__class__.objects.get(pk=self.instance.pk)
-                    original_quantity = original.quantity
-                    original_product = original.product
-                except self.instance.__class__.DoesNotExist:
-                    pass
-            if original_product and original_product == product:
-                quantity_difference = quantity - original_quantity
-                if quantity_difference <= 0:
-                    # Even if quantity is reduced, we should still validate the price
-                    if price and product and shop:
-                        try:
-                            InventoryValidator.validate_price_not_below_selling_price(None, product, price, shop)
-                        except forms.ValidationError as e:
-                            self.add_error('price', e)
-                    return cleaned_data
-                try:
-                    InventoryValidator.validate_stock_quantity(product, quantity_difference, shop)
-                except forms.ValidationError as e:
-                    self.add_error('quantity', e)
-            else:
-                try:
-                    InventoryValidator.validate_stock_quantity(product, quantity, shop)
-                except forms.ValidationError as e:
-                    self.add_error('quantity', e)
-            if price and product and shop:
-                try:
-                    InventoryValidator.validate_price_not_below_selling_price(None, product, price, shop)
-                except forms.ValidationError as e:
-                    self.add_error('price', e)
-
-        return cleaned_data
\ No newline at end of file
+
+        validate_item_forms([self], shop, self.reservation_token)
+        return cleaned_data
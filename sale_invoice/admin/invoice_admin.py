@@ -1,5 +1,6 @@
 from django.contrib import admin
 from django.core.exceptions import ValidationError
+from django.db.models import Prefetch
 from simple_history.admin import SimpleHistoryAdmin
 from unfold.admin import ModelAdmin
 from django.urls import reverse
@@ -8,8 +9,11 @@ from django.utils.safestring import mark_safe
 from django.shortcuts import redirect
 from guardian.shortcuts import get_objects_for_user
 
+from inventory.services.stock_reservations import new_reservation_token, release_reservations
+from receipt.models import Receipt
 from sale_invoice.admin.payment_status_filter import PaymentStatusFilter
 from sale_invoice.models import SalesInvoice, SalesInvoiceItem
+from sale_invoice.services.unit_of_work import sales_unit_of_work
 from shop.models import Shop
 from utils import invoice_number
 from .forms import SalesInvoiceForm
@@ -51,16 +55,16 @@ class SalesInvoiceAdmin(SimpleHistoryAdmin, PDFViewMixin, MessageMixin, ModelAdm
     get_created_at.short_description = "Created At"
 
     def average_cost(self, obj):
-        """Display total of all average costs of items"""
-        total_avg_cost = obj.get_total_average_cost()
-        return "{:.2f}".format(total_avg_cost) if total_avg_cost else "0.00"
+        """Display total of all average costs of items (stored on the invoice)"""
+        return "{:.2f}".format(obj.cost_total) if obj.cost_total else "0.00"
     average_cost.short_description = "Total Avg Cost"
+    average_cost.admin_order_field = 'cost_total'
 
     def profit(self, obj):
         """Display profit (total amount - total average cost) formatted as currency"""
-        profit_value = obj.get_profit()
-        return "{:.2f}".format(profit_value) if profit_value else "0.00"
+        return "{:.2f}".format(obj.profit) if obj.profit else "0.00"
     profit.short_description = "Profit"
+    profit.admin_order_field = 'profit'
     
     def has_delete_permission(self, request, obj=None):
         if not InvoiceService.can_delete_invoice(obj):
@@ -77,6 +81,48 @@ class SalesInvoiceAdmin(SimpleHistoryAdmin, PDFViewMixin, MessageMixin, ModelAdm
         
         super().save_model(request, obj, form, change)
     
+    def changeform_view(self, request, object_id=None, form_url='', extra_context=None):
+        """
+        Give the request a stock reservation token. Item forms reserve the stock
+        they validate under it; saving the invoice consumes the reservations,
+        and whatever is left (the form had errors) is released afterwards.
+        """
+        request.stock_reservation_token = new_reservation_token()
+        try:
+            return super().changeform_view(request, object_id, form_url, extra_context)
+        except ValidationError as e:
+            # Raised by a guarded update while saving, when a concurrent change
+            # got past the formset's checks (e.g. the credit limit); the whole
+            # save has already been rolled back.
+            self.display_error(request, " ".join(e.messages))
+            return redirect(request.get_full_path())
+        finally:
+            release_reservations(request.stock_reservation_token)
+
+    def get_formset_kwargs(self, request, obj, inline, prefix):
+        kwargs = super().get_formset_kwargs(request, obj, inline, prefix)
+        if isinstance(inline, SalesInvoiceItemInline):
+            kwargs['form_kwargs'] = {'reservation_token': getattr(request, 'stock_reservation_token', None)}
+        return kwargs
+
+    def save_related(self, request, form, formsets, change):
+        """
+        Save the item inlines as one unit of work, so stock, the invoice total
+        and customer credit are updated once for the whole invoice rather than
+        once per line. The stock reserved while validating is consumed in the
+        same transaction.
+        """
+        token = getattr(request, 'stock_reservation_token', None)
+        with sales_unit_of_work(reservation_token=token) as unit_of_work:
+            products = [
+                item_form.cleaned_data['product'].pk
+                for formset in formsets
+                for item_form in formset.forms
+                if getattr(item_form, 'cleaned_data', None) and item_form.cleaned_data.get('product')
+            ]
+            unit_of_work.prime_average_costs(form.instance.shop_id, products)
+            super().save_related(request, form, formsets, change)
+
     def response_change(self, request, obj):
         if not InvoiceService.can_edit_invoice(obj):
             return redirect(reverse('admin:inventory_salesinvoice_changelist'))
@@ -122,7 +168,11 @@ class SalesInvoiceAdmin(SimpleHistoryAdmin, PDFViewMixin, MessageMixin, ModelAdm
     view_invoice_pdf.short_description = 'Invoice PDF'
 
     def get_queryset(self, request):
-        qs = super().get_queryset(request)
+        # Cost and profit are stored on the invoice and receipts come from one
+        # prefetch, so list_display methods never query per row
+        qs = (super().get_queryset(request)
+              .select_related('shop', 'customer')
+              .prefetch_related(Prefetch('receipts', queryset=Receipt.objects.only('id', 'amount', 'sales_invoice_id'))))
         if request.user.is_superuser:
             return qs
         allowed_shops = get_objects_for_user(request.user, 'shop.view_shop', Shop)
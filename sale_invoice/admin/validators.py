@@ -1,7 +1,9 @@
 from django.forms import ValidationError
 from django.utils import timezone
 
+from customer.models import Customer
 from inventory.models.stock import Stock
+from inventory.services.stock_reservations import available_quantity, reserve_stock
 
 class CustomerValidator:
     @staticmethod
@@ -22,37 +24,97 @@ class CustomerValidator:
                 f"Due date cannot exceed customer credit period ({customer.credit_period} days)."
             )
 
+    @staticmethod
+    def validate_credit_limit(customer, increase):
+        """
+        Check that adding increase to the customer's stored credit stays within
+        their credit limit; a credit_limit of zero or less means no limit is set.
+
+        This lets a form report the problem; the guarded update that moves the
+        credit applies the same rule when the sale is saved.
+        """
+        if not customer or increase <= 0:
+            return
+        credit, credit_limit = Customer.objects.filter(pk=customer.pk).values_list('credit', 'credit_limit').get()
+        if credit_limit > 0 and credit + increase > credit_limit:
+            raise ValidationError(
+                f"This sale would take {customer} over their credit limit "
+                f"(credit {credit}, limit {credit_limit}, sale adds {increase})."
+            )
+
 class InventoryValidator:
     @staticmethod
-    def validate_stock_quantity(product, quantity, shop):
+    def validate_stock_quantity(product, quantity, shop, reservation_token=None):
+        """
+        Check that the quantity is available (stock not reserved by other sales).
+
+        With a reservation token the quantity is also reserved under that
+        token, in the same conditional update that checks it, so the stock
+        cannot be sold to someone else before this sale is committed.
+        """
         if not all([product, quantity, shop]):
-            return        
-        try:
-            stock = product.stock_set.get(shop=shop)            
-            if quantity > stock.quantity:
-                raise ValidationError(
-                    f"Quantity {quantity} exceeds available stock {stock.quantity} for {product.name} in {shop.name}."
-                )
-        except product.stock_set.model.DoesNotExist:
+            return
+        if reservation_token and reserve_stock(shop, product, quantity, reservation_token) is not None:
+            return
+        available = available_quantity(shop, product)
+        if available is None:
             raise ValidationError(f"No stock available for {product.name} in {shop.name}.")
-        except Exception as e:
-            raise ValidationError(f"{str(e)}")
+        if quantity > available or reservation_token:
+            raise ValidationError(
+                f"Quantity {quantity} exceeds available stock {available} for {product.name} in {shop.name}."
+            )
         
+    @staticmethod
+    def validate_stock_lines(shop, demands, stocks, reservation_token=None):
+        """
+        Check the net quantity an invoice needs of each product against Stock
+        rows that have already been read, so a whole invoice is checked at once.
+
+        With a reservation token each quantity is also reserved, by the same
+        conditional update as validate_stock_quantity.
+
+        Args:
+            shop: The Shop
+            demands: dict mapping Product to the net quantity needed
+            stocks: dict mapping product id to the shop's Stock row
+
+        Returns:
+            dict mapping Product to a ValidationError, for every product short of stock
+        """
+        errors = {}
+        # Reserve in product order so concurrent multi-line sales lock rows in the same order
+        for product, quantity in sorted(demands.items(), key=lambda demand: demand[0].pk):
+            if quantity <= 0:
+                continue
+            stock = stocks.get(product.pk)
+            if stock is None:
+                errors[product] = ValidationError(f"No stock available for {product.name} in {shop.name}.")
+                continue
+            if reservation_token and reserve_stock(shop, product, quantity, reservation_token) is not None:
+                continue
+            available = stock.quantity - stock.reserved_quantity
+            if quantity > available or reservation_token:
+                errors[product] = ValidationError(
+                    f"Quantity {quantity} exceeds available stock {available} for {product.name} in {shop.name}."
+                )
+        return errors
+
+    @staticmethod
+    def validate_price_against_stock(price, stock):
+        """Validate that the invoice price isn't below the selling price of a Stock row already read."""
+        if stock is not None and price < stock.selling_price:
+            raise ValidationError(
+                f"Price ({price}) cannot be lower than the product's selling price ({stock.selling_price})"
+            )
+
     @staticmethod
     def validate_price_not_below_selling_price(self, product, price, shop):
         """
         Validate that the invoice price isn't below the product's selling price.
         This would be implemented in your InventoryValidator class.
         """
-        try:
-            stock = Stock.objects.get(shop=shop, product=product)
-            if price < stock.selling_price:
-                raise ValidationError(
-                    f"Price ({price}) cannot be lower than the product's selling price ({stock.selling_price})"
-                )
-        except Stock.DoesNotExist:
-            pass
-            # raise ValidationError(f"No stock available for {product.name} in {shop.name}.")
+        stock = Stock.objects.filter(shop=shop, product=product).first()
+        InventoryValidator.validate_price_against_stock(price, stock)
 
 class InvoiceValidator:
     @staticmethod
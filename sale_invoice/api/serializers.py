@@ -1,4 +1,43 @@
+from decimal import Decimal
+
 from rest_framework import serializers
 
+from sale_invoice.models import SalesInvoiceItem
+
 class TotalReceivablesSerializer(serializers.Serializer):
-    total_receivables = serializers.DecimalField(max_digits=15, decimal_places=2)
\ No newline at end of file
+    total_receivables = serializers.DecimalField(max_digits=15, decimal_places=2)
+
+
+class CheckoutLineSerializer(serializers.Serializer):
+    product = serializers.IntegerField()
+    quantity = serializers.IntegerField(min_value=1)
+    price = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.00'), required=False)
+    discount_method = serializers.ChoiceField(choices=SalesInvoiceItem.DISCOUNT_METHOD_CHOICES, default='amount')
+    discount_amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.00'),
+                                               default=Decimal('0.00'))
+
+
+class CheckoutPaymentSerializer(serializers.Serializer):
+    account = serializers.IntegerField()
+    amount = serializers.DecimalField(max_digits=10, decimal_places=2, min_value=Decimal('0.01'))
+
+
+class CheckoutSerializer(serializers.Serializer):
+    """A sale sent by a till. Ids are checked against the database in bulk by the checkout."""
+    shop = serializers.IntegerField()
+    customer = serializers.IntegerField(required=False, allow_null=True)
+    due_date = serializers.DateField(required=False, allow_null=True)
+    reservation_token = serializers.CharField(max_length=64, required=False, allow_blank=True)
+    items = CheckoutLineSerializer(many=True, allow_empty=False)
+    payment = CheckoutPaymentSerializer(required=False, allow_null=True)
+
+
+class SyncSaleSerializer(serializers.Serializer):
+    """One sale of an offline sync batch. Ids are checked against the database in bulk later."""
+    idempotency_key = serializers.CharField(max_length=64)
+    shop = serializers.IntegerField()
+    customer = serializers.IntegerField(required=False, allow_null=True)
+    due_date = serializers.DateField(required=False, allow_null=True)
+    sold_at = serializers.DateTimeField(required=False, allow_null=True)
+    items = CheckoutLineSerializer(many=True, allow_empty=False)
+    payment = CheckoutPaymentSerializer(required=False, allow_null=True)
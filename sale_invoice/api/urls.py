@@ -1,6 +1,8 @@
 from django.urls import path
-from .views import TotalReceivablesView
+from .views import CheckoutAPI, SalesSyncAPI, TotalReceivablesView
 
 urlpatterns = [
     path('total-receivables/', TotalReceivablesView.as_view(), name='total-receivables'),
-]
\ No newline at end of file
+    path('checkout/', CheckoutAPI.as_view(), name='checkout-api'),
+    path('sync/', SalesSyncAPI.as_view(), name='sales-sync-api'),
+]
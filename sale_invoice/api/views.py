@@ -1,9 +1,15 @@
+from django.core.exceptions import ValidationError
+from rest_framework import status
+from rest_framework.permissions import IsAuthenticated
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from django.db.models import Sum, F
 
 from sale_invoice.models import SalesInvoice
-from .serializers import TotalReceivablesSerializer
+from sale_invoice.services.checkout import checkout
+from sale_invoice.services.sales_sync import sync_sales
+from shop.permissions import forbidden_shops
+from .serializers import CheckoutSerializer, SyncSaleSerializer, TotalReceivablesSerializer
 
 class TotalReceivablesView(APIView):
     def get(self, request):
@@ -14,4 +20,118 @@ class TotalReceivablesView(APIView):
         result = {'total_receivables': total['total_receivables'] or 0}
         
         serializer = TotalReceivablesSerializer(result)
-        return Response(serializer.data)
\ No newline at end of file
+        return Response(serializer.data)
+
+
+class CheckoutAPI(APIView):
+    """
+    API to record a whole sale in one request
+
+    POST ``{"shop", "customer", "due_date", "reservation_token",
+    "items": [{"product", "quantity", "price", "discount_method", "discount_amount"}],
+    "payment": {"account", "amount"}}`` creates the invoice, its items and the
+    receipt, and takes the stock, in one transaction. Only shop and items are
+    required; lines without a price are sold at the selling price. Stock held
+    under the reservation token is consumed. Every problem with the sale is
+    reported at once and nothing is recorded. The user needs the
+    ``shop.view_shop`` permission on the shop.
+    """
+    permission_classes = [IsAuthenticated]
+    MAX_ITEMS = 500
+
+    def post(self, request):
+        serializer = CheckoutSerializer(data=request.data)
+        if not serializer.is_valid():
+            return Response(serializer.errors, status=status.HTTP_400_BAD_REQUEST)
+
+        data = serializer.validated_data
+        if len(data['items']) > self.MAX_ITEMS:
+            return Response(
+                {'error': f'At most {self.MAX_ITEMS} items can be sent in one sale'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if forbidden_shops(request.user, [data['shop']]):
+            return Response(
+                {'error': f"You do not have permission to sell in shop {data['shop']}"},
+                status=status.HTTP_403_FORBIDDEN
+            )
+        try:
+            invoice = checkout(data, reservation_token=data.get('reservation_token'))
+        except ValidationError as e:
+            return Response({'error': 'Sale rejected', 'errors': e.message_dict},
+                            status=status.HTTP_400_BAD_REQUEST)
+
+        return Response({
+            'invoice_id': invoice.pk,
+            'receipt_id': invoice.receipt.pk if invoice.receipt else None,
+            'total_amount': str(invoice.total_amount),
+            'paid_amount': str(invoice.paid_amount),
+            'due_amount': str(invoice.get_due_amount()),
+            'due_date': invoice.due_date,
+        }, status=status.HTTP_201_CREATED)
+
+
+class SalesSyncAPI(APIView):
+    """
+    API for tills to upload the sales they recorded while offline
+
+    Accepts ``{"sales": [{"idempotency_key", "shop", "customer", "due_date", "sold_at",
+    "items": [...], "payment": {...}}]}``, sales and lines as for the checkout,
+    and answers with one result per sale, in request order. A sale whose
+    idempotency key was already synced is reported as a duplicate with its
+    invoice, so a till can re-send its whole queue after a failed upload.
+    Sales for shops the user has no ``shop.view_shop`` permission on are
+    rejected.
+    """
+    permission_classes = [IsAuthenticated]
+    MAX_SALES = 1000
+
+    def post(self, request):
+        sales = request.data.get('sales') if isinstance(request.data, dict) else None
+        if not isinstance(sales, list) or not sales:
+            return Response(
+                {'error': 'sales must be a non-empty list'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+        if len(sales) > self.MAX_SALES:
+            return Response(
+                {'error': f'At most {self.MAX_SALES} sales can be sent in one request'},
+                status=status.HTTP_400_BAD_REQUEST
+            )
+
+        results = [None] * len(sales)
+        valid = []
+        for index, sale in enumerate(sales):
+            serializer = SyncSaleSerializer(data=sale)
+            if serializer.is_valid():
+                valid.append((index, serializer.validated_data))
+            else:
+                results[index] = {'status': 'rejected', 'errors': serializer.errors}
+
+        forbidden = set(forbidden_shops(request.user, [data['shop'] for index, data in valid]))
+        if forbidden:
+            for index, data in valid:
+                if data['shop'] in forbidden:
+                    results[index] = {'status': 'rejected', 'errors': {
+                        'shop': [f"You do not have permission to sell in shop {data['shop']}"]}}
+            valid = [(index, data) for index, data in valid if data['shop'] not in forbidden]
+
+        if valid:
+            synced = sync_sales([data for index, data in valid])
+            for (index, data), result in zip(valid, synced):
+                results[index] = result
+
+        response = []
+        for index, (sale, result) in enumerate(zip(sales, results)):
+            key = sale.get('idempotency_key') if isinstance(sale, dict) else None
+            response.append({'index': index, 'idempotency_key': key, **result})
+
+        counts = {state: sum(1 for result in response if result['status'] == state)
+                  for state in ('created', 'duplicate', 'rejected')}
+        if not counts['rejected']:
+            response_status = status.HTTP_200_OK
+        elif counts['rejected'] < len(response):
+            response_status = status.HTTP_207_MULTI_STATUS
+        else:
+            response_status = status.HTTP_400_BAD_REQUEST
+        return Response({**counts, 'results': response}, status=response_status)
@@ -0,0 +1,51 @@
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import transaction
+from django.db.models import Sum
+
+from sale_invoice.models import SalesInvoice, SalesInvoiceItem
+
+
+class Command(BaseCommand):
+    help = ("Fill the stored cost_total and profit of sales invoices from their items, "
+            "in chunks of invoices. Safe to re-run.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Number of invoices updated per transaction (default 500)")
+
+    def handle(self, *args, **options):
+        chunk_size = options['chunk_size']
+        last_pk = 0
+        updated = 0
+
+        while True:
+            invoices = list(SalesInvoice.objects.filter(pk__gt=last_pk).order_by('pk')
+                            .only('pk', 'total_amount', 'cost_total', 'profit')[:chunk_size])
+            if not invoices:
+                break
+            last_pk = invoices[-1].pk
+
+            costs = dict(SalesInvoiceItem.objects
+                         .filter(sales_invoice__in=[invoice.pk for invoice in invoices])
+                         .values('sales_invoice')
+                         .annotate(cost=Sum(SalesInvoiceItem.line_cost_expression()))
+                         .order_by()
+                         .values_list('sales_invoice', 'cost'))
+
+            changed = []
+            for invoice in invoices:
+                cost_total = costs.get(invoice.pk) or Decimal('0.00')
+                profit = invoice.total_amount - cost_total
+                if invoice.cost_total != cost_total or invoice.profit != profit:
+                    invoice.cost_total = cost_total
+                    invoice.profit = profit
+                    changed.append(invoice)
+
+            with transaction.atomic():
+                SalesInvoice.objects.bulk_update(changed, ['cost_total', 'profit'])
+            updated += len(changed)
+            self.stdout.write(f"Processed invoices up to #{last_pk}, {updated} updated so far")
+
+        self.stdout.write(self.style.SUCCESS(f"Backfilled cost and profit on {updated} invoices"))
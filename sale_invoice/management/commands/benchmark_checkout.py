@@ -0,0 +1,74 @@
+import random
+import statistics
+import time
+from decimal import Decimal
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from django.test.utils import CaptureQueriesContext
+
+from account.models import Account
+from customer.models import Customer
+from inventory.models.stock import Stock
+from product.models import Product
+from sale_invoice.services.checkout import checkout
+from shop.models import Shop
+
+
+class Command(BaseCommand):
+    help = ("Time the one-shot checkout on generated data and report its latency percentiles and "
+            "query count. Everything it writes is rolled back.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('--basket-size', type=int, default=10,
+                            help="Number of lines per sale (default 10)")
+        parser.add_argument('--runs', type=int, default=200,
+                            help="Number of sales timed (default 200)")
+        parser.add_argument('--products', type=int, default=200,
+                            help="Number of products the baskets are drawn from (default 200)")
+
+    def handle(self, *args, **options):
+        basket_size, runs = options['basket_size'], options['runs']
+        products = max(options['products'], basket_size)
+        timings, query_counts = [], []
+
+        with transaction.atomic():
+            shop = Shop.objects.create(name="Checkout benchmark", code="BENCH")
+            customer = Customer.objects.create(name="Checkout benchmark", credit=Decimal('0.00'),
+                                               credit_limit=Decimal('0.00'))
+            account = Account.objects.create(name="Checkout benchmark")
+            product_ids = [product.pk for product in Product.objects.bulk_create(
+                [Product(name=f"Benchmark product {index}", profit_margin=Decimal('10.00'))
+                 for index in range(products)])]
+            if None in product_ids:
+                # bulk_create does not set primary keys on MySQL
+                product_ids = list(Product.objects.filter(name__startswith="Benchmark product ")
+                                   .order_by('-pk').values_list('pk', flat=True)[:products])
+            Stock.objects.bulk_create([
+                Stock(shop=shop, product_id=product_id, quantity=runs * basket_size + 1000,
+                      average_cost=Decimal('10.00'), selling_price=Decimal('11.00'))
+                for product_id in product_ids
+            ])
+
+            for run in range(runs + 5):
+                items = [{'product': product_id, 'quantity': 1, 'price': Decimal('12.50')}
+                         for product_id in random.sample(product_ids, basket_size)]
+                sale = {'shop': shop.pk, 'customer': customer.pk, 'items': items,
+                        'payment': {'account': account.pk, 'amount': Decimal('12.50') * basket_size}}
+                with CaptureQueriesContext(connection) as queries:
+                    started = time.perf_counter()
+                    checkout(sale)
+                    elapsed = time.perf_counter() - started
+                # The first few sales warm up caches and connections
+                if run >= 5:
+                    timings.append(elapsed * 1000)
+                    query_counts.append(len(queries))
+
+            transaction.set_rollback(True)
+
+        percentiles = statistics.quantiles(timings, n=100) if len(timings) > 1 else timings * 99
+        self.stdout.write(f"{runs} sales of {basket_size} lines")
+        self.stdout.write(f"p50 {percentiles[49]:.1f} ms, p95 {percentiles[94]:.1f} ms, "
+                          f"max {max(timings):.1f} ms")
+        self.stdout.write(f"Queries per sale: {min(query_counts)}-{max(query_counts)}")
+        self.stdout.write(self.style.SUCCESS("Benchmark data rolled back"))
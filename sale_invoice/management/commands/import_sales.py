@@ -0,0 +1,39 @@
+from django.core.exceptions import ValidationError
+from django.core.management.base import BaseCommand, CommandError
+
+from sale_invoice.services.sales_import import IMPORT_CHUNK_SIZE, import_sales, read_sales_file
+
+
+class Command(BaseCommand):
+    help = ("Import historical sales from a CSV or JSON Lines file with one invoice item per line. "
+            "Invoices and items are bulk-inserted chunk by chunk, and their totals, customer credit "
+            "and stock recomputed per chunk. Invoices already imported are skipped, so it is safe to re-run.")
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="File to import")
+        parser.add_argument('--format', choices=['csv', 'jsonl'],
+                            help="File format (default: guessed from the file extension)")
+        parser.add_argument('--chunk-size', type=int, default=IMPORT_CHUNK_SIZE,
+                            help=f"Number of lines imported per transaction (default {IMPORT_CHUNK_SIZE})")
+        parser.add_argument('--skip-stock', action='store_true',
+                            help="Leave stock quantities alone (when they already account for these sales)")
+
+    def handle(self, *args, **options):
+        def progress(summary):
+            self.stdout.write(f"Imported {summary['invoices']} invoices ({summary['lines']} lines) so far")
+
+        try:
+            summary = import_sales(read_sales_file(options['path'], options['format']),
+                                   chunk_size=options['chunk_size'], adjust_stock=not options['skip_stock'],
+                                   progress=progress)
+        except (OSError, ValidationError) as e:
+            raise CommandError(" ".join(getattr(e, 'messages', [str(e)])))
+
+        for error in summary['errors']:
+            self.stderr.write(error)
+        if summary['rejected'] > len(summary['errors']):
+            self.stderr.write(f"... and {summary['rejected'] - len(summary['errors'])} more rejected invoices")
+        self.stdout.write(self.style.SUCCESS(
+            f"Imported {summary['invoices']} invoices ({summary['lines']} lines); "
+            f"{summary['skipped']} already imported, {summary['rejected']} rejected"
+        ))
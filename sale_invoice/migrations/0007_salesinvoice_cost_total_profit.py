@@ -0,0 +1,43 @@
+# Generated by Django 5.2 on 2026-10-17 02:25
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('customer', '0006_alter_customer_options'),
+        ('sale_invoice', '0006_alter_salesinvoice_options'),
+        ('shop', '0006_alter_shop_options'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalsalesinvoice',
+            name='cost_total',
+            field=models.DecimalField(decimal_places=2, default=0.0, editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='historicalsalesinvoice',
+            name='profit',
+            field=models.DecimalField(decimal_places=2, default=0.0, editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='salesinvoice',
+            name='cost_total',
+            field=models.DecimalField(decimal_places=2, default=0.0, editable=False, max_digits=10),
+        ),
+        migrations.AddField(
+            model_name='salesinvoice',
+            name='profit',
+            field=models.DecimalField(decimal_places=2, default=0.0, editable=False, max_digits=10),
+        ),
+        migrations.AddIndex(
+            model_name='salesinvoice',
+            index=models.Index(fields=['profit'], name='sale_invoic_profit_823701_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='salesinvoice',
+            index=models.Index(fields=['created_at', 'profit'], name='sale_invoic_created_33c3be_idx'),
+        ),
+    ]
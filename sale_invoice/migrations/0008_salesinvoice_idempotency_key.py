@@ -0,0 +1,23 @@
+# Generated by Django 5.2 on 2026-10-17 03:13
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sale_invoice', '0007_salesinvoice_cost_total_profit'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='historicalsalesinvoice',
+            name='idempotency_key',
+            field=models.CharField(blank=True, db_index=True, editable=False, max_length=64, null=True),
+        ),
+        migrations.AddField(
+            model_name='salesinvoice',
+            name='idempotency_key',
+            field=models.CharField(blank=True, editable=False, max_length=64, null=True, unique=True),
+        ),
+    ]
@@ -1,13 +1,22 @@
+from decimal import Decimal, ROUND_HALF_UP
+
 from django.db import models
+from django.db.models import Case, F, Sum, Value, When
+from django.db.models.functions import Coalesce, Greatest, Round
 from simple_history.models import HistoricalRecords
+from utils import FieldTrackerMixin
 
 class SalesInvoice(models.Model):
     customer = models.ForeignKey('customer.Customer', on_delete=models.SET_NULL, null=True)
     shop = models.ForeignKey('shop.Shop', on_delete=models.CASCADE)
     total_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, editable=False)
     paid_amount = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, editable=False)
+    cost_total = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, editable=False)
+    profit = models.DecimalField(max_digits=10, decimal_places=2, default=0.00, editable=False)
     due_date = models.DateField()
     created_at = models.DateTimeField(auto_now_add=True)
+    # Set by the till that recorded the sale offline, so a re-sent sale is recognised
+    idempotency_key = models.CharField(max_length=64, unique=True, blank=True, null=True, editable=False)
     history = HistoricalRecords()
 
     def __str__(self):
@@ -17,24 +26,31 @@ class SalesInvoice(models.Model):
         permissions = [
             ("can_view_icon_sale_invoice", "Can view icon sale invoice"),
         ]
+        indexes = [
+            models.Index(fields=['profit']),
+            models.Index(fields=['created_at', 'profit']),
+        ]
     
-    def update_total_amount(self):
-        """Calculate and update total amount from sales invoice items, considering discounts.
-        Both amount and percentage discounts are applied per unit."""
-        total = 0
-        for item in self.items.all():
-            unit_price = item.price if item.price else 0            
-            if item.discount_method == 'amount':
-                discounted_unit_price = max(unit_price - item.discount_amount, 0)
-            elif item.discount_method == 'percentage':
-                discount_value = unit_price * (item.discount_amount / 100)
-                discounted_unit_price = max(unit_price - discount_value, 0)
-            else:
-                discounted_unit_price = unit_price                
-            line_total = discounted_unit_price * item.quantity
-            total += line_total        
-        self.total_amount = total
-        self.save(update_fields=['total_amount'])
+    def update_total_amount(self, delta=None, cost_delta=Decimal('0.00')):
+        """Update total amount, cost total and profit from sales invoice items,
+        considering discounts. Both amount and percentage discounts are applied per unit.
+
+        Without a delta the totals are re-summed in the database in one aggregate.
+        With a delta (the change in one line's total, and in its cost) only that
+        change is added, on top of the locked current totals, so a line edit does
+        not re-read every line."""
+        if delta is None:
+            totals = self.items.aggregate(total=Sum(SalesInvoiceItem.line_total_expression()),
+                                          cost=Sum(SalesInvoiceItem.line_cost_expression()))
+            self.total_amount = totals['total'] or Decimal('0.00')
+            self.cost_total = totals['cost'] or Decimal('0.00')
+        else:
+            current_total, current_cost = (SalesInvoice.objects.select_for_update()
+                                           .values_list('total_amount', 'cost_total').get(pk=self.pk))
+            self.total_amount = current_total + delta
+            self.cost_total = current_cost + cost_delta
+        self.profit = self.total_amount - self.cost_total
+        self.save(update_fields=['total_amount', 'cost_total', 'profit'])
     
     def get_due_amount(self):
         """Calculate remaining due amount."""
@@ -72,7 +88,7 @@ class SalesInvoice(models.Model):
         total_avg_cost = self.get_total_average_cost()
         return self.total_amount - total_avg_cost
 
-class SalesInvoiceItem(models.Model):
+class SalesInvoiceItem(FieldTrackerMixin, models.Model):
     DISCOUNT_METHOD_CHOICES = [
         ('amount', 'Amount'),
         ('percentage', 'Percentage'),
@@ -89,3 +105,52 @@ class SalesInvoiceItem(models.Model):
     
     def __str__(self):
         return f"{self.product.name}"
+
+    @staticmethod
+    def line_total_expression(prefix=''):
+        """
+        Database expression for a line's total after its per-unit discount,
+        rounded to cents. Use prefix (e.g. 'items__') to total lines from a
+        related model.
+        """
+        zero = Value(Decimal('0.00'))
+        price = Coalesce(F(f'{prefix}price'), zero)
+        discount = F(f'{prefix}discount_amount')
+        unit_price = Case(
+            When(**{f'{prefix}discount_method': 'amount'}, then=Greatest(price - discount, zero)),
+            # Multiply by 0.01 rather than divide by 100: SQLite truncates integer division
+            When(**{f'{prefix}discount_method': 'percentage'},
+                 then=Greatest(price - price * discount * Value(Decimal('0.01')), zero)),
+            default=price,
+            output_field=models.DecimalField(max_digits=12, decimal_places=2),
+        )
+        return Round(unit_price * F(f'{prefix}quantity'), 2,
+                     output_field=models.DecimalField(max_digits=12, decimal_places=2))
+
+    @staticmethod
+    def calculate_line_total(quantity, price, discount_method=None, discount_amount=Decimal('0.00')):
+        """Python counterpart of line_total_expression, for computing line deltas."""
+        unit_price = price or Decimal('0.00')
+        if discount_method == 'amount':
+            unit_price = max(unit_price - discount_amount, Decimal('0.00'))
+        elif discount_method == 'percentage':
+            unit_price = max(unit_price - unit_price * discount_amount * Decimal('0.01'), Decimal('0.00'))
+        return (unit_price * quantity).quantize(Decimal('0.01'), rounding=ROUND_HALF_UP)
+
+    def line_total(self):
+        """This line's total after discount."""
+        return self.calculate_line_total(self.quantity, self.price, self.discount_method, self.discount_amount)
+
+    @staticmethod
+    def line_cost_expression(prefix=''):
+        """Database expression for a line's cost (average cost times quantity)."""
+        return Coalesce(F(f'{prefix}average_cost'), Value(Decimal('0.00'))) * F(f'{prefix}quantity')
+
+    @staticmethod
+    def calculate_line_cost(quantity, average_cost):
+        """Python counterpart of line_cost_expression."""
+        return (average_cost or Decimal('0.00')) * quantity
+
+    def line_cost(self):
+        """This line's cost at the average cost it was sold at."""
+        return self.calculate_line_cost(self.quantity, self.average_cost)
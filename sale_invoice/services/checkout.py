@@ -0,0 +1,226 @@
+import logging
+from datetime import timedelta
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Q
+from django.utils import timezone
+
+from account.models import Account
+from customer.models import Customer
+from inventory.models.stock import Stock
+from inventory.models.stock_movement import StockMovement
+from inventory.models.stock_reservation import StockReservation
+from inventory.services.stock_ledger import build_movement, record_movements
+from inventory.services.stock_lots import fifo_costing_enabled
+from inventory.services.stock_posting import lock_stock_rows, stock_changed, write_stock_rows
+from product.models import Product
+from receipt.models import Receipt
+from sale_invoice.admin.validators import CustomerValidator, InventoryValidator
+from sale_invoice.models import SalesInvoice, SalesInvoiceItem
+from sale_invoice.services.fifo_costing import cost_sales_items_fifo
+from shop.models import Shop
+from utils import guarded_update
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0.00')
+CHECKOUT_REASON = "Checkout"
+
+
+def _requested_quantities(items):
+    """Total quantity requested per product, and the lines each product is on."""
+    quantities, lines = {}, {}
+    for index, item in enumerate(items):
+        quantities[item['product']] = quantities.get(item['product'], 0) + item['quantity']
+        lines.setdefault(item['product'], []).append(index)
+    return quantities, lines
+
+
+def _reserved_quantities(reservation_token, shop_id):
+    """
+    Lock the reservations held under a token in the sale's shop; returns their
+    ids and the quantity per stock row. Reservations the token holds in other
+    shops are left alone, since the sale does not take that stock.
+    """
+    if not reservation_token:
+        return [], {}
+    rows = list(StockReservation.objects.select_for_update().filter(token=reservation_token, shop_id=shop_id)
+                .values_list('pk', 'shop_id', 'product_id', 'quantity'))
+    reserved = {}
+    for pk, shop_id, product_id, quantity in rows:
+        reserved[(shop_id, product_id)] = reserved.get((shop_id, product_id), 0) + quantity
+    return [row[0] for row in rows], reserved
+
+
+def _raise_if_errors(errors, line_errors):
+    if line_errors:
+        errors['items'] = [f"Line {index + 1}: {message}"
+                           for index, messages in sorted(line_errors.items()) for message in messages]
+    if errors:
+        raise ValidationError(errors)
+
+
+def checkout(sale, reservation_token=None):
+    """
+    Record a sale in one transaction: the invoice, its items, the stock they
+    take, the customer's credit and, when something is paid, the receipt.
+
+    The shop, customer, account and products are read with one query each,
+    the shop's Stock rows are locked with one more, and every line is checked
+    against them in memory (stock reserved under the token counts as
+    available to this sale), so all problems are reported together and
+    nothing is written. The invoice is then inserted with its totals, the
+    items with one bulk insert, and the stock rows written back with one
+    upsert, one bulk history insert and one bulk movement insert, consuming
+    the reservations in the same write. The customer's credit is moved with
+    one guarded update that only counts the unpaid part of the sale against
+    the credit limit, and the payment is saved as a regular Receipt. The
+    number of queries does not depend on the number of lines.
+
+    Args:
+        sale: dict with shop, customer (or None), due_date (or None), items (list
+            of dicts with product, quantity and optionally price, discount_method
+            and discount_amount) and payment (None, or a dict with account and
+            amount), ids as integers. A line without a price is sold at the
+            stock row's selling price.
+        reservation_token: Token of the stock reservations this sale consumes
+
+    Returns:
+        The SalesInvoice, with its Receipt (or None) as ``receipt``
+
+    Raises:
+        ValidationError: With lists of messages for 'shop', 'customer',
+            'due_date', 'items' and 'payment'
+    """
+    items = sale['items']
+    payment = sale.get('payment')
+    quantities, product_lines = _requested_quantities(items)
+    errors, line_errors = {}, {}
+
+    with transaction.atomic():
+        shop = Shop.objects.filter(pk=sale['shop']).first()
+        customer = Customer.objects.filter(pk=sale['customer']).first() if sale.get('customer') else None
+        # Locked so the receipt's balance update works from the committed balance
+        account = Account.objects.select_for_update().filter(pk=payment['account']).first() if payment else None
+        products = Product.objects.in_bulk(quantities)
+
+        if shop is None:
+            errors['shop'] = [f"Shop {sale['shop']} does not exist."]
+        if sale.get('customer') and customer is None:
+            errors['customer'] = [f"Customer {sale['customer']} does not exist."]
+        today = timezone.now().date()
+        due_date = sale.get('due_date') or today + timedelta(days=customer.credit_period if customer else 0)
+        if customer is not None:
+            try:
+                CustomerValidator.validate_blacklist(customer)
+            except ValidationError as e:
+                errors['customer'] = e.messages
+            try:
+                CustomerValidator.validate_due_date(due_date, customer, today)
+            except ValidationError as e:
+                errors['due_date'] = e.messages
+        if payment and account is None:
+            errors['payment'] = [f"Account {payment['account']} does not exist."]
+        for product_id, indexes in product_lines.items():
+            if product_id not in products:
+                for index in indexes:
+                    line_errors.setdefault(index, []).append(f"Product {product_id} does not exist.")
+        if shop is None:
+            _raise_if_errors(errors, line_errors)
+
+        reservation_ids, reserved = _reserved_quantities(reservation_token, shop.pk)
+        stocks = lock_stock_rows({(shop.pk, product_id) for product_id in products} | set(reserved))
+
+        for product_id, quantity in quantities.items():
+            if product_id not in products:
+                continue
+            product = products[product_id]
+            stock = stocks.get((shop.pk, product_id))
+            if stock is None:
+                message = f"No stock available for {product.name} in {shop.name}."
+            else:
+                available = stock.quantity - stock.reserved_quantity + reserved.get((shop.pk, product_id), 0)
+                if quantity <= available:
+                    continue
+                message = f"Quantity {quantity} exceeds available stock {available} for {product.name} in {shop.name}."
+            for index in product_lines[product_id]:
+                line_errors.setdefault(index, []).append(message)
+
+        invoice_items = []
+        for index, item in enumerate(items):
+            stock = stocks.get((shop.pk, item['product']))
+            if index in line_errors or stock is None:
+                continue
+            price = item.get('price')
+            if price is None:
+                price = stock.selling_price
+            try:
+                InventoryValidator.validate_price_against_stock(price, stock)
+            except ValidationError as e:
+                line_errors.setdefault(index, []).extend(e.messages)
+                continue
+            invoice_items.append(SalesInvoiceItem(
+                product=products[item['product']], quantity=item['quantity'], price=price,
+                average_cost=stock.average_cost, discount_method=item.get('discount_method', 'amount'),
+                discount_amount=item.get('discount_amount', ZERO),
+            ))
+
+        total_amount = sum((item.line_total() for item in invoice_items), ZERO)
+        paid = payment['amount'] if payment else ZERO
+        if paid > total_amount and not line_errors:
+            errors.setdefault('payment', []).append(f"Payment {paid} exceeds the invoice total {total_amount}.")
+        _raise_if_errors(errors, line_errors)
+
+        if customer is not None and total_amount:
+            # The receipt takes the paid part off again, so only the unpaid part counts against the limit
+            applied = guarded_update(Customer.objects.filter(pk=customer.pk), 'credit', total_amount,
+                                     maximum=F('credit_limit') + paid, unless=Q(credit_limit__lte=0))
+            if not applied:
+                raise ValidationError({'customer': ["This sale would take the customer over their credit limit."]})
+            customer.refresh_from_db(fields=['credit'])
+            Customer.history.bulk_history_create([customer], update=True, default_change_reason=CHECKOUT_REASON)
+
+        cost_total = sum((item.line_cost() for item in invoice_items), ZERO)
+        invoice = SalesInvoice(shop=shop, customer=customer, due_date=due_date, total_amount=total_amount,
+                               paid_amount=ZERO, cost_total=cost_total, profit=total_amount - cost_total)
+        invoice._change_reason = CHECKOUT_REASON
+        invoice.save()
+        for item in invoice_items:
+            item.sales_invoice = invoice
+        SalesInvoiceItem.objects.bulk_create(invoice_items)
+        # Read the items back rather than rely on bulk_create setting primary keys (it does not on MySQL)
+        invoice_items = list(invoice.items.order_by('pk'))
+        SalesInvoiceItem.history.bulk_history_create(invoice_items, default_change_reason=CHECKOUT_REASON)
+
+        for item in invoice_items:
+            stocks[(shop.pk, item.product_id)].quantity -= item.quantity
+        for key, quantity in reserved.items():
+            stocks[key].reserved_quantity = max(stocks[key].reserved_quantity - quantity, 0)
+        changed = sorted({(shop.pk, product_id) for product_id in quantities} | (set(reserved) & set(stocks)))
+        write_stock_rows([stocks[key] for key in changed], fields=('quantity', 'reserved_quantity'))
+        Stock.history.bulk_history_create([stocks[key] for key in changed], update=True,
+                                          default_change_reason=CHECKOUT_REASON)
+        record_movements([build_movement(shop.pk, item.product_id, -item.quantity, StockMovement.SALE,
+                                         source=item, note=f"Sold on invoice {invoice.pk}")
+                          for item in invoice_items])
+        if reservation_ids:
+            StockReservation.objects.filter(pk__in=reservation_ids).delete()
+        stock_changed(changed)
+
+        if fifo_costing_enabled():
+            cost_sales_items_fifo([(shop.pk, item.product_id, -item.quantity, item) for item in invoice_items],
+                                  invoice_items)
+            invoice.cost_total = sum((item.line_cost() for item in invoice_items), ZERO)
+            invoice.profit = invoice.total_amount - invoice.cost_total
+            invoice.save(update_fields=['cost_total', 'profit'])
+
+        invoice.receipt = None
+        if paid:
+            invoice.receipt = Receipt(sales_invoice=invoice, amount=paid, account=account)
+            invoice.receipt.save()
+
+    logger.info(f"Checked out invoice {invoice.pk} with {len(invoice_items)} lines, "
+                f"total {invoice.total_amount}, paid {invoice.paid_amount}")
+    return invoice
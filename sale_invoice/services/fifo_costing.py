@@ -0,0 +1,38 @@
+from inventory.services.stock_lots import consume_lots, consumed_unit_costs, release_lots, source_key
+from sale_invoice.models import SalesInvoiceItem
+
+
+def cost_sales_items_fifo(lines, items):
+    """
+    Move sales items' stock through the FIFO lots and set their average cost
+    from the lots they consumed.
+
+    Lines are netted per item and stock row first, so an item edited several
+    times in one batch only consumes or releases the difference. Stock given
+    back is released before new stock is consumed, and the items' costs are
+    written with one bulk update. Items whose stock did not move (e.g. only
+    the price changed) keep their cost, as do items with no consumption
+    recorded, such as lines sold before FIFO costing was enabled.
+
+    Args:
+        lines: Iterable of (shop_id, product_id, quantity, item) tuples, the
+            quantity signed like the stock change (negative for a sale)
+        items: Items whose average_cost to refresh (not deleted ones)
+    """
+    net = {}
+    for shop_id, product_id, quantity, item in lines:
+        key = (shop_id, product_id, source_key(item))
+        net[key] = (net.get(key, (0, item))[0] + quantity, item)
+    release_lots([(shop_id, product_id, quantity, item)
+                  for (shop_id, product_id, _), (quantity, item) in net.items() if quantity > 0])
+    consume_lots([(shop_id, product_id, -quantity, item)
+                  for (shop_id, product_id, _), (quantity, item) in net.items() if quantity < 0])
+
+    moved = {key for (_, _, key), (quantity, _) in net.items() if quantity}
+    items = [item for item in items if item.pk is not None and source_key(item) in moved]
+    if not items:
+        return
+    costs = consumed_unit_costs(items)
+    for item in items:
+        item.average_cost = costs.get(source_key(item), item.average_cost)
+    SalesInvoiceItem.objects.bulk_update(items, ['average_cost'])
@@ -0,0 +1,347 @@
+import csv
+import json
+import logging
+from datetime import datetime, time, timedelta
+from decimal import Decimal, InvalidOperation
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, OuterRef, Subquery, Sum, Value
+from django.db.models.functions import Coalesce, Greatest
+from django.utils import timezone
+from django.utils.dateparse import parse_date, parse_datetime
+
+from customer.models import Customer
+from inventory.models.stock import Stock
+from inventory.models.stock_movement import StockMovement
+from inventory.services.stock_ledger import build_movement, record_movements
+from inventory.services.stock_posting import stock_changed, stock_filter
+from product.models import Product
+from sale_invoice.models import SalesInvoice, SalesInvoiceItem
+from sale_invoice.services.sales_sync import backdate
+from shop.models import Shop
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0.00')
+IMPORT_CHUNK_SIZE = 5000
+IMPORT_KEY_PREFIX = 'import:'
+IMPORT_REASON = "Sales imported"
+REQUIRED_COLUMNS = {'invoice', 'shop', 'product', 'quantity', 'price'}
+MAX_REPORTED_ERRORS = 100
+
+
+def read_sales_file(path, file_format=None):
+    """
+    Read sales lines from a CSV or JSON Lines file, one line at a time.
+
+    Each line is one invoice item. The ``invoice`` column is the invoice's
+    reference in the old system; the invoice columns (shop, customer,
+    due_date, created_at, paid_amount) are taken from its first line. The
+    other columns are product, quantity, price and optionally
+    discount_method, discount_amount and average_cost.
+
+    Args:
+        path: Path to the file
+        file_format: 'csv' or 'jsonl'; guessed from the file extension if not given
+
+    Yields:
+        dict per line
+
+    Raises:
+        ValidationError: If a CSV file lacks a required column or a JSON line cannot be read
+    """
+    file_format = file_format or ('jsonl' if str(path).endswith(('.jsonl', '.json')) else 'csv')
+    with open(path, encoding='utf-8-sig', newline='') as file:
+        if file_format == 'jsonl':
+            for line_number, line in enumerate(file, start=1):
+                if not line.strip():
+                    continue
+                try:
+                    yield json.loads(line)
+                except json.JSONDecodeError as e:
+                    raise ValidationError(f"Line {line_number}: {e}")
+            return
+
+        reader = csv.DictReader(file)
+        missing = REQUIRED_COLUMNS - set(reader.fieldnames or [])
+        if missing:
+            raise ValidationError(f"The file has no {', '.join(sorted(missing))} column.")
+        yield from reader
+
+
+def _invoice_chunks(rows, chunk_size):
+    """
+    Group consecutive lines by invoice reference and yield lists of
+    (reference, lines) holding at least chunk_size lines, so no invoice is
+    split between two chunks.
+    """
+    chunk, size, reference, lines = [], 0, None, None
+    for row in rows:
+        row_reference = str(row.get('invoice') or '').strip()
+        if lines is None or row_reference != reference:
+            if lines is not None:
+                chunk.append((reference, lines))
+                size += len(lines)
+                if size >= chunk_size:
+                    yield chunk
+                    chunk, size = [], 0
+            reference, lines = row_reference, []
+        lines.append(row)
+    if lines:
+        chunk.append((reference, lines))
+    if chunk:
+        yield chunk
+
+
+def _decimal(value, default=None):
+    if value is None or value == '':
+        return default
+    return Decimal(str(value))
+
+
+def _optional_int(value):
+    return int(value) if value not in (None, '') else None
+
+
+def _parse_moment(value):
+    """A timestamp or a date (taken as the start of that day) in the current time zone, or None."""
+    if value in (None, ''):
+        return None
+    moment = parse_datetime(str(value))
+    if moment is None:
+        day = parse_date(str(value))
+        if day is None:
+            raise ValueError(f"'{value}' is not a date")
+        moment = datetime.combine(day, time.min)
+    if timezone.is_naive(moment):
+        moment = timezone.make_aware(moment)
+    return moment
+
+
+def _parse_invoice(reference, lines):
+    """Parse an invoice's lines into its invoice fields and items; raises ValueError on a bad value."""
+    if not reference:
+        raise ValueError("no invoice reference")
+    first = lines[0]
+    invoice = {
+        'shop': int(first['shop']),
+        'customer': _optional_int(first.get('customer')),
+        'due_date': parse_date(str(first['due_date'])) if first.get('due_date') else None,
+        'created_at': _parse_moment(first.get('created_at')),
+        'paid_amount': _decimal(first.get('paid_amount'), ZERO),
+        'items': [],
+    }
+    for line in lines:
+        discount_method = line.get('discount_method') or 'amount'
+        if discount_method not in ('amount', 'percentage'):
+            raise ValueError(f"unknown discount method '{discount_method}'")
+        invoice['items'].append({
+            'product': int(line['product']),
+            'quantity': int(line['quantity']),
+            'price': _decimal(line['price']),
+            'discount_method': discount_method,
+            'discount_amount': _decimal(line.get('discount_amount'), ZERO),
+            'average_cost': _decimal(line.get('average_cost')),
+        })
+    return invoice
+
+
+def import_sales(rows, chunk_size=IMPORT_CHUNK_SIZE, adjust_stock=True, progress=None):
+    """
+    Import historical sales, bulk-inserting invoices and items chunk by chunk.
+
+    Lines are streamed and grouped into chunks of whole invoices (an
+    invoice's lines must be consecutive). Each chunk is one transaction:
+    the invoices and items are bulk-inserted, so none of the sales item
+    signals run, and the derived fields are then recomputed with set-based
+    statements over the chunk: invoice totals, cost and profit from their
+    items, customer credit from the unpaid part of their invoices and, with
+    adjust_stock, Stock quantities from the quantities sold (one ledger
+    movement per stock row). Items without an average cost are costed at
+    the Stock row's current average cost. Only one chunk is held in memory,
+    plus the references seen so far.
+
+    Invoices are keyed by their old reference, so running the import again
+    skips the invoices that are already in. An invoice with an unknown shop,
+    customer or product, or a value that cannot be read, is skipped and
+    reported. With adjust_stock, so is an invoice selling a product its
+    shop has no Stock row for, as the offline sales sync does. So is a run of lines for a reference already seen in this
+    import (its lines were not consecutive); only its first run is imported.
+
+    Args:
+        rows: Iterable of line dicts (see read_sales_file)
+        chunk_size: Minimum number of lines per transaction
+        adjust_stock: Take the quantities sold out of the shops' stock
+        progress: Optional callable receiving the running summary after each chunk
+
+    Returns:
+        dict with the number of 'invoices' and 'lines' imported, the number
+        of invoices 'skipped' as already imported, the number 'rejected', and
+        up to MAX_REPORTED_ERRORS 'errors' messages
+    """
+    summary = {'invoices': 0, 'lines': 0, 'skipped': 0, 'rejected': 0, 'errors': []}
+    seen = set()
+    for chunk in _invoice_chunks(rows, chunk_size):
+        _import_chunk(chunk, adjust_stock, summary, seen)
+        if progress:
+            progress(summary)
+    return summary
+
+
+def _reject(summary, reference, message):
+    summary['rejected'] += 1
+    if len(summary['errors']) < MAX_REPORTED_ERRORS:
+        summary['errors'].append(f"Invoice {reference}: {message}")
+
+
+def _import_chunk(chunk, adjust_stock, summary, seen):
+    """Import one chunk of (reference, lines) in one transaction, adding its references to ``seen``."""
+    parsed = {}
+    for reference, lines in chunk:
+        if reference in seen:
+            _reject(summary, reference, f"its lines are not consecutive; {len(lines)} lines after its first "
+                                        f"run were not imported")
+            continue
+        seen.add(reference)
+        try:
+            parsed[reference] = _parse_invoice(reference, lines)
+        except (KeyError, TypeError, ValueError, InvalidOperation) as e:
+            _reject(summary, reference, f"cannot be read ({e!r})")
+
+    with transaction.atomic():
+        imported = set(SalesInvoice.objects.filter(
+            idempotency_key__in=[IMPORT_KEY_PREFIX + reference for reference in parsed]
+        ).values_list('idempotency_key', flat=True))
+        shops = set(Shop.objects.filter(pk__in={invoice['shop'] for invoice in parsed.values()})
+                    .values_list('pk', flat=True))
+        customers = dict(Customer.objects.filter(
+            pk__in={invoice['customer'] for invoice in parsed.values() if invoice['customer']}
+        ).values_list('pk', 'credit_period'))
+        products = set(Product.objects.filter(
+            pk__in={item['product'] for invoice in parsed.values() for item in invoice['items']}
+        ).values_list('pk', flat=True))
+        keys = {(invoice['shop'], item['product']) for invoice in parsed.values() for item in invoice['items']}
+        average_costs = {(shop_id, product_id): average_cost for shop_id, product_id, average_cost
+                         in Stock.objects.filter(stock_filter(keys))
+                         .values_list('shop_id', 'product_id', 'average_cost')}
+
+        accepted = {}
+        for reference, invoice in parsed.items():
+            if IMPORT_KEY_PREFIX + reference in imported:
+                summary['skipped'] += 1
+            elif invoice['shop'] not in shops:
+                _reject(summary, reference, f"shop {invoice['shop']} does not exist")
+            elif invoice['customer'] and invoice['customer'] not in customers:
+                _reject(summary, reference, f"customer {invoice['customer']} does not exist")
+            elif any(item['product'] not in products for item in invoice['items']):
+                unknown = sorted({item['product'] for item in invoice['items']} - products)
+                _reject(summary, reference, f"products {unknown} do not exist")
+            elif adjust_stock and any((invoice['shop'], item['product']) not in average_costs
+                                      for item in invoice['items']):
+                # There would be no stock row to take the quantity sold out of
+                unstocked = sorted({item['product'] for item in invoice['items']
+                                    if (invoice['shop'], item['product']) not in average_costs})
+                _reject(summary, reference, f"products {unstocked} have no stock record in shop {invoice['shop']}")
+            else:
+                accepted[IMPORT_KEY_PREFIX + reference] = invoice
+        if not accepted:
+            return
+
+        keys = {(invoice['shop'], item['product']) for invoice in accepted.values() for item in invoice['items']}
+        invoice_ids = _insert_invoices(accepted, customers)
+        _insert_items(accepted, invoice_ids, average_costs)
+        _recompute_invoice_totals(invoice_ids)
+        _recompute_customer_credit(invoice_ids)
+        if adjust_stock:
+            _adjust_stock(keys, invoice_ids)
+
+    summary['invoices'] += len(accepted)
+    summary['lines'] += sum(len(invoice['items']) for invoice in accepted.values())
+    logger.info(f"Imported {len(accepted)} invoices, {summary['invoices']} so far")
+
+
+def _insert_invoices(accepted, customers):
+    """Bulk-insert a chunk's invoices at zero totals; returns their ids by key."""
+    today = timezone.now().date()
+    invoices = []
+    for key, invoice in accepted.items():
+        sold_on = timezone.localtime(invoice['created_at']).date() if invoice['created_at'] else today
+        due_date = invoice['due_date'] or sold_on + timedelta(days=customers.get(invoice['customer']) or 0)
+        invoices.append(SalesInvoice(shop_id=invoice['shop'], customer_id=invoice['customer'], due_date=due_date,
+                                     total_amount=ZERO, paid_amount=invoice['paid_amount'], cost_total=ZERO,
+                                     profit=ZERO, idempotency_key=key))
+    SalesInvoice.objects.bulk_create(invoices, batch_size=1000)
+    # Read the ids back rather than rely on bulk_create setting primary keys (it does not on MySQL)
+    invoice_ids = dict(SalesInvoice.objects.filter(idempotency_key__in=accepted)
+                       .values_list('idempotency_key', 'pk'))
+    backdate(SalesInvoice, 'created_at', {invoice_ids[key]: invoice['created_at']
+                                          for key, invoice in accepted.items() if invoice['created_at']})
+    return invoice_ids
+
+
+def _insert_items(accepted, invoice_ids, average_costs):
+    """Bulk-insert a chunk's items, costing those without an average cost at their stock row's."""
+    items = [
+        SalesInvoiceItem(sales_invoice_id=invoice_ids[key], product_id=item['product'], quantity=item['quantity'],
+                         price=item['price'], discount_method=item['discount_method'],
+                         discount_amount=item['discount_amount'],
+                         average_cost=(item['average_cost'] if item['average_cost'] is not None
+                                       else average_costs.get((invoice['shop'], item['product']))))
+        for key, invoice in accepted.items()
+        for item in invoice['items']
+    ]
+    SalesInvoiceItem.objects.bulk_create(items, batch_size=1000)
+    items = SalesInvoiceItem.objects.filter(sales_invoice_id__in=invoice_ids.values()).order_by('pk')
+    SalesInvoiceItem.history.bulk_history_create(list(items), default_change_reason=IMPORT_REASON,
+                                                 batch_size=1000)
+
+
+def _recompute_invoice_totals(invoice_ids):
+    """Set the chunk's invoice totals, cost and profit from their items, then write their history."""
+    lines = (SalesInvoiceItem.objects.filter(sales_invoice=OuterRef('pk'))
+             .values('sales_invoice').order_by())
+    invoices = SalesInvoice.objects.filter(pk__in=invoice_ids.values())
+    invoices.update(
+        total_amount=Coalesce(Subquery(lines.annotate(total=Sum(SalesInvoiceItem.line_total_expression()))
+                                       .values('total')), Value(ZERO)),
+        cost_total=Coalesce(Subquery(lines.annotate(cost=Sum(SalesInvoiceItem.line_cost_expression()))
+                                     .values('cost')), Value(ZERO)),
+    )
+    invoices.update(profit=F('total_amount') - F('cost_total'))
+    SalesInvoice.history.bulk_history_create(list(invoices), default_change_reason=IMPORT_REASON,
+                                             batch_size=1000)
+
+
+def _recompute_customer_credit(invoice_ids):
+    """Add the unpaid part of the chunk's invoices to their customers' credit, one UPDATE for all."""
+    invoices = SalesInvoice.objects.filter(pk__in=invoice_ids.values())
+    unpaid = (invoices.filter(customer=OuterRef('pk')).values('customer').order_by()
+              .annotate(unpaid=Sum(F('total_amount') - F('paid_amount'))).values('unpaid'))
+    customers = Customer.objects.filter(pk__in=invoices.exclude(customer=None).values('customer'))
+    if customers.update(credit=F('credit') + Coalesce(Subquery(unpaid), Value(ZERO))):
+        Customer.history.bulk_history_create(list(customers), update=True, default_change_reason=IMPORT_REASON)
+
+
+def _adjust_stock(keys, invoice_ids):
+    """
+    Take the quantities the chunk sold out of stock, one UPDATE for every row, clamped at zero.
+
+    The sales are historical, so reserved_quantity is deliberately not held
+    back from them.
+    """
+    stocks = Stock.objects.filter(stock_filter(keys))
+    before = {(shop_id, product_id): quantity for shop_id, product_id, quantity
+              in stocks.select_for_update().values_list('shop_id', 'product_id', 'quantity')}
+    sold = (SalesInvoiceItem.objects.filter(sales_invoice__in=invoice_ids.values(),
+                                            sales_invoice__shop=OuterRef('shop'), product=OuterRef('product'))
+            .values('product').order_by().annotate(sold=Sum('quantity')).values('sold'))
+    stocks.update(quantity=Greatest(F('quantity') - Coalesce(Subquery(sold), Value(0)), Value(0)))
+
+    changed = list(stocks)
+    Stock.history.bulk_history_create(changed, update=True, default_change_reason=IMPORT_REASON, batch_size=1000)
+    record_movements([build_movement(stock.shop_id, stock.product_id,
+                                     stock.quantity - before[(stock.shop_id, stock.product_id)],
+                                     StockMovement.SALE, note=IMPORT_REASON)
+                      for stock in changed])
+    stock_changed(before)
@@ -0,0 +1,309 @@
+import logging
+from datetime import timedelta
+from decimal import Decimal
+from itertools import islice
+
+from django.db import IntegrityError, transaction
+from django.db.models import Case, DateTimeField, Value, When
+from django.utils import timezone
+
+from account.models import Account
+from customer.models import Customer
+from inventory.models.stock import Stock
+from inventory.models.stock_movement import StockMovement
+from inventory.services.stock_ledger import build_movement, record_movements
+from inventory.services.stock_lots import fifo_costing_enabled
+from inventory.services.stock_posting import lock_stock_rows, stock_changed, write_stock_rows
+from product.models import Product
+from receipt.models import Receipt
+from sale_invoice.models import SalesInvoice, SalesInvoiceItem
+from sale_invoice.services.fifo_costing import cost_sales_items_fifo
+from shop.models import Shop
+
+logger = logging.getLogger(__name__)
+
+ZERO = Decimal('0.00')
+SYNC_CHUNK_SIZE = 100
+SYNC_REASON = "Offline sale synced"
+
+
+def _chunks(items, size):
+    items = iter(items)
+    while chunk := list(islice(items, size)):
+        yield chunk
+
+
+def backdate(model, field, values):
+    """Set a date field that auto_now_add filled in, on many rows in one UPDATE."""
+    if values:
+        model.objects.filter(pk__in=values).update(**{field: Case(
+            *[When(pk=pk, then=Value(value)) for pk, value in values.items()],
+            output_field=DateTimeField(),
+        )})
+
+
+def sync_sales(sales, chunk_size=SYNC_CHUNK_SIZE):
+    """
+    Record a batch of sales that tills made offline, at most once each.
+
+    Every sale carries an idempotency key that is stored on its invoice
+    under a unique index: a sale whose key is already recorded is reported
+    as a duplicate and skipped, so a till can safely send its queue again.
+    The batch is replayed in chunks of sales, one transaction per chunk.
+    Within a chunk the invoices, items and receipts are bulk-inserted and
+    their effects coalesced: every Stock row is written once with the net
+    quantity sold, every customer's credit and every account's balance once
+    with their net change.
+
+    The sales have already happened, so they are recorded as they were made:
+    prices below the selling price and credit over the limit are accepted
+    (and logged), and stock short of a sale is taken down to zero, as
+    post_stock_quantity does. Only sales that cannot be recorded (an unknown
+    shop, customer, account or product, a product the shop has no stock row
+    for, or a payment over the sale's total) are rejected.
+
+    Args:
+        sales: List of dicts with idempotency_key, shop, customer (or None),
+            due_date (or None), sold_at (or None), items (list of dicts with
+            product, quantity and optionally price, discount_method and
+            discount_amount) and payment (None, or a dict with account and
+            amount), ids as integers
+        chunk_size: Number of sales per transaction
+
+    Returns:
+        List aligned with ``sales``: {'status': 'created' or 'duplicate',
+        'invoice_id': id} or {'status': 'rejected', 'errors': [messages]}
+    """
+    results = [None] * len(sales)
+    seen = {}
+    for index, sale in enumerate(sales):
+        key = sale['idempotency_key']
+        if key in seen:
+            results[index] = {'status': 'duplicate', 'duplicate_of': seen[key]}
+        else:
+            seen[key] = index
+
+    pending = [index for index in range(len(sales)) if results[index] is None]
+    for chunk in _chunks(pending, chunk_size):
+        try:
+            _sync_chunk(sales, chunk, results)
+        except IntegrityError:
+            # Another sync recorded some of these keys first; they are duplicates on the retry
+            logger.warning(f"Idempotency key conflict while syncing sales, retrying {len(chunk)} sales")
+            _sync_chunk(sales, chunk, results)
+
+    for index, result in enumerate(results):
+        if 'duplicate_of' in result:
+            results[index] = {'status': 'duplicate', 'invoice_id': results[result['duplicate_of']].get('invoice_id')}
+    return results
+
+
+def _sync_chunk(sales, chunk, results):
+    """Record one chunk of sales (indexes into ``sales``) in one transaction, filling in their results."""
+    chunk_sales = [sales[index] for index in chunk]
+    with transaction.atomic():
+        recorded = dict(SalesInvoice.objects.filter(idempotency_key__in=[sale['idempotency_key']
+                                                                       for sale in chunk_sales])
+                        .values_list('idempotency_key', 'pk'))
+        shops = Shop.objects.in_bulk({sale['shop'] for sale in chunk_sales})
+        customers = Customer.objects.select_for_update().in_bulk(
+            {sale['customer'] for sale in chunk_sales if sale.get('customer')})
+        accounts = Account.objects.select_for_update().in_bulk(
+            {sale['payment']['account'] for sale in chunk_sales if sale.get('payment')})
+        products = Product.objects.in_bulk({item['product'] for sale in chunk_sales for item in sale['items']})
+        stocks = lock_stock_rows({(sale['shop'], item['product']) for sale in chunk_sales for item in sale['items']})
+
+        accepted = []
+        for index, sale in zip(chunk, chunk_sales):
+            if sale['idempotency_key'] in recorded:
+                results[index] = {'status': 'duplicate', 'invoice_id': recorded[sale['idempotency_key']]}
+                continue
+            errors = _sale_errors(sale, shops, customers, accounts, products, stocks)
+            if errors:
+                results[index] = {'status': 'rejected', 'errors': errors}
+                continue
+            accepted.append((index, sale, _build_invoice(sale, shops, customers, stocks)))
+
+        if not accepted:
+            return
+        invoices = _record_invoices(accepted)
+        items = _record_items(accepted, invoices)
+        _post_stock(items, invoices, stocks)
+        _post_credit(accepted, invoices, customers)
+        _record_receipts(accepted, invoices, accounts)
+        for index, sale, invoice in accepted:
+            results[index] = {'status': 'created', 'invoice_id': invoices[sale['idempotency_key']].pk}
+    logger.info(f"Synced {len(accepted)} offline sales ({len(items)} lines)")
+
+
+def _sale_errors(sale, shops, customers, accounts, products, stocks):
+    errors = []
+    if sale['shop'] not in shops:
+        errors.append(f"Shop {sale['shop']} does not exist.")
+    if sale.get('customer') and sale['customer'] not in customers:
+        errors.append(f"Customer {sale['customer']} does not exist.")
+    payment = sale.get('payment')
+    if payment and payment['account'] not in accounts:
+        errors.append(f"Account {payment['account']} does not exist.")
+    for line, item in enumerate(sale['items'], start=1):
+        if item['product'] not in products:
+            errors.append(f"Line {line}: Product {item['product']} does not exist.")
+        elif sale['shop'] in shops and (sale['shop'], item['product']) not in stocks:
+            errors.append(f"Line {line}: No stock record for product {item['product']} in shop {sale['shop']}.")
+    if errors:
+        return errors
+
+    total = sum((SalesInvoiceItem.calculate_line_total(item['quantity'], _price(sale, item, stocks),
+                                                       item.get('discount_method', 'amount'),
+                                                       item.get('discount_amount', ZERO))
+                 for item in sale['items']), ZERO)
+    if payment and payment['amount'] > total:
+        errors.append(f"Payment {payment['amount']} exceeds the invoice total {total}.")
+    return errors
+
+
+def _price(sale, item, stocks):
+    """The line's price, or the stock row's selling price if the till did not send one."""
+    price = item.get('price')
+    return stocks[(sale['shop'], item['product'])].selling_price if price is None else price
+
+
+def _build_invoice(sale, shops, customers, stocks):
+    """Unsaved invoice and items of a sale, with their totals worked out in memory."""
+    customer = customers.get(sale.get('customer'))
+    sold_on = timezone.localtime(sale['sold_at']).date() if sale.get('sold_at') else timezone.now().date()
+    due_date = sale.get('due_date') or sold_on + timedelta(days=customer.credit_period if customer else 0)
+    invoice = SalesInvoice(shop=shops[sale['shop']], customer=customer, due_date=due_date,
+                           idempotency_key=sale['idempotency_key'])
+    invoice.sync_items = []
+    for item in sale['items']:
+        stock = stocks[(sale['shop'], item['product'])]
+        price = _price(sale, item, stocks)
+        if price < stock.selling_price:
+            logger.warning(f"Offline sale {sale['idempotency_key']} sold product {item['product']} "
+                           f"at {price}, below its selling price {stock.selling_price}")
+        invoice.sync_items.append(SalesInvoiceItem(
+            product_id=item['product'], quantity=item['quantity'], price=price, average_cost=stock.average_cost,
+            discount_method=item.get('discount_method', 'amount'), discount_amount=item.get('discount_amount', ZERO),
+        ))
+    invoice.total_amount = sum((item.line_total() for item in invoice.sync_items), ZERO)
+    invoice.cost_total = sum((item.line_cost() for item in invoice.sync_items), ZERO)
+    invoice.profit = invoice.total_amount - invoice.cost_total
+    invoice.paid_amount = sale['payment']['amount'] if sale.get('payment') else ZERO
+    return invoice
+
+
+def _record_invoices(accepted):
+    """Insert the invoices in bulk; returns them read back, by idempotency key."""
+    SalesInvoice.objects.bulk_create([invoice for index, sale, invoice in accepted])
+    # Read the invoices back rather than rely on bulk_create setting primary keys (it does not on MySQL)
+    invoices = SalesInvoice.objects.in_bulk([sale['idempotency_key'] for index, sale, invoice in accepted],
+                                            field_name='idempotency_key')
+    SalesInvoice.history.bulk_history_create(list(invoices.values()), default_change_reason=SYNC_REASON)
+    backdate(SalesInvoice, 'created_at', {invoices[sale['idempotency_key']].pk: sale['sold_at']
+                                           for index, sale, invoice in accepted if sale.get('sold_at')})
+    return invoices
+
+
+def _record_items(accepted, invoices):
+    """Insert every item of the chunk in one bulk insert; returns them read back."""
+    new_items = []
+    for index, sale, invoice in accepted:
+        for item in invoice.sync_items:
+            item.sales_invoice = invoices[sale['idempotency_key']]
+            new_items.append(item)
+    SalesInvoiceItem.objects.bulk_create(new_items, batch_size=1000)
+    items = list(SalesInvoiceItem.objects.filter(sales_invoice__in=[invoice.pk for invoice in invoices.values()])
+                 .order_by('pk'))
+    SalesInvoiceItem.history.bulk_history_create(items, default_change_reason=SYNC_REASON, batch_size=1000)
+    return items
+
+
+def _post_stock(items, invoices, stocks):
+    """
+    Take the chunk's sales out of stock, writing each Stock row once with its net quantity.
+
+    The sales already happened at the till, so they take stock that is
+    reserved for other sales too (with a warning) and only stop at zero.
+    """
+    shop_of = {invoice.pk: invoice.shop_id for invoice in invoices.values()}
+    sold = {}
+    for item in items:
+        sold.setdefault((shop_of[item.sales_invoice_id], item.product_id), []).append(item)
+
+    movements = []
+    for key, key_items in sorted(sold.items()):
+        stock, quantity = stocks[key], sum(item.quantity for item in key_items)
+        if stock.quantity >= quantity:
+            if stock.quantity - stock.reserved_quantity < quantity:
+                logger.warning(f"Synced sales of {quantity} of product {key[1]} in shop {key[0]} "
+                               f"take reserved stock")
+            movements += [build_movement(key[0], key[1], -item.quantity, StockMovement.SALE, source=item,
+                                         note=f"Sold on invoice {item.sales_invoice_id}")
+                          for item in key_items]
+            stock.quantity -= quantity
+        else:
+            logger.warning(f"Insufficient stock for product {key[1]} in shop {key[0]}. "
+                           f"Available: {stock.quantity}, Requested: {quantity}")
+            movements.append(build_movement(key[0], key[1], -stock.quantity, StockMovement.SALE, note=SYNC_REASON))
+            stock.quantity = 0
+    changed = [stocks[key] for key in sorted(sold)]
+    write_stock_rows(changed, fields=('quantity',))
+    Stock.history.bulk_history_create(changed, update=True, default_change_reason=SYNC_REASON)
+    record_movements(movements)
+    stock_changed(sold)
+
+    if fifo_costing_enabled():
+        cost_sales_items_fifo([(shop_of[item.sales_invoice_id], item.product_id, -item.quantity, item)
+                               for item in items], items)
+        costs = {}
+        for item in items:
+            costs[item.sales_invoice_id] = costs.get(item.sales_invoice_id, ZERO) + item.line_cost()
+        for invoice in invoices.values():
+            invoice.cost_total = costs.get(invoice.pk, ZERO)
+            invoice.profit = invoice.total_amount - invoice.cost_total
+        SalesInvoice.objects.bulk_update(list(invoices.values()), ['cost_total', 'profit'])
+
+
+def _post_credit(accepted, invoices, customers):
+    """Add the unpaid part of the chunk's sales to each customer's credit, once per customer."""
+    changes = {}
+    for index, sale, invoice in accepted:
+        if invoice.customer_id:
+            changes[invoice.customer_id] = (changes.get(invoice.customer_id, ZERO)
+                                            + invoice.total_amount - invoice.paid_amount)
+    changed = []
+    for customer_id, change in sorted(changes.items()):
+        if not change:
+            continue
+        customer = customers[customer_id]
+        customer.credit += change
+        if 0 < customer.credit_limit < customer.credit:
+            logger.warning(f"Offline sales took customer {customer_id} over their credit limit")
+        changed.append(customer)
+    if changed:
+        Customer.objects.bulk_update(changed, ['credit'])
+        Customer.history.bulk_history_create(changed, update=True, default_change_reason=SYNC_REASON)
+
+
+def _record_receipts(accepted, invoices, accounts):
+    """Insert the chunk's receipts in bulk and add them to each account's balance, once per account."""
+    receipts = [Receipt(sales_invoice=invoices[sale['idempotency_key']], amount=sale['payment']['amount'],
+                        account_id=sale['payment']['account'])
+                for index, sale, invoice in accepted if sale.get('payment')]
+    if not receipts:
+        return
+    Receipt.objects.bulk_create(receipts)
+    receipts = list(Receipt.objects.filter(sales_invoice__in=[receipt.sales_invoice_id for receipt in receipts])
+                    .order_by('pk'))
+    Receipt.history.bulk_history_create(receipts, default_change_reason=SYNC_REASON)
+    sold_at = {invoices[sale['idempotency_key']].pk: sale['sold_at']
+               for index, sale, invoice in accepted if sale.get('sold_at')}
+    backdate(Receipt, 'received_at', {receipt.pk: sold_at[receipt.sales_invoice_id]
+                                       for receipt in receipts if receipt.sales_invoice_id in sold_at})
+
+    for receipt in receipts:
+        accounts[receipt.account_id].balance += receipt.amount
+    changed = [accounts[account_id] for account_id in sorted({receipt.account_id for receipt in receipts})]
+    Account.objects.bulk_update(changed, ['balance'])
+    Account.history.bulk_history_create(changed, update=True, default_change_reason=SYNC_REASON)
@@ -0,0 +1,157 @@
+import logging
+import threading
+from contextlib import contextmanager
+from decimal import Decimal
+
+from django.core.exceptions import ValidationError
+from django.db import transaction
+from django.db.models import F, Q
+
+from customer.models import Customer
+from inventory.models.stock import Stock
+from inventory.models.stock_movement import StockMovement
+from inventory.services.stock_lots import fifo_costing_enabled
+from inventory.services.stock_posting import post_stock_quantity
+from inventory.services.stock_reservations import consume_reservations
+from sale_invoice.models import SalesInvoice
+from sale_invoice.services.fifo_costing import cost_sales_items_fifo
+from utils import guarded_update
+
+logger = logging.getLogger(__name__)
+
+_state = threading.local()
+
+
+class SalesUnitOfWork:
+    """
+    Collects the stock, invoice total and customer credit effects of sales
+    item saves and applies them once, when the unit of work is flushed.
+
+    The sales item signal logic checks current_unit_of_work() and, when one is
+    active, records its effects here instead of applying them immediately.
+    On flush every stock row is posted once with the net quantity, every
+    touched invoice is re-totalled once, and every affected customer's credit
+    is moved once by the net change of their invoices' totals, with a guarded
+    update that refuses to take them over their credit limit. Stock reserved
+    under the reservation token is consumed just before the stock is posted.
+    Under FIFO costing every item is costed from its lots in one batch before
+    the invoices are re-totalled.
+    """
+
+    def __init__(self, reservation_token=None):
+        self.reservation_token = reservation_token
+        self.stock_deltas = {}
+        self.restock_keys = set()
+        self.invoice_ids = set()
+        self.average_costs = {}
+
+    def add_stock(self, shop_id, product_id, quantity, source, create_missing=False):
+        """Queue a quantity change for one stock row, remembering the item that caused it."""
+        if not quantity:
+            return
+        self.stock_deltas.setdefault((shop_id, product_id), []).append((quantity, source))
+        if create_missing:
+            self.restock_keys.add((shop_id, product_id))
+
+    def touch_invoice(self, invoice_id):
+        """Mark an invoice for re-totalling (and its customer for a credit update) on flush."""
+        if invoice_id is not None:
+            self.invoice_ids.add(invoice_id)
+
+    def prime_average_costs(self, shop_id, product_ids):
+        """Load the average cost of several products in one query."""
+        product_ids = {product_id for product_id in product_ids if product_id is not None}
+        missing = product_ids - {product for shop, product in self.average_costs if shop == shop_id}
+        if not missing:
+            return
+        for product_id in missing:
+            self.average_costs[(shop_id, product_id)] = None
+        for product_id, average_cost in (Stock.objects.filter(shop_id=shop_id, product_id__in=missing)
+                                         .values_list('product_id', 'average_cost')):
+            self.average_costs[(shop_id, product_id)] = average_cost
+
+    def average_cost(self, shop_id, product_id):
+        """Average cost of a product in a shop, or None if there is no stock row."""
+        key = (shop_id, product_id)
+        if key not in self.average_costs:
+            self.prime_average_costs(shop_id, [product_id])
+        return self.average_costs[key]
+
+    def flush(self):
+        """Apply the queued stock, invoice total and credit changes."""
+        consume_reservations(self.reservation_token)
+        for (shop_id, product_id), splits in sorted(self.stock_deltas.items()):
+            quantity = sum(quantity for quantity, source in splits)
+            post_stock_quantity(shop_id, product_id, quantity, logger,
+                                create_missing=(shop_id, product_id) in self.restock_keys,
+                                movement_type=StockMovement.SALE, splits=splits,
+                                reason=f"Sales invoice items saved ({len(splits)} lines)")
+        if fifo_costing_enabled():
+            # Cost every item of the batch from its lots before the invoices are re-totalled
+            lines = [(shop_id, product_id, quantity, item)
+                     for (shop_id, product_id), splits in sorted(self.stock_deltas.items())
+                     for quantity, item in splits]
+            # Deleted items are still in the batch; updating their cost touches no rows
+            items = {item.pk: item for _, _, _, item in lines}
+            cost_sales_items_fifo(lines, list(items.values()))
+
+        credit_changes = {}
+        for invoice in SalesInvoice.objects.filter(pk__in=self.invoice_ids).order_by('pk'):
+            original_total = Decimal(invoice.total_amount)
+            invoice.update_total_amount()
+            logger.info(f"Updated total for invoice {invoice.id} from {original_total} to {invoice.total_amount}")
+            if invoice.customer_id:
+                credit_changes[invoice.customer_id] = (credit_changes.get(invoice.customer_id, Decimal('0.00'))
+                                                       + Decimal(invoice.total_amount) - original_total)
+
+        credit_changes = {customer_id: change for customer_id, change in credit_changes.items() if change}
+        for customer_id, change in sorted(credit_changes.items()):
+            rows = Customer.objects.filter(pk=customer_id)
+            if change > 0:
+                # A credit_limit of zero or less means no limit is set
+                applied = guarded_update(rows, 'credit', change, maximum=F('credit_limit'),
+                                         unless=Q(credit_limit__lte=0))
+                if not applied:
+                    raise ValidationError(f"This sale would take customer {customer_id} over their credit limit.")
+            else:
+                rows.update(credit=F('credit') + change)
+            logger.info(f"Adjusted credit for customer {customer_id} by {change}")
+        if credit_changes:
+            Customer.history.bulk_history_create(Customer.objects.filter(pk__in=credit_changes), update=True)
+
+        self.stock_deltas.clear()
+        self.restock_keys.clear()
+        self.invoice_ids.clear()
+
+
+def current_unit_of_work():
+    """The unit of work active on this thread, or None."""
+    return getattr(_state, 'unit_of_work', None)
+
+
+@contextmanager
+def sales_unit_of_work(reservation_token=None):
+    """
+    Run a block of sales item saves as one unit of work inside a transaction.
+
+    Nested calls join the outer unit of work, which flushes once when it ends.
+    If the block raises, nothing queued is applied and the transaction rolls back.
+
+    Args:
+        reservation_token: Token of the stock reservations this sale consumes
+    """
+    active = current_unit_of_work()
+    if active is not None:
+        if reservation_token:
+            active.reservation_token = reservation_token
+        yield active
+        return
+
+    unit_of_work = SalesUnitOfWork(reservation_token)
+    with transaction.atomic():
+        _state.unit_of_work = unit_of_work
+        try:
+            yield unit_of_work
+        finally:
+            _state.unit_of_work = None
+        unit_of_work.flush()
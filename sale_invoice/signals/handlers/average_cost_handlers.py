@@ -1,9 +1,11 @@
 from django.db.models.signals import pre_save
 from django.dispatch import receiver
 
+from bulk_recompute import skip_during_bulk_recompute
 from sale_invoice.models import SalesInvoiceItem
 from sale_invoice.signals.logic.average_cost_logic import update_sales_invoice_item_average_cost
 
 @receiver(pre_save, sender=SalesInvoiceItem)
+@skip_during_bulk_recompute
 def handle_sales_invoice_item_pre_save(sender, instance, **kwargs):
     update_sales_invoice_item_average_cost(instance)
\ No newline at end of file
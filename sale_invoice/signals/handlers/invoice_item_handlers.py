@@ -2,6 +2,7 @@ from django.db.models.signals import pre_save, post_save, pre_delete, post_delet
 from django.dispatch import receiver
 import logging
 
+from bulk_recompute import skip_during_bulk_recompute
 from sale_invoice.models import SalesInvoiceItem
 from sale_invoice.signals.logic.invoice_item_logic import capture_original_sales_item_data, process_sales_item_creation, process_sales_item_deletion, process_sales_item_update, update_invoice_total_after_delete
 
@@ -9,6 +10,7 @@ from sale_invoice.signals.logic.invoice_item_logic import capture_original_sales
 logger = logging.getLogger(__name__)
 
 @receiver(pre_save, sender=SalesInvoiceItem)
+@skip_during_bulk_recompute
 def store_original_sales_item_data(sender, instance, **kwargs):
     """
     Store the original values before a SalesInvoiceItem is updated.
@@ -19,6 +21,7 @@ def store_original_sales_item_data(sender, instance, **kwargs):
 
 
 @receiver(post_save, sender=SalesInvoiceItem)
+@skip_during_bulk_recompute
 def update_stock_on_sales_item_save(sender, instance, created, **kwargs):
     """
     Update stock quantities when a sales invoice item is created or updated.
@@ -30,6 +33,7 @@ def update_stock_on_sales_item_save(sender, instance, created, **kwargs):
 
 
 @receiver(pre_delete, sender=SalesInvoiceItem)
+@skip_during_bulk_recompute
 def update_stock_on_sales_item_delete(sender, instance, **kwargs):
     """
     When a sales invoice item is deleted, return the stock to inventory.
@@ -38,6 +42,7 @@ def update_stock_on_sales_item_delete(sender, instance, **kwargs):
 
 
 @receiver(post_delete, sender=SalesInvoiceItem)
+@skip_during_bulk_recompute
 def update_invoice_total_after_delete_handler(sender, instance, **kwargs):
     """
     Update the invoice total after an item is deleted.
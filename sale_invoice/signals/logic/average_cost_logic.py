@@ -1,9 +1,14 @@
 from inventory.models.stock import Stock
+from inventory.services.stock_lots import fifo_costing_enabled
+from sale_invoice.services.unit_of_work import current_unit_of_work
 
 def update_sales_invoice_item_average_cost(item):
     """
     Update the average_cost of a SalesInvoiceItem with the 
     product's average cost from the corresponding Stock entry.
+
+    Under FIFO costing the cost is set from the consumed lots once the item
+    is saved (see sale_invoice.services.fifo_costing), so nothing is looked up here.
     
     Args:
         item: The SalesInvoiceItem instance to update
@@ -11,7 +16,20 @@ def update_sales_invoice_item_average_cost(item):
     Returns:
         bool: True if the average_cost was updated, False otherwise
     """
+    if fifo_costing_enabled():
+        return False
     if item.average_cost is None or getattr(item, '_update_average_cost', False):
+        unit_of_work = current_unit_of_work()
+        if unit_of_work is not None:
+            # Served from the costs the unit of work loaded for the whole invoice
+            average_cost = unit_of_work.average_cost(item.sales_invoice.shop_id, item.product_id)
+            if average_cost is None:
+                return False
+            item.average_cost = average_cost
+            if hasattr(item, '_update_average_cost'):
+                delattr(item, '_update_average_cost')
+            return True
+
         try:
             shop = item.sales_invoice.shop
             stock = Stock.objects.get(
@@ -27,4 +45,5 @@ def update_sales_invoice_item_average_cost(item):
         except Stock.DoesNotExist:
             return False
     
-    return False
\ No newline at end of file
+    return False
+
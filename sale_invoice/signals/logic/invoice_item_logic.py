@@ -1,31 +1,58 @@
 from decimal import Decimal
+from django.core.exceptions import ValidationError
 from django.db import transaction
-from inventory.models.stock import Stock
+from django.db.models import F, Q
+
+from inventory.models.stock_movement import StockMovement
+from inventory.services.stock_lots import fifo_costing_enabled
+from inventory.services.stock_posting import post_stock_quantity
+from sale_invoice.models import SalesInvoiceItem
+from sale_invoice.services.fifo_costing import cost_sales_items_fifo
+from sale_invoice.services.unit_of_work import current_unit_of_work
+from utils import increment_field
 
 def capture_original_sales_item_data(instance, logger):
     """
     Store the original values before a SalesInvoiceItem is updated.
     
+    The values come from the item's change tracker. The original product is
+    kept as an id; the original invoice is only loaded if it changed.
+    
     Args:
         instance: The SalesInvoiceItem instance being saved
         logger: Logger instance for recording operations
     """
     if instance.pk:
-        try:
-            original = instance.__class__.objects.get(pk=instance.pk)
-            instance._original_quantity = original.quantity
-            instance._original_product = original.product
-            instance._original_invoice = original.sales_invoice
-            instance._original_price = original.price
-            instance._original_discount_method = original.discount_method
-            instance._original_discount_amount = original.discount_amount
-            logger.debug(f"Stored original sales item data: quantity={original.quantity}, "
-                       f"product={original.product}, invoice={original.sales_invoice}, "
-                       f"price={original.price}, discount_method={original.discount_method}, "
-                       f"discount_amount={original.discount_amount}")
-        except instance.__class__.DoesNotExist:
-            logger.warning(f"Could not find original sales item with ID {instance.pk}")
-            pass
+        instance._original_quantity = instance.original('quantity')
+        instance._original_product = instance.original('product')
+        instance._original_invoice = instance.original_related('sales_invoice')
+        instance._original_price = instance.original('price')
+        instance._original_average_cost = instance.original('average_cost')
+        instance._original_discount_method = instance.original('discount_method')
+        instance._original_discount_amount = instance.original('discount_amount')
+        logger.debug(f"Stored original sales item data: quantity={instance._original_quantity}, "
+                     f"product={instance._original_product}, invoice={instance.original('sales_invoice')}, "
+                     f"price={instance._original_price}, discount_method={instance._original_discount_method}, "
+                     f"discount_amount={instance._original_discount_amount}")
+
+
+def adjust_customer_credit(customer, change):
+    """
+    Move a customer's credit by change in the database.
+
+    Increases are refused when they would take the customer over their
+    credit limit, the same rule SalesUnitOfWork.flush applies; a
+    credit_limit of zero or less means no limit is set.
+
+    Raises:
+        ValidationError: If the increase would exceed the credit limit
+    """
+    if change > 0:
+        if not increment_field(customer, 'credit', change, maximum=F('credit_limit'),
+                               unless=Q(credit_limit__lte=0)):
+            raise ValidationError(f"This sale would take customer {customer.pk} over their credit limit.")
+    elif change:
+        increment_field(customer, 'credit', change)
 
 
 def calculate_item_total(quantity, price, discount_method=None, discount_amount=Decimal('0.00')):
@@ -41,20 +68,23 @@ def calculate_item_total(quantity, price, discount_method=None, discount_amount=
     Returns:
         The total price after discount
     """
-    if not price:
-        return Decimal('0.00')
-    
-    unit_price = price
-    
-    if discount_method == 'amount':
-        discounted_unit_price = max(unit_price - discount_amount, Decimal('0.00'))
-    elif discount_method == 'percentage':
-        discount_value = unit_price * (discount_amount / Decimal('100.00'))
-        discounted_unit_price = max(unit_price - discount_value, Decimal('0.00'))
-    else:
-        discounted_unit_price = unit_price
-    
-    return quantity * discounted_unit_price
+    return SalesInvoiceItem.calculate_line_total(quantity, price, discount_method, discount_amount)
+
+
+def calculate_original_item_total(instance):
+    """Total of a sales item as it was before the current save."""
+    return calculate_item_total(
+        instance._original_quantity,
+        instance._original_price,
+        getattr(instance, '_original_discount_method', None),
+        getattr(instance, '_original_discount_amount', Decimal('0.00'))
+    )
+
+
+def calculate_original_item_cost(instance):
+    """Cost of a sales item as it was before the current save."""
+    return SalesInvoiceItem.calculate_line_cost(instance._original_quantity,
+                                                getattr(instance, '_original_average_cost', None))
 
 
 def process_sales_item_creation(instance, logger):
@@ -65,37 +95,29 @@ def process_sales_item_creation(instance, logger):
         instance: The new SalesInvoiceItem instance
         logger: Logger instance for recording operations
     """
-    shop = instance.sales_invoice.shop
-    product = instance.product
+    shop = instance.sales_invoice.shop_id
+    product = instance.product_id
+    
+    # Inside a unit of work the stock, total and credit changes are applied once on flush
+    unit_of_work = current_unit_of_work()
+    if unit_of_work is not None:
+        unit_of_work.add_stock(shop, product, -instance.quantity, instance)
+        unit_of_work.touch_invoice(instance.sales_invoice_id)
+        return
     
     # Handle new sales invoice items
     with transaction.atomic():
-        try:
-            stock = Stock.objects.get(shop=shop, product=product)
-            
-            # Check if there's enough stock
-            if stock.quantity < instance.quantity:
-                logger.warning(f"Insufficient stock for product {product} in shop {shop}. "
-                             f"Available: {stock.quantity}, Requested: {instance.quantity}")
-                # We'll still allow the sale but flag the warning
-            
-            # Reduce stock quantity
-            stock.quantity -= instance.quantity
-            if stock.quantity < 0:
-                stock.quantity = 0
-                logger.warning(f"Stock quantity set to zero for product {product} in shop {shop}")
-            
-            stock.save()
-            logger.info(f"Stock reduced by {instance.quantity} for product {product} in shop {shop}")
-        except Stock.DoesNotExist:
-            logger.error(f"No stock record found for product {product} in shop {shop}")
-            # Still allow the sale, but log the error
+        post_stock_quantity(shop, product, -instance.quantity, logger,
+                            movement_type=StockMovement.SALE, source=instance,
+                            reason=f"Sold on invoice {instance.sales_invoice_id}")
+        if fifo_costing_enabled():
+            cost_sales_items_fifo([(shop, product, -instance.quantity, instance)], [instance])
         
         # Get original invoice total before update
         original_total = instance.sales_invoice.total_amount
         
-        # Update the invoice total
-        instance.sales_invoice.update_total_amount()
+        # Add this line to the invoice total
+        instance.sales_invoice.update_total_amount(delta=instance.line_total(), cost_delta=instance.line_cost())
         new_total = instance.sales_invoice.total_amount
         logger.info(f"Updated total for invoice {instance.sales_invoice.id} from {original_total} to {new_total}")
         
@@ -111,8 +133,7 @@ def process_sales_item_creation(instance, logger):
             total_change = new_total - original_total
             
             # Update the customer credit based on the total change
-            instance.sales_invoice.customer.credit += total_change
-            instance.sales_invoice.customer.save(update_fields=['credit'])
+            adjust_customer_credit(instance.sales_invoice.customer, total_change)
             logger.info(f"Adjusted credit for customer {instance.sales_invoice.customer} by {total_change}")
 
 def process_sales_item_update(instance, logger):
@@ -128,14 +149,26 @@ def process_sales_item_update(instance, logger):
         logger.warning(f"Missing original data for sales item {instance.pk}")
         return
     
-    shop = instance.sales_invoice.shop
-    product = instance.product
+    shop = instance.sales_invoice.shop_id
+    product = instance.product_id
     
-    product_changed = (hasattr(instance, '_original_product') and 
-                      instance._original_product != instance.product)
+    product_changed = instance.has_changed('product')
     
-    invoice_changed = (hasattr(instance, '_original_invoice') and 
-                      instance._original_invoice != instance.sales_invoice)
+    invoice_changed = instance.has_changed('sales_invoice')
+    
+    unit_of_work = current_unit_of_work()
+    if unit_of_work is not None:
+        if product_changed or invoice_changed:
+            original_invoice = getattr(instance, '_original_invoice', None)
+            if original_invoice is not None:
+                unit_of_work.add_stock(original_invoice.shop_id, instance._original_product,
+                                       instance._original_quantity, instance)
+                unit_of_work.touch_invoice(original_invoice.pk)
+            unit_of_work.add_stock(shop, product, -instance.quantity, instance)
+        else:
+            unit_of_work.add_stock(shop, product, instance._original_quantity - instance.quantity, instance)
+        unit_of_work.touch_invoice(instance.sales_invoice_id)
+        return
     
     with transaction.atomic():
         try:
@@ -145,90 +178,63 @@ def process_sales_item_update(instance, logger):
             # If product or invoice changed, handle specially
             if product_changed or invoice_changed:
                 # Return stock for the original product
-                try:
-                    original_shop = instance._original_invoice.shop
-                    original_stock = Stock.objects.get(
-                        shop=original_shop, 
-                        product=instance._original_product
-                    )
-                    original_stock.quantity += instance._original_quantity
-                    original_stock.save()
-                    logger.info(f"Returned {instance._original_quantity} to stock for product "
-                               f"{instance._original_product} in shop {original_shop}")
-                except (Stock.DoesNotExist, AttributeError):
+                original_shop = getattr(getattr(instance, '_original_invoice', None), 'shop_id', None)
+                if original_shop is not None:
+                    post_stock_quantity(original_shop, instance._original_product, instance._original_quantity,
+                                        logger, movement_type=StockMovement.SALE, source=instance,
+                                        reason=f"Sales item {instance.pk} moved")
+                else:
                     logger.warning(f"Could not return stock for original product "
-                                  f"{getattr(instance, '_original_product', 'unknown')} "
-                                  f"in shop {getattr(getattr(instance, '_original_invoice', None), 'shop', 'unknown')}")
+                                  f"{getattr(instance, '_original_product', 'unknown')}")
                 
                 # Reduce stock for the new product/shop
-                try:
-                    new_stock = Stock.objects.get(shop=shop, product=product)
-                    
-                    # Check if there's enough stock
-                    if new_stock.quantity < instance.quantity:
-                        logger.warning(f"Insufficient stock for product {product} in shop {shop}. "
-                                     f"Available: {new_stock.quantity}, Requested: {instance.quantity}")
-                    
-                    new_stock.quantity -= instance.quantity
-                    if new_stock.quantity < 0:
-                        new_stock.quantity = 0
-                    new_stock.save()
-                    logger.info(f"Stock reduced by {instance.quantity} for product {product} in shop {shop}")
-                except Stock.DoesNotExist:
-                    logger.error(f"No stock record found for product {product} in shop {shop}")
-                
-                # Handle customer credit changes if invoice changed
-                if invoice_changed:
-                    # We'll handle customer credit after updating invoice totals
-                    pass
+                post_stock_quantity(shop, product, -instance.quantity, logger,
+                                    movement_type=StockMovement.SALE, source=instance,
+                                    reason=f"Sold on invoice {instance.sales_invoice_id}")
             else:
                 # Just a quantity or price change on the same product
                 quantity_change = instance.quantity - instance._original_quantity
                 
                 if quantity_change != 0:
-                    try:
-                        stock = Stock.objects.get(shop=shop, product=product)
-                        
-                        # Only adjust stock by the difference in quantity
-                        if quantity_change > 0:
-                            # If quantity increased, check if there's enough stock
-                            if stock.quantity < quantity_change:
-                                logger.warning(f"Insufficient stock for additional quantity. "
-                                            f"Available: {stock.quantity}, Additional: {quantity_change}")
-                            
-                            # Decrease stock by additional quantity
-                            stock.quantity -= quantity_change
-                            if stock.quantity < 0:
-                                stock.quantity = 0
-                            logger.info(f"Stock decreased by {quantity_change} for product {product} in shop {shop}")
-                        else:
-                            # If quantity decreased, return stock
-                            stock.quantity -= quantity_change  # This is actually adding because quantity_change is negative
-                            logger.info(f"Stock increased by {abs(quantity_change)} for product {product} in shop {shop}")
-                        
-                        stock.save()
-                    except Stock.DoesNotExist:
-                        logger.error(f"No stock record found for product {product} in shop {shop}")
+                    # Only adjust stock by the difference in quantity
+                    post_stock_quantity(shop, product, -quantity_change, logger,
+                                        movement_type=StockMovement.SALE, source=instance,
+                                        reason=f"Sales item {instance.pk} quantity changed")
+            
+            if fifo_costing_enabled():
+                if product_changed or invoice_changed:
+                    original_shop = getattr(getattr(instance, '_original_invoice', None), 'shop_id', None)
+                    lines = [(original_shop, instance._original_product, instance._original_quantity, instance),
+                             (shop, product, -instance.quantity, instance)]
+                else:
+                    lines = [(shop, product, instance._original_quantity - instance.quantity, instance)]
+                cost_sales_items_fifo(lines, [instance])
             
             # Update the invoice totals
             if invoice_changed and instance._original_invoice:
                 # Get original invoice's total before update
                 original_old_invoice_total = instance._original_invoice.total_amount
                 
-                # Update original invoice total
-                instance._original_invoice.update_total_amount()
+                # Take the line out of the original invoice total
+                instance._original_invoice.update_total_amount(delta=-calculate_original_item_total(instance),
+                                                               cost_delta=-calculate_original_item_cost(instance))
                 new_old_invoice_total = instance._original_invoice.total_amount
                 logger.info(f"Updated total for original invoice {instance._original_invoice.id} from {original_old_invoice_total} to {new_old_invoice_total}")
                 
                 # Update original customer's credit if exists
                 if instance._original_invoice.customer:
                     total_change = new_old_invoice_total - original_old_invoice_total
-                    instance._original_invoice.customer.credit += total_change
-                    instance._original_invoice.customer.save(update_fields=['credit'])
+                    adjust_customer_credit(instance._original_invoice.customer, total_change)
                     logger.info(f"Adjusted credit for original customer {instance._original_invoice.customer} by {total_change}")
             
-            # Update current invoice total
-            instance.sales_invoice.update_total_amount()
+            # Update current invoice total by the change in this line
+            if invoice_changed:
+                line_delta = instance.line_total()
+                cost_delta = instance.line_cost()
+            else:
+                line_delta = instance.line_total() - calculate_original_item_total(instance)
+                cost_delta = instance.line_cost() - calculate_original_item_cost(instance)
+            instance.sales_invoice.update_total_amount(delta=line_delta, cost_delta=cost_delta)
             new_invoice_total = instance.sales_invoice.total_amount
             logger.info(f"Updated total for invoice {instance.sales_invoice.id} from {original_invoice_total} to {new_invoice_total}")
             
@@ -242,14 +248,12 @@ def process_sales_item_update(instance, logger):
                         instance.discount_method, 
                         instance.discount_amount
                     )
-                    instance.sales_invoice.customer.credit += item_total
-                    instance.sales_invoice.customer.save(update_fields=['credit'])
+                    adjust_customer_credit(instance.sales_invoice.customer, item_total)
                     logger.info(f"Added credit for new customer {instance.sales_invoice.customer} by {item_total}")
                 else:
                     # For other changes, we adjust based on the change in invoice total
                     total_change = new_invoice_total - original_invoice_total
-                    instance.sales_invoice.customer.credit += total_change
-                    instance.sales_invoice.customer.save(update_fields=['credit'])
+                    adjust_customer_credit(instance.sales_invoice.customer, total_change)
                     logger.info(f"Adjusted credit for customer {instance.sales_invoice.customer} by {total_change}")
                 
         except Exception as e:
@@ -265,26 +269,23 @@ def process_sales_item_deletion(instance, logger):
         instance: The SalesInvoiceItem instance being deleted
         logger: Logger instance for recording operations
     """
+    unit_of_work = current_unit_of_work()
+    if unit_of_work is not None:
+        unit_of_work.add_stock(instance.sales_invoice.shop_id, instance.product_id, instance.quantity,
+                               instance, create_missing=True)
+        unit_of_work.touch_invoice(instance.sales_invoice_id)
+        return
+
     with transaction.atomic():
-        shop = instance.sales_invoice.shop
-        product = instance.product
+        shop = instance.sales_invoice.shop_id
+        product = instance.product_id
         
         # Return stock when item is deleted
-        try:
-            stock = Stock.objects.get(shop=shop, product=product)
-            stock.quantity += instance.quantity
-            stock.save()
-            logger.info(f"Returned {instance.quantity} to stock for product {product} in shop {shop} (item deleted)")
-        except Stock.DoesNotExist:
-            # Create a new stock record if it doesn't exist
-            Stock.objects.create(
-                shop=shop,
-                product=product,
-                quantity=instance.quantity,
-                average_cost=Decimal('0.00'),
-                selling_price=Decimal('0.00')
-            )
-            logger.warning(f"Created new stock record for product {product} in shop {shop} with returned quantity")
+        post_stock_quantity(shop, product, instance.quantity, logger, create_missing=True,
+                            movement_type=StockMovement.SALE, source=instance,
+                            reason=f"Sales item {instance.pk} deleted")
+        if fifo_costing_enabled():
+            cost_sales_items_fifo([(shop, product, instance.quantity, instance)], [])
         
         # Get original invoice total before update
         original_invoice_total = instance.sales_invoice.total_amount
@@ -299,8 +300,7 @@ def process_sales_item_deletion(instance, logger):
         
         # Update customer credit if customer exists
         if instance.sales_invoice.customer:
-            instance.sales_invoice.customer.credit -= item_total
-            instance.sales_invoice.customer.save(update_fields=['credit'])
+            adjust_customer_credit(instance.sales_invoice.customer, -item_total)
             logger.info(f"Reduced credit for customer {instance.sales_invoice.customer} by {item_total} (item deleted)")
 
 
@@ -312,12 +312,15 @@ def update_invoice_total_after_delete(instance, logger):
         instance: The SalesInvoiceItem instance that was deleted
         logger: Logger instance for recording operations
     """
+    if current_unit_of_work() is not None:
+        return  # Re-totalled when the unit of work is flushed
+
     try:
         # Get original invoice total before update
         original_invoice_total = instance.sales_invoice.total_amount
         
-        # Update the invoice total
-        instance.sales_invoice.update_total_amount()
+        # Take the deleted line out of the invoice total
+        instance.sales_invoice.update_total_amount(delta=-instance.line_total(), cost_delta=-instance.line_cost())
         new_invoice_total = instance.sales_invoice.total_amount
         
         logger.info(f"Updated total for invoice {instance.sales_invoice.id} from {original_invoice_total} to {new_invoice_total} after item deletion")
@@ -1,14 +1,33 @@
+import json
+import os
+import tempfile
 from decimal import Decimal
+from io import StringIO
+from django.contrib.auth.models import User
+from django.core.exceptions import ValidationError
+from django.core.management import call_command
+from django.db import connection, transaction
+from django.forms import inlineformset_factory
 from django.test import TestCase
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
 from django.utils import timezone
+from guardian.shortcuts import assign_perm
 import datetime
 
+from account.models import Account
+from bulk_recompute import bulk_recompute
 from inventory.models.stock import Stock
-from sale_invoice.admin.forms import SalesInvoiceForm, SalesInvoiceItemForm
+from inventory.models.stock_movement import StockMovement
+from inventory.models.stock_reservation import StockReservation
+from inventory.services.stock_reservations import reserve_stock, reserve_stock_lines
+from sale_invoice.admin.forms import SalesInvoiceForm, SalesInvoiceItemForm, SalesInvoiceItemFormSet
 from sale_invoice.models import SalesInvoice, SalesInvoiceItem
+from sale_invoice.services.unit_of_work import sales_unit_of_work
 from shop.models import Shop
 from customer.models import Customer
 from product.models import Product, Category
+from receipt.models import Receipt
 
 
 class SalesInvoiceItemTestCase(TestCase):
@@ -384,6 +403,199 @@ class SalesInvoiceItemTestCase(TestCase):
         self.assertEqual(self.invoice.get_total_average_cost(), Decimal('110.00'))
         self.assertEqual(self.invoice.get_profit(), Decimal('45.50'))
 
+    def test_incremental_total_matches_full_recompute(self):
+        """Test that line-delta total updates agree with the database aggregate."""
+        item1 = SalesInvoiceItem.objects.create(
+            sales_invoice=self.invoice,
+            product=self.product1,
+            quantity=3,
+            price=Decimal('15.35'),
+            discount_method='percentage',
+            discount_amount=Decimal('7.50')
+        )
+        item2 = SalesInvoiceItem.objects.create(
+            sales_invoice=self.invoice,
+            product=self.product2,
+            quantity=2,
+            price=Decimal('30.00'),
+            discount_method='amount',
+            discount_amount=Decimal('35.00')  # Discount above the price floors the line at zero
+        )
+        item1.quantity = 7
+        item1.save()
+        item2.discount_amount = Decimal('4.00')
+        item2.save()
+        item1.delete()
+
+        self.invoice.refresh_from_db()
+        incremental_total = self.invoice.total_amount
+        self.invoice.update_total_amount()
+
+        self.assertEqual(incremental_total, Decimal('52.00'))
+        self.assertEqual(self.invoice.total_amount, incremental_total)
+
+    def test_cost_total_and_profit_are_stored(self):
+        """Test that stored cost and profit follow item creation, updates and deletion."""
+        item = SalesInvoiceItem.objects.create(
+            sales_invoice=self.invoice,
+            product=self.product1,
+            quantity=4,
+            price=Decimal('15.00')
+        )
+        SalesInvoiceItem.objects.create(
+            sales_invoice=self.invoice,
+            product=self.product2,
+            quantity=1,
+            price=Decimal('30.00')
+        )
+        item.quantity = 6
+        item.save()
+
+        self.invoice.refresh_from_db()
+        # Cost: 6 * 10 + 1 * 20 = 80; total: 6 * 15 + 30 = 120
+        self.assertEqual(self.invoice.cost_total, Decimal('80.00'))
+        self.assertEqual(self.invoice.profit, Decimal('40.00'))
+        self.assertEqual(self.invoice.cost_total, self.invoice.get_total_average_cost())
+
+        item.delete()
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.cost_total, Decimal('20.00'))
+        self.assertEqual(self.invoice.profit, Decimal('10.00'))
+
+    def test_backfill_invoice_profit_command(self):
+        """Test that the backfill command recomputes stored cost and profit in chunks."""
+        SalesInvoiceItem.objects.create(
+            sales_invoice=self.invoice,
+            product=self.product1,
+            quantity=2,
+            price=Decimal('15.00')
+        )
+        SalesInvoice.objects.update(cost_total=0, profit=0)
+
+        call_command('backfill_invoice_profit', chunk_size=1, stdout=StringIO())
+
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.invoice.cost_total, Decimal('20.00'))
+        self.assertEqual(self.invoice.profit, Decimal('10.00'))
+
+    def test_unit_of_work_coalesces_item_saves(self):
+        """Test that item saves inside a unit of work update stock, total and credit once."""
+        stock_history = self.stock1.history.count()
+        credit_history = self.customer.history.count()
+
+        with sales_unit_of_work() as unit_of_work:
+            unit_of_work.prime_average_costs(self.shop.pk, [self.product1.pk, self.product2.pk])
+            for quantity in (2, 3, 5):
+                SalesInvoiceItem.objects.create(
+                    sales_invoice=self.invoice,
+                    product=self.product1,
+                    quantity=quantity,
+                    price=Decimal('15.00')
+                )
+            item = SalesInvoiceItem.objects.create(
+                sales_invoice=self.invoice,
+                product=self.product2,
+                quantity=4,
+                price=Decimal('30.00')
+            )
+            item.quantity = 1
+            item.save()
+
+            # Nothing is applied until the unit of work is flushed
+            self.assertEqual(Stock.objects.get(pk=self.stock1.pk).quantity, 100)
+
+        self.stock1.refresh_from_db()
+        self.stock2.refresh_from_db()
+        self.invoice.refresh_from_db()
+        self.customer.refresh_from_db()
+        self.assertEqual(self.stock1.quantity, 90)
+        self.assertEqual(self.stock2.quantity, 49)
+        self.assertEqual(self.invoice.total_amount, Decimal('180.00'))
+        self.assertEqual(self.customer.credit, Decimal('180.00'))
+        self.assertEqual(self.invoice.get_total_average_cost(), Decimal('120.00'))
+
+        # One stock update and one credit update, one ledger movement per line
+        self.assertEqual(self.stock1.history.count(), stock_history + 1)
+        self.assertEqual(self.customer.history.count(), credit_history + 1)
+        self.assertEqual(StockMovement.objects.filter(shop=self.shop, product=self.product1,
+                                                      movement_type=StockMovement.SALE).count(), 3)
+
+    def test_unit_of_work_discards_changes_on_error(self):
+        """Test that nothing queued in a failed unit of work is applied."""
+        with self.assertRaises(RuntimeError):
+            with sales_unit_of_work():
+                SalesInvoiceItem.objects.create(
+                    sales_invoice=self.invoice,
+                    product=self.product1,
+                    quantity=10,
+                    price=Decimal('15.00')
+                )
+                raise RuntimeError("Inline save failed")
+
+        self.stock1.refresh_from_db()
+        self.invoice.refresh_from_db()
+        self.assertEqual(self.stock1.quantity, 100)
+        self.assertEqual(self.invoice.total_amount, Decimal('0.00'))
+        self.assertFalse(SalesInvoiceItem.objects.filter(sales_invoice=self.invoice).exists())
+
+    def test_item_save_outside_unit_of_work_moves_credit_in_database(self):
+        """Test that a plain item save adds to the stored credit and refuses to cross the credit limit."""
+        # Another writer moves the credit after the invoice's customer was loaded
+        Customer.objects.filter(pk=self.customer.pk).update(credit=Decimal('900.00'))
+
+        SalesInvoiceItem.objects.create(
+            sales_invoice=self.invoice,
+            product=self.product1,
+            quantity=2,
+            price=Decimal('15.00')
+        )
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.credit, Decimal('930.00'))
+
+        with self.assertRaises(ValidationError):
+            with transaction.atomic():
+                SalesInvoiceItem.objects.create(
+                    sales_invoice=self.invoice,
+                    product=self.product1,
+                    quantity=5,
+                    price=Decimal('15.00')
+                )
+        self.customer.refresh_from_db()
+        self.stock1.refresh_from_db()
+        self.assertEqual(self.customer.credit, Decimal('930.00'))
+        self.assertEqual(self.stock1.quantity, 98)
+
+    def test_unit_of_work_refuses_sale_over_credit_limit(self):
+        """Test that a sale taking the customer over their credit limit is rolled back."""
+        self.customer.credit = Decimal('950.00')
+        self.customer.save()
+
+        with self.assertRaises(ValidationError):
+            with sales_unit_of_work():
+                SalesInvoiceItem.objects.create(
+                    sales_invoice=self.invoice,
+                    product=self.product1,
+                    quantity=4,
+                    price=Decimal('15.00')
+                )
+
+        self.stock1.refresh_from_db()
+        self.customer.refresh_from_db()
+        self.assertEqual(self.stock1.quantity, 100)
+        self.assertEqual(self.customer.credit, Decimal('950.00'))
+        self.assertFalse(SalesInvoiceItem.objects.filter(sales_invoice=self.invoice).exists())
+
+        # The same sale fits once it stays within the limit
+        with sales_unit_of_work():
+            SalesInvoiceItem.objects.create(
+                sales_invoice=self.invoice,
+                product=self.product1,
+                quantity=3,
+                price=Decimal('15.00')
+            )
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.credit, Decimal('995.00'))
+
     def test_insufficient_stock_validation(self):
         """Test validation when there's insufficient stock."""
         # Set up a stock with low quantity
@@ -446,6 +658,31 @@ class SalesInvoiceItemTestCase(TestCase):
         form = SalesInvoiceItemForm(data=form_data, instance=item)
         self.assertTrue(form.is_valid())
 
+    def test_validated_stock_is_reserved_until_the_invoice_is_saved(self):
+        """Test that validation reserves stock, blocks other sales and is consumed on save."""
+        self.stock1.quantity = 5
+        self.stock1.save()
+        form_data = {
+            'sales_invoice': self.invoice.id,
+            'product': self.product1.id,
+            'quantity': 5,
+            'price': Decimal('15.00'),
+            'discount_method': 'amount',
+            'discount_amount': Decimal('0.00')
+        }
+
+        first_till = SalesInvoiceItemForm(data=form_data, reservation_token='till-1')
+        self.assertTrue(first_till.is_valid())
+        second_till = SalesInvoiceItemForm(data={**form_data, 'quantity': 1}, reservation_token='till-2')
+        self.assertFalse(second_till.is_valid())
+        self.assertIn('quantity', second_till.errors)
+
+        with sales_unit_of_work(reservation_token='till-1'):
+            first_till.save()
+
+        self.stock1.refresh_from_db()
+        self.assertEqual((self.stock1.quantity, self.stock1.reserved_quantity), (0, 0))
+
     def test_edit_validation_decrease_quantity(self):
         """Test validation when editing to decrease quantity."""
         # Create an initial sales invoice item
@@ -474,6 +711,63 @@ class SalesInvoiceItemTestCase(TestCase):
         # Should always be valid when decreasing
         self.assertTrue(form.is_valid())
 
+    def item_formset(self, lines, **kwargs):
+        ItemFormSet = inlineformset_factory(SalesInvoice, SalesInvoiceItem, form=SalesInvoiceItemForm,
+                                            formset=SalesInvoiceItemFormSet, exclude=['average_cost'], extra=0)
+        data = {'items-TOTAL_FORMS': len(lines), 'items-INITIAL_FORMS': 0}
+        for index, (product, quantity) in enumerate(lines):
+            data.update({
+                f'items-{index}-product': product.id,
+                f'items-{index}-quantity': quantity,
+                f'items-{index}-price': Decimal('16.00'),
+                f'items-{index}-discount_method': 'amount',
+                f'items-{index}-discount_amount': Decimal('0.00'),
+            })
+        return ItemFormSet(data=data, instance=self.invoice, **kwargs)
+
+    def test_formset_validates_products_against_their_total(self):
+        """Test that lines of the same product are checked together, with one stock query for the formset."""
+        self.stock1.quantity = 10
+        self.stock1.save()
+
+        formset = self.item_formset([(self.product1, 4), (self.product2, 1), (self.product1, 4), (self.product1, 4)])
+        with CaptureQueriesContext(connection) as queries:
+            self.assertFalse(formset.is_valid())
+        self.assertEqual([bool(form.errors.get('quantity')) for form in formset.forms], [True, False, True, True])
+        self.assertIn('Quantity 12 exceeds available stock 10', formset.forms[0].errors['quantity'][0])
+        stock_reads = [query for query in queries.captured_queries if 'FROM "inventory_stock"' in query['sql']]
+        self.assertEqual(len(stock_reads), 1)
+
+        formset = self.item_formset([(self.product1, 5), (self.product1, 5)])
+        self.assertTrue(formset.is_valid())
+
+    def test_formset_reports_a_sale_over_the_credit_limit(self):
+        """Test that the item formset reports the credit limit instead of leaving it to the save."""
+        Customer.objects.filter(pk=self.customer.pk).update(credit=Decimal('950.00'))
+
+        formset = self.item_formset([(self.product1, 4)])
+        self.assertFalse(formset.is_valid())
+        self.assertIn('over their credit limit', formset.non_form_errors()[0])
+
+        self.assertTrue(self.item_formset([(self.product1, 3)]).is_valid())
+
+    def test_admin_keeps_the_invoice_on_the_form_over_the_credit_limit(self):
+        """Test that the admin re-renders an invoice over the credit limit with the error and saves nothing."""
+        Customer.objects.filter(pk=self.customer.pk).update(credit=Decimal('950.00'))
+        self.client.force_login(User.objects.create_superuser('admin', 'admin@test.com', 'password'))
+        data = {'shop': self.shop.id, 'customer': self.customer.id,
+                'due_date': (timezone.now().date() + datetime.timedelta(days=10)).isoformat(),
+                'items-TOTAL_FORMS': 1, 'items-INITIAL_FORMS': 0,
+                'items-0-product': self.product1.id, 'items-0-quantity': 4, 'items-0-price': '16.00',
+                'items-0-discount_method': 'amount', 'items-0-discount_amount': '0.00'}
+
+        response = self.client.post(reverse('admin:sale_invoice_salesinvoice_add'), data)
+
+        self.assertEqual(response.status_code, 200)
+        self.assertContains(response, 'over their credit limit')
+        self.assertEqual(SalesInvoice.objects.count(), 1)
+        self.assertEqual(Stock.objects.get(pk=self.stock1.pk).reserved_quantity, 0)
+
     def test_invoice_payment_status(self):
         """Test the payment status method of the invoice."""
         # Create a sales invoice item
@@ -527,20 +821,24 @@ class SalesInvoiceItemTestCase(TestCase):
         self.assertEqual(self.customer.credit, Decimal('750.00'))
         self.assertTrue('Near Limit' in self.customer.credit_status())
         
-        # Push over limit
-        item2 = SalesInvoiceItem.objects.create(
-            sales_invoice=self.invoice,
-            product=self.product2,
-            quantity=10,
-            price=Decimal('30.00'),
-            average_cost=Decimal('20.00'),
-            discount_method='amount',
-            discount_amount=Decimal('0.00')
-        )
-        
-        # Check customer credit status again
+        # A sale that would push the customer over the limit is refused
+        with self.assertRaises(ValidationError):
+            with transaction.atomic():
+                SalesInvoiceItem.objects.create(
+                    sales_invoice=self.invoice,
+                    product=self.product2,
+                    quantity=10,
+                    price=Decimal('30.00'),
+                    average_cost=Decimal('20.00'),
+                    discount_method='amount',
+                    discount_amount=Decimal('0.00')
+                )
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.credit, Decimal('750.00'))
+
+        # A credit limit lowered below what is already owed shows as over the limit
+        Customer.objects.filter(pk=self.customer.pk).update(credit_limit=Decimal('700.00'))
         self.customer.refresh_from_db()
-        self.assertEqual(self.customer.credit, Decimal('1050.00'))
         self.assertTrue('Over Limit' in self.customer.credit_status())
         
     def test_invoice_total_change_affects_customer_credit(self):
@@ -775,4 +1073,497 @@ class SalesInvoiceItemTestCase(TestCase):
         # Should be able to create invoice for non-blacklisted customer
         form_data['customer'] = new_customer.id
         form = SalesInvoiceForm(data=form_data)
-        self.assertTrue(form.is_valid())
\ No newline at end of file
+        self.assertTrue(form.is_valid())
+
+class SalesInvoiceChangelistQueryTestCase(TestCase):
+    """Test that the sales invoice changelist runs a fixed number of queries per page."""
+
+    def setUp(self):
+        """Set up an admin user, a shop, a customer and a stocked product."""
+        self.user = User.objects.create_superuser('admin', 'admin@test.com', 'password')
+        self.client.force_login(self.user)
+        self.shop = Shop.objects.create(name="Test Shop", code="TS01")
+        self.customer = Customer.objects.create(
+            name="Test Customer",
+            mobile_number="9876543210",
+            credit=Decimal('0.00'),
+            credit_limit=Decimal('100000.00'),
+            credit_period=30
+        )
+        self.product = Product.objects.create(name="Product 1", profit_margin=Decimal('10.00'))
+        Stock.objects.create(shop=self.shop, product=self.product, quantity=1000, average_cost=Decimal('10.00'))
+        self.account = Account.objects.create(name="Cash")
+
+    def create_invoices(self, count):
+        """Create invoices with two items and a receipt each."""
+        for _ in range(count):
+            invoice = SalesInvoice.objects.create(
+                shop=self.shop,
+                customer=self.customer,
+                due_date=timezone.now().date() + datetime.timedelta(days=30)
+            )
+            for quantity in (1, 2):
+                SalesInvoiceItem.objects.create(
+                    sales_invoice=invoice,
+                    product=self.product,
+                    quantity=quantity,
+                    price=Decimal('15.00')
+                )
+            Receipt.objects.create(sales_invoice=invoice, amount=Decimal('5.00'), account=self.account)
+
+    def changelist_queries(self):
+        """Render the changelist and return the number of queries it ran."""
+        url = reverse('admin:sale_invoice_salesinvoice_changelist')
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(url)
+        self.assertEqual(response.status_code, 200)
+        return len(queries)
+
+    def test_changelist_query_count_does_not_grow_with_rows(self):
+        """Test that a full page costs the same number of queries as a page with two rows."""
+        self.create_invoices(2)
+        small_page = self.changelist_queries()
+
+        self.create_invoices(15)
+        full_page = self.changelist_queries()
+
+        self.assertEqual(full_page, small_page)
+
+    def test_changelist_shows_annotated_cost_and_profit(self):
+        """Test that cost and profit columns come out of the annotated queryset."""
+        self.create_invoices(1)
+        response = self.client.get(reverse('admin:sale_invoice_salesinvoice_changelist'))
+
+        # 3 units at an average cost of 10.00 sold for 45.00
+        self.assertContains(response, "30.00")
+        self.assertContains(response, "15.00")
+
+
+class CheckoutAPITestCase(TestCase):
+    """Test recording a whole sale through the checkout API."""
+
+    def setUp(self):
+        """Set up a shop with stocked products, a customer with a credit limit and an account."""
+        self.user = User.objects.create_user('cashier', 'cashier@test.com', 'password')
+        self.client.force_login(self.user)
+        self.url = reverse('checkout-api')
+        self.shop = Shop.objects.create(name="Test Shop", code="TS01")
+        assign_perm('shop.view_shop', self.user, self.shop)
+        self.customer = Customer.objects.create(name="Test Customer", mobile_number="9876543210",
+                                                credit=Decimal('0.00'), credit_limit=Decimal('100.00'),
+                                                credit_period=30)
+        self.account = Account.objects.create(name="Cash", balance=Decimal('0.00'))
+        self.products = [Product.objects.create(name=f"Product {index}", profit_margin=Decimal('10.00'))
+                         for index in range(8)]
+        for product in self.products:
+            Stock.objects.create(shop=self.shop, product=product, quantity=10, average_cost=Decimal('10.00'))
+
+    def sell(self, items, **sale):
+        return self.client.post(self.url, {'shop': self.shop.id, 'items': items, **sale},
+                                content_type='application/json')
+
+    def test_checkout_records_the_whole_sale(self):
+        """Test that the invoice, items, stock, credit, receipt and account balance are all recorded."""
+        response = self.sell(
+            [{'product': self.products[0].id, 'quantity': 2, 'price': '15.00'},
+             {'product': self.products[1].id, 'quantity': 1}],
+            customer=self.customer.id, payment={'account': self.account.id, 'amount': '20.00'},
+        )
+
+        self.assertEqual(response.status_code, 201)
+        body = response.json()
+        self.assertEqual((body['total_amount'], body['paid_amount'], body['due_amount']),
+                         ('41.00', '20.00', '21.00'))
+        invoice = SalesInvoice.objects.get(pk=body['invoice_id'])
+        self.assertEqual((invoice.cost_total, invoice.profit), (Decimal('30.00'), Decimal('11.00')))
+        self.assertEqual(invoice.items.count(), 2)
+        self.assertEqual(Stock.objects.get(shop=self.shop, product=self.products[0]).quantity, 8)
+        self.assertEqual(StockMovement.objects.filter(movement_type=StockMovement.SALE).count(), 2)
+        self.customer.refresh_from_db()
+        self.account.refresh_from_db()
+        self.assertEqual(self.customer.credit, Decimal('21.00'))
+        self.assertEqual(self.account.balance, Decimal('20.00'))
+        self.assertEqual(Receipt.objects.get(pk=body['receipt_id']).amount, Decimal('20.00'))
+
+    def test_checkout_query_count_does_not_grow_with_lines(self):
+        """Test that an eight line sale costs the same number of queries as a two line sale."""
+        def queries(products):
+            items = [{'product': product.id, 'quantity': 1} for product in products]
+            with CaptureQueriesContext(connection) as captured:
+                self.assertEqual(self.sell(items, payment={'account': self.account.id, 'amount': '5.00'})
+                                 .status_code, 201)
+            return len(captured)
+
+        self.assertEqual(queries(self.products[:2]), queries(self.products))
+
+    def test_checkout_reports_every_problem_and_records_nothing(self):
+        """Test that unknown products, short stock, low prices and overpayment are reported together."""
+        response = self.sell(
+            [{'product': self.products[0].id, 'quantity': 6}, {'product': self.products[0].id, 'quantity': 6},
+             {'product': self.products[1].id, 'quantity': 1, 'price': '5.00'},
+             {'product': 999, 'quantity': 1}],
+            customer=self.customer.id, payment={'account': 999, 'amount': '1.00'},
+        )
+
+        self.assertEqual(response.status_code, 400)
+        errors = response.json()['errors']
+        self.assertEqual(len(errors['items']), 4)
+        self.assertIn('Line 1: Quantity 12 exceeds available stock 10', errors['items'][0])
+        self.assertIn('payment', errors)
+        self.assertFalse(SalesInvoice.objects.exists())
+        self.assertEqual(Stock.objects.get(shop=self.shop, product=self.products[0]).quantity, 10)
+
+    def test_checkout_refuses_credit_over_the_limit(self):
+        """Test that only the unpaid part of a sale counts against the customer's credit limit."""
+        items = [{'product': self.products[0].id, 'quantity': 10, 'price': '15.00'}]
+        response = self.sell(items, customer=self.customer.id)
+        self.assertEqual(response.status_code, 400)
+        self.assertIn('customer', response.json()['errors'])
+
+        response = self.sell(items, customer=self.customer.id,
+                             payment={'account': self.account.id, 'amount': '60.00'})
+        self.assertEqual(response.status_code, 201)
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.credit, Decimal('90.00'))
+
+    def test_checkout_consumes_reserved_stock(self):
+        """Test that stock reserved under the sale's token is available to it and released by it."""
+        reserve_stock_lines(self.shop, [(self.products[0], 10)], 'till-1')
+        items = [{'product': self.products[0].id, 'quantity': 10}]
+        self.assertEqual(self.sell(items).status_code, 400)
+
+        response = self.sell(items, reservation_token='till-1')
+
+        self.assertEqual(response.status_code, 201)
+        stock = Stock.objects.get(shop=self.shop, product=self.products[0])
+        self.assertEqual((stock.quantity, stock.reserved_quantity), (0, 0))
+        self.assertFalse(StockReservation.objects.exists())
+
+    def test_checkout_keeps_the_token_reservations_of_other_shops(self):
+        """Test that a sale only consumes the reservations its token holds in the sale's shop."""
+        other_shop = Shop.objects.create(name="Other Shop", code="OS01")
+        Stock.objects.create(shop=other_shop, product=self.products[0], quantity=10, average_cost=Decimal('10.00'))
+        reserve_stock(self.shop, self.products[0], 2, 'till-1')
+        reserve_stock(other_shop, self.products[0], 4, 'till-1')
+
+        response = self.sell([{'product': self.products[0].id, 'quantity': 2}], reservation_token='till-1')
+
+        self.assertEqual(response.status_code, 201)
+        stock = Stock.objects.get(shop=self.shop, product=self.products[0])
+        self.assertEqual((stock.quantity, stock.reserved_quantity), (8, 0))
+        other_stock = Stock.objects.get(shop=other_shop, product=self.products[0])
+        self.assertEqual((other_stock.quantity, other_stock.reserved_quantity), (10, 4))
+        self.assertEqual(list(StockReservation.objects.values_list('shop_id', 'quantity')), [(other_shop.pk, 4)])
+
+    def test_checkout_requires_permission_on_the_shop(self):
+        """Test that a user can only sell in shops they have the view_shop permission on."""
+        other_shop = Shop.objects.create(name="Other Shop", code="OS01")
+        Stock.objects.create(shop=other_shop, product=self.products[0], quantity=10, average_cost=Decimal('10.00'))
+
+        response = self.client.post(self.url, {'shop': other_shop.id,
+                                               'items': [{'product': self.products[0].id, 'quantity': 1}]},
+                                     content_type='application/json')
+
+        self.assertEqual(response.status_code, 403)
+        self.assertFalse(SalesInvoice.objects.exists())
+
+
+class SalesSyncAPITestCase(TestCase):
+    """Test uploading sales recorded offline through the sync API."""
+
+    def setUp(self):
+        """Set up a shop with stocked products, a customer and an account."""
+        self.user = User.objects.create_user('till', 'till@test.com', 'password')
+        self.client.force_login(self.user)
+        self.url = reverse('sales-sync-api')
+        self.shop = Shop.objects.create(name="Branch Shop", code="BS01")
+        assign_perm('shop.view_shop', self.user, self.shop)
+        self.customer = Customer.objects.create(name="Test Customer", mobile_number="9876543210",
+                                                credit=Decimal('0.00'), credit_limit=Decimal('1000.00'),
+                                                credit_period=30)
+        self.account = Account.objects.create(name="Till", balance=Decimal('0.00'))
+        self.products = [Product.objects.create(name=f"Product {index}", profit_margin=Decimal('10.00'))
+                         for index in range(2)]
+        for product in self.products:
+            Stock.objects.create(shop=self.shop, product=product, quantity=100, average_cost=Decimal('10.00'))
+
+    def sale(self, key, quantity=1, **extra):
+        return {'idempotency_key': key, 'shop': self.shop.id, 'customer': self.customer.id,
+                'items': [{'product': self.products[0].id, 'quantity': quantity, 'price': '15.00'}], **extra}
+
+    def sync(self, sales):
+        return self.client.post(self.url, {'sales': sales}, content_type='application/json')
+
+    def test_sync_records_sales_with_coalesced_effects(self):
+        """Test that a batch is recorded with one stock, credit and balance change per row."""
+        stock = Stock.objects.get(shop=self.shop, product=self.products[0])
+        stock_history = stock.history.count()
+        sold_at = timezone.now() - datetime.timedelta(days=2)
+
+        response = self.sync([
+            self.sale('till-1-1', 2, sold_at=sold_at.isoformat(),
+                      payment={'account': self.account.id, 'amount': '30.00'}),
+            self.sale('till-1-2', 3),
+        ])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.json()['created'], 2)
+        stock.refresh_from_db()
+        self.assertEqual(stock.quantity, 95)
+        self.assertEqual(stock.history.count(), stock_history + 1)
+        self.customer.refresh_from_db()
+        self.account.refresh_from_db()
+        self.assertEqual(self.customer.credit, Decimal('45.00'))
+        self.assertEqual(self.account.balance, Decimal('30.00'))
+        invoice = SalesInvoice.objects.get(idempotency_key='till-1-1')
+        self.assertEqual((invoice.total_amount, invoice.paid_amount, invoice.cost_total),
+                         (Decimal('30.00'), Decimal('30.00'), Decimal('20.00')))
+        self.assertEqual(invoice.created_at, sold_at)
+        self.assertEqual(invoice.receipts.get().received_at, sold_at)
+        self.assertEqual(StockMovement.objects.filter(movement_type=StockMovement.SALE).count(), 2)
+
+    def test_resent_sales_are_duplicates(self):
+        """Test that sending a batch again records nothing and points at the first invoices."""
+        sales = [self.sale('till-1-1', payment={'account': self.account.id, 'amount': '15.00'}),
+                 self.sale('till-1-2')]
+        first = self.sync(sales).json()['results']
+
+        response = self.sync(sales + [self.sale('till-1-2')])
+
+        results = response.json()['results']
+        self.assertEqual([result['status'] for result in results], ['duplicate'] * 3)
+        self.assertEqual([result['invoice_id'] for result in results],
+                         [first[0]['invoice_id'], first[1]['invoice_id'], first[1]['invoice_id']])
+        self.assertEqual(SalesInvoice.objects.count(), 2)
+        self.assertEqual(Stock.objects.get(shop=self.shop, product=self.products[0]).quantity, 98)
+        self.account.refresh_from_db()
+        self.assertEqual(self.account.balance, Decimal('15.00'))
+
+    def test_unrecordable_sales_are_rejected_alone(self):
+        """Test that a sale that cannot be recorded is rejected while the rest are recorded."""
+        bad_product = self.sale('till-1-2')
+        bad_product['items'][0]['product'] = 999
+
+        response = self.sync([self.sale('till-1-1'), bad_product, {'shop': self.shop.id}])
+
+        self.assertEqual(response.status_code, 207)
+        self.assertEqual([result['status'] for result in response.json()['results']],
+                         ['created', 'rejected', 'rejected'])
+        self.assertEqual(SalesInvoice.objects.count(), 1)
+
+    def test_sales_for_forbidden_shops_are_rejected(self):
+        """Test that sales for a shop the user has no permission on are rejected and the rest recorded."""
+        other_shop = Shop.objects.create(name="Other Shop", code="OS01")
+        Stock.objects.create(shop=other_shop, product=self.products[0], quantity=10, average_cost=Decimal('10.00'))
+
+        response = self.sync([self.sale('till-1-1'), self.sale('till-1-2', shop=other_shop.id)])
+
+        self.assertEqual(response.status_code, 207)
+        results = response.json()['results']
+        self.assertEqual([result['status'] for result in results], ['created', 'rejected'])
+        self.assertIn('shop', results[1]['errors'])
+        self.assertEqual(Stock.objects.get(shop=other_shop, product=self.products[0]).quantity, 10)
+
+    def test_synced_sales_take_reserved_stock(self):
+        """Test that sales made offline are recorded even when the stock is reserved online."""
+        reserve_stock(self.shop, self.products[0], 99, 'till-2')
+
+        with self.assertLogs('sale_invoice.services.sales_sync', 'WARNING'):
+            response = self.sync([self.sale('till-1-1', 3)])
+
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(Stock.objects.get(shop=self.shop, product=self.products[0]).quantity, 97)
+
+    def test_sync_query_count_does_not_grow_with_sales(self):
+        """Test that a chunk of twelve sales costs the same number of queries as a chunk of three."""
+        def queries(prefix, count):
+            sales = [self.sale(f'{prefix}-{index}', payment={'account': self.account.id, 'amount': '5.00'})
+                     for index in range(count)]
+            with CaptureQueriesContext(connection) as captured:
+                self.assertEqual(self.sync(sales).status_code, 200)
+            return len(captured)
+
+        self.assertEqual(queries('small', 3), queries('large', 12))
+
+
+class SalesImportTestCase(TestCase):
+    """Test importing historical sales with the import_sales command."""
+
+    def setUp(self):
+        """Set up a shop with two stocked products and a customer."""
+        self.shop = Shop.objects.create(name="Test Shop", code="TS01")
+        self.customer = Customer.objects.create(name="Test Customer", mobile_number="9876543210",
+                                                credit=Decimal('0.00'), credit_limit=Decimal('100.00'),
+                                                credit_period=30)
+        self.products = [Product.objects.create(name=f"Product {index}", profit_margin=Decimal('10.00'))
+                         for index in range(2)]
+        for product in self.products:
+            Stock.objects.create(shop=self.shop, product=product, quantity=100, average_cost=Decimal('10.00'))
+
+    def write_file(self, content, suffix):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        path = os.path.join(directory.name, f'sales{suffix}')
+        with open(path, 'w', encoding='utf-8') as file:
+            file.write(content)
+        return path
+
+    def import_csv(self, lines, *args):
+        header = "invoice,shop,customer,created_at,paid_amount,product,quantity,price,discount_method,average_cost\n"
+        out, err = StringIO(), StringIO()
+        call_command('import_sales', self.write_file(header + "".join(lines), '.csv'), *args, stdout=out, stderr=err)
+        return out.getvalue(), err.getvalue()
+
+    def lines(self):
+        first, second = self.products
+        return [
+            f"A-1,{self.shop.id},{self.customer.id},2020-01-15,5.00,{first.id},2,15.00,amount,8.00\n",
+            f"A-1,{self.shop.id},{self.customer.id},2020-01-15,5.00,{second.id},1,20.00,percentage,\n",
+            f"A-2,{self.shop.id},,2020-02-01,,{first.id},3,15.00,,\n",
+        ]
+
+    def test_import_recomputes_totals_credit_and_stock(self):
+        """Test that invoices get their totals, customers their credit and stock its quantities."""
+        self.import_csv(self.lines(), '--chunk-size', '1')
+
+        invoice = SalesInvoice.objects.get(idempotency_key='import:A-1')
+        self.assertEqual((invoice.total_amount, invoice.paid_amount, invoice.cost_total, invoice.profit),
+                         (Decimal('50.00'), Decimal('5.00'), Decimal('26.00'), Decimal('24.00')))
+        self.assertEqual(timezone.localtime(invoice.created_at).date(), datetime.date(2020, 1, 15))
+        self.assertEqual(invoice.due_date, datetime.date(2020, 2, 14))
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.credit, Decimal('45.00'))
+        self.assertEqual(Stock.objects.get(shop=self.shop, product=self.products[0]).quantity, 95)
+        self.assertEqual(SalesInvoiceItem.objects.filter(sales_invoice__idempotency_key='import:A-2').count(), 1)
+
+    def test_reimport_skips_invoices_and_rejects_bad_ones(self):
+        """Test that a second run skips imported invoices and bad invoices are reported without stopping."""
+        self.import_csv(self.lines())
+        bad = f"A-3,{self.shop.id},,,,999,1,15.00,,\n"
+
+        out, err = self.import_csv(self.lines() + [bad], '--skip-stock')
+
+        self.assertIn("0 invoices (0 lines); 2 already imported, 1 rejected", out)
+        self.assertIn("Invoice A-3: products [999] do not exist", err)
+        self.assertEqual(SalesInvoice.objects.count(), 2)
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.credit, Decimal('45.00'))
+
+    def test_invoice_split_across_chunks_is_reported(self):
+        """Test that a later run of lines for an invoice already seen is rejected, not counted as imported."""
+        first, second, third = self.lines()
+
+        out, err = self.import_csv([first, third, second], '--chunk-size', '1')
+
+        self.assertIn("2 invoices (2 lines); 0 already imported, 1 rejected", out)
+        self.assertIn("Invoice A-1: its lines are not consecutive", err)
+        self.assertEqual(SalesInvoiceItem.objects.filter(sales_invoice__idempotency_key='import:A-1').count(), 1)
+
+    def test_invoice_without_stock_record_is_rejected(self):
+        """Test that an invoice selling a product its shop has no stock row for is reported, not imported."""
+        unstocked = Product.objects.create(name="Unstocked", profit_margin=Decimal('10.00'))
+        line = f"U-1,{self.shop.id},,,,{unstocked.id},1,15.00,,\n"
+
+        out, err = self.import_csv(self.lines() + [line])
+
+        self.assertIn("2 invoices (3 lines); 0 already imported, 1 rejected", out)
+        self.assertIn(f"Invoice U-1: products [{unstocked.id}] have no stock record in shop {self.shop.id}", err)
+        self.assertFalse(SalesInvoice.objects.filter(idempotency_key='import:U-1').exists())
+
+        self.import_csv([line], '--skip-stock')
+        self.assertTrue(SalesInvoice.objects.filter(idempotency_key='import:U-1').exists())
+
+    def test_import_jsonl(self):
+        """Test that JSON Lines files are read the same way."""
+        path = self.write_file(json.dumps({'invoice': 'J-1', 'shop': self.shop.id, 'product': self.products[1].id,
+                                           'quantity': 4, 'price': 12.5}) + "\n", '.jsonl')
+
+        call_command('import_sales', path, stdout=StringIO())
+
+        invoice = SalesInvoice.objects.get(idempotency_key='import:J-1')
+        self.assertEqual((invoice.total_amount, invoice.cost_total), (Decimal('50.00'), Decimal('40.00')))
+        self.assertEqual(Stock.objects.get(shop=self.shop, product=self.products[1]).quantity, 96)
+
+
+class BulkRecomputeTestCase(TestCase):
+    """Test that work done inside bulk_recompute leaves the same derived state as the signal handlers."""
+
+    def setUp(self):
+        """Set up a shop with two stocked products, a customer and an account."""
+        self.shop = Shop.objects.create(name="Test Shop", code="TS01")
+        self.customer = Customer.objects.create(name="Test Customer", mobile_number="9876543210",
+                                                credit=Decimal('7.00'), credit_limit=Decimal('0.00'),
+                                                credit_period=30)
+        self.account = Account.objects.create(name="Cash", balance=Decimal('50.00'))
+        self.products = [Product.objects.create(name=f"Product {index}", profit_margin=Decimal('10.00'))
+                         for index in range(2)]
+        for product in self.products:
+            Stock.objects.create(shop=self.shop, product=product, quantity=100, average_cost=Decimal('10.00'))
+
+    def sell(self):
+        due_date = timezone.now().date()
+        invoice = SalesInvoice.objects.create(shop=self.shop, customer=self.customer, due_date=due_date)
+        first = SalesInvoiceItem.objects.create(sales_invoice=invoice, product=self.products[0], quantity=3,
+                                                price=Decimal('15.00'))
+        second = SalesInvoiceItem.objects.create(sales_invoice=invoice, product=self.products[1], quantity=2,
+                                                 price=Decimal('25.00'), discount_method='percentage',
+                                                 discount_amount=Decimal('10.00'))
+        Receipt.objects.create(sales_invoice=invoice, amount=Decimal('20.00'), account=self.account)
+        first.quantity = 5
+        first.save()
+        second.delete()
+
+        cancelled = SalesInvoice.objects.create(shop=self.shop, customer=self.customer, due_date=due_date)
+        SalesInvoiceItem.objects.create(sales_invoice=cancelled, product=self.products[1], quantity=4,
+                                        price=Decimal('12.00'))
+        Receipt.objects.create(sales_invoice=cancelled, amount=Decimal('5.00'), account=self.account)
+        SalesInvoice.objects.get(pk=cancelled.pk).delete()
+
+    def derived_state(self):
+        self.customer.refresh_from_db()
+        self.account.refresh_from_db()
+        return {
+            'credit': self.customer.credit,
+            'balance': self.account.balance,
+            'stock': list(Stock.objects.order_by('product_id').values_list('quantity', flat=True)),
+            'invoices': list(SalesInvoice.objects.order_by('pk')
+                             .values_list('total_amount', 'paid_amount', 'cost_total', 'profit')),
+            'costs': list(SalesInvoiceItem.objects.order_by('pk').values_list('average_cost', flat=True)),
+        }
+
+    def test_bulk_recompute_matches_signal_handlers(self):
+        """Test that totals, credit, balance, stock and costs match what the handlers leave behind."""
+        with transaction.atomic():
+            self.sell()
+            expected = self.derived_state()
+            transaction.set_rollback(True)
+
+        with bulk_recompute():
+            self.sell()
+            # The handlers are off inside the block
+            self.assertEqual(Stock.objects.get(shop=self.shop, product=self.products[0]).quantity, 100)
+
+        self.assertEqual(self.derived_state(), expected)
+        self.assertEqual(expected['credit'], Decimal('62.00'))
+        self.assertEqual(expected['stock'], [95, 100])
+
+    def test_bulk_recompute_records_bulk_inserts_it_is_told_about(self):
+        """Test that rows written without signals are recomputed once they are touched."""
+        invoice = SalesInvoice.objects.create(shop=self.shop, customer=self.customer,
+                                              due_date=timezone.now().date())
+
+        with bulk_recompute() as recompute:
+            SalesInvoiceItem.objects.bulk_create([
+                SalesInvoiceItem(sales_invoice=invoice, product=product, quantity=2, price=Decimal('15.00'))
+                for product in self.products
+            ])
+            recompute.touch_sales_invoice(invoice.pk)
+            for product in self.products:
+                recompute.add_stock(self.shop.pk, product.pk, -2, StockMovement.SALE)
+
+        invoice.refresh_from_db()
+        self.customer.refresh_from_db()
+        self.assertEqual((invoice.total_amount, invoice.cost_total), (Decimal('60.00'), Decimal('40.00')))
+        self.assertEqual(self.customer.credit, Decimal('67.00'))
+        self.assertEqual(list(Stock.objects.order_by('product_id').values_list('quantity', flat=True)), [98, 98])
+        self.assertEqual(StockMovement.objects.filter(movement_type=StockMovement.SALE).count(), 2)
@@ -0,0 +1,25 @@
+from guardian.shortcuts import get_objects_for_user
+
+from shop.models import Shop
+
+
+def forbidden_shops(user, shop_ids):
+    """
+    The shops among shop_ids that exist but that the user may not work in.
+
+    A user works in a shop with the per-shop ``shop.view_shop`` permission,
+    as in the admin; superusers work in every shop. Ids of shops that do not
+    exist are left to the caller's own validation. One query.
+
+    Args:
+        user: The requesting user
+        shop_ids: Iterable of shop ids (None is ignored)
+
+    Returns:
+        Sorted list of the forbidden shop ids
+    """
+    shop_ids = {shop_id for shop_id in shop_ids if shop_id is not None}
+    if not shop_ids or user.is_superuser:
+        return []
+    allowed = get_objects_for_user(user, 'shop.view_shop', Shop).filter(pk__in=shop_ids).values('pk')
+    return sorted(Shop.objects.filter(pk__in=shop_ids).exclude(pk__in=allowed).values_list('pk', flat=True))
@@ -1,8 +1,10 @@
+from decimal import Decimal
 from io import BytesIO
 from django.http import HttpResponse
 from django.template.loader import get_template
 from xhtml2pdf import pisa
 from django.core.validators import RegexValidator
+from django.db.models import F, Q
 
 def render_to_pdf(template_src, context_dict={}):
     """Generate PDF from HTML template"""
@@ -35,3 +37,148 @@ def invoice_number(input_string, number, padding=4):
     zeros = '0' * (padding - len(number_str)) if len(number_str) < padding else ''
     result = f"{input_string}{zeros}{number}"    
     return result
+
+
+def guarded_update(queryset, field, delta, minimum=None, maximum=None, unless=None):
+    """
+    Add ``delta`` to a numeric field, but only on rows where the result stays in bounds.
+
+    The check and the write are one statement, e.g. for a debit
+    ``UPDATE ... SET balance = balance - d WHERE id = ? AND balance >= d``,
+    so there is no read beforehand and no window for a concurrent writer to
+    spend the same balance. The number of rows updated is the validation
+    result: 0 means the bound would have been crossed (or the row is gone).
+
+    Args:
+        queryset: Rows to update, usually filtered down to one pk
+        field: Name of the numeric field to change
+        delta: Signed amount to add
+        minimum: Lowest value the field may end at (a number or an expression such as F('x')), or None
+        maximum: Highest value the field may end at (a number or an expression), or None
+        unless: Optional Q; rows matching it are updated without the bounds check
+
+    Returns:
+        int: Number of rows updated
+    """
+    condition = Q()
+    if minimum is not None:
+        condition &= Q(**{f'{field}__gte': minimum - delta})
+    if maximum is not None:
+        condition &= Q(**{f'{field}__lte': maximum - delta})
+    if unless is not None:
+        condition |= unless
+    return queryset.filter(condition).update(**{field: F(field) + delta})
+
+
+
+def increment_field(instance, field, delta, minimum=None, maximum=None, unless=None):
+    """
+    Add ``delta`` to a numeric field of a saved instance with one UPDATE.
+
+    The write is ``field = field + delta`` in the database, so it adds to the
+    stored value rather than writing back a value computed from a possibly
+    stale instance. Bounds are checked in the same statement, as in
+    guarded_update(). When the row is updated the instance is refreshed and
+    its history written with its _change_reason.
+
+    Args:
+        instance: Saved model instance with a history manager
+        field: Name of the numeric field to change
+        delta: Signed amount to add
+        minimum, maximum, unless: Optional bounds, see guarded_update()
+
+    Returns:
+        bool: Whether the row was updated
+    """
+    if isinstance(delta, float):
+        delta = Decimal(str(delta))
+    model = type(instance)
+    if not guarded_update(model.objects.filter(pk=instance.pk), field, delta,
+                          minimum=minimum, maximum=maximum, unless=unless):
+        return False
+    instance.refresh_from_db(fields=[field])
+    model.history.bulk_history_create([instance], update=True)
+    return True
+
+class FieldTrackerMixin:
+    """
+    Model mixin that remembers the field values an instance was loaded with.
+
+    Signal handlers use original() and has_changed() to see what a save
+    changes, instead of re-reading the row in pre_save. Foreign keys are
+    tracked by id, so comparing them never loads the related objects.
+    The snapshot is taken in from_db() and moved forward after every save()
+    and refresh_from_db(), once the post_save handlers have run. An instance
+    built by hand with the pk of an existing row reads its stored values
+    once, the first time they are asked for.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = dict(zip(field_names, values))
+        return instance
+
+    def _tracked_attname(self, field_name):
+        return self._meta.get_field(field_name).attname
+
+    def _stored_values(self):
+        if not hasattr(self, '_loaded_values'):
+            stored = None
+            if self.pk is not None:
+                stored = type(self)._base_manager.filter(pk=self.pk).values().first()
+            self._loaded_values = stored or {}
+        return self._loaded_values
+
+    def mark_as_loaded(self, fields=None):
+        """
+        Treat the current values of the given fields (default: all) as the
+        stored ones, e.g. after writing them or reading them back.
+        """
+        loaded = self._stored_values() if fields is not None else {}
+        names = fields if fields is not None else [field.attname for field in self._meta.concrete_fields]
+        for name in names:
+            attname = self._tracked_attname(name)
+            if attname in self.__dict__:
+                loaded[attname] = self.__dict__[attname]
+        self._loaded_values = loaded
+
+    def original(self, field_name):
+        """
+        Value of a field as it is stored, or None for an unsaved instance.
+        Foreign keys return the related id.
+        """
+        attname = self._tracked_attname(field_name)
+        stored = self._stored_values()
+        if attname not in stored and self.pk is not None:
+            # Deferred when loaded; read it now
+            stored[attname] = (type(self)._base_manager.filter(pk=self.pk)
+                               .values_list(attname, flat=True).first())
+        return stored.get(attname)
+
+    def has_changed(self, field_name):
+        """Whether a field differs from its stored value (always True before the first save)."""
+        if self.pk is None or not self._stored_values():
+            return True
+        return getattr(self, self._tracked_attname(field_name)) != self.original(field_name)
+
+    def original_related(self, field_name):
+        """
+        Related object a foreign key pointed to as stored. If the key has not
+        changed this is the instance's own related object; otherwise the
+        original one is fetched.
+        """
+        if not self.has_changed(field_name):
+            return getattr(self, field_name)
+        original_id = self.original(field_name)
+        if original_id is None:
+            return None
+        return self._meta.get_field(field_name).related_model._base_manager.filter(pk=original_id).first()
+
+    def save(self, *args, **kwargs):
+        super().save(*args, **kwargs)
+        self.mark_as_loaded(kwargs.get('update_fields'))
+
+    def refresh_from_db(self, using=None, fields=None, from_queryset=None):
+        super().refresh_from_db(using=using, fields=fields, from_queryset=from_queryset)
+        self.mark_as_loaded(fields)